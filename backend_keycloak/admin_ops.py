@@ -0,0 +1,90 @@
+# admin_ops.py
+# Endpoints de diagnóstico para administradores (/api/admin/profile, /api/admin/memory
+# y /api/admin/faults) sin el servidor web.
+#
+# Solo actúan sobre el proceso local, así que routes.py y asgi.py comprueban la sesión
+# de administrador y delegan aquí la petición completa: cada función recibe el método
+# y los parámetros y retorna (cuerpo, estado), como user_ops.
+
+import fault_injection
+import memory_guard
+import profiler
+
+
+def profile_request(method, args):
+    """
+    /api/admin/profile (ver profiler.py). GET descarga el perfil agregado; POST firma
+    una cabecera para perfilar peticiones concretas; DELETE descarta los perfiles.
+
+    Returns:
+        tuple: (cuerpo, estado, descarga). descarga es (mimetype, nombre de fichero)
+               cuando el cuerpo es el perfil, o None cuando es JSON
+    """
+    if method == 'DELETE':
+        profiler.reset()
+        return {"message": "Perfiles descartados"}, 200, None
+
+    if method == 'POST':
+        ttl = min(max(args.get("ttl", 300, type=int), 1), 3600)
+        value = profiler.sign(ttl)
+        if not value:
+            return {"error": "PROFILE_SECRET no está configurado"}, 409, None
+        return {"header": profiler.SIGNATURE_HEADER, "value": value, "expires_in": ttl}, 200, None
+
+    if args.get("status"):
+        return profiler.status(), 200, None
+    fmt = args.get("format", profiler.default_format())
+    if fmt not in profiler.FORMATS:
+        return {"error": "Formato no soportado, use 'pstats', 'text' o 'collapsed'"}, 400, None
+    body = profiler.export(fmt, args.get("route"), args.get("window", "current"))
+    if body is None:
+        return {"error": "No hay datos de perfilado para esa ventana y formato"}, 404, None
+    extension = "prof" if fmt == "pstats" else "txt"
+    return body, 200, (profiler.FORMATS[fmt], f"profile.{extension}")
+
+
+def memory_request(method, args):
+    """
+    /api/admin/memory (ver memory_guard.py). POST con action=start | stop | baseline
+    | evict; GET retorna el informe. Las instantáneas de tracemalloc tardan: asgi.py
+    la ejecuta fuera del event loop.
+    """
+    if method == 'POST':
+        action = args.get("action")
+        actions = {
+            "start": memory_guard.start_tracing,
+            "stop": memory_guard.stop_tracing,
+            "baseline": memory_guard.reset_baseline,
+            "evict": lambda: memory_guard.enforce_budget(force=True),
+        }
+        if action not in actions:
+            return {"error": "Acción no soportada, use 'start', 'stop', 'baseline' o 'evict'"}, 400
+        result = actions[action]()
+        body = {"message": f"Acción '{action}' ejecutada"}
+        if action == "evict":
+            body["evicted"] = result
+        return body, 200
+
+    limit = min(max(args.get("limit", 20, type=int), 1), 200)
+    group_by = args.get("group_by", "lineno")
+    if group_by not in ("lineno", "filename", "traceback"):
+        return {"error": "group_by debe ser 'lineno', 'filename' o 'traceback'"}, 400
+    return memory_guard.report(limit, group_by, args.get("diff") == "1"), 200
+
+
+def faults_request(method, body):
+    """
+    /api/admin/faults (ver fault_injection.py). PUT reemplaza las reglas con
+    {"spec": ..., "seed": ...}; DELETE las quita; todos retornan las reglas activas.
+    """
+    if method == 'PUT':
+        body = body or {}
+        try:
+            fault_injection.configure(body.get("spec", ""))
+        except fault_injection.FaultSpecError as e:
+            return {"error": str(e)}, 400
+        if body.get("seed") is not None:
+            fault_injection.seed(body["seed"])
+    elif method == 'DELETE':
+        fault_injection.clear()
+    return fault_injection.status(), 200
@@ -0,0 +1,324 @@
+# admission.py
+# Control de admisión y descarte de carga por clase de ruta.
+#
+# Sin límites, una ráfaga de listados de /api/users ocupaba todos los hilos del
+# worker y todas las conexiones administrativas con Keycloak, y los logins y las
+# validaciones esperaban detrás. Cada petición se clasifica por su ruta:
+#
+#   auth          login, validate y logout: de ellas dependen todas las sesiones
+#   interactive   el resto de la API que usan profesores y alumnos
+#   bulk          exportación, estadísticas y diagnóstico de administradores
+#
+# Cada clase tiene su límite de peticiones concurrentes por proceso
+# (ADMISSION_LIMITS) y una cola acotada (ADMISSION_QUEUE) en la que se espera como
+# mucho ADMISSION_QUEUE_TIMEOUT segundos. Una petición que no cabe en la cola o que
+# agota la espera recibe enseguida 503 con Retry-After, sin llegar a Keycloak.
+#
+# Los límites de interactive y bulk se adaptan (AIMD) a la latencia media de Keycloak
+# en cada ventana de ADMISSION_WINDOW segundos: si supera ADMISSION_TARGET_LATENCY_MS,
+# bulk se reduce a la mitad e interactive un 10 %; si no, suben de uno en uno, primero
+# interactive y bulk solo cuando interactive ya está en su máximo. La carga masiva es
+# la primera en descartarse y la última en recuperarse; auth conserva su límite.
+#
+# /metrics, /healthz/ready y /api/admin/faults no pasan por el control: tienen que
+# responder precisamente cuando la instancia está saturada.
+
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+
+from config import (
+    ADMISSION_ENABLED, ADMISSION_LIMITS, ADMISSION_QUEUE, ADMISSION_QUEUE_TIMEOUT, ADMISSION_TARGET_LATENCY_MS,
+    ADMISSION_WINDOW
+)
+import metrics
+
+logger = logging.getLogger(__name__)
+
+AUTH, INTERACTIVE, BULK = "auth", "interactive", "bulk"
+CLASSES = (AUTH, INTERACTIVE, BULK)
+
+# Regla de la ruta -> clase; el resto de rutas son interactive
+_ROUTE_CLASSES = {
+    "/api/login": AUTH,
+    "/api/validate": AUTH,
+    "/api/logout": AUTH,
+    "/api/users/export": BULK,
+    "/api/users/stats": BULK,
+    "/api/admin/profile": BULK,
+    "/api/admin/memory": BULK,
+}
+# Rutas que nunca se limitan ('unmatched' son los 404)
+EXEMPT = frozenset(("/metrics", "/healthz/ready", "/api/admin/faults", "unmatched"))
+# Reducción multiplicativa de las clases adaptativas cuando Keycloak va lento
+_DECREASE = {INTERACTIVE: 0.9, BULK: 0.5}
+# Retry-After máximo, en segundos
+_MAX_RETRY_AFTER = 60
+
+rejections = metrics.Counter(
+    "admission_rejected_total", "Peticiones rechazadas por el control de admisión por clase y motivo",
+    ("class", "reason"))
+
+
+class Rejected(Exception):
+    """No hay hueco para la petición: se responde 503 con Retry-After."""
+
+    def __init__(self, route_class, reason, retry_after):
+        super().__init__(f"{route_class}: {reason}")
+        self.route_class = route_class
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Gate:
+    """Límite de concurrencia y cola de espera de una clase."""
+
+    def __init__(self, name, limit, queue, timeout):
+        self.name = name
+        self.max_limit = limit
+        # Límite actual; fraccionario para que la reducción multiplicativa no se redondee a cero
+        self.limit = float(limit)
+        self.queue = queue
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waiters = deque()
+
+    def capacity(self):
+        return max(1, int(self.limit))
+
+    def retry_after(self):
+        # Ventanas que tarda el límite en volver a su máximo subiendo de uno en uno
+        return min(_MAX_RETRY_AFTER, max(1, math.ceil(ADMISSION_WINDOW * (self.max_limit - self.capacity() + 1))))
+
+
+class _Waiter:
+    __slots__ = ("wake", "granted")
+
+    def __init__(self, wake):
+        self.wake = wake
+        self.granted = False
+
+
+class _Ticket:
+    """Hueco concedido; release() lo libera una sola vez."""
+
+    __slots__ = ("gate", "released")
+
+    def __init__(self, gate):
+        self.gate = gate
+        self.released = False
+
+
+def _parse(spec, cast):
+    """'auth=64,interactive=32,bulk=4' -> {clase: valor}."""
+    values = {}
+    for item in spec.split(","):
+        name, _, value = item.partition("=")
+        name = name.strip()
+        if not name:
+            continue
+        if name not in CLASSES:
+            raise ValueError(f"Clase de admisión desconocida: {name}")
+        values[name] = cast(value)
+    return values
+
+
+_lock = threading.Lock()
+_gates = {}
+# Latencias de Keycloak de la ventana en curso
+_window = {"start": time.monotonic(), "sum": 0.0, "count": 0}
+
+
+def reset():
+    """(Re)crea los límites y colas a partir de la configuración."""
+    limits = _parse(ADMISSION_LIMITS, int)
+    queues = _parse(ADMISSION_QUEUE, int)
+    timeouts = _parse(ADMISSION_QUEUE_TIMEOUT, float)
+    gates = {name: _Gate(name, max(1, limits.get(name, 1)), max(0, queues.get(name, 0)), timeouts.get(name, 0.0))
+             for name in CLASSES}
+    with _lock:
+        _gates.clear()
+        _gates.update(gates)
+        _window.update(start=time.monotonic(), sum=0.0, count=0)
+
+
+def classify(rule):
+    """Clase de una regla de ruta ('/api/users/<user_id>'), o None si no se limita."""
+    if rule in EXEMPT:
+        return None
+    return _ROUTE_CLASSES.get(rule, INTERACTIVE)
+
+
+def _reject(gate, reason):
+    rejections.inc(gate.name, reason)
+    return Rejected(gate.name, reason, gate.retry_after())
+
+
+def _try_admit(gate):
+    """Con _lock: concede un hueco libre si nadie espera delante."""
+    if not gate.waiters and gate.in_flight < gate.capacity():
+        gate.in_flight += 1
+        return True
+    return False
+
+
+def _dispatch(gate):
+    """Con _lock: pasa los huecos libres a los primeros de la cola."""
+    while gate.waiters and gate.in_flight < gate.capacity():
+        waiter = gate.waiters.popleft()
+        waiter.granted = True
+        gate.in_flight += 1
+        waiter.wake()
+
+
+def admit(route_class):
+    """
+    Espera un hueco en la clase de la ruta.
+
+    Returns:
+        El hueco concedido, para release(); None si la ruta no se limita
+
+    Raises:
+        Rejected: La cola está llena o se agotó la espera
+    """
+    if not ADMISSION_ENABLED or route_class is None:
+        return None
+    _maybe_adjust()
+    with _lock:
+        gate = _gates[route_class]
+        if _try_admit(gate):
+            return _Ticket(gate)
+        if len(gate.waiters) >= gate.queue or gate.timeout <= 0:
+            raise _reject(gate, "queue_full")
+        event = threading.Event()
+        waiter = _Waiter(event.set)
+        gate.waiters.append(waiter)
+    event.wait(gate.timeout)
+    with _lock:
+        # Se comprueba bajo el lock: el hueco puede llegar justo al agotarse la espera
+        if waiter.granted:
+            return _Ticket(gate)
+        gate.waiters.remove(waiter)
+    raise _reject(gate, "timeout")
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+async def admit_async(route_class):
+    """Equivalente de admit para el modo ASGI: la espera no bloquea el event loop."""
+    if not ADMISSION_ENABLED or route_class is None:
+        return None
+    _maybe_adjust()
+    loop = asyncio.get_running_loop()
+    with _lock:
+        gate = _gates[route_class]
+        if _try_admit(gate):
+            return _Ticket(gate)
+        if len(gate.waiters) >= gate.queue or gate.timeout <= 0:
+            raise _reject(gate, "queue_full")
+        future = loop.create_future()
+        waiter = _Waiter(lambda: loop.call_soon_threadsafe(_resolve, future))
+        gate.waiters.append(waiter)
+    try:
+        await asyncio.wait_for(future, gate.timeout)
+    except asyncio.TimeoutError:
+        pass
+    except asyncio.CancelledError:
+        # El cliente se fue mientras esperaba: el hueco (si llegó) pasa al siguiente
+        with _lock:
+            if waiter.granted:
+                gate.in_flight -= 1
+                _dispatch(gate)
+            else:
+                gate.waiters.remove(waiter)
+        raise
+    with _lock:
+        if waiter.granted:
+            return _Ticket(gate)
+        gate.waiters.remove(waiter)
+    raise _reject(gate, "timeout")
+
+
+def release(ticket):
+    """Libera un hueco concedido por admit (None se ignora)."""
+    if ticket is None or ticket.released:
+        return
+    ticket.released = True
+    with _lock:
+        ticket.gate.in_flight -= 1
+        _dispatch(ticket.gate)
+
+
+# ----------------------------------------------------------------------
+# Límites adaptativos (AIMD)
+# ----------------------------------------------------------------------
+def observe_upstream(seconds):
+    """Registra la latencia de una llamada a Keycloak (keycloak_http y keycloak_async)."""
+    if not ADMISSION_ENABLED:
+        return
+    with _lock:
+        _window["sum"] += seconds
+        _window["count"] += 1
+    _maybe_adjust()
+
+
+def _maybe_adjust():
+    now = time.monotonic()
+    with _lock:
+        elapsed = now - _window["start"]
+        if not _gates or elapsed < ADMISSION_WINDOW:
+            return
+        count = _window["count"]
+        mean_ms = _window["sum"] / count * 1000 if count else None
+        _window.update(start=now, sum=0.0, count=0)
+        interactive, bulk = _gates[INTERACTIVE], _gates[BULK]
+        before = (interactive.capacity(), bulk.capacity())
+        if mean_ms is not None and mean_ms > ADMISSION_TARGET_LATENCY_MS:
+            for gate in (interactive, bulk):
+                gate.limit = max(1.0, gate.limit * _DECREASE[gate.name])
+        else:
+            # Una subida por ventana transcurrida, también por las ventanas sin tráfico
+            windows = int(elapsed / ADMISSION_WINDOW) if ADMISSION_WINDOW > 0 else 1
+            for _ in range(min(max(1, windows), interactive.max_limit + bulk.max_limit)):
+                gate = interactive if interactive.limit < interactive.max_limit else bulk
+                gate.limit = min(gate.max_limit, gate.limit + 1)
+            _dispatch(interactive)
+            _dispatch(bulk)
+        after = (interactive.capacity(), bulk.capacity())
+    if after != before:
+        level = logging.WARNING if after < before else logging.INFO
+        logger.log(level, "[admission] Latencia de Keycloak %s: límites interactive=%d bulk=%d",
+                   f"{mean_ms:.0f} ms" if mean_ms is not None else "sin llamadas", *after)
+
+
+def status():
+    """Límite actual, en curso y en cola de cada clase."""
+    with _lock:
+        return {name: {"limit": gate.capacity(), "max_limit": gate.max_limit, "in_flight": gate.in_flight,
+                       "queued": len(gate.waiters)} for name, gate in _gates.items()}
+
+
+def _gauge(field):
+    return lambda: {(name,): values[field] for name, values in status().items()}
+
+
+def _after_fork_in_child():
+    global _lock
+    _lock = threading.Lock()
+    # Los huecos y esperas del padre no pertenecen a este proceso
+    reset()
+
+
+reset()
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+metrics.Gauge("admission_limit", "Límite de concurrencia actual por clase de ruta", ("class",), _gauge("limit"))
+metrics.Gauge("admission_in_flight", "Peticiones admitidas en curso por clase de ruta", ("class",), _gauge("in_flight"))
+metrics.Gauge("admission_queued", "Peticiones esperando un hueco por clase de ruta", ("class",), _gauge("queued"))
@@ -1,9 +1,16 @@
 from flask import Flask
-from flask_cors import CORS
-from app.config import Config
-from app.routes import routes
 
 def create_app():
+    # dotenv, flask_cors and the config/routes modules are loaded when the app is
+    # created, not when the package is imported
+    from dotenv import load_dotenv
+    from flask_cors import CORS
+
+    # .env must be loaded before app.config reads the environment
+    load_dotenv()
+    from app.config import Config
+    from app.routes import routes
+
     app = Flask(__name__)
     app.config.from_object(Config)
 
@@ -1,8 +1,6 @@
 import os
-from dotenv import load_dotenv
-
-load_dotenv()
 
+# The environment (.env included) is loaded by create_app() before this module is imported
 class Config:
     SECRET_KEY = os.getenv('SECRET_KEY', 'supersecretkey')
     KEYCLOAK_URL = os.getenv('KEYCLOAK_URL', 'https://keycloak.agroup.app')
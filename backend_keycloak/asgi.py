@@ -0,0 +1,974 @@
+# asgi.py
+# Punto de entrada ASGI: los mismos endpoints de routes.py como handlers asíncronos.
+#
+# Cada handler espera a Keycloak con el cliente asíncrono (keycloak_async), por lo
+# que un solo proceso puede mantener miles de peticiones en vuelo sin un hilo por
+# petición. Los contratos de request/response son idénticos a los de routes.py:
+# los handlers solo hacen las llamadas a Keycloak, y las validaciones, permisos,
+# cuerpos de respuesta y la propagación de los cambios están en user_ops (y en
+# admin_ops, mutation_queue y roster_export), compartidos con routes.py.
+#
+# Ejecución: uvicorn asgi:app --host 0.0.0.0 --port 5000
+
+import asyncio
+import json
+import logging
+import time
+
+import httpx
+from quart import Quart, Response, g, request, jsonify, make_response
+
+from config import EXPORT_PAGE_SIZE, WARMUP_CONNECTIONS
+from keycloak_async import AsyncKeycloakClient
+import log_config
+import roster_changes
+import search_index
+import roster_stats
+import roster_export
+import availability
+import user_ops
+import metrics
+import tracing
+import profiler
+import memory_guard
+import fault_injection
+import keycloak_recording
+import invalidation
+import read_cache
+import mutation_queue
+import admission
+import admin_ops
+import warmup
+from cache import token_key
+
+logger = logging.getLogger(__name__)
+
+app = Quart(__name__)
+
+# Cliente compartido por todas las peticiones del proceso
+keycloak = None
+# Fallos de Keycloak con los que read_cache sirve la última copia buena
+_READ_ERRORS = (httpx.HTTPError, json.JSONDecodeError, read_cache.Unavailable)
+
+
+@app.before_serving
+async def _open_keycloak_client():
+    global keycloak
+    # Igual que routes.create_app: los efectos del proceso empiezan al servir, no al importar
+    log_config.configure()
+    invalidation.start()
+    keycloak = AsyncKeycloakClient()
+    loop = asyncio.get_running_loop()
+
+    def open_connections():
+        # El calentamiento corre en un hilo: las conexiones se abren en el loop del cliente
+        future = asyncio.run_coroutine_threadsafe(keycloak.warm_connections(WARMUP_CONNECTIONS), loop)
+        return future.result() or None
+
+    warmup.ensure_started(open_connections)
+    mutation_queue.ensure_started()
+
+
+@app.after_serving
+async def _close_keycloak_client():
+    await keycloak.aclose()
+
+
+def _route_label():
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+
+@app.before_request
+async def _begin_request():
+    g.request_start = time.perf_counter()
+    read_cache.begin()
+    g.request_id = tracing.begin(request.headers.get(tracing.REQUEST_ID_HEADER))
+    g.profile = profiler.start(_route_label(), request.headers.get(profiler.SIGNATURE_HEADER))
+    try:
+        g.admission = await admission.admit_async(admission.classify(_route_label()))
+    except admission.Rejected as e:
+        return _shed(e)
+
+
+@app.after_request
+async def _finish_request(response):
+    route = _route_label()
+    start = g.get("request_start")
+    if start is not None:
+        metrics.http_request_duration.observe(time.perf_counter() - start, route, request.method)
+        if keycloak_recording.recording():
+            await _record_request(route, response.status_code, time.perf_counter() - start)
+    metrics.http_requests.inc(route, request.method, str(response.status_code))
+    memory_guard.ensure_checked()
+    timing = tracing.end(request.method, route, response.status_code)
+    if timing:
+        response.headers["Server-Timing"] = timing
+    if g.get("request_id"):
+        response.headers[tracing.REQUEST_ID_HEADER] = g.request_id
+    response.headers.update(read_cache.response_headers())
+    return response
+
+
+async def _record_request(route, status, elapsed):
+    """Graba la petición para poder reenviarla con bench/replay_traffic.py."""
+    form = await request.form
+    body = form.to_dict() if form else await request.get_json(silent=True)
+    path = request.path + (f"?{request.query_string.decode('utf-8')}" if request.query_string else "")
+    keycloak_recording.record_api(g.get("request_id"), request.method, path, route, body, bool(form),
+                                  request.cookies.get("access_token"), status, elapsed)
+
+
+@app.teardown_request
+async def _stop_profile(exc):
+    profiler.stop(g.pop("profile", None))
+    admission.release(g.pop("admission", None))
+
+
+def _shed(rejected):
+    """Respuesta 503 de una petición descartada por el control de admisión (ver routes.py)."""
+    logger.warning("[%s] Petición descartada (%s, %s)", _route_label(), rejected.route_class, rejected.reason)
+    response = jsonify({"error": "Servidor saturado, inténtalo de nuevo más tarde"})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(rejected.retry_after)
+    return response
+
+
+def _raise_for_upstream_error(resp):
+    """Un 5xx de Keycloak se trata como indisponibilidad (503), igual que en routes.py."""
+    if resp.status_code >= 500:
+        resp.raise_for_status()
+
+
+@app.errorhandler(httpx.HTTPError)
+async def _upstream_error(e):
+    logger.warning("[%s] Fallo en la llamada a Keycloak: %s", _route_label(), e)
+    mutation = g.pop("mutation", None)
+    if mutation is not None:
+        return await _defer_mutation(*mutation, upstream_failed=True)
+    if isinstance(e, httpx.TimeoutException):
+        return jsonify({"error": "Keycloak no respondió a tiempo"}), 504
+    return jsonify({"error": "Keycloak no disponible"}), 503
+
+
+@app.errorhandler(json.JSONDecodeError)
+async def _invalid_upstream_body(e):
+    # httpx.Response.json() lanza JSONDecodeError con cuerpos de error en HTML
+    logger.warning("[%s] Respuesta no JSON de Keycloak: %s", _route_label(), e)
+    return jsonify({"error": "Respuesta no válida de Keycloak"}), 502
+
+
+async def _defer_mutation(kind, actor_id, token, payload, user_id=None, upstream_failed=False):
+    """
+    Igual que en routes.py: encola la mutación (mutation_queue) si Keycloak está caído
+    o el usuario tiene cambios en cola y la deja en g para _upstream_error. Retorna la
+    respuesta 202, o None si la petición sigue contra Keycloak.
+    """
+    if not mutation_queue.enabled():
+        return None
+    g.mutation = (kind, actor_id, token, payload, user_id)
+    if not upstream_failed and not await asyncio.to_thread(mutation_queue.should_defer, kind, payload, user_id):
+        return None
+    g.pop("mutation", None)
+    body, status = await asyncio.to_thread(mutation_queue.submit, kind, actor_id, token, payload, user_id,
+                                           request.headers.get(mutation_queue.IDEMPOTENCY_HEADER), upstream_failed)
+    return jsonify(body), status
+
+
+async def _fetch_roster(owner_id, admin_token):
+    """
+    Obtiene desde Keycloak los usuarios creados por un profesor.
+    Retorna la lista de usuarios en formato Keycloak o None si la consulta falla.
+    """
+    resp = await keycloak.list_users(admin_token)
+    if resp.status_code != 200:
+        logger.error("[fetch_roster] Error obteniendo usuarios: %s", resp.text)
+        return None
+    return user_ops.filter_own_users(resp.json(), owner_id)
+
+
+async def _fetch_user(user_id):
+    """Usuario de la Admin API, o None si no existe; lanza si Keycloak no responde."""
+    admin_token = await keycloak.get_admin_token()
+    if not admin_token:
+        raise read_cache.AdminTokenUnavailable()
+    resp = await keycloak.get_user(admin_token, user_id)
+    _raise_for_upstream_error(resp)
+    return resp.json() if resp.status_code == 200 else None
+
+
+def _refresh_in_loop(owner_id, loop):
+    """
+    Retorna una función síncrona que recarga el roster usando el event loop del
+    servidor; roster_stats la ejecuta en un hilo en segundo plano.
+    """
+    async def reload():
+        admin_token = await keycloak.get_admin_token()
+        return await _fetch_roster(owner_id, admin_token) if admin_token else None
+
+    def refresh():
+        return asyncio.run_coroutine_threadsafe(reload(), loop).result()
+    return refresh
+
+
+async def _json_body():
+    return await request.get_json()
+
+
+async def _require_admin():
+    token = request.cookies.get("access_token")
+    if not token:
+        return jsonify({"error": "No autenticado"}), 401
+    if not await keycloak.introspect_active(token):
+        return jsonify({"error": "Token inválido"}), 401
+    error = user_ops.admin_error(token, "_require_admin")
+    if error:
+        body, status = error
+        return jsonify(body), status
+    return None
+
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Login
+# ----------------------------------------------------------------------
+@app.route('/api/login', methods=['POST'])
+async def login():
+    data = await request.form
+    # Nunca se registra el formulario ni la carga útil: llevan la contraseña, el TOTP
+    # y el secreto del cliente
+    logger.debug("[login] Inicio de sesión de %s", data.get("username"))
+
+    keycloak_payload = user_ops.login_payload(data)
+
+    response = await keycloak.token(keycloak_payload)
+    logger.debug("[login] Status code: %s", response.status_code)
+    _raise_for_upstream_error(response)
+
+    if response.status_code == 200:
+        access_token = response.json().get("access_token")
+        if not access_token:
+            return jsonify({"error": "No se recibió access_token desde Keycloak"}), 401
+
+        resp = await make_response(jsonify(user_ops.login_body(access_token)))
+        resp.set_cookie("access_token", access_token, **user_ops.SESSION_COOKIE)
+        return resp
+
+    return jsonify({"error": "Credenciales inválidas"}), 401
+
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Validar Token
+# ----------------------------------------------------------------------
+@app.route('/api/validate', methods=['GET'])
+async def validate_token():
+    token = request.cookies.get("access_token")
+    if not token:
+        return jsonify({"error": "No autenticado"}), 401
+
+    introspection_result = await keycloak.introspect_active(token)
+    if introspection_result:
+        return jsonify(user_ops.validate_body(introspection_result)), 200
+
+    logger.warning("[validate_token] Token inválido o expirado")
+    return jsonify({"error": "Token inválido o expirado"}), 401
+
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Logout
+# ----------------------------------------------------------------------
+@app.route('/api/logout', methods=['POST'])
+async def logout():
+    token = request.cookies.get("access_token")
+    if token:
+        await keycloak.forget_introspection(token)
+        read_cache.forget("profile", token_key("profile", token))
+    resp = await make_response(jsonify({"message": "Logout exitoso"}))
+    resp.set_cookie("access_token", "", expires=0)
+    return resp
+
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Obtener Perfil con Roles
+# ----------------------------------------------------------------------
+@app.route('/api/profile', methods=['GET'])
+async def get_profile():
+    token = request.cookies.get("access_token")
+    if not token:
+        return jsonify({"error": "No autenticado"}), 401
+
+    claims = user_ops.token_claims(token)
+    cache_key = token_key("profile", token)
+    if claims.get("exp", 0) <= time.time():
+        read_cache.forget("profile", cache_key)
+    user_info = await read_cache.read_async("profile", cache_key, lambda: _load_profile(token),
+                                            user_id=claims.get("sub"), errors=_READ_ERRORS)
+    if user_info is None:
+        return jsonify({"error": "No se pudo obtener el perfil"}), 400
+    return jsonify(user_info), 200
+
+
+async def _load_profile(token):
+    userinfo_response = await keycloak.userinfo(token)
+    _raise_for_upstream_error(userinfo_response)
+    if userinfo_response.status_code != 200:
+        return None
+
+    user_info = userinfo_response.json()
+    # build_profile abre o regenera el snapshot del roster (stat, mmap, caché compartida)
+    professor_id = await asyncio.to_thread(user_ops.build_profile, user_info, token)
+    if professor_id:
+        try:
+            prof_data = await read_cache.read_async("user", professor_id, lambda: _fetch_user(professor_id),
+                                                    user_id=professor_id, errors=_READ_ERRORS)
+        except Exception as ex:
+            logger.error("[get_profile] Error obteniendo nombre del profesor: %s", ex)
+            prof_data = None
+        user_info["teacher_name"] = user_ops.teacher_name(professor_id, prof_data)
+    return user_info
+
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Cambiar Email
+# ----------------------------------------------------------------------
+@app.route('/api/change-email', methods=['POST'])
+async def change_email():
+    token = request.cookies.get("access_token")
+    if not token:
+        return jsonify({"error": "No autenticado"}), 401
+
+    data = await keycloak.introspect_active(token)
+    if not data:
+        return jsonify({"error": "Token inválido"}), 401
+
+    user_id = data.get("sub")
+    new_email = (await _json_body()).get("new_email")
+    if not new_email:
+        return jsonify({"error": "Email no proporcionado"}), 400
+
+    admin_token = await keycloak.get_admin_token()
+    if not admin_token:
+        return jsonify({"error": "No se pudo obtener token administrativo"}), 500
+
+    user_resp = await keycloak.get_user(admin_token, user_id)
+    if user_resp.status_code != 200:
+        logger.error("[change_email] Error obteniendo usuario: %s", user_resp.text)
+        return jsonify({"error": "No se pudo obtener información de usuario"}), 500
+
+    user_data = user_resp.json()
+    user_data["email"] = new_email
+    user_data["username"] = new_email
+
+    update_resp = await keycloak.update_user(admin_token, user_id, user_data)
+    if update_resp.status_code not in (200, 204):
+        logger.error("[change_email] Error actualizando email: %s", update_resp.text)
+        return jsonify({"error": "No se pudo actualizar el email"}), 500
+
+    await asyncio.to_thread(user_ops.user_saved, user_data)
+    return jsonify({"message": "Email actualizado correctamente"}), 200
+
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Cambiar Contraseña
+# ----------------------------------------------------------------------
+@app.route('/api/change-password', methods=['POST'])
+async def change_password():
+    token = request.cookies.get("access_token")
+    if not token:
+        return jsonify({"error": "No autenticado"}), 401
+
+    data = await keycloak.introspect_active(token)
+    if not data:
+        return jsonify({"error": "Token inválido"}), 401
+
+    user_id = data.get("sub")
+    new_password = (await _json_body()).get("new_password")
+    if not new_password:
+        return jsonify({"error": "Contraseña no proporcionada"}), 400
+
+    admin_token = await keycloak.get_admin_token()
+    if not admin_token:
+        return jsonify({"error": "No se pudo obtener token administrativo"}), 500
+
+    update_resp = await keycloak.reset_password(admin_token, user_id, {
+        "type": "password",
+        "value": new_password,
+        "temporary": False
+    })
+    if update_resp.status_code not in (200, 204):
+        logger.error("[change_password] Error actualizando contraseña: %s", update_resp.text)
+        return jsonify({"error": "No se pudo actualizar la contraseña"}), 500
+
+    return jsonify({"message": "Contraseña actualizada correctamente"}), 200
+
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Actualizar Perfil
+# ----------------------------------------------------------------------
+@app.route('/api/update-profile', methods=['POST'])
+async def update_profile():
+    token = request.cookies.get("access_token")
+    if not token:
+        return jsonify({"error": "No autenticado"}), 401
+
+    data = await keycloak.introspect_active(token)
+    if not data:
+        return jsonify({"error": "Token inválido"}), 401
+
+    user_id = data.get("sub")
+    profile_data = await _json_body()
+
+    admin_token = await keycloak.get_admin_token()
+    if not admin_token:
+        return jsonify({"error": "No se pudo obtener token administrativo"}), 500
+
+    user_resp = await keycloak.get_user(admin_token, user_id)
+    if user_resp.status_code != 200:
+        logger.error("[update_profile] Error obteniendo usuario: %s", user_resp.text)
+        return jsonify({"error": "No se pudo obtener información de usuario"}), 500
+
+    user_data = user_ops.apply_profile_attributes(user_resp.json(), profile_data)
+
+    update_resp = await keycloak.update_user(admin_token, user_id, user_data)
+    if update_resp.status_code not in (200, 204):
+        logger.error("[update_profile] Error actualizando perfil: %s", update_resp.text)
+        return jsonify({"error": "No se pudo actualizar el perfil"}), 500
+
+    await asyncio.to_thread(user_ops.user_saved, user_data)
+    return jsonify({"message": "Perfil actualizado correctamente"}), 200
+
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Obtener Usuarios (filtrados por creador)
+# ----------------------------------------------------------------------
+@app.route('/api/users', methods=['GET'])
+async def get_users():
+    token = request.cookies.get("access_token")
+    if not token:
+        return jsonify({"error": "No autenticado"}), 401
+
+    data = await keycloak.introspect_active(token)
+    if not data:
+        return jsonify({"error": "Token inválido"}), 401
+
+    current_user_id = data.get("sub")
+
+    async def fetch_roster():
+        with tracing.span("upstream"):
+            admin_token = await keycloak.get_admin_token()
+            if not admin_token:
+                raise read_cache.AdminTokenUnavailable()
+            own_users = await _fetch_roster(current_user_id, admin_token)
+        if own_users is None:
+            raise read_cache.Unavailable("No se pudo obtener usuarios")
+
+        with tracing.span("filter"):
+            filtered = [roster_changes.serialize_user(user) for user in own_users]
+            version = await asyncio.to_thread(roster_changes.sync, current_user_id, own_users)
+        return {"users": filtered, "version": version}
+
+    try:
+        roster = await read_cache.read_async("roster", current_user_id, fetch_roster,
+                                             fresh_if=user_ops.roster_unchanged(current_user_id),
+                                             errors=_READ_ERRORS)
+    except read_cache.AdminTokenUnavailable:
+        logger.warning("[get_users] Sin token administrativo ni copia del roster")
+        body, status = user_ops.roster_unavailable()
+        return jsonify(body), status
+    except read_cache.Unavailable:
+        return jsonify({"error": "No se pudo obtener usuarios"}), 500
+
+    with tracing.span("serialize"):
+        resp = await make_response(jsonify(roster["users"]), 200)
+    resp.headers["X-Roster-Version"] = str(roster["version"])
+    return resp
+
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Cambios del roster desde una versión (sincronización delta)
+# ----------------------------------------------------------------------
+@app.route('/api/users/changes', methods=['GET'])
+async def get_user_changes():
+    token = request.cookies.get("access_token")
+    if not token:
+        return jsonify({"error": "No autenticado"}), 401
+
+    since = request.args.get("since")
+    if not since:
+        return jsonify({"error": "Parámetro 'since' inválido o ausente"}), 400
+
+    introspect_data = await keycloak.introspect_active(token)
+    if not introspect_data:
+        return jsonify({"error": "Token inválido"}), 401
+
+    current_user_id = introspect_data.get("sub")
+    if roster_changes.is_stale(current_user_id):
+        admin_token = await keycloak.get_admin_token()
+        own_users = await _fetch_roster(current_user_id, admin_token) if admin_token else None
+        if own_users is None:
+            return jsonify({"error": "No se pudo obtener usuarios"}), 500
+        await asyncio.to_thread(roster_changes.sync, current_user_id, own_users)
+
+    changes = await asyncio.to_thread(roster_changes.changes_since, current_user_id, since)
+    return jsonify(changes), 200
+
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Búsqueda de alumnos (typeahead)
+# ----------------------------------------------------------------------
+@app.route('/api/users/search', methods=['GET'])
+async def search_users():
+    token = request.cookies.get("access_token")
+    if not token:
+        return jsonify({"error": "No autenticado"}), 401
+
+    query = request.args.get("q", "")
+    limit = min(max(request.args.get("limit", 10, type=int), 1), 50)
+
+    introspect_data = await keycloak.introspect_active(token)
+    if not introspect_data:
+        return jsonify({"error": "Token inválido"}), 401
+
+    current_user_id = introspect_data.get("sub")
+    if not search_index.is_loaded(current_user_id) or roster_changes.is_stale(current_user_id):
+        admin_token = await keycloak.get_admin_token()
+        if not admin_token:
+            return jsonify({"error": "No se pudo obtener token administrativo"}), 500
+        own_users = await _fetch_roster(current_user_id, admin_token)
+        if own_users is None:
+            return jsonify({"error": "No se pudo obtener usuarios"}), 500
+        await asyncio.to_thread(roster_changes.sync, current_user_id, own_users)
+
+    return jsonify(search_index.search(current_user_id, query, limit)), 200
+
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Estadísticas del roster
+# ----------------------------------------------------------------------
+@app.route('/api/users/stats', methods=['GET'])
+async def get_user_stats():
+    token = request.cookies.get("access_token")
+    if not token:
+        return jsonify({"error": "No autenticado"}), 401
+
+    introspect_data = await keycloak.introspect_active(token)
+    if not introspect_data:
+        return jsonify({"error": "Token inválido"}), 401
+
+    current_user_id = introspect_data.get("sub")
+    admin_token = await keycloak.get_admin_token()
+    if not admin_token:
+        return jsonify({"error": "No se pudo obtener token administrativo"}), 500
+
+    own_users = None
+    stale = roster_changes.is_stale(current_user_id)
+    if stale or not roster_stats.is_loaded(current_user_id):
+        own_users = await _fetch_roster(current_user_id, admin_token)
+        if own_users is None:
+            return jsonify({"error": "No se pudo obtener usuarios"}), 500
+        if stale or roster_changes.current_version(current_user_id) is None:
+            await asyncio.to_thread(roster_changes.sync, current_user_id, own_users)
+        if not roster_stats.is_loaded(current_user_id):
+            await asyncio.to_thread(roster_stats.rebuild, current_user_id, own_users)
+
+    loop = asyncio.get_running_loop()
+    stats = roster_stats.get_stats(current_user_id, _refresh_in_loop(current_user_id, loop))
+    if stats is None:
+        # El roster se descartó (evict) después de comprobarlo: se calcula de la lista completa
+        if own_users is None:
+            own_users = await _fetch_roster(current_user_id, admin_token)
+        if own_users is None:
+            return jsonify({"error": "No se pudo obtener usuarios"}), 500
+        stats = await asyncio.to_thread(roster_stats.rebuild, current_user_id, own_users)
+
+    # Solo se consulta /users/count cuando el valor en caché caducó
+    count = None
+    if roster_stats.realm_total_stale():
+        count_resp = await keycloak.count_users(admin_token)
+        if count_resp.status_code == 200:
+            count = count_resp.json()
+        else:
+            logger.error("[fetch_realm_user_count] Error obteniendo total de usuarios: %s", count_resp.text)
+    stats["realm_total"] = roster_stats.realm_total(lambda: count)
+    return jsonify(stats), 200
+
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Exportar usuarios (CSV / NDJSON en streaming)
+# ----------------------------------------------------------------------
+@app.route('/api/users/export', methods=['GET'])
+async def export_users():
+    token = request.cookies.get("access_token")
+    if not token:
+        return jsonify({"error": "No autenticado"}), 401
+
+    export_format = request.args.get("format", "csv").lower()
+    if export_format not in roster_export.FORMATS:
+        return jsonify({"error": "Formato no soportado, use 'csv' o 'ndjson'"}), 400
+    columns = roster_export.parse_columns(request.args.get("columns"))
+
+    introspect_data = await keycloak.introspect_active(token)
+    if not introspect_data:
+        return jsonify({"error": "Token inválido"}), 401
+    current_user_id = introspect_data.get("sub")
+
+    realm_scope = request.args.get("scope") == "realm"
+    if realm_scope:
+        error = user_ops.admin_error(token, "export_users", "No tienes permiso para exportar todo el realm")
+        if error:
+            body, status = error
+            return jsonify(body), status
+
+    users = keycloak.iter_users(keycloak.get_admin_token, EXPORT_PAGE_SIZE)
+
+    async def own_users():
+        async for user in users:
+            if realm_scope or roster_changes.owner_of(user) == current_user_id:
+                yield user
+
+    # Leer el primer usuario antes de responder para poder informar errores con un código HTTP
+    selected = own_users()
+    try:
+        first = await selected.__anext__()
+    except StopAsyncIteration:
+        first = None
+    except roster_export.ExportError as e:
+        logger.error("[export_users] %s", e)
+        return jsonify({"error": "No se pudo obtener usuarios"}), 500
+
+    async def rows():
+        if first is None:
+            return
+        yield first
+        async for user in selected:
+            yield user
+
+    return Response(
+        roster_export.stream_export_async(rows(), columns, export_format, errors=(httpx.HTTPError,)),
+        mimetype=roster_export.FORMATS[export_format],
+        headers={"Content-Disposition": f"attachment; filename=usuarios.{export_format}"}
+    )
+
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Disponibilidad de email / username
+# ----------------------------------------------------------------------
+@app.route('/api/users/availability', methods=['GET'])
+async def check_availability():
+    value = request.args.get("email") or request.args.get("username")
+    if not value:
+        return jsonify({"error": "Falta el parámetro 'email' o 'username'"}), 400
+
+    exact = request.args.get("exact", "false").lower() in ("true", "1")
+    if exact:
+        # Solo las sesiones válidas pueden confirmar contra Keycloak (con límite por minuto)
+        token = request.cookies.get("access_token")
+        session = await keycloak.introspect_active(token) if token else None
+        exact = bool(session) and availability.allow_exact(session.get("sub"))
+    # La confirmación exacta usa el cliente síncrono: se ejecuta fuera del event loop
+    result = await asyncio.to_thread(availability.check, value, exact)
+    return jsonify({"value": value, **result}), 200
+
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Crear Usuario
+# ----------------------------------------------------------------------
+@app.route('/api/users', methods=['POST'])
+async def create_user():
+    token = request.cookies.get("access_token")
+    if not token:
+        return jsonify({"error": "No autenticado"}), 401
+
+    introspect_data = await keycloak.introspect_active(token)
+    if not introspect_data:
+        return jsonify({"error": "Token inválido"}), 401
+
+    current_user_id = introspect_data.get("sub")
+    user_input = await _json_body()
+    if not user_input.get("email"):
+        return jsonify({"error": "Falta el email del usuario"}), 400
+
+    new_user = user_ops.build_new_user(user_input, current_user_id)
+
+    email_check = await asyncio.to_thread(availability.check, new_user["email"], True)
+    if email_check["available"] is False:
+        body, status = user_ops.duplicate_email_error()
+        return jsonify(body), status
+
+    deferred = await _defer_mutation(mutation_queue.CREATE_USER, current_user_id, token, user_input)
+    if deferred:
+        return deferred
+
+    admin_token = await keycloak.get_admin_token()
+    if not admin_token:
+        deferred = await _defer_mutation(mutation_queue.CREATE_USER, current_user_id, token, user_input,
+                                         upstream_failed=True)
+        if deferred:
+            return deferred
+        body, status = user_ops.admin_unavailable("create_user")
+        return jsonify(body), status
+
+    response = await keycloak.create_user(admin_token, new_user)
+    _raise_for_upstream_error(response)
+    # El alta ya llegó a Keycloak: un fallo posterior no la encola
+    g.pop("mutation", None)
+    if response.status_code not in (201, 204):
+        logger.error("[create_user] Error al crear usuario: %s, %s", response.status_code, response.text)
+        if response.status_code == 409:
+            availability.add_value(new_user["email"])
+        body, status = user_ops.create_error(response.status_code, response.text)
+        return jsonify(body), status
+
+    try:
+        search_response = await keycloak.list_users(admin_token, {"username": new_user["username"]})
+        created = search_response.json() if search_response.status_code == 200 else None
+    except (httpx.HTTPError, json.JSONDecodeError) as e:
+        # El alta ya se hizo: un fallo al releer no debe hacer que el cliente la reintente
+        logger.warning("[create_user] No se pudo obtener el usuario creado: %s", e)
+        created = None
+    created_user = created[0] if created else None
+    if created_user:
+        await asyncio.to_thread(user_ops.user_saved, created_user)
+    return jsonify(user_ops.created_body(created_user)), 201
+
+
+async def _load_managed_user(token, user_id, verb, tag, mutation=None):
+    """
+    Valida la sesión, obtiene el usuario y comprueba que el usuario actual sea su
+    creador o administrador. Retorna (admin_token, user_data, creator_id, None)
+    o (None, None, None, respuesta), con respuesta de error o, sin token
+    administrativo, 503 (user_ops.admin_unavailable).
+    mutation = (tipo, payload) permite aceptar la petición en la cola de escritura
+    diferida (202) en lugar de responder 503.
+    """
+    introspect_data = await keycloak.introspect_active(token)
+    if not introspect_data:
+        return None, None, None, (jsonify({"error": "Token inválido"}), 401)
+
+    current_user_id = introspect_data.get("sub")
+    if mutation:
+        deferred = await _defer_mutation(mutation[0], current_user_id, token, mutation[1], user_id)
+        if deferred:
+            return None, None, None, deferred
+
+    admin_token = await keycloak.get_admin_token()
+    if not admin_token:
+        deferred = mutation and await _defer_mutation(mutation[0], current_user_id, token, mutation[1], user_id,
+                                                      upstream_failed=True)
+        if deferred:
+            return None, None, None, deferred
+        body, status = user_ops.admin_unavailable(tag)
+        return None, None, None, (jsonify(body), status)
+
+    user_resp = await keycloak.get_user(admin_token, user_id)
+    _raise_for_upstream_error(user_resp)
+    if user_resp.status_code != 200:
+        logger.error("[%s] Error obteniendo usuario: %s", tag, user_resp.text)
+        return None, None, None, (jsonify({"error": "No se pudo obtener información del usuario"}), 500)
+
+    user_data = user_resp.json()
+    error = user_ops.manage_error(token, user_data, current_user_id, verb, tag)
+    if error:
+        body, status = error
+        return None, None, None, (jsonify(body), status)
+    return admin_token, user_data, user_ops.creator_id(user_data), None
+
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Eliminar Usuario
+# ----------------------------------------------------------------------
+@app.route('/api/users/<user_id>', methods=['DELETE'])
+async def delete_user(user_id):
+    token = request.cookies.get("access_token")
+    if not token:
+        return jsonify({"error": "No autenticado"}), 401
+
+    admin_token, _, creator_id, error = await _load_managed_user(token, user_id, "eliminar", "delete_user")
+    if error:
+        return error
+
+    delete_resp = await keycloak.delete_user(admin_token, user_id)
+    _raise_for_upstream_error(delete_resp)
+    if delete_resp.status_code not in (200, 204):
+        logger.error("[delete_user] Error eliminando usuario: %s", delete_resp.text)
+        return jsonify({"error": "No se pudo eliminar el usuario"}), 500
+
+    await asyncio.to_thread(user_ops.user_deleted, user_id, creator_id)
+    return jsonify({"message": f"Usuario {user_id} eliminado correctamente"}), 200
+
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Actualizar Usuario
+# ----------------------------------------------------------------------
+@app.route('/api/users/<user_id>', methods=['PUT'])
+async def update_user(user_id):
+    token = request.cookies.get("access_token")
+    if not token:
+        return jsonify({"error": "No autenticado"}), 401
+
+    update_data = await _json_body()
+    admin_token, user_data, _, error = await _load_managed_user(
+        token, user_id, "actualizar", "update_user", mutation=(mutation_queue.UPDATE_USER, update_data))
+    if error:
+        return error
+
+    user_ops.apply_user_update(user_data, update_data)
+
+    update_resp = await keycloak.update_user(admin_token, user_id, user_data)
+    _raise_for_upstream_error(update_resp)
+    if update_resp.status_code not in (200, 204):
+        logger.error("[update_user] Error actualizando usuario: %s", update_resp.text)
+        return jsonify({"error": "No se pudo actualizar el usuario"}), 500
+
+    await asyncio.to_thread(user_ops.user_saved, user_data)
+    return jsonify(user_ops.updated_body(user_data)), 200
+
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Actualizar perfil propio
+# ----------------------------------------------------------------------
+@app.route('/api/user-profile', methods=['PUT'])
+async def update_user_profile():
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return jsonify({'error': 'Missing or invalid token'}), 401
+
+    token = auth_header.split(' ')[1]
+    user_info = await keycloak.validate_token(token)
+    if not user_info:
+        return jsonify({'error': 'Invalid or expired token'}), 401
+
+    user_id = user_info.get('sub')
+    if not user_id:
+        return jsonify({'error': 'User ID not found in token'}), 400
+
+    data = await _json_body()
+    error = user_ops.own_profile_error(user_id, data)
+    if error:
+        body, status = error
+        return jsonify(body), status
+
+    deferred = await _defer_mutation(mutation_queue.UPDATE_PROFILE, user_id, token, data, user_id)
+    if deferred:
+        return deferred
+
+    admin_token = await keycloak.get_admin_token()
+    if not admin_token:
+        deferred = await _defer_mutation(mutation_queue.UPDATE_PROFILE, user_id, token, data, user_id,
+                                         upstream_failed=True)
+        if deferred:
+            return deferred
+        logger.error("[update_user_profile] Failed to get admin token")
+        return jsonify({'error': 'Internal server error: admin authentication failed'}), 500
+
+    user_response = await keycloak.get_user(admin_token, user_id)
+    _raise_for_upstream_error(user_response)
+    if user_response.status_code != 200:
+        logger.error("[update_user_profile] Failed to get user data: %s - %s", user_response.status_code, user_response.text)
+        return jsonify({'error': f'Failed to retrieve user data: {user_response.status_code}'}), 500
+
+    user_data = user_ops.apply_own_profile_update(user_response.json(), data)
+
+    update_response = await keycloak.update_user(admin_token, user_id, user_data)
+    _raise_for_upstream_error(update_response)
+    if update_response.status_code >= 400:
+        logger.error("[update_user_profile] Failed to update user: %s - %s", update_response.status_code, update_response.text)
+        return jsonify({'error': f'Failed to update user: {update_response.text}'}), update_response.status_code
+
+    await asyncio.to_thread(user_ops.user_saved, user_data)
+    return jsonify(user_ops.own_profile_body(user_id, user_data))
+
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Cola de escritura diferida
+# ----------------------------------------------------------------------
+async def _mutation_session():
+    """Sesión de /api/mutations (cookie o Bearer). Retorna (token, user_id, None) o (None, None, respuesta)."""
+    if not mutation_queue.enabled():
+        return None, None, (jsonify({"error": "La cola de escritura diferida no está activa"}), 404)
+    token = user_ops.request_token(request.cookies, request.headers)
+    if not token:
+        return None, None, (jsonify({"error": "No autenticado"}), 401)
+    introspect_data = await keycloak.introspect_active(token)
+    if not introspect_data:
+        return None, None, (jsonify({"error": "Token inválido"}), 401)
+    return token, introspect_data.get("sub"), None
+
+
+@app.route('/api/mutations', methods=['GET'])
+async def list_mutations():
+    token, current_user_id, error = await _mutation_session()
+    if error:
+        return error
+    body, status = await asyncio.to_thread(mutation_queue.list_request, current_user_id, token, request.args)
+    return jsonify(body), status
+
+
+@app.route('/api/mutations/<op_id>', methods=['GET', 'DELETE'])
+async def mutation_detail(op_id):
+    token, current_user_id, error = await _mutation_session()
+    if error:
+        return error
+    operation = mutation_queue.discard_operation if request.method == 'DELETE' else mutation_queue.get_operation
+    body, status = await asyncio.to_thread(operation, op_id, current_user_id, token)
+    return jsonify(body), status
+
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Perfilado de CPU (solo administradores)
+# ----------------------------------------------------------------------
+@app.route('/api/admin/profile', methods=['GET', 'POST', 'DELETE'])
+async def admin_profile():
+    error = await _require_admin()
+    if error:
+        return error
+
+    body, status, download = admin_ops.profile_request(request.method, request.args)
+    if download:
+        mimetype, filename = download
+        return Response(body, mimetype=mimetype, headers={"Content-Disposition": f"attachment; filename={filename}"})
+    return jsonify(body), status
+
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Diagnóstico de memoria (solo administradores)
+# ----------------------------------------------------------------------
+@app.route('/api/admin/memory', methods=['GET', 'POST'])
+async def admin_memory():
+    error = await _require_admin()
+    if error:
+        return error
+
+    # Las instantáneas de tracemalloc tardan: se toman fuera del event loop
+    body, status = await asyncio.to_thread(admin_ops.memory_request, request.method, request.args)
+    return jsonify(body), status
+
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Inyección de fallos en Keycloak (solo administradores, FAULT_INJECTION)
+# ----------------------------------------------------------------------
+@app.route('/api/admin/faults', methods=['GET', 'PUT', 'DELETE'])
+async def admin_faults():
+    if not fault_injection.enabled():
+        return jsonify({"error": "La inyección de fallos no está activada (FAULT_INJECTION)"}), 404
+    with fault_injection.bypass():
+        error = await _require_admin()
+    if error:
+        return error
+
+    body, status = admin_ops.faults_request(request.method, await request.get_json(silent=True))
+    return jsonify(body), status
+
+
+@app.route('/healthz/ready', methods=['GET'])
+async def healthz_ready():
+    status = warmup.status()
+    return jsonify(status), 200 if status["ready"] else 503
+
+
+@app.route('/metrics', methods=['GET'])
+async def get_metrics():
+    return Response(metrics.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=5000)
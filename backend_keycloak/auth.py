@@ -1,5 +1,6 @@
 # Authentication utilities for Keycloak integration
 
+import keycloak_http
 import requests
 import json
 import time
@@ -10,11 +11,13 @@ from config import (
     CLIENT_ID, CLIENT_SECRET,
     ADMIN_CLIENT_ID, ADMIN_USERNAME, ADMIN_PASSWORD,
     VERIFY_SSL, SSL_CERT_PATH,
-    KEYCLOAK_URL_ALTERNATIVES
+    KEYCLOAK_URL_ALTERNATIVES,
+    OIDC_METADATA_TTL, INTROSPECTION_CACHE_TTL
 )
+from cache import shared_cache, token_key
+import metrics
+import read_cache
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
 # CRITICAL FIX: Disable insecure request warnings if we're not verifying SSL
@@ -24,9 +27,7 @@ if not VERIFY_SSL:
         "SSL verification is disabled. This should only be used in development environments."
     )
 
-# Cache for tokens to reduce API calls
-_token_cache = {}
-# Variable to store the discovered working Keycloak URL
+# Discovered working Keycloak URL (the shared cache holds it for the other workers)
 _working_keycloak_url = None
 
 # CRITICAL FIX: Create standard request settings for Keycloak
@@ -42,15 +43,15 @@ def get_request_settings():
     
     return settings
 
-def try_keycloak_url(url):
+def fetch_oidc_metadata(url):
     """
-    Test if a Keycloak URL is working by making a request to the well-known endpoint.
+    Fetch the OpenID configuration of the realm from a Keycloak base URL.
     
     Args:
         url (str): The Keycloak base URL to test
         
     Returns:
-        bool: True if the URL works, False otherwise
+        dict: The well-known metadata if the URL works, None otherwise
     """
     try:
         # Try with both formats (with and without /auth prefix)
@@ -63,32 +64,58 @@ def try_keycloak_url(url):
             well_known_urls.append(f"{url}/auth/realms/{REALM}/.well-known/openid-configuration")
         
         for well_known_url in well_known_urls:
-            logger.debug(f"[try_keycloak_url] Testing URL: {well_known_url}")
+            logger.debug("[try_keycloak_url] Testing URL: %s", well_known_url)
             
             request_settings = get_request_settings()
             try:
-                response = requests.get(well_known_url, timeout=5, **request_settings)
+                response = keycloak_http.get(well_known_url, timeout=5, **request_settings)
                 
                 if response.status_code == 200:
                     # Check if the response is valid JSON with token_endpoint
                     try:
                         config = response.json()
                         if 'token_endpoint' in config:
-                            logger.info(f"[try_keycloak_url] Found working Keycloak URL: {well_known_url}")
-                            logger.info(f"[try_keycloak_url] Token endpoint: {config['token_endpoint']}")
-                            return True
+                            logger.info("[try_keycloak_url] Found working Keycloak URL: %s", well_known_url)
+                            logger.info("[try_keycloak_url] Token endpoint: %s", config['token_endpoint'])
+                            return config
                     except json.JSONDecodeError:
-                        logger.debug(f"[try_keycloak_url] Response is not valid JSON")
+                        logger.debug("[try_keycloak_url] Response is not valid JSON")
                 else:
-                    logger.debug(f"[try_keycloak_url] Failed with status code: {response.status_code}")
+                    logger.debug("[try_keycloak_url] Failed with status code: %s", response.status_code)
             except Exception as inner_e:
-                logger.debug(f"[try_keycloak_url] Error testing specific URL {well_known_url}: {inner_e}")
+                logger.debug("[try_keycloak_url] Error testing specific URL %s: %s", well_known_url, inner_e)
                 
-        logger.debug(f"[try_keycloak_url] All URL patterns failed for base: {url}")
-        return False
+        logger.debug("[try_keycloak_url] All URL patterns failed for base: %s", url)
+        return None
     except Exception as e:
-        logger.debug(f"[try_keycloak_url] Error testing Keycloak URL: {url} - {str(e)}")
-        return False
+        logger.debug("[try_keycloak_url] Error testing Keycloak URL: %s - %s", url, str(e))
+        return None
+
+def try_keycloak_url(url):
+    """
+    Test if a Keycloak URL is working by making a request to the well-known endpoint.
+    
+    Args:
+        url (str): The Keycloak base URL to test
+        
+    Returns:
+        bool: True if the URL works, False otherwise
+    """
+    return fetch_oidc_metadata(url) is not None
+
+def _discover_oidc():
+    """
+    Try the configured URL and then the alternatives. Returns ({"url", "metadata"}, ttl)
+    for the shared cache, or (None, None) if no URL works.
+    """
+    for url in [KEYCLOAK_URL] + list(KEYCLOAK_URL_ALTERNATIVES):
+        if url != KEYCLOAK_URL:
+            logger.info("[discover_keycloak_url] Trying alternative URL: %s", url)
+        metadata = fetch_oidc_metadata(url)
+        if metadata:
+            logger.info("[discover_keycloak_url] Using Keycloak URL: %s", url)
+            return {"url": url, "metadata": metadata}, OIDC_METADATA_TTL
+    return None, None
 
 def discover_keycloak_url():
     """
@@ -104,81 +131,148 @@ def discover_keycloak_url():
     if _working_keycloak_url:
         return _working_keycloak_url
     
-    # Try standard URL first
-    if try_keycloak_url(KEYCLOAK_URL):
-        _working_keycloak_url = KEYCLOAK_URL
-        logger.info(f"[discover_keycloak_url] Using Keycloak URL: {_working_keycloak_url}")
+    # Only one worker on the host probes the URLs; the rest reuse its result
+    discovery = shared_cache().get_or_compute("oidc_discovery", _discover_oidc)
+    if discovery:
+        _working_keycloak_url = discovery["url"]
         return _working_keycloak_url
     
-    # Try alternative URLs
-    for alt_url in KEYCLOAK_URL_ALTERNATIVES:
-        logger.info(f"[discover_keycloak_url] Trying alternative URL: {alt_url}")
-        if try_keycloak_url(alt_url):
-            _working_keycloak_url = alt_url
-            logger.info(f"[discover_keycloak_url] Using alternative Keycloak URL: {_working_keycloak_url}")
-            return _working_keycloak_url
-    
     # If no URL works, log an error and return the default
     logger.error("[discover_keycloak_url] Could not find a working Keycloak URL")
     return KEYCLOAK_URL
 
+def get_oidc_metadata():
+    """
+    Get the realm's OpenID configuration shared by all workers.
+    
+    Returns:
+        dict: The well-known metadata, or None if Keycloak could not be reached
+    """
+    discovery = shared_cache().get_or_compute("oidc_discovery", _discover_oidc)
+    return discovery["metadata"] if discovery else None
+
+def _fetch_jwks():
+    """
+    Fetch the realm's signing keys from the jwks_uri of the OIDC metadata. Returns
+    (jwks, ttl) for the shared cache, or (None, None) on failure.
+    """
+    metadata = get_oidc_metadata()
+    if not metadata or not metadata.get('jwks_uri'):
+        logger.error("[get_jwks] No jwks_uri in the OIDC metadata")
+        return None, None
+    response = keycloak_http.get(metadata['jwks_uri'], **get_request_settings())
+    if response.status_code != 200:
+        logger.error("[get_jwks] Failed to get JWKS: %s", response.status_code)
+        return None, None
+    return response.json(), OIDC_METADATA_TTL
+
+def get_jwks():
+    """
+    Get the realm's signing keys (JWKS) shared by all workers.
+    
+    Returns:
+        dict: The JWKS document, or None if Keycloak could not be reached
+    """
+    return shared_cache().get_or_compute("jwks", _fetch_jwks)
+
+def _request_admin_token():
+    """
+    Request a new admin token from Keycloak. Returns (token, ttl) for the shared
+    cache, or (None, None) on failure.
+    """
+    # Discover the working Keycloak URL
+    keycloak_url = discover_keycloak_url()
+    
+    # Request a new admin token
+    token_url = f"{keycloak_url}/realms/master/protocol/openid-connect/token"
+    payload = {
+        'grant_type': 'password',
+        'client_id': ADMIN_CLIENT_ID,
+        'username': ADMIN_USERNAME,
+        'password': ADMIN_PASSWORD
+    }
+    
+    # Log attempt without credentials
+    logger.debug("[get_admin_token] Requesting new admin token for %s at %s", ADMIN_USERNAME, token_url)
+    
+    # CRITICAL FIX: Add request settings with SSL handling
+    request_settings = get_request_settings()
+    
+    response = keycloak_http.post(token_url, data=payload, **request_settings)
+    
+    if response.status_code != 200:
+        logger.error("[get_admin_token] Failed to get admin token: %s - %s", response.status_code, response.text)
+        metrics.admin_token_refreshes.inc("error")
+        return None, None
+    
+    metrics.admin_token_refreshes.inc("ok")
+    token_response = response.json()
+    expires_in = token_response.get('expires_in', 60)  # Default to 60 seconds
+    logger.debug("[get_admin_token] New administrative token obtained and cached.")
+    # Cache the token with expiration time (subtract 30s for safety margin)
+    return token_response['access_token'], expires_in - 30
+
 def get_admin_token():
     """
     Get a Keycloak admin token with proper error handling and caching.
+    The token is shared by all workers on the host through the shared cache.
     
     Returns:
         str: The admin access token if successful, None otherwise
     """
-    cache_key = 'admin_token'
+    try:
+        return shared_cache().get_or_compute("admin_token", _request_admin_token)
+    except Exception as e:
+        logger.error("[get_admin_token] Error obtaining admin token: %s", e)
+        return None
+
+def introspection_ttl(result):
+    """Seconds an active introspection result may be reused."""
+    ttl = INTROSPECTION_CACHE_TTL
+    if result.get('exp'):
+        ttl = max(0, min(ttl, result['exp'] - time.time()))
+    return ttl
+
+def cached_introspection(token, introspect):
+    """
+    Return the introspection result of a token, reusing active results across
+    workers for INTROSPECTION_CACHE_TTL seconds (never past the token's exp).
     
-    # Check if we have a valid cached token
-    if cache_key in _token_cache:
-        token_data = _token_cache[cache_key]
-        if token_data['expires_at'] > time.time():
-            logger.debug("[get_admin_token] Token administrativo obtenido del cache.")
-            return token_data['token']
+    Args:
+        token (str): The token to introspect
+        introspect (callable): Performs the introspection; returns the result
+                               if the token is active, None otherwise
+        
+    Returns:
+        dict: The token information if active, None otherwise
+    """
+    def compute():
+        result = introspect(token)
+        if result:
+            read_cache.remember_introspection(token, result)
+        return (result, introspection_ttl(result)) if result else (None, None)
     
     try:
-        # Discover the working Keycloak URL
-        keycloak_url = discover_keycloak_url()
-        
-        # Request a new admin token
-        token_url = f"{keycloak_url}/realms/master/protocol/openid-connect/token"
-        payload = {
-            'grant_type': 'password',
-            'client_id': ADMIN_CLIENT_ID,
-            'username': ADMIN_USERNAME,
-            'password': ADMIN_PASSWORD
-        }
-        
-        # Log attempt without credentials
-        logger.debug(f"[get_admin_token] Requesting new admin token for {ADMIN_USERNAME} at {token_url}")
-        
-        # CRITICAL FIX: Add request settings with SSL handling
-        request_settings = get_request_settings()
-        
-        response = requests.post(token_url, data=payload, **request_settings)
-        
-        if response.status_code != 200:
-            logger.error(f"[get_admin_token] Failed to get admin token: {response.status_code} - {response.text}")
-            return None
-        
-        token_response = response.json()
-        admin_token = token_response['access_token']
-        expires_in = token_response.get('expires_in', 60)  # Default to 60 seconds
-        
-        # Cache the token with expiration time (subtract 30s for safety margin)
-        _token_cache[cache_key] = {
-            'token': admin_token,
-            'expires_at': time.time() + expires_in - 30
-        }
-        
-        logger.debug("[get_admin_token] New administrative token obtained and cached.")
-        return admin_token
-        
+        return shared_cache().get_or_compute(token_key("introspect", token), compute)
+    except requests.RequestException:
+        # Keycloak failed, not the cache: retrying here would only double the wait.
+        # Within the grace period the last active result keeps the session working
+        last = read_cache.last_introspection(token)
+        if last:
+            return last
+        raise
     except Exception as e:
-        logger.error(f"[get_admin_token] Error obtaining admin token: {e}")
-        return None
+        # A broken cache must not block authentication
+        logger.error("[cached_introspection] Shared cache error: %s", e)
+        return introspect(token)
+
+def forget_introspection(token):
+    """Drop the cached introspection of a token (e.g. on logout)."""
+    try:
+        shared_cache().delete(token_key("introspect", token))
+        read_cache.forget_introspection(token)
+    except Exception as e:
+        logger.error("[forget_introspection] Shared cache error: %s", e)
 
 def validate_token(token):
     """
@@ -194,19 +288,23 @@ def validate_token(token):
         logger.warning("[validate_token] No token provided")
         return None
     
+    return cached_introspection(token, _introspect_basic_auth)
+
+def _introspect_basic_auth(token):
+    """Introspect a token authenticating the client with HTTP Basic Auth."""
     try:
         # Discover the working Keycloak URL
         keycloak_url = discover_keycloak_url()
         
         introspect_url = f"{keycloak_url}/realms/{REALM}/protocol/openid-connect/token/introspect"
-        logger.debug(f"[validate_token] POST to {introspect_url}")
+        logger.debug("[validate_token] POST to %s", introspect_url)
         
         # CRITICAL FIX: Add request settings with SSL handling
         request_settings = get_request_settings()
         
         # Use direct HTTP Basic Auth for client authentication instead of form parameters
         # This appears to be more reliable for Keycloak token introspection
-        response = requests.post(
+        response = keycloak_http.post(
             introspect_url,
             auth=(CLIENT_ID, CLIENT_SECRET),  # Use HTTP Basic Auth
             data={'token': token},
@@ -214,14 +312,16 @@ def validate_token(token):
             **request_settings
         )
         
-        logger.debug(f"[validate_token] Status code: {response.status_code}")
+        logger.debug("[validate_token] Status code: %s", response.status_code)
         
         if response.status_code != 200:
-            logger.error(f"[validate_token] Error response: {response.text}")
+            logger.error("[validate_token] Error response: %s", response.text)
             return None
         
         introspection_result = response.json()
-        logger.debug(f"[validate_token] Response text: {introspection_result}")
+        # Only these two fields: the rest of the response is the user's personal data
+        logger.debug("[validate_token] active=%s sub=%s",
+                     introspection_result.get('active'), introspection_result.get('sub'))
         
         # If token is not active, return None
         if not introspection_result.get('active', False):
@@ -231,7 +331,7 @@ def validate_token(token):
         return introspection_result
         
     except Exception as e:
-        logger.error(f"[validate_token] Error validating token: {e}")
+        logger.error("[validate_token] Error validating token: %s", e)
         return None
 
 def check_permissions(token, required_roles=None):
@@ -270,5 +370,5 @@ def check_permissions(token, required_roles=None):
         return all(role in user_roles for role in required_roles)
         
     except Exception as e:
-        logger.error(f"[check_permissions] Error checking permissions: {e}")
+        logger.error("[check_permissions] Error checking permissions: %s", e)
         return False
@@ -0,0 +1,267 @@
+# availability.py
+# Índice local de usernames y emails ocupados para comprobar disponibilidad.
+#
+# Un conjunto exacto (en minúsculas) responde en memoria si un valor está libre. El
+# índice se carga en segundo plano recorriendo el realm página a página y se
+# mantiene al día desde los handlers de alta, modificación y baja de routes.py.
+# Solo las respuestas "puede estar ocupado" se confirman contra Keycloak, y solo
+# para usuarios con sesión y hasta AVAILABILITY_EXACT_PER_MINUTE consultas por
+# minuto: la consulta usa el token administrativo y no debe servir a un anónimo
+# para multiplicar llamadas a Keycloak ni para enumerar emails.
+
+import json
+import logging
+import threading
+import time
+
+from auth import get_admin_token, get_request_settings
+from config import KEYCLOAK_ADMIN_URL, REALM, AVAILABILITY_REFRESH, AVAILABILITY_EXACT_PER_MINUTE
+import invalidation
+import keycloak_http
+import memory_guard
+import roster_export
+
+logger = logging.getLogger(__name__)
+
+
+_lock = threading.Lock()
+# Conjunto exacto: valor en minúsculas -> número de usuarios que lo usan
+_taken = {}
+# user_id -> valores (username, email) que ese usuario ocupa
+_by_user = {}
+_state = {"warm": False, "loading": False, "loaded_at": 0, "attempted_at": 0}
+# Segundos de espera antes de reintentar una carga fallida
+RETRY_INTERVAL = 30
+# Consultas exactas por usuario en el minuto en curso: user_id -> (inicio, consultas)
+_exact_budget = {}
+
+
+def _keys_of(user):
+    return {str(v).strip().lower() for v in (user.get("username"), user.get("email")) if v}
+
+
+def _index_user(user, taken, by_user):
+    user_id = user.get("id")
+    keys = _keys_of(user)
+    for key in by_user.pop(user_id, ()) if user_id else ():
+        if key in taken:
+            taken[key] -= 1
+            if taken[key] <= 0:
+                del taken[key]
+    for key in keys:
+        taken[key] = taken.get(key, 0) + 1
+    if user_id:
+        by_user[user_id] = keys
+
+
+def add_user(user):
+    """Registra (o actualiza) los valores ocupados por un usuario creado o modificado."""
+    with _lock:
+        _index_user(user, _taken, _by_user)
+    if user.get("id"):
+        # Los demás workers reemplazan los valores anteriores del usuario por los nuevos
+        # y los asocian a él, para poder liberarlos cuando se elimine
+        invalidation.publish("availability_user", json.dumps(
+            {"id": user["id"], "username": user.get("username"), "email": user.get("email")}))
+    else:
+        for key in _keys_of(user):
+            invalidation.publish("availability", key)
+
+
+def _add_value(key):
+    with _lock:
+        _taken[key] = _taken.get(key, 0) + 1
+
+
+def add_value(value):
+    """Marca un username o email como ocupado sin conocer el usuario (p. ej. tras un 409)."""
+    key = str(value).strip().lower()
+    if key:
+        _add_value(key)
+        invalidation.publish("availability", key)
+
+
+def _remove_user(user_id):
+    with _lock:
+        _index_user({"id": user_id}, _taken, _by_user)
+        _by_user.pop(user_id, None)
+
+
+def remove_user(user_id):
+    """Libera los valores de un usuario eliminado."""
+    _remove_user(user_id)
+    invalidation.publish("availability_release", user_id)
+
+
+def warm_up():
+    """
+    Carga el índice recorriendo el realm página a página. Construye un índice nuevo
+    y lo intercambia al final, de modo que los valores liberados fuera de esta API
+    desaparecen.
+    """
+    global _taken, _by_user
+    with _lock:
+        if _state["loading"]:
+            return
+        _state["loading"] = True
+
+    try:
+        taken, by_user = {}, {}
+        count = 0
+        for user in roster_export.iter_realm_users(get_admin_token):
+            _index_user(user, taken, by_user)
+            count += 1
+        with _lock:
+            _taken, _by_user = taken, by_user
+            _state["warm"] = True
+            _state["loaded_at"] = time.time()
+        logger.info("[availability] Índice cargado con %s usuarios", count)
+    except Exception as e:
+        logger.error("[availability] Error cargando índice de disponibilidad: %s", e)
+    finally:
+        with _lock:
+            _state["loading"] = False
+
+
+def ensure_warm():
+    """Lanza la carga en segundo plano si el índice no está listo o caducó."""
+    now = time.time()
+    with _lock:
+        stale = now - _state["loaded_at"] > AVAILABILITY_REFRESH
+        start = stale and not _state["loading"] and now - _state["attempted_at"] > RETRY_INTERVAL
+        if start:
+            _state["attempted_at"] = now
+    if start:
+        threading.Thread(target=warm_up, daemon=True).start()
+
+
+def export_state():
+    """Índice cargado, serializable a JSON (para el snapshot de apagado de warmup), o None."""
+    with _lock:
+        if not _state["warm"]:
+            return None
+        return {"loaded_at": _state["loaded_at"], "taken": dict(_taken),
+                "by_user": {user_id: sorted(keys) for user_id, keys in _by_user.items()}}
+
+
+def restore_state(data):
+    """
+    Restaura un índice exportado si sigue vigente (AVAILABILITY_REFRESH).
+    Retorna True si se restauró.
+    """
+    global _taken, _by_user
+    if not data or time.time() - data["loaded_at"] > AVAILABILITY_REFRESH:
+        return False
+    with _lock:
+        if _state["warm"]:
+            return False
+        _taken = dict(data["taken"])
+        _by_user = {user_id: set(keys) for user_id, keys in data["by_user"].items()}
+        _state["warm"] = True
+        _state["loaded_at"] = data["loaded_at"]
+    logger.info("[availability] Índice restaurado con %s usuarios", len(_by_user))
+    return True
+
+
+def lookup_exact(value):
+    """
+    Consulta en vivo a Keycloak si existe un usuario con ese username o email.
+
+    Returns:
+        bool: True si existe, False si no, None si Keycloak no respondió
+    """
+    admin_token = get_admin_token()
+    if not admin_token:
+        return None
+    users_url = f"{KEYCLOAK_ADMIN_URL}/admin/realms/{REALM}/users"
+    headers = {"Authorization": f"Bearer {admin_token}"}
+    for field in ("email", "username"):
+        resp = keycloak_http.get(
+            users_url,
+            headers=headers,
+            params={field: value, "exact": "true", "briefRepresentation": "true", "max": 1},
+            **get_request_settings()
+        )
+        if resp.status_code != 200:
+            logger.error("[availability] Error en consulta exacta: %s", resp.status_code)
+            return None
+        users = resp.json()
+        if users:
+            with _lock:
+                for user in users:
+                    _index_user(user, _taken, _by_user)
+            return True
+    return False
+
+
+def allow_exact(user_id):
+    """
+    Indica si el usuario puede hacer otra consulta exacta este minuto
+    (AVAILABILITY_EXACT_PER_MINUTE) y la descuenta.
+    """
+    now = time.monotonic()
+    with _lock:
+        if len(_exact_budget) > 10000:
+            # Se olvidan los usuarios cuyo minuto ya terminó
+            for key in [k for k, (start, _) in _exact_budget.items() if now - start >= 60]:
+                del _exact_budget[key]
+        start, used = _exact_budget.get(user_id, (now, 0))
+        if now - start >= 60:
+            start, used = now, 0
+        if used >= AVAILABILITY_EXACT_PER_MINUTE:
+            return False
+        _exact_budget[user_id] = (start, used + 1)
+        return True
+
+
+def check(value, exact=False):
+    """
+    Comprueba si un username o email está libre.
+
+    Args:
+        value (str): Username o email a comprobar
+        exact (bool): Confirmar en vivo contra Keycloak las respuestas no definitivas;
+                      los handlers solo lo activan para sesiones válidas (allow_exact)
+
+    Returns:
+        dict: {"available": bool o None, "confirmed": bool}. 'confirmed' indica que
+              la respuesta viene de una consulta en vivo a Keycloak.
+    """
+    key = str(value or "").strip().lower()
+    ensure_warm()
+    with _lock:
+        warm = _state["warm"]
+        maybe_taken = key in _taken
+
+    if warm and not maybe_taken:
+        # El valor no existía al cargar el índice ni se ha creado después mediante esta API
+        return {"available": True, "confirmed": False}
+    if not exact:
+        return {"available": False if warm else None, "confirmed": False}
+
+    exists = lookup_exact(key)
+    if exists is None:
+        return {"available": False if warm else None, "confirmed": False}
+    if not exists:
+        with _lock:
+            # El valor quedó libre fuera de esta API: olvidarlo en el conjunto exacto
+            _taken.pop(key, None)
+    return {"available": not exists, "confirmed": True}
+
+
+def _memory_stats():
+    with _lock:
+        size = memory_guard.estimate_size(_taken) + memory_guard.estimate_size(_by_user)
+        return len(_taken), size
+
+
+def _on_user_event(key, version):
+    with _lock:
+        _index_user(json.loads(key), _taken, _by_user)
+
+
+invalidation.subscribe("availability_user", _on_user_event)
+invalidation.subscribe("availability_release", lambda user_id, version: _remove_user(user_id))
+invalidation.subscribe("availability", lambda key, version: _add_value(key))
+# El índice no se vacía por presión de memoria: sin él todas las comprobaciones irían a Keycloak
+memory_guard.register_cache("availability", _memory_stats)
@@ -1,9 +1,11 @@
 # backend.py
 # Punto de entrada principal para ejecutar la aplicación Flask.
+# Con gunicorn: gunicorn backend:app (la aplicación ya sale preparada de create_app).
 
-from routes import app  # Importamos la aplicación Flask desde el módulo routes
+from routes import create_app  # La fábrica de routes prepara el proceso y retorna la aplicación
+
+app = create_app()
 
 if __name__ == '__main__':
     # Ejecuta la aplicación en modo debug para facilitar el desarrollo
     app.run(debug=True)
-
@@ -0,0 +1,109 @@
+# bench_logging.py
+# Mide el coste del logging por petición: la configuración anterior (basicConfig en
+# DEBUG, mensajes con f-string escritos en el hilo de la petición) frente a
+# log_config (formato diferido, cola y redacción en segundo plano).
+#
+# Cada "petición" emite los mensajes que registra /api/users con su payload real
+# (introspección y lista de 200 alumnos) más los de login y create_user.
+#
+# Uso: python bench/bench_logging.py [--requests 2000] [--students 200]
+
+import argparse
+import io
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def _payloads(students):
+    users = [{
+        "id": f"00000000-0000-0000-0000-{i:012d}",
+        "username": f"alumno{i}@colegio.cl",
+        "email": f"alumno{i}@colegio.cl",
+        "firstName": "Alumno",
+        "lastName": f"Número {i}",
+        "attributes": {"gender": "F", "birth_date": "2008-03-01", "phone_number": "+56 9 1234 5678",
+                       "created_by": "11111111-1111-1111-1111-111111111111"},
+    } for i in range(students)]
+    login = {"grant_type": "password", "client_id": "app", "client_secret": "s3cr3t",
+             "username": "profe@colegio.cl", "password": "hunter2", "scope": "openid profile email"}
+    new_user = {"username": "nuevo@colegio.cl", "email": "nuevo@colegio.cl",
+                "credentials": [{"type": "password", "value": "hunter2", "temporary": False}]}
+    return users, login, new_user
+
+
+def _request_fstrings(log, users, login, new_user):
+    # Mensajes tal como se registraban antes: el texto se construye siempre
+    log.debug(f"[login] Datos recibidos del cliente: {login}")
+    log.debug(f"[login] Enviando POST a http://keycloak/token con {login}")
+    log.debug(f"[login] Status code: {200}")
+    for user in users:
+        log.debug(f"[get_users] Evaluando usuario: ID={user['id']}, firstName={user['firstName']}, lastName={user['lastName']}")
+    log.debug(f"[get_users] Usuarios filtrados: {users}")
+    log.debug(f"[create_user] Enviando datos a Keycloak: {new_user}")
+
+
+def _request_lazy(log, users, login, new_user):
+    log.debug("[login] Datos recibidos del cliente: %s", login)
+    log.debug("[login] Enviando POST a %s con %s", "http://keycloak/token", login)
+    log.debug("[login] Status code: %s", 200)
+    log.debug("[get_users] Usuarios filtrados: %d", len(users))
+    log.debug("[create_user] Enviando datos a Keycloak: %s", new_user)
+
+
+def _measure(label, request, log, requests, payloads, flush=None):
+    start = time.perf_counter()
+    for _ in range(requests):
+        request(log, *payloads)
+    elapsed = time.perf_counter() - start
+    if flush:
+        flush()
+    per_request = elapsed / requests * 1e6
+    print(f"{label:<48} {per_request:10.1f} us/petición")
+    return per_request
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--students", type=int, default=200)
+    args = parser.parse_args()
+    payloads = _payloads(args.students)
+    sink = open(os.devnull, "w")
+
+    root = logging.getLogger()
+    # 1. Antes: basicConfig(level=DEBUG), f-strings y escritura síncrona
+    handler = logging.StreamHandler(sink)
+    root.addHandler(handler)
+    root.setLevel(logging.DEBUG)
+    log = logging.getLogger("routes")
+    before = _measure("antes (DEBUG, f-string, síncrono)", _request_fstrings, log, args.requests, payloads)
+    root.removeHandler(handler)
+
+    # 2-3. log_config con el nivel por defecto (INFO) y con DEBUG activado
+    os.environ.setdefault("VERIFY_SSL", "true")
+    import log_config
+    log_config.configure(stream=sink)
+    root.setLevel(logging.INFO)
+    after_info = _measure("log_config, INFO (por defecto)", _request_lazy, log, args.requests, payloads)
+    root.setLevel(logging.DEBUG)
+    after_debug = _measure("log_config, DEBUG (cola + redacción)", _request_lazy, log, args.requests, payloads,
+                           flush=log_config.shutdown)
+
+    print(f"\nReducción por petición: {before - after_info:.1f} us con INFO, "
+          f"{before - after_debug:.1f} us con DEBUG")
+
+    # Comprobación de la redacción
+    buffer = io.StringIO()
+    formatter = log_config.RedactingFormatter("%(message)s")
+    record = logging.LogRecord("routes", logging.DEBUG, __file__, 0, "[login] %s", (payloads[1],), None)
+    buffer.write(formatter.format(record))
+    assert "hunter2" not in buffer.getvalue() and "s3cr3t" not in buffer.getvalue()
+    print("Redacción verificada:", buffer.getvalue()[:120], "...")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+# keycloak_stub.py
+# Sustituto local de Keycloak para los benchmarks: el emulador de keycloak_emulator.py
+# con un realm pequeño por defecto (2000 alumnos de 20 profesores) y latencia configurable.
+#
+# Cualquier usuario del realm inicia sesión con STUB_PASSWORD; el administrador del
+# realm 'master' usa las credenciales de config.py.
+#
+# Uso: python bench/keycloak_stub.py [--port 8089] [--users 2000] [--owners 20] [--latency-ms 5]
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from keycloak_emulator import DEFAULT_PASSWORD, KeycloakEmulator
+
+STUB_PASSWORD = DEFAULT_PASSWORD
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Sustituto local de Keycloak para benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--realm", default=os.environ.get("KEYCLOAK_REALM", "servicios_agroup"))
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--owners", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    stub = KeycloakEmulator(args.realm, args.users, args.owners, args.latency_ms, args.jitter_ms,
+                            host=args.host, port=args.port, password=STUB_PASSWORD)
+    print(f"Keycloak stub en {stub.url} (realm {args.realm}, {args.users} alumnos, {args.owners} profesores)",
+          flush=True)
+    try:
+        stub.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stub.server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,189 @@
+# loadgen.py
+# Generador de carga concurrente en bucle cerrado: N hilos ejecutan el paso de un
+# escenario una y otra vez durante un tiempo fijo, cada uno con su propia sesión
+# HTTP (keep-alive), y se registran la latencia y el resultado de cada paso.
+
+import json
+import math
+import threading
+import time
+
+import requests
+
+
+class Result:
+    """Latencias (segundos) y errores de un escenario."""
+
+    def __init__(self, name, concurrency):
+        self.name = name
+        self.concurrency = concurrency
+        self.latencies = []
+        self.errors = 0
+        self.error_samples = []
+        self.elapsed = 0.0
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        return {
+            "requests": count,
+            "errors": self.errors,
+            "concurrency": self.concurrency,
+            "throughput": round(count / self.elapsed, 1) if self.elapsed else 0.0,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        }
+
+
+def percentile(sorted_values, pct):
+    """Percentil por el método nearest-rank sobre una lista ya ordenada."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+class StepError(Exception):
+    """Un paso del escenario obtuvo una respuesta inesperada."""
+
+
+def check(response, *expected):
+    """Lanza StepError si el código de estado no es uno de los esperados."""
+    if response.status_code not in expected:
+        raise StepError(f"{response.request.method} {response.request.path_url} -> "
+                        f"{response.status_code}: {response.text[:200]}")
+    return response
+
+
+def run(scenario, base_url, concurrency, duration, warmup=1.0):
+    """
+    Ejecuta un escenario con 'concurrency' hilos durante 'duration' segundos.
+    Las respuestas del periodo de calentamiento no se cuentan.
+
+    Args:
+        scenario: Objeto con name, setup(client, worker) -> estado y step(client, estado);
+                  si step retorna un número, se usa como latencia del paso
+        base_url (str): URL de la API
+        concurrency (int): Número de hilos
+        duration (float): Segundos de medición
+        warmup (float): Segundos previos que no se miden
+
+    Returns:
+        Result
+    """
+    result = Result(scenario.name, concurrency)
+    lock = threading.Lock()
+    ready = threading.Barrier(concurrency + 1)
+    go = threading.Event()
+    times = {}
+
+    def worker(index):
+        client = Client(base_url)
+        try:
+            state = scenario.setup(client, index)
+        except Exception as e:
+            with lock:
+                result.errors += 1
+                result.error_samples.append(f"setup: {e}")
+            ready.wait()
+            return
+        ready.wait()
+        go.wait()
+        latencies, errors, samples = [], 0, []
+        while True:
+            now = time.perf_counter()
+            if now >= times["end"]:
+                break
+            try:
+                measured = scenario.step(client, state)
+                ok = True
+            except (StepError, requests.RequestException) as e:
+                ok = False
+                if len(samples) < 3:
+                    samples.append(str(e))
+            finished = time.perf_counter()
+            if now >= times["measure"]:
+                if ok:
+                    latencies.append(measured if measured is not None else finished - now)
+                else:
+                    errors += 1
+        with lock:
+            result.latencies.extend(latencies)
+            result.errors += errors
+            result.error_samples.extend(samples)
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    start = time.perf_counter()
+    times["measure"] = start + warmup
+    times["end"] = start + warmup + duration
+    go.set()
+    for thread in threads:
+        thread.join()
+    result.elapsed = duration
+    return result
+
+
+class Client:
+    """Sesión HTTP de un hilo de carga; guarda el token de acceso tras el login."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        self.token = None
+
+    def request(self, method, path, **kwargs):
+        headers = kwargs.pop("headers", {})
+        if self.token:
+            # La cookie de la API es Secure: sobre HTTP local se envía a mano
+            headers["Cookie"] = f"access_token={self.token}"
+        return self.session.request(method, self.base_url + path, headers=headers, timeout=30, **kwargs)
+
+    def login(self, username, password):
+        response = check(self.request("POST", "/api/login", data={"username": username, "password": password}), 200)
+        self.token = response.json()["access_token"]
+        return self.token
+
+
+def format_report(summaries, baselines=None, tolerance=0.2):
+    """
+    Tabla de resultados; con baselines marca las regresiones de p95 o throughput
+    mayores que la tolerancia.
+
+    Returns:
+        (str, list): Texto del informe y nombres de los escenarios con regresión
+    """
+    lines = [f"{'escenario':<12} {'req':>7} {'err':>5} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} "
+             f"{'p99 ms':>8} {'max ms':>8}  vs. baseline"]
+    regressions = []
+    for name, s in summaries.items():
+        note = ""
+        base = (baselines or {}).get(name)
+        if base:
+            p95_change = (s["p95_ms"] - base["p95_ms"]) / base["p95_ms"] if base["p95_ms"] else 0.0
+            tput_change = (s["throughput"] - base["throughput"]) / base["throughput"] if base["throughput"] else 0.0
+            note = f"p95 {p95_change:+.0%}, req/s {tput_change:+.0%}"
+            if p95_change > tolerance or tput_change < -tolerance:
+                regressions.append(name)
+                note += "  REGRESIÓN"
+        lines.append(f"{name:<12} {s['requests']:>7} {s['errors']:>5} {s['throughput']:>8} {s['p50_ms']:>8} "
+                     f"{s['p95_ms']:>8} {s['p99_ms']:>8} {s['max_ms']:>8}  {note}")
+    return "\n".join(lines), regressions
+
+
+def load_baselines(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_baselines(path, baselines):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+        f.write("\n")
@@ -0,0 +1,186 @@
+# replay_traffic.py
+# Reenvía a la API el tráfico grabado con KEYCLOAK_RECORD_FILE y la compara con la
+# grabación, sin Keycloak: la API se levanta con KEYCLOAK_REPLAY_FILE apuntando a la
+# misma grabación, así que cada llamada a Keycloak recibe la respuesta (y, según
+# --upstream-latency, la latencia) que tuvo originalmente.
+#
+# Las peticiones se reenvían con su X-Request-ID original y el ritmo grabado
+# (--speed 2 lo duplica, --speed 0 las envía tan rápido como permitan los hilos).
+# El informe compara por ruta p50/p95 grabados y reproducidos y cuenta las
+# respuestas cuyo estado cambió.
+#
+# Uso:
+#   KEYCLOAK_RECORD_FILE=/tmp/kc.jsonl.gz python run.py          (grabar)
+#   python bench/replay_traffic.py /tmp/kc.jsonl.gz               (reproducir)
+#   python bench/replay_traffic.py '/tmp/kc-*.jsonl.gz' --speed 0 --upstream-latency 0 --mode asgi
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+
+from loadgen import percentile
+from run_bench import _free_port, _wait_for
+
+
+def _load_requests(pattern):
+    # keycloak_recording importa config, que solo lee variables de entorno
+    import keycloak_recording
+    return [entry for entry in keycloak_recording.load(pattern) if entry.get("kind") == "api"]
+
+
+def _start_api(args, workdir):
+    port = _free_port()
+    env = dict(
+        os.environ,
+        KEYCLOAK_BASE_URL="http://keycloak.replay.invalid",
+        KEYCLOAK_REPLAY_FILE=os.path.abspath(args.recording),
+        KEYCLOAK_REPLAY_LATENCY=str(args.upstream_latency),
+        VERIFY_SSL="true",
+        CACHE_PATH=os.path.join(workdir, "cache.sqlite3"),
+        ROSTER_SNAPSHOT_PATH=os.path.join(workdir, "roster.snap"),
+        INVALIDATION_DIR=os.path.join(workdir, "invalidation"),
+        LOG_LEVEL=os.environ.get("LOG_LEVEL", "WARNING"),
+        LOG_LEVEL_WERKZEUG="WARNING",
+    )
+    env.pop("KEYCLOAK_RECORD_FILE", None)
+    api = subprocess.Popen([
+        sys.executable, os.path.join(BENCH_DIR, "serve_backend.py"), "--port", str(port), "--mode", args.mode,
+    ], env=env)
+    url = f"http://127.0.0.1:{port}"
+    _wait_for(f"{url}/metrics", api)
+    return api, url
+
+
+def _send(session_factory, base_url, entry):
+    session = session_factory()
+    headers = {"X-Request-ID": entry["rid"]} if entry.get("rid") else {}
+    if entry.get("token"):
+        headers["Cookie"] = f"access_token={entry['token']}"
+    kwargs = {}
+    if entry.get("body") is not None:
+        kwargs["data" if entry.get("form") else "json"] = entry["body"]
+    start = time.perf_counter()
+    try:
+        status = session.request(entry["method"], base_url + entry["path"], headers=headers, timeout=60,
+                                 **kwargs).status_code
+    except requests.RequestException:
+        status = None
+    return status, time.perf_counter() - start
+
+
+def replay(entries, base_url, speed, concurrency):
+    """
+    Reenvía las peticiones respetando su separación original dividida por speed.
+
+    Returns:
+        list: (entrada, estado obtenido, segundos) por petición
+    """
+    local = threading.local()
+
+    def session():
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return local.session
+
+    results = []
+    origin = entries[0]["t"] - entries[0]["elapsed"] if entries else 0.0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = []
+        for entry in entries:
+            if speed > 0:
+                # t es la hora de fin grabada: el envío corresponde a t - elapsed
+                due = (entry["t"] - entry["elapsed"] - origin) / speed
+                wait = due - (time.perf_counter() - start)
+                if wait > 0:
+                    time.sleep(wait)
+            futures.append((entry, pool.submit(_send, session, base_url, entry)))
+        for entry, future in futures:
+            status, elapsed = future.result()
+            results.append((entry, status, elapsed))
+    return results
+
+
+def summarize(results):
+    """Resumen por ruta: peticiones, estados distintos y p50/p95 grabados y reproducidos (ms)."""
+    routes = {}
+    for entry, status, elapsed in results:
+        key = f"{entry['method']} {entry['route']}"
+        route = routes.setdefault(key, {"requests": 0, "status_changed": 0, "recorded": [], "replayed": []})
+        route["requests"] += 1
+        route["status_changed"] += status != entry["status"]
+        route["recorded"].append(entry["elapsed"])
+        route["replayed"].append(elapsed)
+    summary = {}
+    for key, route in sorted(routes.items()):
+        recorded, replayed = sorted(route["recorded"]), sorted(route["replayed"])
+        summary[key] = {
+            "requests": route["requests"],
+            "status_changed": route["status_changed"],
+            "recorded_p50_ms": round(percentile(recorded, 50) * 1000, 2),
+            "recorded_p95_ms": round(percentile(recorded, 95) * 1000, 2),
+            "replayed_p50_ms": round(percentile(replayed, 50) * 1000, 2),
+            "replayed_p95_ms": round(percentile(replayed, 95) * 1000, 2),
+        }
+    return summary
+
+
+def format_summary(summary):
+    lines = [f"{'ruta':<36} {'req':>6} {'estado≠':>8} {'p50 grab':>9} {'p50 rep':>9} {'p95 grab':>9} "
+             f"{'p95 rep':>9}  p95"]
+    for key, s in summary.items():
+        change = ((s["replayed_p95_ms"] - s["recorded_p95_ms"]) / s["recorded_p95_ms"]
+                  if s["recorded_p95_ms"] else 0.0)
+        lines.append(f"{key:<36} {s['requests']:>6} {s['status_changed']:>8} {s['recorded_p50_ms']:>9} "
+                     f"{s['replayed_p50_ms']:>9} {s['recorded_p95_ms']:>9} {s['replayed_p95_ms']:>9}  {change:+.0%}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reproduce tráfico grabado contra la API sin Keycloak")
+    parser.add_argument("recording", help="Archivo de grabación (admite patrón glob)")
+    parser.add_argument("--mode", choices=("wsgi", "asgi"), default="wsgi")
+    parser.add_argument("--speed", type=float, default=1.0, help="Factor de ritmo; 0 = sin pausas")
+    parser.add_argument("-c", "--concurrency", type=int, default=32, help="Peticiones en vuelo como máximo")
+    parser.add_argument("--upstream-latency", type=float, default=1.0,
+                        help="Escala de la latencia grabada de Keycloak (0 = inmediata)")
+    parser.add_argument("--json", help="Guardar el resumen en este archivo")
+    args = parser.parse_args()
+
+    entries = _load_requests(args.recording)
+    if not entries:
+        print(f"No hay peticiones de la API en {args.recording}")
+        return 1
+
+    with tempfile.TemporaryDirectory(prefix="replay-") as workdir:
+        api, url = _start_api(args, workdir)
+        try:
+            results = replay(entries, url, args.speed, args.concurrency)
+        finally:
+            api.terminate()
+            api.wait()
+
+    summary = summarize(results)
+    print(f"{len(results)} peticiones reproducidas en modo {args.mode} "
+          f"(ritmo x{args.speed:g}, latencia de Keycloak x{args.upstream_latency:g})")
+    print(format_summary(summary))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+# run_bench.py
+# Benchmark de la API contra el sustituto local de Keycloak, sin red externa.
+#
+# Arranca keycloak_stub.py y la API (serve_backend.py) en procesos separados,
+# ejecuta los escenarios de scenarios.py con el generador de carga de loadgen.py
+# e informa p50/p95/p99 y throughput por escenario comparados con baselines.json.
+#
+# Uso:
+#   python bench/run_bench.py                          todos los escenarios
+#   python bench/run_bench.py list_users profile -c 16 -d 20
+#   python bench/run_bench.py --latency-ms 20          Keycloak más lento
+#   python bench/run_bench.py --check                  código de salida 1 si hay regresiones
+#   python bench/run_bench.py --update-baseline        guarda los resultados como baseline
+#
+# Los baselines se guardan por configuración (modo, hilos, latencia y tamaño del
+# realm) y dependen de la máquina: actualícelos en el mismo equipo en el que se
+# van a comparar.
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+import loadgen
+from scenarios import SCENARIOS
+
+BASELINES = os.path.join(BENCH_DIR, "baselines.json")
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_for(url, process, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"El proceso terminó antes de estar listo ({url})")
+        try:
+            if requests.get(url, timeout=1).status_code < 500:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"{url} no respondió en {timeout}s")
+
+
+def _start_stack(args, workdir):
+    realm = os.environ.get("KEYCLOAK_REALM", "servicios_agroup")
+    stub_port, api_port = _free_port(), _free_port()
+    stub = subprocess.Popen([
+        sys.executable, os.path.join(BENCH_DIR, "keycloak_stub.py"), "--port", str(stub_port),
+        "--realm", realm, "--users", str(args.users), "--owners", str(args.owners),
+        "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+    ], stdout=subprocess.DEVNULL)
+    stub_url = f"http://127.0.0.1:{stub_port}"
+    _wait_for(f"{stub_url}/realms/{realm}/.well-known/openid-configuration", stub)
+
+    env = dict(
+        os.environ,
+        KEYCLOAK_BASE_URL=stub_url,
+        KEYCLOAK_REALM=realm,
+        KEYCLOAK_ADMIN_USERNAME="admin",
+        KEYCLOAK_ADMIN_PASSWORD="password",
+        VERIFY_SSL="true",
+        CACHE_PATH=os.path.join(workdir, "cache.sqlite3"),
+        ROSTER_SNAPSHOT_PATH=os.path.join(workdir, "roster.snap"),
+        INVALIDATION_DIR=os.path.join(workdir, "invalidation"),
+        LOG_LEVEL=os.environ.get("LOG_LEVEL", "WARNING"),
+        # El log de accesos de werkzeug por petición distorsiona la medición
+        LOG_LEVEL_WERKZEUG="WARNING",
+    )
+    api = subprocess.Popen([
+        sys.executable, os.path.join(BENCH_DIR, "serve_backend.py"), "--port", str(api_port), "--mode", args.mode,
+    ], env=env)
+    api_url = f"http://127.0.0.1:{api_port}"
+    _wait_for(f"{api_url}/metrics", api)
+    return stub, api, api_url
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de la API contra un Keycloak local")
+    parser.add_argument("scenarios", nargs="*", help=f"Escenarios ({', '.join(SCENARIOS)}); por defecto todos")
+    parser.add_argument("-c", "--concurrency", type=int, default=8)
+    parser.add_argument("-d", "--duration", type=float, default=10.0, help="Segundos de medición por escenario")
+    parser.add_argument("--warmup", type=float, default=2.0)
+    parser.add_argument("--mode", choices=("wsgi", "asgi"), default="wsgi")
+    parser.add_argument("--users", type=int, default=2000, help="Alumnos del realm del stub")
+    parser.add_argument("--owners", type=int, default=20, help="Profesores del realm del stub")
+    parser.add_argument("--latency-ms", type=float, default=2.0, help="Latencia añadida por el stub")
+    parser.add_argument("--jitter-ms", type=float, default=1.0)
+    parser.add_argument("--baseline", default=BASELINES)
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Regresión tolerada en p95 y throughput")
+    parser.add_argument("--check", action="store_true", help="Salir con código 1 si hay regresiones")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--json", help="Guardar los resultados en este archivo")
+    args = parser.parse_args()
+
+    names = args.scenarios or list(SCENARIOS)
+    unknown = [name for name in names if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"Escenarios desconocidos: {', '.join(unknown)}")
+
+    summaries = {}
+    with tempfile.TemporaryDirectory(prefix="bench-") as workdir:
+        stub, api, api_url = _start_stack(args, workdir)
+        try:
+            for name in names:
+                scenario = SCENARIOS[name](args.owners)
+                result = loadgen.run(scenario, api_url, args.concurrency, args.duration, args.warmup)
+                summaries[name] = result.summary()
+                print(f"{name}: {summaries[name]['requests']} peticiones, {summaries[name]['errors']} errores",
+                      flush=True)
+                for sample in result.error_samples[:3]:
+                    print(f"  error: {sample}", flush=True)
+        finally:
+            api.terminate()
+            stub.terminate()
+            api.wait()
+            stub.wait()
+
+    profile = f"{args.mode}-c{args.concurrency}-lat{args.latency_ms:g}ms-u{args.users}"
+    all_baselines = loadgen.load_baselines(args.baseline)
+    baselines = all_baselines.get(profile, {})
+    report, regressions = loadgen.format_report(summaries, baselines, args.tolerance)
+    print()
+    print(f"modo {args.mode}, {args.concurrency} hilos, {args.duration:.0f}s por escenario, "
+          f"latencia del stub {args.latency_ms} ms, realm de {args.users} alumnos (baseline '{profile}')")
+    print(report)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(summaries, f, indent=2)
+    if args.update_baseline:
+        all_baselines[profile] = dict(baselines, **summaries)
+        loadgen.save_baselines(args.baseline, all_baselines)
+        print(f"\nBaselines actualizados en {args.baseline}")
+    if regressions:
+        print(f"\nRegresiones: {', '.join(regressions)}")
+        if args.check:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,104 @@
+# scenarios.py
+# Escenarios de carga sobre la API. Cada hilo inicia sesión como uno de los
+# profesores del realm del stub (setup) y repite step(); si step retorna un número,
+# esa es la latencia medida (para excluir la preparación del paso, p. ej. el alta
+# previa a una baja).
+
+import itertools
+import time
+import uuid
+
+from keycloak_stub import STUB_PASSWORD
+from loadgen import check
+
+_sequence = itertools.count()
+
+
+def _professor(worker, owners):
+    return f"profesor{worker % owners}@bench.local"
+
+
+def _new_student(client, tag):
+    email = f"{tag}-{uuid.uuid4().hex[:12]}@bench.local"
+    response = check(client.request("POST", "/api/users", json={
+        "firstName": "Carga", "lastName": f"Prueba {next(_sequence)}", "email": email,
+        "gender": "F", "birthdate": "2010-05-04", "phone_number": "+56 9 5555 5555",
+    }), 201)
+    return response.json()["id"]
+
+
+class Scenario:
+    name = None
+
+    def __init__(self, owners):
+        self.owners = owners
+
+    def setup(self, client, worker):
+        client.login(_professor(worker, self.owners), STUB_PASSWORD)
+        return {}
+
+    def step(self, client, state):
+        raise NotImplementedError
+
+
+class Login(Scenario):
+    name = "login"
+
+    def setup(self, client, worker):
+        return {"username": _professor(worker, self.owners)}
+
+    def step(self, client, state):
+        check(client.request("POST", "/api/login", data={"username": state["username"], "password": STUB_PASSWORD}), 200)
+
+
+class Validate(Scenario):
+    name = "validate"
+
+    def step(self, client, state):
+        check(client.request("GET", "/api/validate"), 200)
+
+
+class Profile(Scenario):
+    name = "profile"
+
+    def step(self, client, state):
+        check(client.request("GET", "/api/profile"), 200)
+
+
+class ListUsers(Scenario):
+    name = "list_users"
+
+    def step(self, client, state):
+        check(client.request("GET", "/api/users"), 200)
+
+
+class Create(Scenario):
+    name = "create"
+
+    def step(self, client, state):
+        _new_student(client, "alta")
+
+
+class Update(Scenario):
+    name = "update"
+
+    def setup(self, client, worker):
+        super().setup(client, worker)
+        return {"user_id": _new_student(client, "edicion")}
+
+    def step(self, client, state):
+        check(client.request("PUT", f"/api/users/{state['user_id']}",
+                             json={"firstName": f"Editado {next(_sequence)}"}), 200)
+
+
+class Delete(Scenario):
+    name = "delete"
+
+    def step(self, client, state):
+        user_id = _new_student(client, "baja")
+        start = time.perf_counter()
+        check(client.request("DELETE", f"/api/users/{user_id}"), 200)
+        return time.perf_counter() - start
+
+
+SCENARIOS = {cls.name: cls for cls in (Login, Validate, Profile, ListUsers, Create, Update, Delete)}
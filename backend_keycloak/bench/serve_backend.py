@@ -0,0 +1,38 @@
+# serve_backend.py
+# Levanta la API para los benchmarks: la aplicación Flask con el servidor WSGI
+# multihilo de werkzeug o la aplicación ASGI con uvicorn. La configuración
+# (KEYCLOAK_BASE_URL, rutas de caché, etc.) llega por variables de entorno.
+#
+# Uso: python bench/serve_backend.py [--port 5055] [--mode wsgi|asgi]
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor de la API para benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5055)
+    parser.add_argument("--mode", choices=("wsgi", "asgi"), default="wsgi")
+    args = parser.parse_args()
+
+    if args.mode == "asgi":
+        import uvicorn
+        uvicorn.run("asgi:app", host=args.host, port=args.port, log_level="warning")
+        return 0
+
+    from werkzeug.serving import make_server
+    from routes import create_app
+    server = make_server(args.host, args.port, create_app(), threaded=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
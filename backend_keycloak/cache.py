@@ -1,21 +1,336 @@
 # cache.py
-# Implementación de una caché simple para almacenar el token administrativo.
+# Caché compartida para el token administrativo, la metadata OIDC y las introspecciones.
+#
+# Hay dos implementaciones con la misma interfaz:
+#   - InProcessCache: diccionario en memoria, válido con un solo proceso.
+#   - SQLiteCache: fichero SQLite en modo WAL compartido por todos los workers del
+#     host, de modo que N workers hacen una sola petición a Keycloak en lugar de N.
+# get_or_compute es atómico: solo un proceso (o hilo) calcula un valor ausente y el
+# resto espera a que aparezca en la caché. update modifica un valor de forma atómica
+# (p. ej. el log de cambios de un roster que escriben todos los workers).
 
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
 import time
+import uuid
+
+from config import CACHE_BACKEND, CACHE_PATH, CACHE_LEASE_TIMEOUT
+import memory_guard
+import metrics
+import private_files
+
+logger = logging.getLogger(__name__)
+
+# Intervalo (segundos) con el que se consulta la caché mientras otro proceso calcula un valor
+_POLL_INTERVAL = 0.05
+
+
+def _count(key, hit):
+    # La métrica se etiqueta con el prefijo de la clave ('introspect', 'admin_token', ...)
+    metrics.cache_requests.inc(key.split(":", 1)[0], "hit" if hit else "miss")
+
+
+class InProcessCache:
+    """Caché en memoria del proceso actual."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+        # clave -> [lock, nº de hilos que lo usan], para que get_or_compute calcule cada
+        # valor una sola vez; la entrada se quita cuando nadie lo usa (hay una clave
+        # por token de sesión)
+        self._key_locks = {}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.time():
+                del self._data[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl is not None else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def update(self, key, update, ttl=None):
+        """
+        Reemplaza de forma atómica el valor por update(valor actual o None) y retorna
+        el nuevo. update no debe modificar el valor recibido, que otros hilos pueden
+        estar leyendo, sino construir uno nuevo.
+        """
+        with self._lock:
+            entry = self._data.get(key)
+            current = entry[0] if entry and (entry[1] is None or entry[1] > time.time()) else None
+            value = update(current)
+            self._data[key] = (value, time.time() + ttl if ttl is not None else None)
+        return value
+
+    def memory_stats(self):
+        with self._lock:
+            return len(self._data), memory_guard.estimate_size(self._data)
+
+    def export_entries(self):
+        """Entradas vigentes como [clave, valor, expira_en] (para el snapshot de apagado de warmup)."""
+        now = time.time()
+        with self._lock:
+            return [[key, value, expires_at] for key, (value, expires_at) in self._data.items()
+                    if expires_at is None or expires_at > now]
+
+    def import_entries(self, entries):
+        """Restaura entradas exportadas que no han caducado sin pisar las ya presentes. Retorna cuántas."""
+        now = time.time()
+        restored = 0
+        with self._lock:
+            for key, value, expires_at in entries:
+                if key not in self._data and (expires_at is None or expires_at > now):
+                    self._data[key] = (value, expires_at)
+                    restored += 1
+        return restored
+
+    def evict(self, fraction):
+        """Descarta las entradas caducadas y la fracción de las restantes más próximas a caducar."""
+        now = time.time()
+        with self._lock:
+            expired = [key for key, (_, expires_at) in self._data.items()
+                       if expires_at is not None and expires_at <= now]
+            for key in expired:
+                del self._data[key]
+            by_expiry = sorted(self._data.items(), key=lambda item: item[1][1] or float("inf"))
+            victims = [key for key, _ in by_expiry[:int(len(by_expiry) * fraction)]]
+            for key in victims:
+                del self._data[key]
+        return len(expired) + len(victims)
+
+    def get_or_compute(self, key, compute, renew=False):
+        """
+        Retorna el valor en caché o lo calcula con compute(), que debe retornar
+        (valor, ttl). Los valores None no se guardan. renew no tiene efecto: el
+        lock de la clave no caduca.
+        """
+        value = self.get(key)
+        _count(key, value is not None)
+        if value is not None:
+            return value
+        with self._lock:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                value = self.get(key)
+                if value is not None:
+                    return value
+                value, ttl = compute()
+                if value is not None:
+                    self.set(key, value, ttl)
+                return value
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._key_locks[key]
+
+
+class SQLiteCache:
+    """
+    Caché compartida entre procesos sobre un fichero SQLite en modo WAL.
+    Los valores se guardan serializados en JSON.
+    """
+
+    def __init__(self, path, lease_timeout=CACHE_LEASE_TIMEOUT):
+        self.path = path
+        self.lease_timeout = lease_timeout
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    def _connect(self):
+        # Una conexión por hilo y por proceso: una conexión SQLite no sobrevive a un fork
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.lease_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._connect().execute(
+            "SELECT value FROM cache WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl is not None else None
+        self._connect().execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value), expires_at)
+        )
+
+    def delete(self, key):
+        self._connect().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def update(self, key, update, ttl=None):
+        """
+        Reemplaza de forma atómica el valor por update(valor actual o None) y retorna
+        el nuevo. La transacción bloquea la base de datos: update debe ser breve.
+        """
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT value FROM cache WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+                (key, time.time())
+            ).fetchone()
+            value = update(json.loads(row[0]) if row else None)
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time() + ttl if ttl is not None else None)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return value
+
+    def _acquire_lease(self, key, owner):
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Un lease caducado pertenece a un proceso que murió calculando el valor
+            conn.execute("DELETE FROM leases WHERE key = ? AND expires_at <= ?", (key, now))
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO leases (key, owner, expires_at) VALUES (?, ?, ?)",
+                (key, owner, now + self.lease_timeout)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return cursor.rowcount == 1
+
+    def _release_lease(self, key, owner):
+        self._connect().execute("DELETE FROM leases WHERE key = ? AND owner = ?", (key, owner))
+
+    def _renew_lease(self, key, owner):
+        self._connect().execute(
+            "UPDATE leases SET expires_at = ? WHERE key = ? AND owner = ?",
+            (time.time() + self.lease_timeout, key, owner)
+        )
+
+    def _keep_lease(self, key, owner, done):
+        # Si el proceso muere deja de renovarse y el lease caduca como cualquier otro
+        while not done.wait(self.lease_timeout / 3):
+            self._renew_lease(key, owner)
+
+    def _lease_held(self, key):
+        row = self._connect().execute(
+            "SELECT 1 FROM leases WHERE key = ? AND expires_at > ?", (key, time.time())
+        ).fetchone()
+        return row is not None
+
+    def get_or_compute(self, key, compute, renew=False):
+        """
+        Retorna el valor en caché o lo calcula con compute(), que debe retornar
+        (valor, ttl). Solo el proceso que obtiene el lease de la clave calcula; el
+        resto espera y comparte su resultado. Si quien calculaba no guardó nada
+        (p. ej. Keycloak falló) los demás retornan None en lugar de repetir la
+        petición; si murió sin liberar el lease, se reintenta al caducar este.
+
+        Con renew=True el lease se renueva mientras compute() sigue en marcha, para
+        cálculos que pueden durar más que lease_timeout.
+        """
+        owner = uuid.uuid4().hex
+        value = self.get(key)
+        _count(key, value is not None)
+        if value is not None:
+            return value
+        while True:
+            value = self.get(key)
+            if value is not None:
+                return value
+            if self._acquire_lease(key, owner):
+                done = threading.Event()
+                if renew:
+                    threading.Thread(target=self._keep_lease, args=(key, owner, done), daemon=True).start()
+                try:
+                    value = self.get(key)
+                    if value is not None:
+                        return value
+                    value, ttl = compute()
+                    if value is not None:
+                        self.set(key, value, ttl)
+                    return value
+                finally:
+                    done.set()
+                    self._release_lease(key, owner)
+
+            while self._lease_held(key):
+                time.sleep(_POLL_INTERVAL)
+                value = self.get(key)
+                if value is not None:
+                    return value
+            value = self.get(key)
+            if value is not None or not self._connect().execute(
+                    "SELECT 1 FROM leases WHERE key = ?", (key,)).fetchone():
+                return value
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def shared_cache():
+    """
+    Retorna la caché configurada en CACHE_BACKEND ('sqlite' o 'memory'). Si el
+    fichero SQLite no se puede abrir, o no es privado del usuario del servicio (ver
+    private_files.py), se usa la caché en memoria.
+    """
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                if CACHE_BACKEND == "sqlite":
+                    try:
+                        _backend = SQLiteCache(private_files.ensure_file(CACHE_PATH))
+                    except (sqlite3.Error, OSError) as e:
+                        logger.error("[cache] No se pudo abrir %s, usando caché en memoria: %s", CACHE_PATH, e)
+                        _backend = InProcessCache()
+                else:
+                    _backend = InProcessCache()
+                if isinstance(_backend, InProcessCache):
+                    # La caché SQLite está en disco y no cuenta para el presupuesto de memoria
+                    memory_guard.register_cache("shared_cache", _backend.memory_stats, _backend.evict)
+    return _backend
+
+
+def token_key(prefix, token):
+    """Clave de caché para un token: nunca se guarda el token en claro."""
+    return f"{prefix}:{hashlib.sha256(token.encode('utf-8')).hexdigest()}"
 
-# Diccionario que almacena el token y la hora de expiración.
-_admin_token_cache = {
-    "token": None,
-    "expires_at": 0  # Timestamp Unix en el que expira el token
-}
 
 def get_cached_admin_token():
     """
     Retorna el token almacenado en caché si existe y no ha expirado.
     """
-    if _admin_token_cache["token"] and _admin_token_cache["expires_at"] > time.time():
-        return _admin_token_cache["token"]
-    return None
+    return shared_cache().get("admin_token")
+
 
 def set_cached_admin_token(token, expires_in):
     """
@@ -25,8 +340,5 @@ def set_cached_admin_token(token, expires_in):
         token (str): El token obtenido desde Keycloak.
         expires_in (int): Tiempo en segundos en el que el token será válido.
     """
-    # Se establece la hora de expiración actualizando el timestamp actual más el tiempo de validez.
-    # Se resta un margen de seguridad de 10 segundos para evitar usar tokens expirados.
-    _admin_token_cache["token"] = token
-    _admin_token_cache["expires_at"] = time.time() + expires_in - 10
-
+    # Se resta un margen de seguridad de 30 segundos para evitar usar tokens expirados.
+    shared_cache().set("admin_token", token, expires_in - 30)
@@ -4,6 +4,7 @@
 # Configuration for Keycloak integration
 
 import os
+import tempfile
 
 # Base URLs pointing directly to your Docker container on port 8080
 KEYCLOAK_BASE_URL = os.environ.get('KEYCLOAK_BASE_URL', 'http://10.0.0.1:8080')
@@ -46,3 +47,139 @@ KEYCLOAK_URL_ALTERNATIVES = [
     f"http://127.0.0.1:8080",     # Localhost alternative
     f"{KEYCLOAK_BASE_URL}/auth",  # With /auth prefix (for older Keycloak versions)
 ]
+
+# Roster delta sync: maximum number of changes kept per professor before
+# clients are asked to reload the full roster
+ROSTER_CHANGELOG_SIZE = int(os.environ.get('ROSTER_CHANGELOG_SIZE', '500'))
+
+# Roster statistics: seconds before per-professor stats are rebuilt in the
+# background, and before the realm user count is fetched again
+ROSTER_STATS_TTL = int(os.environ.get('ROSTER_STATS_TTL', '600'))
+REALM_COUNT_TTL = int(os.environ.get('REALM_COUNT_TTL', '300'))
+
+# Streaming export: users requested from Keycloak per page
+EXPORT_PAGE_SIZE = int(os.environ.get('EXPORT_PAGE_SIZE', '500'))
+
+# Username/email availability index: seconds between full reloads from Keycloak,
+# and live Keycloak confirmations (exact=true) allowed per signed-in user and minute
+AVAILABILITY_REFRESH = int(os.environ.get('AVAILABILITY_REFRESH', '3600'))
+AVAILABILITY_EXACT_PER_MINUTE = int(os.environ.get('AVAILABILITY_EXACT_PER_MINUTE', '30'))
+
+# ASGI mode: size of the pooled async connection set to Keycloak and timeouts (seconds)
+ASYNC_POOL_SIZE = int(os.environ.get('ASYNC_POOL_SIZE', '100'))
+ASYNC_CONNECT_TIMEOUT = float(os.environ.get('ASYNC_CONNECT_TIMEOUT', '5'))
+ASYNC_READ_TIMEOUT = float(os.environ.get('ASYNC_READ_TIMEOUT', '15'))
+
+# Directory for the files shared by the workers on the host (cache, roster snapshot,
+# invalidation sockets): created 0700 and refused unless owned by the service user
+RUNTIME_DIR = os.environ.get('RUNTIME_DIR', os.path.join(
+    os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(), f'agroup-{os.geteuid()}'))
+
+# Shared cache for the admin token, OIDC discovery and token introspection:
+# 'sqlite' shares entries between all workers on the host through CACHE_PATH
+# (a 0600 file owned by the service user), 'memory' keeps them per process
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'sqlite').lower()
+CACHE_PATH = os.environ.get('CACHE_PATH', os.path.join(RUNTIME_DIR, 'cache.sqlite3'))
+# Seconds a worker may hold the right to compute a missing entry before others take over
+CACHE_LEASE_TIMEOUT = float(os.environ.get('CACHE_LEASE_TIMEOUT', '10'))
+# Seconds an active introspection result is reused (never beyond the token's exp)
+INTROSPECTION_CACHE_TTL = int(os.environ.get('INTROSPECTION_CACHE_TTL', '30'))
+# Seconds the discovered Keycloak URL and its OIDC metadata are reused
+OIDC_METADATA_TTL = int(os.environ.get('OIDC_METADATA_TTL', '3600'))
+
+# Memory-mapped roster snapshot shared by all workers: file location (a 0600 file
+# owned by the service user) and seconds between rebuilds from Keycloak
+ROSTER_SNAPSHOT_PATH = os.environ.get('ROSTER_SNAPSHOT_PATH', os.path.join(RUNTIME_DIR, 'roster.snap'))
+ROSTER_SNAPSHOT_INTERVAL = int(os.environ.get('ROSTER_SNAPSHOT_INTERVAL', '300'))
+
+# Cross-worker cache invalidation: directory holding one Unix datagram socket per worker
+# (created 0700 and refused unless owned by the service user)
+INVALIDATION_DIR = os.environ.get('INVALIDATION_DIR', os.path.join(RUNTIME_DIR, 'invalidation'))
+
+# Logging: default level, per-module overrides come from LOG_LEVEL_<MODULE>
+# (e.g. LOG_LEVEL_ROUTES=DEBUG); LOG_DEBUG_SAMPLE=N keeps one in N DEBUG lines per call site
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO')
+LOG_DEBUG_SAMPLE = int(os.environ.get('LOG_DEBUG_SAMPLE', '1'))
+
+# Keep-alive connections kept per Keycloak host by the synchronous HTTP session
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '20'))
+
+# Per-request tracing: Server-Timing spans for Keycloak calls and handler phases,
+# optionally appended as JSON lines to TRACE_FILE
+TRACING_ENABLED = os.environ.get('TRACING', 'False').lower() in ('true', '1', 't')
+TRACE_FILE = os.environ.get('TRACE_FILE', '')
+
+# On-demand CPU profiling: per-route sample rates ("0.05" or "/api/users=0.2,*=0.01"),
+# 'cprofile' (pstats) or 'sampler' (collapsed stacks every PROFILE_INTERVAL seconds),
+# aggregation window in seconds and the secret that signs X-Profile-Signature headers
+PROFILE_SAMPLE = os.environ.get('PROFILE_SAMPLE', '')
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'cprofile').lower()
+PROFILE_WINDOW = int(os.environ.get('PROFILE_WINDOW', '300'))
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', '0.005'))
+PROFILE_SECRET = os.environ.get('PROFILE_SECRET', '')
+
+# Soft memory budget: above MEMORY_BUDGET_MB resident (0 disables it) in-memory caches
+# drop MEMORY_EVICT_FRACTION of their least used entries; checked every MEMORY_CHECK_INTERVAL seconds
+MEMORY_BUDGET_MB = int(os.environ.get('MEMORY_BUDGET_MB', '0'))
+MEMORY_CHECK_INTERVAL = int(os.environ.get('MEMORY_CHECK_INTERVAL', '30'))
+MEMORY_EVICT_FRACTION = float(os.environ.get('MEMORY_EVICT_FRACTION', '0.25'))
+
+# Keycloak traffic recording (JSON lines, gzip if the name ends in .gz; "{pid}" is
+# replaced per worker) and offline replay of a recording, with its latencies scaled
+# by KEYCLOAK_REPLAY_LATENCY (0 = immediate, 1 = as recorded)
+KEYCLOAK_RECORD_FILE = os.environ.get('KEYCLOAK_RECORD_FILE', '')
+KEYCLOAK_REPLAY_FILE = os.environ.get('KEYCLOAK_REPLAY_FILE', '')
+KEYCLOAK_REPLAY_LATENCY = float(os.environ.get('KEYCLOAK_REPLAY_LATENCY', '1'))
+
+# Timeouts (connect, read) in seconds for synchronous Keycloak calls that don't pass their own
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', '5'))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', '15'))
+
+# Fault and latency injection on Keycloak calls (testing only): FAULTS holds the initial
+# rules, e.g. "introspect:latency=200;*:error=0.05"; see fault_injection.py for the syntax
+FAULT_INJECTION_ENABLED = os.environ.get('FAULT_INJECTION', 'False').lower() in ('true', '1', 't')
+FAULTS = os.environ.get('FAULTS', '')
+
+# Boot-time warm-up (discovery, JWKS, admin token, pooled connections) run in the background;
+# /healthz/ready answers 503 until it finishes. Failed steps are retried every
+# WARMUP_RETRY_INTERVAL seconds; after WARMUP_DEADLINE seconds the instance reports ready
+# anyway (degraded). WARMUP_SNAPSHOT_PATH, if set, persists in-memory caches at shutdown
+# and restores them at boot
+WARMUP_ENABLED = os.environ.get('WARMUP', 'True').lower() in ('true', '1', 't')
+WARMUP_CONNECTIONS = int(os.environ.get('WARMUP_CONNECTIONS', '4'))
+WARMUP_RETRY_INTERVAL = float(os.environ.get('WARMUP_RETRY_INTERVAL', '5'))
+WARMUP_DEADLINE = float(os.environ.get('WARMUP_DEADLINE', '60'))
+WARMUP_SNAPSHOT_PATH = os.environ.get('WARMUP_SNAPSHOT_PATH', '')
+
+# Read cache for rosters, profiles and user details (read_cache.py): entries are served
+# as-is for READ_CACHE_TTL seconds, served while refreshing in the background for
+# READ_CACHE_SWR more, and served marked stale while Keycloak is unreachable for up to
+# READ_CACHE_GRACE seconds past the TTL (active introspections too, never past the
+# token's exp). All three at 0 disable it
+READ_CACHE_TTL = int(os.environ.get('READ_CACHE_TTL', '30'))
+READ_CACHE_SWR = int(os.environ.get('READ_CACHE_SWR', '300'))
+READ_CACHE_GRACE = int(os.environ.get('READ_CACHE_GRACE', '3600'))
+READ_CACHE_MAX_ENTRIES = int(os.environ.get('READ_CACHE_MAX_ENTRIES', '10000'))
+
+# Write-behind queue for user edits while Keycloak is unreachable (mutation_queue.py):
+# with MUTATION_QUEUE enabled, create/update requests that cannot reach Keycloak are
+# journaled in MUTATION_QUEUE_PATH (SQLite, shared by all workers) and answered with 202;
+# a background worker replays them in order every MUTATION_QUEUE_RETRY_INTERVAL seconds
+# once Keycloak answers. Resolved operations are kept MUTATION_QUEUE_RETENTION seconds
+MUTATION_QUEUE_ENABLED = os.environ.get('MUTATION_QUEUE', 'False').lower() in ('true', '1', 't')
+MUTATION_QUEUE_PATH = os.environ.get('MUTATION_QUEUE_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'storage', 'mutations.sqlite3'))
+MUTATION_QUEUE_RETRY_INTERVAL = float(os.environ.get('MUTATION_QUEUE_RETRY_INTERVAL', '5'))
+MUTATION_QUEUE_RETENTION = int(os.environ.get('MUTATION_QUEUE_RETENTION', '604800'))
+
+# Admission control (admission.py): concurrent requests per process and route class
+# (auth: login/validate/logout; interactive: the rest of the API; bulk: export, stats and
+# admin diagnostics), how many more may wait for a slot and for how long (seconds) before
+# being answered 503 with Retry-After. The interactive and bulk limits adapt (AIMD) to
+# the mean Keycloak latency of each ADMISSION_WINDOW seconds against
+# ADMISSION_TARGET_LATENCY_MS: bulk is cut first and recovers last
+ADMISSION_ENABLED = os.environ.get('ADMISSION_CONTROL', 'True').lower() in ('true', '1', 't')
+ADMISSION_LIMITS = os.environ.get('ADMISSION_LIMITS', 'auth=64,interactive=32,bulk=4')
+ADMISSION_QUEUE = os.environ.get('ADMISSION_QUEUE', 'auth=128,interactive=32,bulk=2')
+ADMISSION_QUEUE_TIMEOUT = os.environ.get('ADMISSION_QUEUE_TIMEOUT', 'auth=2,interactive=1,bulk=0.5')
+ADMISSION_TARGET_LATENCY_MS = float(os.environ.get('ADMISSION_TARGET_LATENCY_MS', '250'))
+ADMISSION_WINDOW = float(os.environ.get('ADMISSION_WINDOW', '1'))
@@ -0,0 +1,221 @@
+# fault_injection.py
+# Inyección de fallos y latencia en las llamadas a Keycloak.
+#
+# Permite comprobar cómo se degrada la API cuando Keycloak está lento, responde
+# 5xx o corta conexiones, sin tocar Keycloak. Las reglas se definen por operación
+# (las mismas etiquetas que metrics.upstream_operation: introspect, token,
+# userinfo, admin_users_get, ...) o con '*' para todas:
+#
+#   FAULTS="introspect:latency=200;admin_users_get:error=0.2,status=502;*:latency=10-50,reset=0.01"
+#
+#   latency=MS            latencia fija antes de la respuesta
+#   latency=MIN-MAX       uniforme entre MIN y MAX ms
+#   latency=P50/P99       log-normal con esos percentiles en ms (colas largas)
+#   error=TASA            fracción de respuestas reemplazadas por un error HTTP
+#   status=CÓDIGO         código del error (503 por defecto); el cuerpo es HTML,
+#                         como el de un proxy, no el JSON de Keycloak
+#   reset=TASA            fracción de llamadas que terminan en conexión reiniciada
+#   slow_body=MS          tiempo extra leyendo el cuerpo tras recibir las cabeceras
+#
+# La latencia respeta el timeout de lectura de la llamada: si lo supera, la llamada
+# espera el timeout y falla con ReadTimeout igual que contra un Keycloak real. El
+# cuerpo lento no está acotado por ese timeout (requests lo aplica por lectura).
+#
+# Solo actúa con FAULT_INJECTION activado. Las reglas iniciales vienen de FAULTS y
+# se cambian en caliente con /api/admin/faults; cada proceso tiene las suyas.
+
+import contextlib
+import contextvars
+import logging
+import math
+import os
+import random
+import threading
+
+from config import FAULT_INJECTION_ENABLED, FAULTS
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ERROR_STATUS = 503
+ERROR_BODY = "<html><head><title>{status}</title></head><body><h1>{status} Service Unavailable</h1></body></html>"
+# Cuantil 0.99 de la normal estándar, para ajustar la log-normal a P50/P99
+_Z99 = 2.3263
+
+
+class FaultSpecError(ValueError):
+    """La especificación de fallos no es válida."""
+
+
+class Rule:
+    """Fallos configurados para una operación."""
+
+    __slots__ = ("latency", "error", "status", "reset", "slow_body", "spec")
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.latency = None
+        self.error = 0.0
+        self.status = DEFAULT_ERROR_STATUS
+        self.reset = 0.0
+        self.slow_body = 0.0
+        for item in filter(None, (part.strip() for part in spec.split(","))):
+            key, sep, value = item.partition("=")
+            if not sep:
+                raise FaultSpecError(f"Se esperaba clave=valor: '{item}'")
+            try:
+                if key == "latency":
+                    self.latency = _latency(value)
+                elif key == "error":
+                    self.error = _rate(value)
+                elif key == "status":
+                    self.status = int(value)
+                elif key == "reset":
+                    self.reset = _rate(value)
+                elif key == "slow_body":
+                    self.slow_body = float(value) / 1000.0
+                else:
+                    raise FaultSpecError(f"Clave desconocida: '{key}'")
+            except ValueError as e:
+                if isinstance(e, FaultSpecError):
+                    raise
+                raise FaultSpecError(f"Valor no válido en '{item}'") from e
+
+    def decide(self, rng):
+        """Sortea el fallo de una llamada: (latencia s, 'reset' | 'error' | None, cuerpo lento s)."""
+        delay = self.latency(rng) if self.latency else 0.0
+        draw = rng.random()
+        if draw < self.reset:
+            action = "reset"
+        elif draw < self.reset + self.error:
+            action = "error"
+        else:
+            action = None
+        return delay, action, self.slow_body
+
+
+def _rate(value):
+    rate = float(value)
+    if not 0.0 <= rate <= 1.0:
+        raise FaultSpecError(f"La tasa debe estar entre 0 y 1: {value}")
+    return rate
+
+
+def _latency(value):
+    """Función rng -> segundos para 'MS', 'MIN-MAX' o 'P50/P99'."""
+    if "/" in value:
+        p50, p99 = (float(v) / 1000.0 for v in value.split("/", 1))
+        if p50 <= 0 or p99 < p50:
+            raise FaultSpecError(f"Se esperaba 0 < P50 <= P99: {value}")
+        mu, sigma = math.log(p50), (math.log(p99) - math.log(p50)) / _Z99
+        return lambda rng: rng.lognormvariate(mu, sigma)
+    if "-" in value:
+        low, high = (float(v) / 1000.0 for v in value.split("-", 1))
+        return lambda rng: rng.uniform(low, high)
+    fixed = float(value) / 1000.0
+    return lambda rng: fixed
+
+
+def parse(spec):
+    """
+    Convierte una especificación 'operación:clave=valor,...;...' en reglas.
+
+    Raises:
+        FaultSpecError: Si la especificación no es válida
+    """
+    rules = {}
+    for part in filter(None, (p.strip() for p in (spec or "").split(";"))):
+        operation, sep, rule = part.partition(":")
+        if not sep or not operation.strip():
+            raise FaultSpecError(f"Se esperaba operación:reglas: '{part}'")
+        rules[operation.strip()] = Rule(rule)
+    return rules
+
+
+_lock = threading.Lock()
+_state = {"spec": "", "rules": {}}
+_rng = random.Random()
+# Activo mientras se atiende /api/admin/faults, para poder quitar las reglas aunque
+# afecten a la introspección con la que se autentica el administrador
+_bypass = contextvars.ContextVar("fault_injection_bypass", default=False)
+
+
+def enabled():
+    return FAULT_INJECTION_ENABLED
+
+
+def configure(spec):
+    """Reemplaza las reglas activas. Lanza FaultSpecError si la especificación no es válida."""
+    rules = parse(spec)
+    with _lock:
+        _state["spec"] = spec or ""
+        _state["rules"] = rules
+    logger.warning("[fault_injection] Reglas activas: %s", spec or "(ninguna)")
+
+
+def clear():
+    configure("")
+
+
+def seed(value):
+    """Fija la semilla del sorteo (pruebas reproducibles)."""
+    with _lock:
+        _rng.seed(value)
+
+
+def status():
+    with _lock:
+        return {"enabled": FAULT_INJECTION_ENABLED, "spec": _state["spec"],
+                "rules": {op: rule.spec for op, rule in _state["rules"].items()}}
+
+
+@contextlib.contextmanager
+def bypass():
+    """Las llamadas hechas dentro del bloque no sufren fallos inyectados."""
+    token = _bypass.set(True)
+    try:
+        yield
+    finally:
+        _bypass.reset(token)
+
+
+def decide(operation):
+    """
+    Fallo a inyectar en una llamada, o None si no hay regla para la operación.
+
+    Returns:
+        tuple: (latencia s, 'reset' | 'error' | None, cuerpo lento s, código de error)
+    """
+    if not FAULT_INJECTION_ENABLED or _bypass.get():
+        return None
+    rules = _state["rules"]
+    rule = rules.get(operation) or rules.get("*")
+    if rule is None:
+        return None
+    with _lock:
+        delay, action, slow_body = rule.decide(_rng)
+    return delay, action, slow_body, rule.status
+
+
+def read_timeout(timeout):
+    """Timeout de lectura de requests/httpx (número o tupla (conexión, lectura))."""
+    if isinstance(timeout, tuple):
+        return timeout[1]
+    return timeout
+
+
+def error_body(status):
+    return ERROR_BODY.format(status=status)
+
+
+def _after_fork_in_child():
+    global _lock
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+if FAULT_INJECTION_ENABLED:
+    try:
+        configure(FAULTS)
+    except FaultSpecError as e:
+        logger.error("[fault_injection] FAULTS no válido, se ignora: %s", e)
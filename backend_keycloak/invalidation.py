@@ -0,0 +1,207 @@
+# invalidation.py
+# Canal local de invalidación de cachés entre los workers del host.
+#
+# Cada worker abre un socket Unix de datagramas en INVALIDATION_DIR y atiende en un
+# hilo los eventos (namespace, key, version) que publican los demás. Cuando un
+# worker modifica un usuario, los workers restantes marcan como obsoletas las
+# entradas afectadas de sus cachés en lugar de esperar a que caduquen, de modo que
+# los TTL pueden ser largos. La entrega es "best effort": si un worker tiene el
+# buffer lleno el evento se pierde y su caché vuelve a depender del TTL.
+#
+# Cada namespace tiene un único módulo que publica y se suscribe, de modo que el
+# significado de la clave no depende de quién más escuche:
+#   roster                key = ID del profesor cuyo roster cambió (roster_changes)
+#   read_cache            key = ID del usuario cuyas copias se descartan (read_cache)
+#   availability_user     key = JSON {"id", "username", "email"} de un usuario creado o
+#                         modificado, cuyos valores ocupados se reemplazan (availability)
+#   availability_release  key = ID del usuario cuyos valores ocupados se liberan (availability)
+#   availability          key = username o email (en minúsculas) ocupado por un usuario
+#                         desconocido, p. ej. tras un 409 (availability)
+#
+# El canal vive en INVALIDATION_DIR, un directorio privado del usuario del servicio
+# (ver private_files.py): otro usuario del host no puede enviar eventos a los workers.
+
+import atexit
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import OrderedDict
+
+from config import INVALIDATION_DIR
+import memory_guard
+import private_files
+
+logger = logging.getLogger(__name__)
+
+# Tamaño máximo de un datagrama; un evento ocupa unos cientos de bytes
+_MAX_DATAGRAM = 4096
+# Claves cuya última versión se recuerda; olvidar una solo hace que un evento
+# repetido o atrasado de esa clave vuelva a invalidar la entrada
+_SEEN_LIMIT = 10000
+
+_lock = threading.Lock()
+# namespace -> funciones callback(key, version)
+_handlers = {}
+# (namespace, key) -> última versión procesada, para descartar eventos repetidos o
+# atrasados; ordenado de la menos a la más reciente
+_seen = OrderedDict()
+# started: start() o publish() ya abrieron el canal en este proceso o en su padre
+_state = {"pid": None, "socket": None, "path": None, "sender": None, "started": False}
+
+ENABLED = hasattr(socket, "AF_UNIX")
+
+
+def subscribe(namespace, handler):
+    """
+    Registra handler(key, version) para los eventos de un namespace publicados por
+    otros workers. Los eventos del propio worker no se entregan: quien publica ya
+    actualizó sus cachés.
+    """
+    with _lock:
+        _handlers.setdefault(namespace, []).append(handler)
+    # Los módulos se suscriben al importarse: el socket se abre en start(), no aquí
+    if _state["started"]:
+        _ensure_started()
+
+
+def start():
+    """Abre el canal de invalidación del proceso (lo llama create_app)."""
+    _ensure_started()
+
+
+def publish(namespace, key, version=None):
+    """
+    Envía un evento de invalidación a los demás workers del host.
+
+    Args:
+        namespace (str): Tipo de entrada invalidada (ver los namespaces arriba)
+        key (str): Clave invalidada dentro del namespace
+        version (int): Versión del cambio; por defecto el reloj en nanosegundos
+    """
+    if not ENABLED or key is None:
+        return
+    _ensure_started()
+    if _state["sender"] is None:
+        return
+    payload = json.dumps([namespace, key, version or time.time_ns(), os.getpid()]).encode("utf-8")
+    own_path = _state["path"]
+    try:
+        entries = list(os.scandir(INVALIDATION_DIR))
+    except OSError as e:
+        logger.error("[invalidation] No se pudo listar %s: %s", INVALIDATION_DIR, e)
+        return
+
+    for entry in entries:
+        if not entry.name.endswith(".sock") or entry.path == own_path:
+            continue
+        try:
+            _state["sender"].sendto(payload, entry.path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            # Socket de un worker que ya terminó
+            try:
+                os.unlink(entry.path)
+            except OSError:
+                pass
+        except BlockingIOError:
+            logger.warning("[invalidation] Buffer lleno en %s, evento descartado", entry.name)
+        except OSError as e:
+            logger.error("[invalidation] Error enviando a %s: %s", entry.name, e)
+
+
+def _dispatch(namespace, key, version):
+    with _lock:
+        seen_key = (namespace, key)
+        if _seen.get(seen_key, 0) >= version:
+            return
+        _seen[seen_key] = version
+        _seen.move_to_end(seen_key)
+        while len(_seen) > _SEEN_LIMIT:
+            _seen.popitem(last=False)
+        handlers = list(_handlers.get(namespace, ()))
+    for handler in handlers:
+        try:
+            handler(key, version)
+        except Exception as e:
+            logger.error("[invalidation] Error invalidando %s:%s: %s", namespace, key, e)
+
+
+def _listen(sock):
+    while True:
+        try:
+            data = sock.recv(_MAX_DATAGRAM)
+        except OSError:
+            # El socket se cerró (p. ej. tras un fork)
+            return
+        try:
+            namespace, key, version, sender_pid = json.loads(data)
+        except (ValueError, TypeError):
+            continue
+        if sender_pid != os.getpid():
+            _dispatch(namespace, key, version)
+
+
+def _ensure_started():
+    """Abre el socket del worker y lanza el hilo receptor (una vez por proceso)."""
+    if not ENABLED or _state["pid"] == os.getpid():
+        return
+    with _lock:
+        if _state["pid"] == os.getpid():
+            return
+        _state["started"] = True
+        try:
+            private_files.ensure_dir(INVALIDATION_DIR)
+            path = os.path.join(INVALIDATION_DIR, f"{os.getpid()}.sock")
+            if os.path.exists(path):
+                os.unlink(path)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.bind(path)
+            sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sender.setblocking(False)
+        except OSError as e:
+            logger.error("[invalidation] No se pudo abrir el canal de invalidación: %s", e)
+            _state["pid"] = os.getpid()
+            return
+        _state.update(pid=os.getpid(), socket=sock, path=path, sender=sender)
+    threading.Thread(target=_listen, args=(sock,), daemon=True).start()
+
+
+def _after_fork_in_child():
+    # El hijo no hereda el hilo receptor, el socket pertenece al padre y el lock
+    # pudo quedar tomado por otro hilo en el momento del fork
+    global _lock
+    _lock = threading.Lock()
+    _state.update(pid=None, socket=None, path=None, sender=None)
+    if _handlers and _state["started"]:
+        _ensure_started()
+
+
+def _memory_stats():
+    with _lock:
+        return len(_seen), memory_guard.estimate_size(_seen)
+
+
+def evict(fraction):
+    """Olvida la fracción de versiones recordadas que llevan más tiempo sin eventos."""
+    with _lock:
+        victims = int(len(_seen) * fraction)
+        for _ in range(victims):
+            _seen.popitem(last=False)
+    return victims
+
+
+def _close():
+    if _state["pid"] == os.getpid() and _state["path"]:
+        try:
+            os.unlink(_state["path"])
+        except OSError:
+            pass
+
+
+memory_guard.register_cache("invalidation", _memory_stats, evict)
+
+if ENABLED:
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+    atexit.register(_close)
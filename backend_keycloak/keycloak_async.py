@@ -0,0 +1,333 @@
+# keycloak_async.py
+# Cliente asíncrono de Keycloak para el modo de servicio ASGI.
+#
+# Usa un único httpx.AsyncClient por proceso, con pool de conexiones keep-alive
+# y timeouts explícitos, de modo que miles de peticiones en vuelo esperando a
+# Keycloak no consumen un hilo cada una. Las respuestas son httpx.Response, que
+# expone status_code, text y json() igual que requests.
+# El token administrativo y las introspecciones se guardan en la misma caché
+# compartida que usa auth.py. Con CACHE_BACKEND=sqlite una lectura o escritura puede
+# esperar al lock del fichero hasta CACHE_LEASE_TIMEOUT segundos, así que se hacen en
+# un hilo (asyncio.to_thread) y nunca bloquean el event loop.
+
+import asyncio
+import logging
+import time
+
+import httpx
+
+from auth import discover_keycloak_url, introspection_ttl
+from cache import shared_cache, token_key
+import admission
+import fault_injection
+import keycloak_recording
+import metrics
+import read_cache
+import tracing
+from roster_export import ExportError
+from config import (
+    KEYCLOAK_URL, KEYCLOAK_ADMIN_URL, REALM,
+    CLIENT_ID, CLIENT_SECRET,
+    ADMIN_CLIENT_ID, ADMIN_USERNAME, ADMIN_PASSWORD,
+    VERIFY_SSL, SSL_CERT_PATH,
+    ASYNC_POOL_SIZE, ASYNC_CONNECT_TIMEOUT, ASYNC_READ_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+
+async def _cache_get(key):
+    return await asyncio.to_thread(lambda: shared_cache().get(key))
+
+
+async def _cache_set(key, value, ttl):
+    await asyncio.to_thread(lambda: shared_cache().set(key, value, ttl))
+
+
+class _InstrumentedClient(httpx.AsyncClient):
+    """AsyncClient que mide cada petición y propaga X-Request-ID igual que keycloak_http._InstrumentedSession."""
+
+    async def send(self, request, **kwargs):
+        request_id = tracing.request_id()
+        if request_id:
+            request.headers[tracing.REQUEST_ID_HEADER] = request_id
+        operation = metrics.upstream_operation(request.method, str(request.url))
+        fault = fault_injection.decide(operation)
+        start = time.perf_counter()
+        try:
+            response = await self._inject(fault, request) if fault else None
+            if response is None:
+                response = await super().send(request, **kwargs)
+            if fault and fault[2]:
+                await asyncio.sleep(fault[2])
+        except httpx.HTTPError:
+            elapsed = time.perf_counter() - start
+            metrics.observe_upstream(operation, "error", elapsed)
+            admission.observe_upstream(elapsed)
+            tracing.record(f"kc.{operation}", start, elapsed)
+            if keycloak_recording.recording():
+                keycloak_recording.record_upstream(request_id, request.method, str(request.url), request.content,
+                                                   request.headers.get("Content-Type"), None, None, None, elapsed)
+            raise
+        elapsed = time.perf_counter() - start
+        metrics.observe_upstream(operation, response.status_code, elapsed)
+        admission.observe_upstream(elapsed)
+        tracing.record(f"kc.{operation}", start, elapsed)
+        if keycloak_recording.recording():
+            keycloak_recording.record_upstream(request_id, request.method, str(request.url), request.content,
+                                               request.headers.get("Content-Type"), response.status_code,
+                                               response.headers, response.text, elapsed)
+        return response
+
+    async def _inject(self, fault, request):
+        """Aplica un fallo de fault_injection; retorna la respuesta de error inyectada o None."""
+        delay, action, _, status = fault
+        timeout = (request.extensions.get("timeout") or {}).get("read")
+        if timeout is not None and delay > timeout:
+            await asyncio.sleep(timeout)
+            raise httpx.ReadTimeout(f"Fallo inyectado: Keycloak no respondió en {timeout}s", request=request)
+        await asyncio.sleep(delay)
+        if action == "reset":
+            raise httpx.ConnectError("Fallo inyectado: conexión reiniciada por Keycloak", request=request)
+        if action != "error":
+            return None
+        return httpx.Response(status, headers={"Content-Type": "text/html"},
+                              content=fault_injection.error_body(status).encode("utf-8"), request=request)
+
+
+class _ReplayTransport(httpx.AsyncBaseTransport):
+    """Transporte que responde con la grabación de keycloak_recording en lugar de abrir conexiones."""
+
+    def __init__(self, replay):
+        self.replay = replay
+
+    async def handle_async_request(self, request):
+        entry = self.replay.match(request.headers.get(tracing.REQUEST_ID_HEADER), request.method, str(request.url))
+        delay = self.replay.delay(entry)
+        if delay:
+            await asyncio.sleep(delay)
+        status, headers, body = keycloak_recording.response_parts(entry)
+        if status is None:
+            raise httpx.ConnectError("Error de conexión grabado", request=request)
+        return httpx.Response(status, headers=headers, content=body, request=request)
+
+
+class AsyncKeycloakClient:
+    """
+    Operaciones de Keycloak usadas por la API: token, introspección, userinfo y
+    CRUD de usuarios administrativos.
+    """
+
+    def __init__(self, pool_size=ASYNC_POOL_SIZE):
+        transport = None
+        if keycloak_recording.replaying():
+            transport = _ReplayTransport(keycloak_recording.replay())
+        self._client = _InstrumentedClient(
+            transport=transport,
+            verify=SSL_CERT_PATH or VERIFY_SSL,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            timeout=httpx.Timeout(ASYNC_READ_TIMEOUT, connect=ASYNC_CONNECT_TIMEOUT),
+        )
+        self._admin_lock = asyncio.Lock()
+        self._base_url = None
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    async def _keycloak_url(self):
+        # El descubrimiento solo se hace una vez y es bloqueante: se ejecuta en un hilo
+        if self._base_url is None:
+            self._base_url = await asyncio.to_thread(discover_keycloak_url)
+        return self._base_url
+
+    async def warm_connections(self, count):
+        """Abre count conexiones del pool con GET concurrentes a la metadata OIDC del realm."""
+        keycloak_url = await self._keycloak_url()
+        url = f"{keycloak_url}/realms/{REALM}/.well-known/openid-configuration"
+        responses = await asyncio.gather(*(self._client.get(url) for _ in range(count)))
+        return sum(1 for response in responses if response.status_code < 500)
+
+    # ------------------------------------------------------------------
+    # Endpoints OIDC del realm
+    # ------------------------------------------------------------------
+    async def token(self, payload):
+        """POST al endpoint de token del realm (grant_type en el payload)."""
+        token_url = f"{KEYCLOAK_URL}/realms/{REALM}/protocol/openid-connect/token"
+        return await self._client.post(token_url, data=payload)
+
+    async def introspect(self, token):
+        """Introspección con las credenciales del cliente en el cuerpo del formulario."""
+        introspect_url = f"{KEYCLOAK_URL}/realms/{REALM}/protocol/openid-connect/token/introspect"
+        return await self._client.post(introspect_url, data={
+            "client_id": CLIENT_ID,
+            "client_secret": CLIENT_SECRET,
+            "token": token
+        })
+
+    async def introspect_active(self, token):
+        """Retorna el resultado de la introspección si el token está activo, None en otro caso."""
+        with tracing.span("auth"):
+            try:
+                return await self._introspect_active(token)
+            except httpx.HTTPError:
+                # Dentro de la gracia, la última introspección activa mantiene la sesión
+                last = await asyncio.to_thread(read_cache.last_introspection, token)
+                if last:
+                    return last
+                raise
+
+    async def _introspect_active(self, token):
+        cache_key = token_key("introspect", token)
+        cached = await _cache_get(cache_key)
+        metrics.cache_requests.inc("introspect", "hit" if cached else "miss")
+        if cached:
+            return cached
+        resp = await self.introspect(token)
+        if resp.status_code >= 500:
+            # Keycloak no disponible: no es un token inválido (el handler responde 503)
+            resp.raise_for_status()
+        if resp.status_code != 200:
+            return None
+        data = resp.json()
+        if not data.get("active"):
+            return None
+        await _cache_set(cache_key, data, introspection_ttl(data))
+        await asyncio.to_thread(read_cache.remember_introspection, token, data)
+        return data
+
+    async def forget_introspection(self, token):
+        def forget():
+            shared_cache().delete(token_key("introspect", token))
+            read_cache.forget_introspection(token)
+        await asyncio.to_thread(forget)
+
+    async def validate_token(self, token):
+        """
+        Equivalente asíncrono de auth.validate_token: introspección con HTTP Basic
+        sobre la URL descubierta. Retorna la información del token o None.
+        """
+        if not token:
+            return None
+        try:
+            keycloak_url = await self._keycloak_url()
+            introspect_url = f"{keycloak_url}/realms/{REALM}/protocol/openid-connect/token/introspect"
+            resp = await self._client.post(
+                introspect_url,
+                auth=(CLIENT_ID, CLIENT_SECRET),
+                data={'token': token},
+                headers={'Content-Type': 'application/x-www-form-urlencoded'}
+            )
+            if resp.status_code != 200:
+                return None
+            result = resp.json()
+            return result if result.get('active', False) else None
+        except Exception as e:
+            logger.error("[validate_token] Error validating token: %s", e)
+            return None
+
+    async def userinfo(self, token):
+        userinfo_url = f"{KEYCLOAK_URL}/realms/{REALM}/protocol/openid-connect/userinfo"
+        return await self._client.get(userinfo_url, headers={"Authorization": f"Bearer {token}"})
+
+    # ------------------------------------------------------------------
+    # Token administrativo
+    # ------------------------------------------------------------------
+    async def get_admin_token(self):
+        """
+        Retorna un token administrativo en caché o pide uno nuevo. El lock evita que
+        varias peticiones concurrentes pidan el token a la vez cuando caduca.
+        """
+        admin_token = await _cache_get("admin_token")
+        metrics.cache_requests.inc("admin_token", "hit" if admin_token else "miss")
+        if admin_token:
+            return admin_token
+
+        async with self._admin_lock:
+            admin_token = await _cache_get("admin_token")
+            if admin_token:
+                return admin_token
+            try:
+                keycloak_url = await self._keycloak_url()
+                token_url = f"{keycloak_url}/realms/master/protocol/openid-connect/token"
+                resp = await self._client.post(token_url, data={
+                    'grant_type': 'password',
+                    'client_id': ADMIN_CLIENT_ID,
+                    'username': ADMIN_USERNAME,
+                    'password': ADMIN_PASSWORD
+                })
+                if resp.status_code != 200:
+                    logger.error("[get_admin_token] Failed to get admin token: %s - %s", resp.status_code, resp.text)
+                    metrics.admin_token_refreshes.inc("error")
+                    return None
+                metrics.admin_token_refreshes.inc("ok")
+                token_response = resp.json()
+                admin_token = token_response['access_token']
+                # Se resta un margen de seguridad de 30s, igual que auth.get_admin_token
+                await _cache_set("admin_token", admin_token, token_response.get('expires_in', 60) - 30)
+                return admin_token
+            except Exception as e:
+                logger.error("[get_admin_token] Error obtaining admin token: %s", e)
+                return None
+
+    # ------------------------------------------------------------------
+    # API administrativa de usuarios
+    # ------------------------------------------------------------------
+    def _users_url(self, suffix=""):
+        return f"{KEYCLOAK_ADMIN_URL}/admin/realms/{REALM}/users{suffix}"
+
+    @staticmethod
+    def _admin_headers(admin_token):
+        return {"Authorization": f"Bearer {admin_token}", "Content-Type": "application/json"}
+
+    async def list_users(self, admin_token, params=None):
+        return await self._client.get(self._users_url(), headers=self._admin_headers(admin_token), params=params)
+
+    async def count_users(self, admin_token):
+        return await self._client.get(self._users_url("/count"), headers=self._admin_headers(admin_token))
+
+    async def get_user(self, admin_token, user_id):
+        return await self._client.get(self._users_url(f"/{user_id}"), headers=self._admin_headers(admin_token))
+
+    async def create_user(self, admin_token, representation):
+        return await self._client.post(self._users_url(), headers=self._admin_headers(admin_token), json=representation)
+
+    async def update_user(self, admin_token, user_id, representation):
+        return await self._client.put(self._users_url(f"/{user_id}"), headers=self._admin_headers(admin_token), json=representation)
+
+    async def delete_user(self, admin_token, user_id):
+        return await self._client.delete(self._users_url(f"/{user_id}"), headers=self._admin_headers(admin_token))
+
+    async def reset_password(self, admin_token, user_id, credential):
+        return await self._client.put(
+            self._users_url(f"/{user_id}/reset-password"),
+            headers=self._admin_headers(admin_token),
+            json=credential
+        )
+
+    async def iter_users(self, admin_token_provider, page_size):
+        """
+        Recorre todos los usuarios del realm página a página (first/max).
+        admin_token_provider es una corrutina que retorna un token vigente.
+        """
+        first = 0
+        while True:
+            admin_token = await admin_token_provider()
+            if not admin_token:
+                raise ExportError("No se pudo obtener token administrativo")
+            try:
+                resp = await self.list_users(admin_token, {"first": first, "max": page_size, "briefRepresentation": "false"})
+            except httpx.HTTPError as e:
+                raise ExportError(f"Error de conexión obteniendo usuarios: {e}") from e
+            if resp.status_code != 200:
+                raise ExportError(f"Error obteniendo usuarios ({resp.status_code}): {resp.text}")
+            try:
+                page = resp.json()
+            except ValueError as e:
+                raise ExportError(f"Respuesta no JSON obteniendo usuarios: {e}") from e
+            if not isinstance(page, list):
+                raise ExportError(f"Respuesta inesperada obteniendo usuarios: {type(page).__name__}")
+            for user in page:
+                yield user
+            if len(page) < page_size:
+                return
+            first += page_size
@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
 """
 Keycloak Doctor - A diagnostic tool for Keycloak connectivity issues
+
+Usage:
+    python keycloak_doctor.py                      # connectivity diagnosis
+    python keycloak_doctor.py --profile [-n 50]    # per-phase latency profile (see keycloak_latency.py)
+        [--json profile.json] [--username U --password P]
 """
 
+import argparse
 import requests
 import sys
 import os
 import logging
+from concurrent.futures import ThreadPoolExecutor
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
@@ -14,8 +21,10 @@ logger = logging.getLogger('keycloak_doctor')
 
 # Import configurations from your app
 try:
-    from config import KEYCLOAK_URL, KEYCLOAK_BASE_URL, REALM, CLIENT_ID, CLIENT_SECRET, VERIFY_SSL
+    from config import (KEYCLOAK_URL, KEYCLOAK_BASE_URL, REALM, CLIENT_ID, CLIENT_SECRET, VERIFY_SSL,
+                        ADMIN_CLIENT_ID, ADMIN_USERNAME, ADMIN_PASSWORD)
     from auth import get_request_settings
+    import keycloak_latency
 except ImportError:
     logger.error("Could not import from config.py or auth.py. Make sure they exist and are in your PYTHONPATH.")
     sys.exit(1)
@@ -45,11 +54,7 @@ def check_keycloak_connectivity():
     
     # Try different URL patterns
     print("\n3. Testing common Keycloak URL patterns:")
-    test_urls = [
-        f"{KEYCLOAK_BASE_URL}/realms/{REALM}/.well-known/openid-configuration",
-        f"{KEYCLOAK_BASE_URL}/auth/realms/{REALM}/.well-known/openid-configuration",
-        f"{KEYCLOAK_BASE_URL}/keycloak/auth/realms/{REALM}/.well-known/openid-configuration"
-    ]
+    test_urls = _url_patterns()
     
     working_urls = []
     for url in test_urls:
@@ -140,5 +145,73 @@ def check_keycloak_connectivity():
     
     print("\nIf problems persist, check Keycloak logs for more specific error messages.")
 
+def _url_patterns():
+    return [
+        f"{KEYCLOAK_BASE_URL}/realms/{REALM}/.well-known/openid-configuration",
+        f"{KEYCLOAK_BASE_URL}/auth/realms/{REALM}/.well-known/openid-configuration",
+        f"{KEYCLOAK_BASE_URL}/keycloak/auth/realms/{REALM}/.well-known/openid-configuration"
+    ]
+
+
+def _check_discovery(url, request_settings):
+    """Returns (url, error): error is None when the URL serves an OpenID configuration"""
+    try:
+        response = requests.get(url, timeout=5, **request_settings)
+        if response.status_code != 200:
+            return url, f"Status code: {response.status_code}"
+        if 'token_endpoint' not in response.json():
+            return url, "Missing token_endpoint in response"
+        return url, None
+    except ValueError:
+        return url, "Response is not valid JSON"
+    except requests.RequestException as e:
+        return url, str(e)
+
+
+def profile_keycloak_latency(repeat, json_path=None, username=None, password=None):
+    """Find the working URL pattern concurrently, then profile every Keycloak endpoint the backend uses"""
+    request_settings = get_request_settings()
+    print("="*80)
+    print(" KEYCLOAK DOCTOR - Latency Profile")
+    print("="*80)
+
+    urls = _url_patterns()
+    with ThreadPoolExecutor(max_workers=len(urls)) as pool:
+        results = list(pool.map(lambda url: _check_discovery(url, request_settings), urls))
+    base_url = None
+    for url, error in results:
+        print(f"   {'✓' if error is None else '✗'} {url}" + (f" ({error})" if error else ""))
+        if error is None and base_url is None:
+            base_url = url.split('/realms')[0]
+    if base_url is None:
+        print(f"\n   ⚠️ No working Keycloak URL pattern found, profiling {KEYCLOAK_URL} anyway")
+        base_url = KEYCLOAK_URL
+
+    profiler = keycloak_latency.Profiler(
+        base_url, REALM, CLIENT_ID, CLIENT_SECRET, ADMIN_CLIENT_ID, ADMIN_USERNAME, ADMIN_PASSWORD,
+        verify=request_settings['verify'], username=username, password=password)
+    report = profiler.run(repeat)
+    print()
+    print(keycloak_latency.format_report(report))
+    if json_path:
+        keycloak_latency.save_report(report, json_path)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Diagnose Keycloak connectivity and latency")
+    parser.add_argument("--profile", action="store_true",
+                        help="Measure DNS/connect/TLS/TTFB per endpoint, cold and pooled")
+    parser.add_argument("-n", "--repeat", type=int, default=20, help="Calls per endpoint and mode (--profile)")
+    parser.add_argument("--json", help="Write the profile as JSON to this file ('-' for stdout)")
+    parser.add_argument("--username", help="Realm user for the userinfo token (--profile)")
+    parser.add_argument("--password", help="Password of --username")
+    args = parser.parse_args()
+    if args.profile:
+        profile_keycloak_latency(args.repeat, args.json, args.username, args.password)
+    else:
+        check_keycloak_connectivity()
+
+
 if __name__ == "__main__":
-    check_keycloak_connectivity()
+    main()
@@ -0,0 +1,930 @@
+# keycloak_emulator.py
+# Emulador de Keycloak en proceso para pruebas locales con realms de tamaño real.
+#
+# Este módulo levanta un servidor HTTP que implementa la parte de Keycloak que usa la
+# API, con un realm sintético reproducible de hasta cientos de miles de usuarios:
+#
+#   /realms/{realm}/.well-known/openid-configuration
+#   /realms/{realm}/protocol/openid-connect/token            password, client_credentials, refresh_token
+#   /realms/{realm}/protocol/openid-connect/token/introspect
+#   /realms/{realm}/protocol/openid-connect/userinfo
+#   /realms/{realm}/protocol/openid-connect/certs            JWKS (RS256)
+#   /realms/{realm}/protocol/openid-connect/logout
+#   /admin/realms/{realm}/users                              GET (search, q, username, email, firstName,
+#                                                            lastName, exact, first, max, briefRepresentation), POST
+#   /admin/realms/{realm}/users/count
+#   /admin/realms/{realm}/users/{id}                         GET, PUT, DELETE
+#   /admin/realms/{realm}/users/{id}/reset-password          PUT
+#   /admin/realms/{realm}/users/{id}/groups[/{groupId}]      GET, PUT, DELETE
+#   /admin/realms/{realm}/groups                             GET (search, first, max), POST
+#   /admin/realms/{realm}/groups/count
+#   /admin/realms/{realm}/groups/{id}                        GET, PUT, DELETE
+#   /admin/realms/{realm}/groups/{id}/members                GET (first, max)
+#   /admin/realms/{realm}/admin-events                       GET (operationTypes, resourceTypes, first, max)
+#   /admin/realms/{realm}/events                             GET (type, user, first, max)
+#
+# Los tokens de acceso son JWT RS256 firmados con una clave RSA generada con la
+# biblioteca estándar (sin dependencias) y publicada en /certs, por lo que un
+# cliente puede verificarlos igual que con Keycloak. La clave y los usuarios se derivan de la
+# semilla: dos emuladores con la misma semilla producen el mismo realm.
+#
+# Uso:
+#   emulator = KeycloakEmulator(users=100_000, owners=2_000).start()
+#   ... KEYCLOAK_BASE_URL=emulator.url ...
+#   emulator.stop()
+#
+#   python keycloak_emulator.py --port 8089 --users 100000 --owners 2000
+
+import argparse
+import base64
+import bisect
+import hashlib
+import hmac
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+# Contraseña de todos los usuarios sintéticos del realm
+DEFAULT_PASSWORD = "bench"
+ADMIN_ROLES = ["admin", "realm-admin"]
+TEACHER_ROLES = ["teacher"]
+# Grupo al que pertenecen todos los profesores sembrados
+TEACHERS_GROUP = "profesores"
+# Vigencia de los tokens emitidos, en segundos
+TOKEN_LIFETIME = 300
+REFRESH_LIFETIME = 1800
+# Máximo de eventos guardados por tipo (los más antiguos se descartan)
+EVENTS_LIMIT = 10_000
+# Fecha de alta del primer usuario sembrado (ms), para que el realm sea reproducible
+SEED_EPOCH_MS = 1_700_000_000_000
+
+# DigestInfo DER de SHA-256 para la firma PKCS#1 v1.5 (RFC 8017, sección 9.2)
+_SHA256_PREFIX = bytes.fromhex("3031300d060960864801650304020105000420")
+_SMALL_PRIMES = [p for p in range(3, 2000, 2) if all(p % d for d in range(3, int(p ** 0.5) + 1, 2))]
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _int_b64(value):
+    return _b64(value.to_bytes((value.bit_length() + 7) // 8, "big"))
+
+
+# ----------------------------------------------------------------------
+# RSA (RS256)
+# ----------------------------------------------------------------------
+def _is_probable_prime(n, rng, rounds=24):
+    for p in _SMALL_PRIMES:
+        if n % p == 0:
+            return n == p
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+    for _ in range(rounds):
+        x = pow(rng.randrange(2, n - 2), d, n)
+        if x in (1, n - 1):
+            continue
+        for _ in range(s - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def _random_prime(bits, rng):
+    while True:
+        # Los dos bits altos a 1 garantizan que p*q tenga exactamente 2*bits bits
+        candidate = rng.getrandbits(bits) | (3 << (bits - 2)) | 1
+        if _is_probable_prime(candidate, rng):
+            return candidate
+
+
+class RsaKey:
+    """Par de claves RSA para firmar y verificar JWT RS256 (PKCS#1 v1.5 con SHA-256)."""
+
+    def __init__(self, bits=2048, seed=None, e=65537):
+        rng = random.Random(seed) if seed is not None else random.SystemRandom()
+        while True:
+            p, q = _random_prime(bits // 2, rng), _random_prime(bits // 2, rng)
+            phi = (p - 1) * (q - 1)
+            if p != q and phi % e:
+                break
+        self.n, self.e = p * q, e
+        d = pow(e, -1, phi)
+        # Parámetros CRT: la firma cuesta unas cuatro veces menos que con pow(m, d, n)
+        self._p, self._q = p, q
+        self._dp, self._dq, self._qinv = d % (p - 1), d % (q - 1), pow(q, -1, p)
+        self.size = (self.n.bit_length() + 7) // 8
+        self.kid = hashlib.sha256(_int_b64(self.n).encode("ascii")).hexdigest()[:16]
+
+    def _encode(self, data):
+        digest = _SHA256_PREFIX + hashlib.sha256(data).digest()
+        return int.from_bytes(b"\x00\x01" + b"\xff" * (self.size - len(digest) - 3) + b"\x00" + digest, "big")
+
+    def sign(self, data):
+        m = self._encode(data)
+        m1, m2 = pow(m, self._dp, self._p), pow(m, self._dq, self._q)
+        s = m2 + (self._qinv * (m1 - m2) % self._p) * self._q
+        return s.to_bytes(self.size, "big")
+
+    def verify(self, data, signature):
+        if len(signature) != self.size:
+            return False
+        return pow(int.from_bytes(signature, "big"), self.e, self.n) == self._encode(data)
+
+    def jwk(self):
+        return {"kid": self.kid, "kty": "RSA", "alg": "RS256", "use": "sig",
+                "n": _int_b64(self.n), "e": _int_b64(self.e)}
+
+
+_keys = {}
+_keys_lock = threading.Lock()
+
+
+def signing_key(seed=None, bits=2048):
+    """
+    Clave RSA del emulador. Con semilla se genera una vez por proceso y se reutiliza
+    (generar una clave de 2048 bits tarda alrededor de un segundo).
+    """
+    if seed is None:
+        return RsaKey(bits)
+    with _keys_lock:
+        key = _keys.get((seed, bits))
+        if key is None:
+            key = _keys[(seed, bits)] = RsaKey(bits, seed=f"rsa-{seed}")
+        return key
+
+
+# ----------------------------------------------------------------------
+# Realm
+# ----------------------------------------------------------------------
+class Realm:
+    """
+    Usuarios, grupos y eventos de un realm en memoria.
+
+    Los usuarios se mantienen ordenados por username (el orden de Keycloak para
+    paginar con first/max) e indexados por username, email y valor de atributo,
+    de modo que las búsquedas exactas y 'q=' no recorren el realm completo.
+    """
+
+    def __init__(self, name, users=100_000, owners=2_000, seed=42, password=DEFAULT_PASSWORD,
+                 domain="bench.local"):
+        self.name = name
+        self.password = password
+        self.lock = threading.RLock()
+        self.users = {}          # id -> representación de Keycloak
+        self.roles = {}          # id -> roles de realm
+        self.passwords = {}      # id -> contraseña distinta de la común
+        self.by_username = {}
+        self.by_email = {}
+        self.by_attribute = {}   # (nombre, valor) -> set de ids
+        self._usernames = []     # usernames ordenados
+        self.groups = {}         # id -> representación del grupo
+        self.members = {}        # id de grupo -> set de ids de usuario
+        self.user_groups = {}    # id de usuario -> set de ids de grupo
+        self.admin_events = deque(maxlen=EVENTS_LIMIT)
+        self.events = deque(maxlen=EVENTS_LIMIT)
+        self.owners = []
+        self._seed(users, owners, seed, domain)
+
+    def _seed(self, users, owners, seed, domain):
+        rng = random.Random(seed)
+        created = SEED_EPOCH_MS
+        default_roles = [f"default-roles-{self.name}"]
+        teachers = self.add_group({"id": str(uuid.UUID(int=rng.getrandbits(128), version=4)), "name": TEACHERS_GROUP})
+        for i in range(owners):
+            created += 1000
+            owner = self.add_user(self._synthetic(rng, f"profesor{i}@{domain}", "Profesor", f"Número {i}", created),
+                                  default_roles + TEACHER_ROLES)
+            self.owners.append(owner["id"])
+            self.join(owner["id"], teachers["id"])
+        for i in range(users):
+            created += 1000
+            user = self._synthetic(rng, f"alumno{i}@{domain}", rng.choice(("Ana", "Luis", "Sofía", "Pedro", "Camila")),
+                                   rng.choice(("Soto", "Rojas", "Muñoz", "Díaz", "Pérez")), created)
+            if owners:
+                owner_id = self.owners[i % owners]
+                user["attributes"] = {
+                    "created_by": [owner_id],
+                    "professor_id": [owner_id],
+                    "gender": [rng.choice(("F", "M"))],
+                    "birth_date": [f"{rng.randint(2005, 2015)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"],
+                    "phone_number": [f"+56 9 {rng.randint(10000000, 99999999)}"],
+                }
+            self.add_user(user, default_roles)
+        admin = self._synthetic(rng, f"admin@{domain}", "Administrador", "Realm", created + 1000)
+        self.add_user(admin, default_roles + ADMIN_ROLES)
+
+    @staticmethod
+    def _synthetic(rng, username, first_name, last_name, created):
+        return {
+            "id": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+            "username": username,
+            "email": username,
+            "firstName": first_name,
+            "lastName": last_name,
+            "enabled": True,
+            "emailVerified": False,
+            "createdTimestamp": created,
+            "attributes": {},
+        }
+
+    # ---- Usuarios ------------------------------------------------------
+    def add_user(self, user, roles=None):
+        with self.lock:
+            user.setdefault("attributes", {})
+            self.users[user["id"]] = user
+            self.roles[user["id"]] = list(roles or [f"default-roles-{self.name}"])
+            self._index(user)
+            return user
+
+    def update_user(self, user_id, changes):
+        with self.lock:
+            user = self.users[user_id]
+            self._unindex(user)
+            user.update(changes)
+            user["id"] = user_id
+            user["username"] = (user.get("username") or "").lower()
+            user.setdefault("attributes", {})
+            self._index(user)
+            return user
+
+    def remove_user(self, user_id):
+        with self.lock:
+            user = self.users.pop(user_id, None)
+            if user is None:
+                return False
+            self._unindex(user)
+            self.roles.pop(user_id, None)
+            self.passwords.pop(user_id, None)
+            for group_id in self.user_groups.pop(user_id, ()):
+                self.members[group_id].discard(user_id)
+            return True
+
+    def _index(self, user):
+        username = user["username"].lower()
+        self.by_username[username] = user["id"]
+        bisect.insort(self._usernames, username)
+        if user.get("email"):
+            self.by_email[user["email"].lower()] = user["id"]
+        for name, values in (user.get("attributes") or {}).items():
+            for value in values or ():
+                self.by_attribute.setdefault((name, value), set()).add(user["id"])
+
+    def _unindex(self, user):
+        username = user["username"].lower()
+        self.by_username.pop(username, None)
+        index = bisect.bisect_left(self._usernames, username)
+        if index < len(self._usernames) and self._usernames[index] == username:
+            del self._usernames[index]
+        if user.get("email") and self.by_email.get(user["email"].lower()) == user["id"]:
+            del self.by_email[user["email"].lower()]
+        for name, values in (user.get("attributes") or {}).items():
+            for value in values or ():
+                ids = self.by_attribute.get((name, value))
+                if ids is not None:
+                    ids.discard(user["id"])
+                    if not ids:
+                        del self.by_attribute[(name, value)]
+
+    def check_password(self, user_id, password):
+        return self.passwords.get(user_id, self.password) == password
+
+    def find_users(self, query):
+        """
+        Usuarios que cumplen los filtros de GET /users, en orden de username.
+        Retorna un iterador para que la paginación corte sin recorrer el realm.
+        """
+        candidates = None
+        if query.get("q"):
+            # 'q=clave:valor clave2:valor2': coincidencia exacta de todos los atributos
+            for term in query["q"].split():
+                name, _, value = term.partition(":")
+                ids = self.by_attribute.get((name, value), set())
+                candidates = ids if candidates is None else candidates & ids
+        exact = query.get("exact") == "true"
+        for field, index in (("username", self.by_username), ("email", self.by_email)):
+            value = (query.get(field) or "").lower()
+            if value and exact:
+                ids = {index[value]} if value in index else set()
+                candidates = ids if candidates is None else candidates & ids
+
+        if candidates is None:
+            ordered = (self.users[self.by_username[u]] for u in self._usernames)
+        else:
+            ordered = sorted((self.users[i] for i in candidates), key=lambda u: u["username"])
+
+        filters = []
+        if not exact:
+            for field in ("username", "email", "firstName", "lastName"):
+                value = (query.get(field) or "").lower()
+                if value:
+                    filters.append(lambda u, f=field, v=value: v in (u.get(f) or "").lower())
+        else:
+            for field in ("firstName", "lastName"):
+                value = (query.get(field) or "").lower()
+                if value:
+                    filters.append(lambda u, f=field, v=value: (u.get(f) or "").lower() == v)
+        term = (query.get("search") or "").strip("*").lower()
+        if term:
+            filters.append(lambda u: any(term in (u.get(f) or "").lower()
+                                         for f in ("username", "email", "firstName", "lastName")))
+        return (u for u in ordered if all(match(u) for match in filters))
+
+    # ---- Grupos --------------------------------------------------------
+    def add_group(self, group):
+        with self.lock:
+            group = {"id": group.get("id") or str(uuid.uuid4()), "name": group["name"],
+                     "path": f"/{group['name']}", "attributes": group.get("attributes") or {}, "subGroups": []}
+            self.groups[group["id"]] = group
+            self.members[group["id"]] = set()
+            return group
+
+    def remove_group(self, group_id):
+        with self.lock:
+            if self.groups.pop(group_id, None) is None:
+                return False
+            for user_id in self.members.pop(group_id):
+                self.user_groups[user_id].discard(group_id)
+            return True
+
+    def join(self, user_id, group_id):
+        with self.lock:
+            self.members[group_id].add(user_id)
+            self.user_groups.setdefault(user_id, set()).add(group_id)
+
+    def leave(self, user_id, group_id):
+        with self.lock:
+            self.members.get(group_id, set()).discard(user_id)
+            self.user_groups.get(user_id, set()).discard(group_id)
+
+    # ---- Eventos -------------------------------------------------------
+    def admin_event(self, operation, resource_type, path, auth, representation=None):
+        event = {
+            "time": int(time.time() * 1000), "realmId": self.name,
+            "authDetails": {"realmId": auth.get("realm", self.name), "clientId": auth.get("azp"),
+                            "userId": auth.get("sub"), "ipAddress": "127.0.0.1"},
+            "operationType": operation, "resourceType": resource_type, "resourcePath": path,
+        }
+        if representation is not None:
+            event["representation"] = json.dumps(representation)
+        self.admin_events.appendleft(event)
+
+    def event(self, event_type, client_id, user_id=None, session_id=None, **details):
+        self.events.appendleft({
+            "time": int(time.time() * 1000), "type": event_type, "realmId": self.name, "clientId": client_id,
+            "userId": user_id, "sessionId": session_id, "ipAddress": "127.0.0.1", "details": details,
+        })
+
+
+def _brief(user):
+    return {k: v for k, v in user.items() if k != "attributes"}
+
+
+def _page(items, query, default_max=100):
+    """Aplica first/max de la Admin API a un iterable ya ordenado."""
+    first = max(0, int(query.get("first") or 0))
+    maximum = int(query.get("max") or default_max)
+    page = []
+    for index, item in enumerate(items):
+        if index < first:
+            continue
+        if maximum >= 0 and len(page) >= maximum:
+            break
+        page.append(item)
+    return page
+
+
+# ----------------------------------------------------------------------
+# Servidor
+# ----------------------------------------------------------------------
+class KeycloakEmulator:
+    """Servidor HTTP que imita Keycloak sobre un Realm sintético."""
+
+    def __init__(self, realm="servicios_agroup", users=100_000, owners=2_000, latency_ms=0.0, jitter_ms=0.0,
+                 admin_username="admin", admin_password="password", clients=None, host="127.0.0.1", port=0,
+                 seed=42, password=DEFAULT_PASSWORD):
+        """
+        Args:
+            realm (str): Nombre del realm de la aplicación
+            users (int): Alumnos sintéticos, repartidos entre los profesores
+            owners (int): Profesores sintéticos
+            latency_ms, jitter_ms (float): Latencia añadida a cada respuesta
+            admin_username, admin_password (str): Credenciales del realm 'master'
+            clients (dict): client_id -> secreto; si se indica, token e introspect
+                            exigen credenciales de cliente válidas
+            seed (int): Semilla del realm y de la clave de firma
+            password (str): Contraseña de los usuarios sintéticos
+        """
+        self.realm = Realm(realm, users, owners, seed, password)
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter_ms / 1000.0
+        self.admin_username = admin_username
+        self.admin_password = admin_password
+        self.clients = clients
+        self.key = signing_key(seed)
+        self.hmac_key = hashlib.sha512(f"hmac-{seed}-{self.key.kid}".encode("ascii")).digest()
+        self.sessions = {}   # sid -> caducidad de las sesiones abiertas
+        self.server = ThreadingHTTPServer((host, port), self._handler_class())
+        self.server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    # ------------------------------------------------------------------
+    # Tokens
+    # ------------------------------------------------------------------
+    def issue_token(self, subject, username, roles, realm=None, client_id="emulator", sid=None, extra=None,
+                    lifetime=TOKEN_LIFETIME, token_type="Bearer"):
+        now = int(time.time())
+        realm = realm or self.realm.name
+        payload = {
+            "exp": now + lifetime, "iat": now, "jti": str(uuid.uuid4()),
+            "iss": f"{self.url}/realms/{realm}", "aud": "account", "sub": subject, "typ": token_type,
+            "azp": client_id, "preferred_username": username,
+            "realm_access": {"roles": list(roles)},
+            "resource_access": {client_id: {"roles": list(roles)}},
+        }
+        if sid:
+            payload["sid"] = sid
+        payload.update(extra or {})
+        # Como en Keycloak, los refresh tokens se firman con HS512 y una clave del realm
+        # que nunca sale del servidor; solo los tokens de acceso usan la clave RSA
+        alg = "HS512" if token_type == "Refresh" else "RS256"
+        header = {"alg": alg, "typ": "JWT", "kid": self.key.kid if alg == "RS256" else "hmac"}
+        signing_input = _b64(json.dumps(header).encode("utf-8")) + "." + _b64(json.dumps(payload).encode("utf-8"))
+        return signing_input + "." + _b64(self._sign(alg, signing_input.encode("ascii")))
+
+    def _sign(self, alg, data):
+        if alg == "HS512":
+            return hmac.new(self.hmac_key, data, hashlib.sha512).digest()
+        return self.key.sign(data)
+
+    def verify_token(self, token, token_type=None):
+        """Retorna el payload si el token es válido, no caducó y su sesión sigue abierta; None en otro caso."""
+        try:
+            header, payload, signature = token.split(".")
+            signing_input, signature = f"{header}.{payload}".encode("ascii"), _unb64(signature)
+            if json.loads(_unb64(header)).get("alg") == "HS512":
+                valid = hmac.compare_digest(self._sign("HS512", signing_input), signature)
+            else:
+                valid = self.key.verify(signing_input, signature)
+            if not valid:
+                return None
+            claims = json.loads(_unb64(payload))
+        except (ValueError, TypeError):
+            return None
+        if claims.get("exp", 0) < time.time():
+            return None
+        if claims.get("sid") and claims["sid"] not in self.sessions:
+            return None
+        if token_type and claims.get("typ") != token_type:
+            return None
+        return claims
+
+    def _login(self, realm, user_id, username, roles, client_id):
+        sid = str(uuid.uuid4())
+        now = time.time()
+        if len(self.sessions) % 1024 == 0:
+            # Las sesiones caducadas se descartan de vez en cuando para acotar la memoria
+            for expired in [s for s, expires in list(self.sessions.items()) if expires < now]:
+                self.sessions.pop(expired, None)
+        self.sessions[sid] = now + REFRESH_LIFETIME
+        return self._token_response(realm, user_id, username, roles, client_id, sid)
+
+    def _token_response(self, realm, user_id, username, roles, client_id, sid):
+        extra = {}
+        user = self.realm.users.get(user_id) if realm == self.realm.name else None
+        if user:
+            extra = {"email": user.get("email"), "given_name": user.get("firstName"),
+                     "family_name": user.get("lastName")}
+            creator = (user.get("attributes") or {}).get("created_by")
+            if creator:
+                extra["created_by"] = creator[0]
+        access = self.issue_token(user_id, username, roles, realm, client_id, sid, extra)
+        refresh = self.issue_token(user_id, username, roles, realm, client_id, sid,
+                                   lifetime=REFRESH_LIFETIME, token_type="Refresh")
+        return 200, {"access_token": access, "expires_in": TOKEN_LIFETIME, "refresh_token": refresh,
+                     "refresh_expires_in": REFRESH_LIFETIME, "token_type": "Bearer", "session_state": sid,
+                     "scope": "openid email profile"}, None
+
+    # ------------------------------------------------------------------
+    # Handler
+    # ------------------------------------------------------------------
+    def _handler_class(self):
+        emulator = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Cabeceras y cuerpo salen en escrituras separadas: con Nagle, en conexiones
+            # keep-alive la segunda espera el ACK retardado del cliente (~40 ms)
+            disable_nagle_algorithm = True
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send(self, status, body=None, headers=None):
+                data = b"" if body is None else json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                if body is not None:
+                    self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _body(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    return json.loads(raw or b"null")
+                return {k: v[0] for k, v in parse_qs(raw.decode("utf-8")).items()}
+
+            def _dispatch(self, method):
+                if emulator.latency or emulator.jitter:
+                    time.sleep(max(0.0, emulator.latency + random.uniform(-emulator.jitter, emulator.jitter)))
+                parts = urlsplit(self.path)
+                query = parse_qs(parts.query)
+                try:
+                    # El cuerpo se lee siempre para no dejar bytes en la conexión keep-alive
+                    body = self._body() if method in ("POST", "PUT") else None
+                    status, payload, headers = emulator.handle(method, parts.path, query, body, self.headers)
+                except Exception as e:
+                    status, payload, headers = 500, {"error": str(e)}, None
+                self._send(status, payload, headers)
+
+            def do_GET(self):
+                self._dispatch("GET")
+
+            def do_POST(self):
+                self._dispatch("POST")
+
+            def do_PUT(self):
+                self._dispatch("PUT")
+
+            def do_DELETE(self):
+                self._dispatch("DELETE")
+
+        return Handler
+
+    def handle(self, method, path, query, body, headers):
+        """
+        Atiende una petición. 'query' es el resultado de parse_qs (listas de valores)
+        y 'body' el JSON o formulario ya decodificado.
+
+        Returns:
+            (status, cuerpo JSON o None, cabeceras)
+        """
+        segments = [s for s in path.split("/") if s]
+        if len(segments) >= 2 and segments[0] == "realms":
+            return self._handle_oidc(method, segments[1], segments[2:], body or {}, headers)
+        if len(segments) >= 4 and segments[:2] == ["admin", "realms"]:
+            if segments[2] != self.realm.name:
+                return 404, {"error": "Realm not found."}, None
+            auth = self.verify_token(_bearer(headers), "Bearer")
+            if not auth:
+                return 401, {"error": "HTTP 401 Unauthorized"}, None
+            if not set(ADMIN_ROLES) & set(auth.get("realm_access", {}).get("roles", [])):
+                return 403, {"error": "HTTP 403 Forbidden"}, None
+            args = {k: v[0] for k, v in query.items()}
+            resource, rest = segments[3], segments[4:]
+            with self.realm.lock:
+                if resource == "users":
+                    return self._handle_users(method, rest, args, body, auth)
+                if resource == "groups":
+                    return self._handle_groups(method, rest, args, body, auth)
+                if resource == "admin-events" and method == "GET":
+                    return 200, self._admin_events(query, args), None
+                if resource == "events" and method == "GET":
+                    return 200, self._events(query, args), None
+        return 404, {"error": "Not found"}, None
+
+    # ---- OIDC ----------------------------------------------------------
+    def _handle_oidc(self, method, realm, rest, form, headers):
+        if realm not in (self.realm.name, "master"):
+            return 404, {"error": "Realm does not exist"}, None
+        base = f"{self.url}/realms/{realm}"
+        oidc = f"{base}/protocol/openid-connect"
+        if rest == [".well-known", "openid-configuration"]:
+            return 200, {
+                "issuer": base,
+                "authorization_endpoint": f"{oidc}/auth",
+                "token_endpoint": f"{oidc}/token",
+                "introspection_endpoint": f"{oidc}/token/introspect",
+                "userinfo_endpoint": f"{oidc}/userinfo",
+                "end_session_endpoint": f"{oidc}/logout",
+                "jwks_uri": f"{oidc}/certs",
+                "grant_types_supported": ["password", "client_credentials", "refresh_token"],
+                "id_token_signing_alg_values_supported": ["RS256"],
+            }, None
+        endpoint = "/".join(rest)
+        if endpoint == "protocol/openid-connect/certs":
+            return 200, {"keys": [self.key.jwk()]}, None
+        if endpoint == "protocol/openid-connect/token" and method == "POST":
+            return self._token(realm, form, headers)
+        if endpoint == "protocol/openid-connect/token/introspect" and method == "POST":
+            if self._client(form, headers) is None:
+                return 401, {"error": "invalid_client"}, None
+            claims = self.verify_token(form.get("token", ""))
+            if not claims or claims.get("typ") != "Bearer":
+                return 200, {"active": False}, None
+            return 200, dict(claims, active=True, username=claims.get("preferred_username"),
+                             client_id=claims.get("azp"), token_type="Bearer"), None
+        if endpoint == "protocol/openid-connect/userinfo":
+            claims = self.verify_token(_bearer(headers), "Bearer")
+            if not claims:
+                return 401, {"error": "invalid_token"}, None
+            user = self.realm.users.get(claims["sub"], {})
+            info = {"sub": claims["sub"], "preferred_username": user.get("username"), "email": user.get("email"),
+                    "email_verified": user.get("emailVerified", False), "given_name": user.get("firstName"),
+                    "family_name": user.get("lastName"),
+                    "name": f"{user.get('firstName') or ''} {user.get('lastName') or ''}".strip()}
+            creator = (user.get("attributes") or {}).get("created_by")
+            if creator:
+                info["created_by"] = creator[0]
+            return 200, info, None
+        if endpoint == "protocol/openid-connect/logout" and method == "POST":
+            claims = self.verify_token(form.get("refresh_token", ""), "Refresh")
+            if claims:
+                self.sessions.pop(claims.get("sid"), None)
+                self.realm.event("LOGOUT", claims.get("azp"), claims.get("sub"), claims.get("sid"))
+            return 204, None, None
+        return 404, {"error": "Not found"}, None
+
+    def _client(self, form, headers):
+        """client_id autenticado (Basic o formulario), o None si las credenciales no son válidas."""
+        client_id, secret = form.get("client_id"), form.get("client_secret")
+        authorization = headers.get("Authorization") or ""
+        if authorization.startswith("Basic "):
+            try:
+                client_id, _, secret = base64.b64decode(authorization[6:]).decode("utf-8").partition(":")
+            except (ValueError, UnicodeDecodeError):
+                return None
+        client_id = client_id or "emulator"
+        if self.clients is None:
+            return client_id
+        if client_id in self.clients and (self.clients[client_id] is None or self.clients[client_id] == secret):
+            return client_id
+        return None
+
+    def _token(self, realm, form, headers):
+        grant = form.get("grant_type")
+        client_id = self._client(form, headers)
+        if client_id is None:
+            return 401, {"error": "invalid_client", "error_description": "Invalid client credentials"}, None
+        if grant == "password":
+            username = (form.get("username") or "").lower()
+            if realm == "master":
+                if username != self.admin_username or form.get("password") != self.admin_password:
+                    return 401, {"error": "invalid_grant", "error_description": "Invalid user credentials"}, None
+                return self._login(realm, "admin", username, ADMIN_ROLES, client_id)
+            user_id = self.realm.by_username.get(username) or self.realm.by_email.get(username)
+            user = self.realm.users.get(user_id)
+            if user is None or not self.realm.check_password(user_id, form.get("password")):
+                self.realm.event("LOGIN_ERROR", client_id, user_id, error="invalid_user_credentials", username=username)
+                return 401, {"error": "invalid_grant", "error_description": "Invalid user credentials"}, None
+            if not user.get("enabled", True):
+                return 400, {"error": "invalid_grant", "error_description": "Account disabled"}, None
+            response = self._login(realm, user_id, user["username"], self.realm.roles.get(user_id, []), client_id)
+            self.realm.event("LOGIN", client_id, user_id, response[1]["session_state"], username=user["username"])
+            return response
+        if grant == "client_credentials":
+            return self._login(realm, f"service-account-{client_id}", f"service-account-{client_id}",
+                               ADMIN_ROLES if realm == "master" else [], client_id)
+        if grant == "refresh_token":
+            claims = self.verify_token(form.get("refresh_token", ""), "Refresh")
+            if not claims or claims.get("azp") != client_id:
+                return 400, {"error": "invalid_grant", "error_description": "Invalid refresh token"}, None
+            self.sessions[claims["sid"]] = time.time() + REFRESH_LIFETIME
+            return self._token_response(realm, claims["sub"], claims["preferred_username"],
+                                        claims["realm_access"]["roles"], client_id, claims["sid"])
+        return 400, {"error": "unsupported_grant_type"}, None
+
+    # ---- Admin API: usuarios ---------------------------------------------
+    def _location(self, kind, resource_id):
+        return {"Location": f"{self.url}/admin/realms/{self.realm.name}/{kind}/{resource_id}"}
+
+    def _handle_users(self, method, rest, args, body, auth):
+        realm = self.realm
+        if not rest:
+            if method == "POST":
+                return self._create_user(body or {}, auth)
+            if method == "GET":
+                users = _page(realm.find_users(args), args)
+                if args.get("briefRepresentation") == "true":
+                    return 200, [_brief(u) for u in users], None
+                return 200, users, None
+            return 405, {"error": "Method not allowed"}, None
+        if rest == ["count"]:
+            filters = {k: v for k, v in args.items() if k not in ("first", "max", "briefRepresentation")}
+            if not filters:
+                return 200, len(realm.users), None
+            return 200, sum(1 for _ in realm.find_users(filters)), None
+
+        user_id, sub = rest[0], rest[1:]
+        user = realm.users.get(user_id)
+        if user is None:
+            return 404, {"error": "User not found"}, None
+        path = f"users/{user_id}"
+        if sub == ["reset-password"] and method == "PUT":
+            realm.passwords[user_id] = (body or {}).get("value") or realm.password
+            realm.admin_event("ACTION", "USER", f"{path}/reset-password", auth)
+            return 204, None, None
+        if sub[:1] == ["groups"]:
+            return self._user_groups(method, user_id, sub[1:], auth)
+        if sub:
+            return 404, {"error": "Not found"}, None
+        if method == "GET":
+            return 200, user, None
+        if method == "PUT":
+            changes = dict(body or {})
+            changes.pop("id", None)
+            changes.pop("credentials", None)
+            new_username = (changes.get("username") or user["username"]).lower()
+            if new_username != user["username"] and new_username in realm.by_username:
+                return 409, {"errorMessage": "User exists with same username"}, None
+            realm.update_user(user_id, changes)
+            realm.admin_event("UPDATE", "USER", path, auth, body)
+            return 204, None, None
+        if method == "DELETE":
+            realm.remove_user(user_id)
+            realm.admin_event("DELETE", "USER", path, auth)
+            return 204, None, None
+        return 405, {"error": "Method not allowed"}, None
+
+    def _create_user(self, body, auth):
+        realm = self.realm
+        username = (body.get("username") or "").lower()
+        if not username:
+            return 400, {"errorMessage": "User name is missing"}, None
+        if username in realm.by_username:
+            return 409, {"errorMessage": "User exists with same username"}, None
+        if body.get("email") and body["email"].lower() in realm.by_email:
+            return 409, {"errorMessage": "User exists with same email"}, None
+        user = {k: v for k, v in body.items() if k not in ("credentials", "groups", "realmRoles")}
+        user.update(id=str(uuid.uuid4()), username=username, createdTimestamp=int(time.time() * 1000))
+        user.setdefault("enabled", True)
+        user.setdefault("emailVerified", False)
+        realm.add_user(user, [f"default-roles-{realm.name}"] + list(body.get("realmRoles") or []))
+        for credential in body.get("credentials") or ():
+            if credential.get("type") == "password":
+                realm.passwords[user["id"]] = credential.get("value")
+        realm.admin_event("CREATE", "USER", f"users/{user['id']}", auth, body)
+        return 201, None, self._location("users", user["id"])
+
+    def _user_groups(self, method, user_id, rest, auth):
+        realm = self.realm
+        if not rest:
+            if method != "GET":
+                return 405, {"error": "Method not allowed"}, None
+            groups = sorted((realm.groups[g] for g in realm.user_groups.get(user_id, ())), key=lambda g: g["name"])
+            return 200, [{k: g[k] for k in ("id", "name", "path")} for g in groups], None
+        group_id = rest[0]
+        if group_id not in realm.groups:
+            return 404, {"error": "Group not found"}, None
+        path = f"users/{user_id}/groups/{group_id}"
+        if method == "PUT":
+            realm.join(user_id, group_id)
+            realm.admin_event("CREATE", "GROUP_MEMBERSHIP", path, auth, realm.groups[group_id])
+            return 204, None, None
+        if method == "DELETE":
+            realm.leave(user_id, group_id)
+            realm.admin_event("DELETE", "GROUP_MEMBERSHIP", path, auth, realm.groups[group_id])
+            return 204, None, None
+        return 405, {"error": "Method not allowed"}, None
+
+    # ---- Admin API: grupos -----------------------------------------------
+    def _handle_groups(self, method, rest, args, body, auth):
+        realm = self.realm
+        if not rest:
+            if method == "POST":
+                name = (body or {}).get("name")
+                if not name:
+                    return 400, {"errorMessage": "Group name is missing"}, None
+                if any(g["name"] == name for g in realm.groups.values()):
+                    return 409, {"errorMessage": f"Top level group named '{name}' already exists."}, None
+                group = realm.add_group({"name": name, "attributes": body.get("attributes")})
+                realm.admin_event("CREATE", "GROUP", f"groups/{group['id']}", auth, body)
+                return 201, None, self._location("groups", group["id"])
+            if method == "GET":
+                term = (args.get("search") or "").lower()
+                groups = sorted((g for g in realm.groups.values() if term in g["name"].lower()),
+                                key=lambda g: g["name"])
+                return 200, _page(groups, args), None
+            return 405, {"error": "Method not allowed"}, None
+        if rest == ["count"]:
+            return 200, {"count": len(realm.groups)}, None
+
+        group_id, sub = rest[0], rest[1:]
+        group = realm.groups.get(group_id)
+        if group is None:
+            return 404, {"error": "Could not find group by id"}, None
+        if sub == ["members"] and method == "GET":
+            members = sorted((realm.users[i] for i in realm.members[group_id]), key=lambda u: u["username"])
+            page = _page(members, args)
+            if args.get("briefRepresentation") == "true":
+                page = [_brief(u) for u in page]
+            return 200, page, None
+        if sub:
+            return 404, {"error": "Not found"}, None
+        path = f"groups/{group_id}"
+        if method == "GET":
+            return 200, group, None
+        if method == "PUT":
+            name = (body or {}).get("name") or group["name"]
+            group.update(name=name, path=f"/{name}", attributes=(body or {}).get("attributes", group["attributes"]))
+            realm.admin_event("UPDATE", "GROUP", path, auth, body)
+            return 204, None, None
+        if method == "DELETE":
+            realm.remove_group(group_id)
+            realm.admin_event("DELETE", "GROUP", path, auth)
+            return 204, None, None
+        return 405, {"error": "Method not allowed"}, None
+
+    # ---- Eventos ---------------------------------------------------------
+    def _admin_events(self, query, args):
+        operations = set(query.get("operationTypes", ()))
+        resources = set(query.get("resourceTypes", ()))
+        path = args.get("resourcePath")
+        events = (e for e in self.realm.admin_events
+                  if (not operations or e["operationType"] in operations)
+                  and (not resources or e["resourceType"] in resources)
+                  and (not path or e["resourcePath"].startswith(path.rstrip("*"))))
+        return _page(events, args)
+
+    def _events(self, query, args):
+        types = set(query.get("type", ()))
+        user = args.get("user")
+        client = args.get("client")
+        events = (e for e in self.realm.events
+                  if (not types or e["type"] in types) and (not user or e["userId"] == user)
+                  and (not client or e["clientId"] == client))
+        return _page(events, args)
+
+
+def _bearer(headers):
+    authorization = headers.get("Authorization") or ""
+    return authorization[7:] if authorization.startswith("Bearer ") else ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Emulador local de Keycloak con un realm sintético")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8089)
+    parser.add_argument("--realm", default="servicios_agroup")
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--owners", type=int, default=2_000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--jitter-ms", type=float, default=0.0)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    emulator = KeycloakEmulator(args.realm, args.users, args.owners, args.latency_ms, args.jitter_ms,
+                                host=args.host, port=args.port, seed=args.seed)
+    print(f"Keycloak emulado en {emulator.url} (realm {args.realm}, {args.users} alumnos, {args.owners} profesores, "
+          f"preparado en {time.perf_counter() - started:.1f}s)", flush=True)
+    try:
+        emulator.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+# keycloak_http.py
+# Cliente HTTP síncrono para las llamadas a Keycloak.
+#
+# Expone get/post/put/delete con la misma firma que requests, pero sobre una única
+# sesión con pool de conexiones keep-alive (sin un handshake TCP/TLS por llamada)
+# y registra la latencia de cada llamada por operación y estado en metrics y como
+# span de la traza de la petición en curso, a la que también propaga X-Request-ID;
+# admission la usa para adaptar sus límites.
+# Con KEYCLOAK_RECORD_FILE graba cada llamada y con KEYCLOAK_REPLAY_FILE responde
+# desde una grabación sin salir a la red (ver keycloak_recording). Todas las
+# llamadas tienen timeout y pasan por fault_injection cuando está activado.
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import HTTP_POOL_SIZE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT
+import admission
+import fault_injection
+import keycloak_recording
+import metrics
+import tracing
+
+
+class _InstrumentedSession(requests.Session):
+    """Sesión que mide cada petición; los errores de conexión se registran como 'error'."""
+
+    def request(self, method, url, *args, **kwargs):
+        request_id = tracing.request_id()
+        if request_id:
+            kwargs["headers"] = {**(kwargs.get("headers") or {}), tracing.REQUEST_ID_HEADER: request_id}
+        # Sin timeout, un Keycloak que no responde bloquearía el hilo indefinidamente
+        kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+        operation = metrics.upstream_operation(method, url)
+        fault = fault_injection.decide(operation)
+        start = time.perf_counter()
+        try:
+            response = self._inject(fault, method, url, kwargs) if fault else None
+            if response is None:
+                response = super().request(method, url, *args, **kwargs)
+            if fault and fault[2]:
+                time.sleep(fault[2])
+        except requests.RequestException as e:
+            elapsed = time.perf_counter() - start
+            metrics.observe_upstream(operation, "error", elapsed)
+            admission.observe_upstream(elapsed)
+            tracing.record(f"kc.{operation}", start, elapsed)
+            if keycloak_recording.recording() and e.request is not None:
+                keycloak_recording.record_upstream(request_id, method.upper(), url, e.request.body,
+                                                   e.request.headers.get("Content-Type"), None, None, None, elapsed)
+            raise
+        elapsed = time.perf_counter() - start
+        metrics.observe_upstream(operation, response.status_code, elapsed)
+        admission.observe_upstream(elapsed)
+        tracing.record(f"kc.{operation}", start, elapsed)
+        if keycloak_recording.recording():
+            sent = response.request
+            keycloak_recording.record_upstream(request_id, sent.method, sent.url, sent.body,
+                                               sent.headers.get("Content-Type"), response.status_code,
+                                               response.headers, response.text, elapsed)
+        return response
+
+    def _inject(self, fault, method, url, kwargs):
+        """Aplica un fallo de fault_injection; retorna la respuesta de error inyectada o None."""
+        delay, action, _, status = fault
+        timeout = fault_injection.read_timeout(kwargs.get("timeout"))
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise requests.ReadTimeout(f"Fallo inyectado: Keycloak no respondió en {timeout}s")
+        time.sleep(delay)
+        if action == "reset":
+            raise requests.ConnectionError("Fallo inyectado: conexión reiniciada por Keycloak")
+        if action != "error":
+            return None
+        response = requests.Response()
+        response.status_code = status
+        response.headers["Content-Type"] = "text/html"
+        response._content = fault_injection.error_body(status).encode("utf-8")
+        response.encoding = "utf-8"
+        response.url = url
+        response.request = self.prepare_request(requests.Request(method.upper(), url, headers=kwargs.get("headers")))
+        return response
+
+
+session = _InstrumentedSession()
+_adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+if keycloak_recording.replaying():
+    _replay_adapter = keycloak_recording.ReplayAdapter(keycloak_recording.replay())
+    session.mount("http://", _replay_adapter)
+    session.mount("https://", _replay_adapter)
+else:
+    session.mount("http://", _adapter)
+    session.mount("https://", _adapter)
+
+
+def get(url, **kwargs):
+    return session.get(url, **kwargs)
+
+
+def post(url, **kwargs):
+    return session.post(url, **kwargs)
+
+
+def put(url, **kwargs):
+    return session.put(url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return session.delete(url, **kwargs)
+
+
+def warm_connections(url, count, **kwargs):
+    """
+    Deja abiertas en el pool hasta count conexiones con el host de url haciendo count
+    GET concurrentes, para que las primeras peticiones no paguen el handshake.
+    Retorna cuántas llamadas no obtuvieron un 5xx.
+    """
+    with ThreadPoolExecutor(max_workers=count) as pool:
+        responses = list(pool.map(lambda _: get(url, **kwargs), range(count)))
+    return sum(1 for response in responses if response.status_code < 500)
+
+
+def _pool_usage():
+    """Conexiones en uso y libres por host en el pool de la sesión."""
+    usage = {}
+    for key in list(_adapter.poolmanager.pools.keys()):
+        pool = _adapter.poolmanager.pools.get(key)
+        if pool is None:
+            continue
+        queue = pool.pool
+        if queue is None:
+            continue
+        host = f"{pool.host}:{pool.port}"
+        # La cola del pool guarda las conexiones libres (o huecos vacíos) hasta maxsize
+        in_use = max(0, queue.maxsize - queue.qsize())
+        idle = sum(1 for conn in list(queue.queue) if conn is not None)
+        usage[(host, "in_use")] = usage.get((host, "in_use"), 0) + in_use
+        usage[(host, "idle")] = usage.get((host, "idle"), 0) + idle
+    return usage
+
+
+metrics.Gauge("keycloak_http_pool_connections",
+              "Conexiones del pool HTTP a Keycloak por host y estado",
+              ("host", "state"), _pool_usage)
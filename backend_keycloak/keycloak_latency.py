@@ -0,0 +1,317 @@
+# keycloak_latency.py
+# Perfil de latencia de los endpoints de Keycloak que usa el backend, para decidir
+# si conviene desplegarlo junto a Keycloak.
+#
+# Cada endpoint (discovery, token, introspect, userinfo, admin_users) se mide N
+# veces, separando las fases de cada llamada:
+#
+#   dns       resolución del nombre (getaddrinfo)
+#   connect   handshake TCP (aproxima un RTT de red)
+#   tls       handshake TLS (solo con https)
+#   ttfb      desde el envío de la petición hasta recibir las cabeceras
+#   total     suma de las fases más la lectura del cuerpo
+#
+# en dos modos: 'cold' abre una conexión nueva por llamada (resolución, TCP y TLS
+# incluidos) y 'pooled' reutiliza una conexión keep-alive, como hace la sesión de
+# keycloak_http. Los endpoints se miden concurrentemente, cada uno en su hilo.
+#
+# El informe da min/p50/p99 por fase en ms y, por endpoint, el RTT estimado (p50 de
+# connect), el tiempo de servidor estimado (p50 de ttfb en pooled menos el RTT) y
+# lo que ahorra el pool. Si el RTT pesa frente al tiempo de servidor, acercar el
+# backend a Keycloak reduce la latencia; si no, el cuello de botella es Keycloak.
+#
+# Uso: python keycloak_doctor.py --profile [-n 50] [--json perfil.json]
+
+import json
+import math
+import socket
+import ssl
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.client import HTTPConnection, HTTPException
+from urllib.parse import urlencode, urlsplit
+
+import requests
+
+ENDPOINTS = ("discovery", "token", "introspect", "userinfo", "admin_users")
+MODES = ("cold", "pooled")
+PHASES = ("dns", "connect", "tls", "ttfb", "total")
+FORM = "application/x-www-form-urlencoded"
+
+
+def percentile(sorted_values, pct):
+    """Percentil por el método nearest-rank sobre una lista ya ordenada."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def ssl_context(verify):
+    """Contexto TLS equivalente al parámetro verify de requests (bool o ruta a una CA)."""
+    if verify is False:
+        context = ssl.create_default_context()
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        return context
+    if isinstance(verify, str):
+        return ssl.create_default_context(cafile=verify)
+    return ssl.create_default_context()
+
+
+class _Connection:
+    """Conexión HTTP/1.1 que cronometra por separado cada fase de su apertura."""
+
+    def __init__(self, base_url, verify, timeout):
+        parts = urlsplit(base_url)
+        self.https = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.https else 80)
+        self.context = ssl_context(verify) if self.https else None
+        self.timeout = timeout
+        self.http = None
+
+    def open(self):
+        """Abre la conexión; retorna los segundos de dns, connect y tls."""
+        self.close()
+        start = time.perf_counter()
+        family, kind, proto, _, address = socket.getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM)[0]
+        resolved = time.perf_counter()
+        sock = socket.socket(family, kind, proto)
+        sock.settimeout(self.timeout)
+        # Como urllib3: sin Nagle, el cuerpo de un POST no espera al ACK de las cabeceras
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            sock.connect(address)
+            connected = time.perf_counter()
+            if self.https:
+                sock = self.context.wrap_socket(sock, server_hostname=self.host)
+        except OSError:
+            sock.close()
+            raise
+        done = time.perf_counter()
+        self.http = HTTPConnection(self.host, self.port, timeout=self.timeout)
+        self.http.sock = sock
+        return {"dns": resolved - start, "connect": connected - resolved,
+                "tls": done - connected if self.https else 0.0}
+
+    def request(self, method, path, body, headers):
+        """Envía una petición por la conexión abierta; retorna (estado, ttfb s, lectura s)."""
+        start = time.perf_counter()
+        self.http.request(method, path, body=body, headers=headers)
+        response = self.http.getresponse()
+        first_byte = time.perf_counter()
+        response.read()
+        if response.will_close:
+            self.close()
+        return response.status, first_byte - start, time.perf_counter() - first_byte
+
+    def close(self):
+        if self.http is not None:
+            self.http.close()
+            self.http = None
+
+
+class Profiler:
+    """
+    Mide los endpoints de Keycloak de un realm.
+
+    Las credenciales sirven para obtener, antes de medir, los tokens que necesitan
+    introspect, userinfo (token de usuario si se indican username y password; si no,
+    el de la cuenta de servicio con scope openid) y admin_users (token de admin-cli
+    en el realm master).
+    """
+
+    def __init__(self, base_url, realm, client_id, client_secret, admin_client_id, admin_username,
+                 admin_password, verify=True, timeout=5.0, username=None, password=None):
+        self.base_url = base_url.rstrip("/")
+        self.realm = realm
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.admin_client_id = admin_client_id
+        self.admin_username = admin_username
+        self.admin_password = admin_password
+        self.verify = verify
+        self.timeout = timeout
+        self.username = username
+        self.password = password
+        self.prefix = urlsplit(self.base_url).path
+        self.tokens = {}
+
+    def _token_url(self, realm):
+        return f"{self.base_url}/realms/{realm}/protocol/openid-connect/token"
+
+    def _fetch_token(self, realm, data):
+        try:
+            response = requests.post(self._token_url(realm), data=data, timeout=self.timeout, verify=self.verify)
+            if response.status_code == 200:
+                return response.json().get("access_token")
+        except (requests.RequestException, ValueError):
+            pass
+        return None
+
+    def prepare(self):
+        """Obtiene los tokens necesarios. Retorna los que no se pudieron obtener."""
+        client = {"client_id": self.client_id, "client_secret": self.client_secret}
+        self.tokens["client"] = self._fetch_token(self.realm, dict(client, grant_type="client_credentials",
+                                                                   scope="openid"))
+        if self.username and self.password:
+            self.tokens["user"] = self._fetch_token(self.realm, dict(client, grant_type="password", scope="openid",
+                                                                     username=self.username, password=self.password))
+        else:
+            self.tokens["user"] = self.tokens["client"]
+        self.tokens["admin"] = self._fetch_token("master", {
+            "grant_type": "password", "client_id": self.admin_client_id,
+            "username": self.admin_username, "password": self.admin_password})
+        return sorted(name for name, token in self.tokens.items() if not token)
+
+    def request_for(self, endpoint):
+        """(método, ruta, cuerpo, cabeceras) de la llamada que mide un endpoint, o None sin token."""
+        realm_path = f"{self.prefix}/realms/{self.realm}"
+        oidc = f"{realm_path}/protocol/openid-connect"
+        headers = {"Host": urlsplit(self.base_url).netloc, "Accept": "application/json"}
+        if endpoint == "discovery":
+            return "GET", f"{realm_path}/.well-known/openid-configuration", None, headers
+        if endpoint == "token":
+            body = urlencode({"grant_type": "client_credentials", "client_id": self.client_id,
+                              "client_secret": self.client_secret})
+            return "POST", f"{oidc}/token", body, dict(headers, **{"Content-Type": FORM})
+        token = self.tokens.get({"introspect": "client", "userinfo": "user", "admin_users": "admin"}[endpoint])
+        if not token:
+            return None
+        if endpoint == "introspect":
+            body = urlencode({"token": token, "client_id": self.client_id, "client_secret": self.client_secret})
+            return "POST", f"{oidc}/token/introspect", body, dict(headers, **{"Content-Type": FORM})
+        auth = dict(headers, Authorization=f"Bearer {token}")
+        if endpoint == "userinfo":
+            return "GET", f"{oidc}/userinfo", None, auth
+        return "GET", f"{self.prefix}/admin/realms/{self.realm}/users?first=0&max=20&briefRepresentation=true", None, auth
+
+    def measure(self, endpoint, mode, repeat):
+        """
+        Repite la llamada de un endpoint en un modo.
+
+        Returns:
+            dict: muestras por fase (s), estados obtenidos, errores y reconexiones
+        """
+        result = {"samples": {phase: [] for phase in PHASES}, "statuses": {}, "errors": [], "reconnects": 0}
+        request = self.request_for(endpoint)
+        if request is None:
+            result["errors"].append("sin token para medir este endpoint")
+            return result
+        method, path, body, headers = request
+        connection = _Connection(self.base_url, self.verify, self.timeout)
+        try:
+            for attempt in range(repeat):
+                try:
+                    if mode == "cold" or connection.http is None:
+                        opened = connection.open()
+                        result["reconnects"] += mode == "pooled" and attempt > 0
+                    else:
+                        opened = {"dns": 0.0, "connect": 0.0, "tls": 0.0}
+                    status, ttfb, body_time = connection.request(method, path, body, headers)
+                except (OSError, HTTPException) as e:
+                    connection.close()
+                    result["errors"].append(f"{type(e).__name__}: {e}")
+                    continue
+                if mode == "cold":
+                    connection.close()
+                samples = result["samples"]
+                for phase, seconds in opened.items():
+                    samples[phase].append(seconds)
+                samples["ttfb"].append(ttfb)
+                samples["total"].append(sum(opened.values()) + ttfb + body_time)
+                result["statuses"][str(status)] = result["statuses"].get(str(status), 0) + 1
+        finally:
+            connection.close()
+        return result
+
+    def run(self, repeat=20, endpoints=ENDPOINTS, concurrency=None):
+        """
+        Mide todos los endpoints en ambos modos, concurrentemente.
+
+        Returns:
+            dict: informe serializable a JSON (ver summarize)
+        """
+        missing = self.prepare()
+        jobs = [(endpoint, mode) for endpoint in endpoints for mode in MODES]
+        with ThreadPoolExecutor(max_workers=concurrency or len(jobs)) as pool:
+            futures = {job: pool.submit(self.measure, job[0], job[1], repeat) for job in jobs}
+            measured = {job: future.result() for job, future in futures.items()}
+        return summarize(self, repeat, endpoints, measured, missing)
+
+
+def _stats(values):
+    values = sorted(values)
+    return {"min_ms": round(values[0] * 1000, 3) if values else 0.0,
+            "p50_ms": round(percentile(values, 50) * 1000, 3),
+            "p99_ms": round(percentile(values, 99) * 1000, 3)}
+
+
+def summarize(profiler, repeat, endpoints, measured, missing_tokens):
+    """Informe con min/p50/p99 por endpoint, modo y fase, y estimaciones de RTT y servidor."""
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "base_url": profiler.base_url,
+        "realm": profiler.realm,
+        "host": socket.gethostname(),
+        "repeat": repeat,
+        "missing_tokens": missing_tokens,
+        "endpoints": {},
+    }
+    for endpoint in endpoints:
+        entry = {}
+        for mode in MODES:
+            result = measured[(endpoint, mode)]
+            entry[mode] = {
+                "phases": {phase: _stats(values) for phase, values in result["samples"].items()},
+                "statuses": result["statuses"],
+                "errors": len(result["errors"]),
+                "reconnects": result["reconnects"],
+            }
+            if result["errors"]:
+                entry[mode]["first_error"] = result["errors"][0]
+        cold, pooled = entry["cold"]["phases"], entry["pooled"]["phases"]
+        rtt = cold["connect"]["p50_ms"]
+        entry["estimate"] = {
+            "rtt_ms": rtt,
+            "server_ms": round(max(0.0, pooled["ttfb"]["p50_ms"] - rtt), 3),
+            "pool_saving_ms": round(cold["total"]["p50_ms"] - pooled["total"]["p50_ms"], 3),
+        }
+        report["endpoints"][endpoint] = entry
+    return report
+
+
+def format_report(report):
+    """Tabla legible del informe."""
+    lines = [f"Perfil de {report['base_url']} (realm {report['realm']}, {report['repeat']} llamadas por modo)"]
+    if report["missing_tokens"]:
+        lines.append(f"  ⚠️ No se obtuvieron los tokens: {', '.join(report['missing_tokens'])}")
+    lines.append(f"  {'endpoint':<12} {'modo':<7} " + " ".join(f"{phase + ' p50/p99':>17}" for phase in PHASES)
+                 + "  estados")
+    for endpoint, entry in report["endpoints"].items():
+        for mode in MODES:
+            data = entry[mode]
+            cells = " ".join(f"{data['phases'][p]['p50_ms']:>8.2f}/{data['phases'][p]['p99_ms']:<8.2f}"
+                             for p in PHASES)
+            statuses = ",".join(f"{code}x{count}" for code, count in sorted(data["statuses"].items()))
+            if data["errors"]:
+                statuses += f" errores={data['errors']}"
+            lines.append(f"  {endpoint:<12} {mode:<7} {cells}  {statuses}")
+    lines.append("")
+    lines.append(f"  {'endpoint':<12} {'RTT ms':>8} {'servidor ms':>12} {'ahorro pool ms':>15}")
+    for endpoint, entry in report["endpoints"].items():
+        estimate = entry["estimate"]
+        lines.append(f"  {endpoint:<12} {estimate['rtt_ms']:>8.2f} {estimate['server_ms']:>12.2f} "
+                     f"{estimate['pool_saving_ms']:>15.2f}")
+    return "\n".join(lines)
+
+
+def save_report(report, path):
+    """Escribe el informe en JSON ('-' para la salida estándar)."""
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if path == "-":
+        print(text)
+        return
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(text + "\n")
@@ -0,0 +1,314 @@
+# keycloak_recording.py
+# Grabación y reproducción del tráfico con Keycloak para pruebas de rendimiento
+# deterministas.
+#
+# Con KEYCLOAK_RECORD_FILE definido, cada llamada a Keycloak (keycloak_http y
+# keycloak_async) y cada petición recibida por la API se añaden como una línea JSON
+# al archivo (comprimido si termina en .gz), con su X-Request-ID, duración, estado
+# y cuerpo. Antes de escribir se eliminan los secretos: contraseñas y secretos de
+# cliente se reemplazan y los JWT pierden la firma, de modo que la grabación no
+# contiene credenciales utilizables pero la API puede seguir leyendo los claims.
+#
+# Con KEYCLOAK_REPLAY_FILE definido, las llamadas a Keycloak no salen a la red: se
+# responden con la grabación. Cada llamada se busca primero por (X-Request-ID,
+# método, ruta), de modo que al reenviar las peticiones grabadas con su ID cada
+# una recibe exactamente las respuestas que tuvo en producción, y si no, por
+# (método, ruta) en orden de grabación. KEYCLOAK_REPLAY_LATENCY escala la latencia
+# original (0 responde de inmediato, 1 la reproduce tal cual).
+#
+# Con varios workers, incluya {pid} en KEYCLOAK_RECORD_FILE para que cada proceso
+# escriba su propio archivo; KEYCLOAK_REPLAY_FILE acepta un patrón glob.
+#
+# bench/replay_traffic.py reenvía las peticiones grabadas a una versión nueva de
+# la API y compara latencias y estados.
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+
+from config import KEYCLOAK_RECORD_FILE, KEYCLOAK_REPLAY_FILE, KEYCLOAK_REPLAY_LATENCY
+import tracing
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+# Campos cuyo valor nunca se graba
+SECRET_FIELDS = {"password", "client_secret", "secret", "credentials", "totp"}
+# Campos con tokens: se graban sin la firma
+TOKEN_FIELDS = {"token", "access_token", "refresh_token", "id_token"}
+SCRUBBED = "***"
+# Cabeceras de respuesta que se conservan
+KEPT_HEADERS = ("Content-Type", "Location")
+
+_file_lock = threading.Lock()
+_file = {"pid": None, "handle": None}
+
+
+def recording():
+    return bool(KEYCLOAK_RECORD_FILE)
+
+
+def replaying():
+    return bool(KEYCLOAK_REPLAY_FILE)
+
+
+# ----------------------------------------------------------------------
+# Limpieza de secretos
+# ----------------------------------------------------------------------
+def strip_signature(token):
+    """Retorna el JWT sin firma; otros valores se reemplazan por completo."""
+    if isinstance(token, str) and token.count(".") == 2:
+        header, payload, _ = token.split(".")
+        return f"{header}.{payload}.scrubbed"
+    return SCRUBBED
+
+
+def scrub(value):
+    """Copia de un cuerpo JSON o de formulario sin contraseñas, secretos ni firmas de tokens."""
+    if isinstance(value, dict):
+        clean = {}
+        for key, item in value.items():
+            lowered = str(key).lower()
+            if lowered in SECRET_FIELDS:
+                clean[key] = SCRUBBED
+            elif lowered in TOKEN_FIELDS:
+                clean[key] = strip_signature(item)
+            elif lowered == "value" and value.get("type") == "password":
+                # Cuerpo de reset-password
+                clean[key] = SCRUBBED
+            else:
+                clean[key] = scrub(item)
+        return clean
+    if isinstance(value, list):
+        return [scrub(item) for item in value]
+    return value
+
+
+def scrub_body(body, content_type):
+    """
+    Decodifica y limpia un cuerpo HTTP (bytes o str).
+
+    Returns:
+        dict, list, str o None: JSON o formulario decodificado; texto si no se reconoce
+    """
+    if not body:
+        return None
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", errors="replace")
+    content_type = (content_type or "").lower()
+    if "json" in content_type or body[:1] in ("{", "["):
+        try:
+            return scrub(json.loads(body))
+        except ValueError:
+            pass
+    if "x-www-form-urlencoded" in content_type or ("=" in body and " " not in body):
+        return scrub(dict(parse_qsl(body, keep_blank_values=True)))
+    return body
+
+
+def _relative(url):
+    """Ruta y query de una URL, sin esquema ni host (la grabación no depende del servidor)."""
+    parts = urlsplit(url)
+    return parts.path + (f"?{parts.query}" if parts.query else "")
+
+
+# ----------------------------------------------------------------------
+# Grabación
+# ----------------------------------------------------------------------
+def record_upstream(request_id, method, url, body, content_type, status, headers, text, elapsed):
+    """Graba una llamada a Keycloak. status None indica un error de conexión."""
+    if not KEYCLOAK_RECORD_FILE:
+        return
+    response_type = headers.get("Content-Type", "") if headers else ""
+    entry = {
+        "kind": "kc", "rid": request_id, "method": method, "path": _relative(url),
+        "body": scrub_body(body, content_type), "status": status, "elapsed": round(elapsed, 6),
+        "headers": {name: headers[name] for name in KEPT_HEADERS if headers and name in headers},
+        "response": scrub_body(text, response_type) if "json" in response_type.lower() else text,
+    }
+    _write(entry)
+
+
+def record_api(request_id, method, path, route, body, form, token, status, elapsed):
+    """
+    Graba una petición recibida por la API: body ya decodificado (formulario si form
+    es True, JSON en otro caso) y token de la cookie de sesión.
+    """
+    if not KEYCLOAK_RECORD_FILE:
+        return
+    _write({
+        "kind": "api", "rid": request_id, "method": method, "path": path, "route": route,
+        "body": scrub(body), "form": form, "token": strip_signature(token) if token else None,
+        "status": status, "elapsed": round(elapsed, 6),
+    })
+
+
+def _path():
+    return KEYCLOAK_RECORD_FILE.replace("{pid}", str(os.getpid()))
+
+
+def _write(entry):
+    with _file_lock:
+        if _file["pid"] != os.getpid():
+            # Cada proceso abre su propio handle (y su miembro gzip) tras un fork
+            path = _path()
+            # gzip solo se importa si se graba: la grabación es una herramienta de diagnóstico
+            import gzip
+            try:
+                opener = gzip.open if path.endswith(".gz") else open
+                _file["handle"] = opener(path, "at", encoding="utf-8")
+                _file["handle"].write(json.dumps({"kind": "meta", "version": FORMAT_VERSION, "pid": os.getpid(),
+                                                  "started": time.time()}) + "\n")
+            except OSError as e:
+                logger.error("[keycloak_recording] No se pudo abrir %s: %s", path, e)
+                _file["handle"] = None
+            _file["pid"] = os.getpid()
+        handle = _file["handle"]
+        if handle is None:
+            return
+        # Hora absoluta: las grabaciones de varios workers se pueden intercalar al cargarlas
+        entry["t"] = round(time.time(), 6)
+        handle.write(json.dumps(entry, separators=(",", ":"), ensure_ascii=False) + "\n")
+        # flush en gzip hace un sync flush: lo escrito se puede leer aunque el proceso muera
+        handle.flush()
+
+
+def load(pattern):
+    """
+    Lee las entradas de uno o varios archivos de grabación (patrón glob), en orden de tiempo.
+    Un archivo .gz cortado (proceso terminado sin cerrar) se lee hasta donde llegó.
+    """
+    import glob
+    import gzip
+    entries = []
+    for path in sorted(glob.glob(pattern)) or [pattern]:
+        opener = gzip.open if path.endswith(".gz") else open
+        with opener(path, "rt", encoding="utf-8") as f:
+            try:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        entry = json.loads(line)
+                        if entry.get("kind") != "meta":
+                            entries.append(entry)
+            except (EOFError, json.JSONDecodeError):
+                pass
+    entries.sort(key=lambda entry: entry.get("t", 0))
+    return entries
+
+
+# ----------------------------------------------------------------------
+# Reproducción
+# ----------------------------------------------------------------------
+class Replay:
+    """Respuestas grabadas de Keycloak indexadas por petición de la API y por ruta."""
+
+    def __init__(self, pattern, latency_scale=1.0):
+        self.latency_scale = latency_scale
+        self.lock = threading.Lock()
+        self.by_request = {}
+        self.by_path = {}
+        self.cursors = {}
+        self.misses = 0
+        for entry in load(pattern):
+            if entry.get("kind") != "kc":
+                continue
+            key = (entry["method"], entry["path"])
+            self.by_path.setdefault(key, []).append(entry)
+            if entry.get("rid"):
+                self.by_request.setdefault((entry["rid"],) + key, deque()).append(entry)
+        logger.info("[replay] %s respuestas de Keycloak cargadas desde %s",
+                    sum(len(v) for v in self.by_path.values()), pattern)
+
+    def match(self, request_id, method, url):
+        """Entrada grabada para una llamada, o None si no hay ninguna para esa ruta."""
+        key = (method, _relative(url))
+        with self.lock:
+            queue = self.by_request.get((request_id,) + key) if request_id else None
+            if queue:
+                return queue.popleft()
+            candidates = self.by_path.get(key)
+            if not candidates:
+                self.misses += 1
+                logger.warning("[replay] Llamada sin grabación: %s %s", method, key[1])
+                return None
+            # Sin ID coincidente se reparten las respuestas de esa ruta en orden, cíclicamente
+            index = self.cursors.get(key, 0)
+            self.cursors[key] = index + 1
+            return candidates[index % len(candidates)]
+
+    def delay(self, entry):
+        return entry["elapsed"] * self.latency_scale if entry else 0.0
+
+
+def response_parts(entry):
+    """(status, cabeceras, cuerpo en bytes) de una entrada; 502 si no hay grabación."""
+    if entry is None:
+        return 502, {"Content-Type": "application/json"}, b'{"error": "not recorded"}'
+    if entry["status"] is None:
+        return None, {}, b""
+    body = entry.get("response")
+    if body is not None and not isinstance(body, str):
+        body = json.dumps(body)
+    return entry["status"], dict(entry.get("headers") or {}), (body or "").encode("utf-8")
+
+
+class ReplayAdapter(BaseAdapter):
+    """Adaptador de requests que responde con la grabación en lugar de abrir conexiones."""
+
+    def __init__(self, replay):
+        super().__init__()
+        self.replay = replay
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        entry = self.replay.match(request.headers.get(tracing.REQUEST_ID_HEADER), request.method, request.url)
+        delay = self.replay.delay(entry)
+        if delay:
+            time.sleep(delay)
+        status, headers, body = response_parts(entry)
+        if status is None:
+            raise requests.ConnectionError("Error de conexión grabado", request=request)
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict(headers)
+        response._content = body
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        response.reason = "Replayed"
+        return response
+
+    def close(self):
+        pass
+
+
+_replay = {"instance": None}
+_replay_lock = threading.Lock()
+
+
+def replay():
+    """Replay compartido del proceso (se carga una vez, al primer uso)."""
+    with _replay_lock:
+        if _replay["instance"] is None:
+            _replay["instance"] = Replay(KEYCLOAK_REPLAY_FILE, KEYCLOAK_REPLAY_LATENCY)
+        return _replay["instance"]
+
+
+def _after_fork_in_child():
+    global _file_lock, _replay_lock
+    _file_lock = threading.Lock()
+    _replay_lock = threading.Lock()
+    instance = _replay["instance"]
+    if instance is not None:
+        instance.lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,147 @@
+# log_config.py
+# Configuración del logging de la API.
+#
+# - Los hilos de las peticiones solo crean el LogRecord y lo encolan; el formateo,
+#   la redacción de secretos y la escritura se hacen en el hilo de un QueueListener.
+# - Nivel global con LOG_LEVEL y por módulo con LOG_LEVEL_<MÓDULO>, p. ej.
+#   LOG_LEVEL_ROUTES=DEBUG o LOG_LEVEL_AUTH=WARNING.
+# - LOG_DEBUG_SAMPLE=N deja pasar uno de cada N mensajes DEBUG de cada línea de
+#   código, para poder activar DEBUG en producción sin inundar el log.
+# - Contraseñas, secretos de cliente y tokens se reemplazan por '***'.
+#
+# Los mensajes deben usar formato diferido: logger.debug("[x] valor: %s", valor).
+
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import threading
+
+from config import LOG_LEVEL, LOG_DEBUG_SAMPLE
+
+_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+_LEVEL_PREFIX = "LOG_LEVEL_"
+
+_SECRET_KEYS = r"password|client_secret|secret|access_token|refresh_token|id_token|token|totp|value"
+_REDACTIONS = (
+    # Diccionarios, JSON y repr: 'password': 'x' / "token": "x"
+    (re.compile(r"""(['"](?:%s)['"]\s*:\s*)(['"])(?:(?!\2).)*\2""" % _SECRET_KEYS, re.IGNORECASE),
+     r"\1\2***\2"),
+    # Pares de MultiDict y tuplas: ('password', 'x')
+    (re.compile(r"""(\(\s*['"](?:%s)['"]\s*,\s*)(['"])(?:(?!\2).)*\2""" % _SECRET_KEYS, re.IGNORECASE),
+     r"\1\2***\2"),
+    # Formularios y URLs: password=x&...
+    (re.compile(r"\b((?:%s)=)[^&\s,'\"]+" % _SECRET_KEYS, re.IGNORECASE), r"\1***"),
+    (re.compile(r"\b(Bearer\s+)[\w\-.~+/]+=*", re.IGNORECASE), r"\1***"),
+    # JWT sueltos
+    (re.compile(r"\beyJ[\w-]+\.[\w-]+\.[\w-]*"), "eyJ***"),
+)
+
+_lock = threading.Lock()
+_listener = None
+_stream = None
+
+
+def redact(text):
+    """Reemplaza credenciales y tokens presentes en un texto."""
+    for pattern, replacement in _REDACTIONS:
+        text = pattern.sub(replacement, text)
+    return text
+
+
+class RedactingFormatter(logging.Formatter):
+    """Formatea el registro y elimina los secretos del texto resultante."""
+
+    def format(self, record):
+        return redact(super().format(record))
+
+
+class DebugSampler(logging.Filter):
+    """Deja pasar uno de cada N registros DEBUG por línea de código."""
+
+    def __init__(self, every):
+        super().__init__()
+        self.every = max(1, every)
+        self._counts = {}
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.every == 1:
+            return True
+        site = (record.pathname, record.lineno)
+        # Sin lock: un conteo perdido por una carrera solo altera el muestreo
+        count = self._counts.get(site, 0)
+        self._counts[site] = count + 1
+        return count % self.every == 0
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler que no formatea en el hilo que registra: la cola es del mismo
+    proceso, así que el registro se pasa intacto y el listener lo formatea.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+def _module_levels(environ=os.environ):
+    levels = {}
+    for name, value in environ.items():
+        if name.startswith(_LEVEL_PREFIX) and value:
+            levels[name[len(_LEVEL_PREFIX):].lower()] = value.upper()
+    return levels
+
+
+def configure(stream=None):
+    """
+    Configura el logging del proceso (solo la primera llamada tiene efecto).
+
+    Args:
+        stream: Destino de los mensajes; por defecto stderr
+    """
+    global _listener, _stream
+    with _lock:
+        if _listener is not None:
+            return
+        _stream = stream
+        output = logging.StreamHandler(stream)
+        output.setFormatter(RedactingFormatter(_FORMAT))
+
+        log_queue = queue.SimpleQueue()
+        handler = _DeferredQueueHandler(log_queue)
+        handler.addFilter(DebugSampler(LOG_DEBUG_SAMPLE))
+
+        root = logging.getLogger()
+        for existing in list(root.handlers):
+            root.removeHandler(existing)
+        root.addHandler(handler)
+        root.setLevel(LOG_LEVEL.upper())
+        for module, level in _module_levels().items():
+            logging.getLogger(module).setLevel(level)
+
+        _listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown)
+
+
+def shutdown():
+    """Vacía la cola y detiene el hilo de escritura."""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
+            _listener = None
+
+
+def _after_fork_in_child():
+    # El hilo del listener no existe en el hijo: se crea una cola y un listener nuevos
+    global _listener, _lock
+    _lock = threading.Lock()
+    if _listener is not None:
+        _listener = None
+        configure(_stream)
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,289 @@
+# memory_guard.py
+# Diagnóstico de memoria y presupuesto blando para las cachés en memoria.
+#
+# Cada caché del proceso se registra con register_cache(nombre, stats, evict):
+#   stats()         -> (nº de entradas, bytes estimados)
+#   evict(fracción) -> nº de entradas descartadas (None si la caché no se puede vaciar)
+#
+# Con MEMORY_BUDGET_MB > 0, cada MEMORY_CHECK_INTERVAL segundos se compara la
+# memoria residente del proceso con el presupuesto y, si lo supera, se descarta
+# una fracción de cada caché (las entradas menos usadas primero). Es un límite
+# blando: CPython no siempre devuelve la memoria liberada al sistema, pero evita
+# que las cachés sigan creciendo en un proceso de larga duración.
+#
+# tracemalloc se activa bajo demanda (start_tracing) porque añade coste a cada
+# reserva de memoria; report() compara con la instantánea de referencia para
+# encontrar las líneas que más memoria retienen (cachés, respuestas grandes...).
+
+import gc
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+from config import MEMORY_BUDGET_MB, MEMORY_CHECK_INTERVAL, MEMORY_EVICT_FRACTION
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Entradas que se miden al estimar el tamaño de una colección grande
+_SIZE_SAMPLE = 64
+# Profundidad máxima al recorrer objetos anidados
+_MAX_DEPTH = 8
+
+_lock = threading.Lock()
+# nombre -> (stats, evict)
+_caches = {}
+_state = {"checking": False, "checked_at": 0, "baseline": None, "evictions": 0, "last_eviction": None}
+
+evictions = metrics.Counter(
+    "memory_cache_evictions_total", "Entradas descartadas por superar el presupuesto de memoria",
+    ("cache",))
+
+
+def register_cache(name, stats, evict=None):
+    """Registra una caché para el diagnóstico y, si tiene evict, para el presupuesto."""
+    with _lock:
+        _caches[name] = (stats, evict)
+
+
+# ----------------------------------------------------------------------
+# Tamaños
+# ----------------------------------------------------------------------
+def deep_sizeof(obj, _seen=None, _depth=0):
+    """Bytes ocupados por un objeto y lo que contiene (sin contar objetos compartidos dos veces)."""
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen or _depth > _MAX_DEPTH:
+        return 0
+    _seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (str, bytes, int, float, bool)) or obj is None:
+        return size
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_sizeof(key, _seen, _depth + 1) + deep_sizeof(value, _seen, _depth + 1)
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        for item in obj:
+            size += deep_sizeof(item, _seen, _depth + 1)
+    else:
+        for name in getattr(type(obj), "__slots__", ()):
+            size += deep_sizeof(getattr(obj, name, None), _seen, _depth + 1)
+        if hasattr(obj, "__dict__"):
+            size += deep_sizeof(vars(obj), _seen, _depth + 1)
+    return size
+
+
+def estimate_size(collection):
+    """
+    Estima el tamaño de un diccionario o secuencia midiendo como mucho _SIZE_SAMPLE
+    entradas y extrapolando al resto.
+    """
+    count = len(collection)
+    if count == 0:
+        return sys.getsizeof(collection)
+    items = collection.items() if isinstance(collection, dict) else collection
+    sample = list(itertools.islice(items, _SIZE_SAMPLE))
+    seen = set()
+    sampled = sum(deep_sizeof(item, seen) for item in sample)
+    return sys.getsizeof(collection) + sampled * count // len(sample)
+
+
+def resident_bytes():
+    """Memoria residente actual del proceso, o None si no se puede leer."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+        # ru_maxrss es el máximo, no el actual (KB en Linux, bytes en macOS)
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+    except (ImportError, OSError):
+        return None
+
+
+def cache_report():
+    """Entradas y tamaño estimado de cada caché registrada."""
+    with _lock:
+        caches = list(_caches.items())
+    report = []
+    for name, (stats, evict) in sorted(caches):
+        try:
+            entries, size = stats()
+        except Exception as e:
+            logger.error("[memory_guard] Error midiendo la caché %s: %s", name, e)
+            continue
+        report.append({"name": name, "entries": entries, "estimated_bytes": size, "evictable": evict is not None})
+    return report
+
+
+# ----------------------------------------------------------------------
+# Presupuesto
+# ----------------------------------------------------------------------
+def enforce_budget(force=False):
+    """
+    Descarta una fracción de cada caché si el proceso supera MEMORY_BUDGET_MB.
+
+    Args:
+        force (bool): Descartar aunque no se supere el presupuesto
+
+    Returns:
+        dict: Entradas descartadas por caché (vacío si no hizo falta)
+    """
+    rss = resident_bytes()
+    over_budget = MEMORY_BUDGET_MB > 0 and rss is not None and rss > MEMORY_BUDGET_MB * 1024 * 1024
+    if not (force or over_budget):
+        return {}
+
+    with _lock:
+        caches = list(_caches.items())
+    evicted = {}
+    for name, (stats, evict) in caches:
+        if evict is None:
+            continue
+        try:
+            count = evict(MEMORY_EVICT_FRACTION)
+        except Exception as e:
+            logger.error("[memory_guard] Error vaciando la caché %s: %s", name, e)
+            continue
+        if count:
+            evicted[name] = count
+            evictions.inc(name, amount=count)
+    gc.collect()
+    _state["evictions"] += 1
+    _state["last_eviction"] = {"at": time.time(), "rss_before": rss, "rss_after": resident_bytes(), "evicted": evicted}
+    logger.warning("[memory_guard] Memoria residente %s MB (presupuesto %s MB), entradas descartadas: %s",
+                   (rss or 0) // (1024 * 1024), MEMORY_BUDGET_MB, evicted)
+    return evicted
+
+
+def _check_in_background():
+    try:
+        enforce_budget()
+    finally:
+        with _lock:
+            _state["checking"] = False
+
+
+def ensure_checked():
+    """Lanza en segundo plano la comprobación del presupuesto si toca (una vez por intervalo)."""
+    if MEMORY_BUDGET_MB <= 0:
+        return
+    now = time.monotonic()
+    if now - _state["checked_at"] < MEMORY_CHECK_INTERVAL:
+        return
+    with _lock:
+        if _state["checking"] or now - _state["checked_at"] < MEMORY_CHECK_INTERVAL:
+            return
+        _state["checking"] = True
+        _state["checked_at"] = now
+    threading.Thread(target=_check_in_background, daemon=True).start()
+
+
+# ----------------------------------------------------------------------
+# tracemalloc
+# ----------------------------------------------------------------------
+def start_tracing(frames=10):
+    """Activa tracemalloc y toma la instantánea de referencia."""
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    _state["baseline"] = tracemalloc.take_snapshot()
+
+
+def stop_tracing():
+    """Desactiva tracemalloc y libera sus estructuras."""
+    _state["baseline"] = None
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def reset_baseline():
+    """Reemplaza la instantánea de referencia por una nueva."""
+    if tracemalloc.is_tracing():
+        _state["baseline"] = tracemalloc.take_snapshot()
+
+
+def _filtered(snapshot):
+    return snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    ))
+
+
+def top_allocations(limit=20, group_by="lineno", diff=False):
+    """
+    Lugares que más memoria retienen según tracemalloc.
+
+    Args:
+        limit (int): Número de entradas
+        group_by (str): 'lineno', 'filename' o 'traceback'
+        diff (bool): Comparar con la instantánea de referencia en lugar de totales
+
+    Returns:
+        list: Entradas ordenadas por tamaño, o None si tracemalloc no está activo
+    """
+    if not tracemalloc.is_tracing():
+        return None
+    snapshot = _filtered(tracemalloc.take_snapshot())
+    baseline = _state["baseline"]
+    if diff and baseline is not None:
+        stats = snapshot.compare_to(_filtered(baseline), group_by)
+        return [{
+            "where": _location(stat.traceback, group_by),
+            "size": stat.size,
+            "size_diff": stat.size_diff,
+            "count": stat.count,
+            "count_diff": stat.count_diff,
+        } for stat in stats[:limit]]
+    return [{
+        "where": _location(stat.traceback, group_by),
+        "size": stat.size,
+        "count": stat.count,
+    } for stat in snapshot.statistics(group_by)[:limit]]
+
+
+def _location(traceback, group_by):
+    if group_by == "traceback":
+        return [f"{frame.filename}:{frame.lineno}" for frame in traceback]
+    frame = traceback[0]
+    return frame.filename if group_by == "filename" else f"{frame.filename}:{frame.lineno}"
+
+
+def report(limit=20, group_by="lineno", diff=False):
+    """Estado completo para el endpoint de diagnóstico."""
+    traced = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else None
+    return {
+        "resident_bytes": resident_bytes(),
+        "budget_bytes": MEMORY_BUDGET_MB * 1024 * 1024 if MEMORY_BUDGET_MB > 0 else None,
+        "evictions": _state["evictions"],
+        "last_eviction": _state["last_eviction"],
+        "caches": cache_report(),
+        "tracemalloc": {
+            "tracing": traced is not None,
+            "traced_bytes": traced[0] if traced else None,
+            "peak_bytes": traced[1] if traced else None,
+            "has_baseline": _state["baseline"] is not None,
+        },
+        "top": top_allocations(limit, group_by, diff),
+    }
+
+
+def _after_fork_in_child():
+    global _lock
+    _lock = threading.Lock()
+    _state.update(checking=False, checked_at=0)
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+metrics.Gauge("process_resident_memory_bytes", "Memoria residente del proceso", (),
+              lambda: {(): resident_bytes() or 0})
@@ -0,0 +1,233 @@
+# metrics.py
+# Métricas en formato de texto de Prometheus para /metrics.
+#
+# Para que instrumentar cueste poco, cada hilo escribe en su propio "shard" (un
+# diccionario que solo ese hilo modifica), así que incrementar un contador o
+# registrar una latencia no toma ningún lock. Al exportar se suman los shards; los
+# de hilos que ya terminaron se acumulan en un shard retirado para que la memoria
+# no crezca con servidores que crean un hilo por petición. Lo mismo se hace al
+# crear un shard cuando la lista dobla a la de la última limpieza, de modo que la
+# memoria queda acotada aunque nadie consulte /metrics. Los histogramas usan
+# buckets fijos definidos al crearlos.
+#
+# Cada worker expone sus propias métricas; Prometheus las agrega por instancia.
+
+import bisect
+import threading
+
+# Buckets de latencia en segundos
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Shards a partir de los cuales crear uno nuevo retira antes los de hilos terminados
+_MIN_RETIRE_AT = 64
+
+_registry_lock = threading.Lock()
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        # (hilo, shard) de los hilos que han escrito alguna vez
+        self._shards = []
+        self._retired = {}
+        self._retire_at = _MIN_RETIRE_AT
+        with _registry_lock:
+            _registry.append(self)
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with _registry_lock:
+                if len(self._shards) >= self._retire_at:
+                    self._retire_dead()
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def _merge(self, target, labels, cell):
+        raise NotImplementedError
+
+    def _retire_dead(self):
+        """Fusiona en el shard retirado los de hilos terminados (con _registry_lock tomado)."""
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                # El hilo ya no escribe: su shard se puede fusionar sin carreras
+                for labels, cell in shard.items():
+                    self._merge(self._retired, labels, cell)
+        self._shards = alive
+        # Con muchos hilos vivos no se repite la limpieza en cada shard nuevo
+        self._retire_at = max(_MIN_RETIRE_AT, 2 * len(alive))
+
+    def _collect(self):
+        """Suma los shards y retira los de hilos terminados."""
+        with _registry_lock:
+            self._retire_dead()
+            totals = {}
+            for labels, cell in self._retired.items():
+                self._merge(totals, labels, cell)
+            for _, shard in self._shards:
+                for labels, cell in list(shard.items()):
+                    self._merge(totals, labels, cell)
+        return totals
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples(self._collect()))
+        return lines
+
+
+class Counter(_Metric):
+    """Contador monótono con etiquetas."""
+
+    kind = "counter"
+
+    def inc(self, *labels, amount=1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def _merge(self, target, labels, cell):
+        target[labels] = target.get(labels, 0) + cell
+
+    def _samples(self, totals):
+        for labels, value in sorted(totals.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+
+
+class Histogram(_Metric):
+    """Histograma con buckets fijos (límites superiores inclusivos)."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labels):
+        shard = self._shard()
+        cell = shard.get(labels)
+        if cell is None:
+            # Un contador por bucket, +Inf, suma y número de observaciones
+            cell = shard[labels] = [0] * (len(self.buckets) + 3)
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-2] += value
+        cell[-1] += 1
+
+    def _merge(self, target, labels, cell):
+        current = target.get(labels)
+        if current is None:
+            target[labels] = list(cell)
+        else:
+            for i, value in enumerate(cell):
+                current[i] += value
+
+    def _samples(self, totals):
+        for labels, cell in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), cell):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {cell[-2]}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {cell[-1]}"
+
+
+class Gauge:
+    """Valor calculado en el momento de exportar: callback() retorna {etiquetas: valor}."""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, labelnames, callback):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.callback = callback
+        with _registry_lock:
+            _registry.append(self)
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        try:
+            values = self.callback()
+        except Exception:
+            values = {}
+        for labels, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+def render():
+    """Retorna todas las métricas registradas en formato de texto de Prometheus."""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# ----------------------------------------------------------------------
+# Métricas de la API
+# ----------------------------------------------------------------------
+http_requests = Counter(
+    "http_requests_total", "Peticiones atendidas por ruta, método y código de estado",
+    ("route", "method", "status"))
+http_request_duration = Histogram(
+    "http_request_duration_seconds", "Latencia de las peticiones por ruta y método",
+    ("route", "method"))
+upstream_duration = Histogram(
+    "keycloak_request_duration_seconds", "Latencia de las llamadas a Keycloak por operación y estado",
+    ("operation", "status"))
+admin_token_refreshes = Counter(
+    "keycloak_admin_token_refresh_total", "Solicitudes de un token administrativo nuevo",
+    ("result",))
+cache_requests = Counter(
+    "cache_requests_total", "Consultas a cachés por caché y resultado (hit/miss)",
+    ("cache", "result"))
+
+
+def observe_upstream(operation, status, seconds):
+    upstream_duration.observe(seconds, operation, str(status))
+
+
+def upstream_operation(method, url):
+    """Clasifica una llamada a Keycloak en una operación con cardinalidad acotada."""
+    path = url.split("?", 1)[0]
+    if path.endswith("/token/introspect"):
+        return "introspect"
+    if path.endswith("/openid-connect/token"):
+        return "token"
+    if path.endswith("/userinfo"):
+        return "userinfo"
+    if path.endswith("/openid-configuration"):
+        return "oidc_discovery"
+    if path.endswith("/protocol/openid-connect/certs"):
+        return "jwks"
+    if "/admin/realms/" in path and "/users" in path:
+        if path.endswith("/users/count"):
+            return "admin_users_count"
+        if path.endswith("/reset-password"):
+            return "admin_users_reset_password"
+        return f"admin_users_{method.lower()}"
+    return "other"
@@ -0,0 +1,726 @@
+# mutation_queue.py
+# Cola de escritura diferida (write-behind) para las ediciones de usuarios mientras
+# Keycloak no está disponible (MUTATION_QUEUE).
+#
+# Durante un mantenimiento de Keycloak, las altas (POST /api/users) y ediciones
+# (PUT /api/users/<id>, PUT /api/user-profile) respondían 500 y se perdían. Con la
+# cola activa, una mutación que no puede llegar a Keycloak se guarda en un diario
+# local y se responde 202 con el identificador de la operación:
+#
+#   - Keycloak marcado como caído: se encola sin llamarlo, de modo que la latencia
+#     de la edición no depende de su disponibilidad (sin esperar timeouts).
+#   - El usuario tiene operaciones anteriores sin resolver: se encola detrás de
+#     ellas para respetar el orden por usuario.
+#   - Fallo de Keycloak a mitad de la petición (sin token administrativo, timeout,
+#     conexión, 5xx): se encola y Keycloak se marca como caído.
+#
+# El diario es una base de datos SQLite en WAL (MUTATION_QUEUE_PATH) compartida por
+# los workers del host; cada operación se confirma en disco antes de responder. Un
+# hilo por proceso intenta el replay cada MUTATION_QUEUE_RETRY_INTERVAL segundos y un
+# lease en la base de datos garantiza que solo un proceso aplica operaciones a la vez.
+# Las operaciones se aplican en orden de llegada; si una termina en conflicto o falla,
+# las posteriores del mismo usuario esperan a que se descarte (DELETE
+# /api/mutations/<id>). Un fallo transitorio detiene el replay sin consumir la
+# operación, que se reintenta en la siguiente pasada.
+#
+# Detección de conflictos: los usuarios de Keycloak no tienen versión, así que al
+# encolar se guarda el valor de cada campo modificado según la última representación
+# conocida del roster (roster_changes). Si al aplicar el valor en Keycloak difiere de
+# ese y del que se quiere escribir, alguien lo modificó entretanto: la operación queda
+# en 'conflict' sin sobrescribirlo.
+#
+# Idempotencia: el cliente puede enviar Idempotency-Key; repetir la petición con la
+# misma clave retorna la operación ya encolada. Reaplicar una operación interrumpida
+# no duplica nada: las ediciones escriben valores absolutos y un alta que encuentra
+# al usuario ya creado por el mismo profesor se da por aplicada.
+#
+# El diario contiene las contraseñas de las altas pendientes: se crea con permisos
+# 0600 y la contraseña se borra de la operación en cuanto se resuelve.
+
+import contextlib
+import copy
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+
+import requests
+
+from config import (
+    KEYCLOAK_ADMIN_URL, REALM, MUTATION_QUEUE_ENABLED, MUTATION_QUEUE_PATH, MUTATION_QUEUE_RETRY_INTERVAL,
+    MUTATION_QUEUE_RETENTION
+)
+from auth import get_admin_token, get_request_settings
+import availability
+import keycloak_http
+import read_cache
+import roster_changes
+import user_ops
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+
+# Tipos de operación
+CREATE_USER, UPDATE_USER, UPDATE_PROFILE = "create_user", "update_user", "update_profile"
+# Estados: 'pending' y 'applying' esperan; 'conflict' y 'failed' bloquean las
+# operaciones posteriores del usuario hasta que se descartan ('discarded')
+PENDING, APPLYING, DONE, CONFLICT, FAILED, DISCARDED = (
+    "pending", "applying", "done", "conflict", "failed", "discarded"
+)
+UNRESOLVED = (PENDING, APPLYING, CONFLICT, FAILED)
+STATES = (PENDING, APPLYING, DONE, CONFLICT, FAILED, DISCARDED)
+
+# Segundos que un proceso conserva el turno de replay sin renovarlo
+LEASE_SECONDS = 60
+# Segundos que se espera a otro proceso que tiene el lock de escritura
+BUSY_TIMEOUT = 10
+
+# Campos de las peticiones -> ruta en la representación de serialize_user
+_FIELDS = {
+    "email": ("email",),
+    "firstName": ("firstName",),
+    "lastName": ("lastName",),
+    "gender": ("attributes", "gender"),
+    "birthdate": ("attributes", "birth_date"),
+    "birth_date": ("attributes", "birth_date"),
+    "phone": ("attributes", "phone_number"),
+    "phone_number": ("attributes", "phone_number"),
+}
+_APPLY = {UPDATE_USER: user_ops.apply_user_update, UPDATE_PROFILE: user_ops.apply_own_profile_update}
+
+_SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS ops (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        op_id TEXT NOT NULL UNIQUE,
+        idempotency_key TEXT,
+        kind TEXT NOT NULL,
+        subject TEXT NOT NULL,
+        user_id TEXT,
+        actor_id TEXT NOT NULL,
+        privileged INTEGER NOT NULL DEFAULT 0,
+        payload TEXT NOT NULL,
+        base TEXT,
+        state TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        result TEXT,
+        claimed_by TEXT,
+        created_at REAL NOT NULL,
+        updated_at REAL NOT NULL
+    )""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS ops_idempotency ON ops (actor_id, idempotency_key)",
+    "CREATE INDEX IF NOT EXISTS ops_state ON ops (state, seq)",
+    "CREATE INDEX IF NOT EXISTS ops_subject ON ops (subject, state)",
+    "CREATE INDEX IF NOT EXISTS ops_actor ON ops (actor_id, seq)",
+    "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+)
+
+
+class MutationQueueError(Exception):
+    """No se pudo leer o escribir el diario de operaciones."""
+
+
+class _Unreachable(Exception):
+    """Keycloak no respondió: la operación sigue pendiente."""
+
+
+class Journal:
+    """Diario de operaciones aceptadas, en orden de llegada (seq)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connect(self):
+        # Una conexión por proceso, usada bajo self._lock: no sobrevive a un fork
+        if self._conn is None or self._pid != os.getpid():
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            # Contiene contraseñas de altas pendientes: solo legible por el usuario del servicio
+            os.close(os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600))
+            self._conn, self._pid = self._open(), os.getpid()
+        return self._conn
+
+    def _open(self):
+        # Con varios workers creando la base de datos a la vez, el cambio a WAL ignora el busy timeout y los perdedores reintentan
+        deadline = time.monotonic() + BUSY_TIMEOUT
+        while True:
+            conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None,
+                                   check_same_thread=False)
+            conn.row_factory = sqlite3.Row
+            try:
+                if conn.execute("PRAGMA journal_mode").fetchone()[0] != "wal":
+                    conn.execute("PRAGMA journal_mode=WAL")
+                # Una operación aceptada (202) no debe perderse con un corte de luz
+                conn.execute("PRAGMA synchronous=FULL")
+                for statement in _SCHEMA:
+                    conn.execute(statement)
+                return conn
+            except sqlite3.OperationalError:
+                conn.close()
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(0.05)
+
+    @contextlib.contextmanager
+    def _reading(self):
+        with self._lock:
+            try:
+                yield self._connect()
+            except sqlite3.Error as e:
+                raise MutationQueueError(str(e)) from e
+
+    @contextlib.contextmanager
+    def _writing(self):
+        with self._lock:
+            try:
+                conn = self._connect()
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    yield conn
+                    conn.execute("COMMIT")
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+            except sqlite3.Error as e:
+                raise MutationQueueError(str(e)) from e
+
+    def add(self, kind, subject, actor_id, payload, user_id=None, base=None, privileged=False,
+            idempotency_key=None):
+        """
+        Encola una operación. base(anteriores) recibe las operaciones sin resolver del
+        mismo sujeto, en orden, y retorna los valores de referencia para detectar
+        conflictos. Retorna (operación, True), o (operación existente, False) si el
+        actor ya encoló una con la misma idempotency_key.
+        """
+        now = time.time()
+        with self._writing() as conn:
+            if idempotency_key:
+                row = conn.execute("SELECT * FROM ops WHERE actor_id = ? AND idempotency_key = ?",
+                                   (actor_id, idempotency_key)).fetchone()
+                if row is not None:
+                    return _op(row), False
+            if base is not None:
+                earlier = conn.execute(
+                    f"SELECT * FROM ops WHERE subject = ? AND state IN ({', '.join('?' * len(UNRESOLVED))})"
+                    " ORDER BY seq", (subject, *UNRESOLVED)).fetchall()
+                base = base([_op(row) for row in earlier])
+            conn.execute(
+                "INSERT INTO ops (op_id, idempotency_key, kind, subject, user_id, actor_id, privileged, payload,"
+                " base, state, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (str(uuid.uuid4()), idempotency_key, kind, subject, user_id, actor_id, int(privileged),
+                 json.dumps(payload), None if base is None else json.dumps(base), PENDING, now, now))
+            row = conn.execute("SELECT * FROM ops WHERE seq = last_insert_rowid()").fetchone()
+        return _op(row), True
+
+    def get(self, op_id):
+        with self._reading() as conn:
+            row = conn.execute("SELECT * FROM ops WHERE op_id = ?", (op_id,)).fetchone()
+        return _op(row) if row is not None else None
+
+    def list(self, actor_id=None, states=None, limit=100):
+        """Operaciones más recientes primero, de un actor (o de todos) y en los estados dados."""
+        clauses, args = [], []
+        if actor_id is not None:
+            clauses.append("actor_id = ?")
+            args.append(actor_id)
+        if states:
+            clauses.append(f"state IN ({', '.join('?' * len(states))})")
+            args.extend(states)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._reading() as conn:
+            rows = conn.execute(f"SELECT * FROM ops {where} ORDER BY seq DESC LIMIT ?", (*args, limit)).fetchall()
+        return [_op(row) for row in rows]
+
+    def counts(self):
+        """Número de operaciones por estado."""
+        with self._reading() as conn:
+            return {state: count for state, count in conn.execute("SELECT state, COUNT(*) FROM ops GROUP BY state")}
+
+    def blocked(self, subject):
+        """Indica si el sujeto (usuario) tiene operaciones sin resolver."""
+        with self._reading() as conn:
+            row = conn.execute(
+                f"SELECT 1 FROM ops WHERE subject = ? AND state IN ({', '.join('?' * len(UNRESOLVED))}) LIMIT 1",
+                (subject, *UNRESOLVED)).fetchone()
+        return row is not None
+
+    def unresolved(self):
+        """Operaciones sin resolver en orden de llegada."""
+        with self._reading() as conn:
+            rows = conn.execute(
+                f"SELECT * FROM ops WHERE state IN ({', '.join('?' * len(UNRESOLVED))}) ORDER BY seq",
+                UNRESOLVED).fetchall()
+        return [_op(row) for row in rows]
+
+    def claim(self, seq, owner):
+        """Marca una operación pendiente como en curso. Retorna False si ya no estaba pendiente."""
+        with self._writing() as conn:
+            cursor = conn.execute(
+                "UPDATE ops SET state = ?, claimed_by = ?, attempts = attempts + 1, updated_at = ?"
+                " WHERE seq = ? AND state = ?", (APPLYING, owner, time.time(), seq, PENDING))
+            return cursor.rowcount == 1
+
+    def finish(self, seq, state, error=None, result=None):
+        """Resuelve una operación en curso (o la devuelve a 'pending'); la contraseña no se conserva."""
+        with self._writing() as conn:
+            row = conn.execute("SELECT payload FROM ops WHERE seq = ?", (seq,)).fetchone()
+            payload = json.loads(row["payload"]) if row is not None else {}
+            if state != PENDING:
+                payload.pop("password", None)
+            conn.execute(
+                "UPDATE ops SET state = ?, error = ?, result = ?, payload = ?, claimed_by = NULL, updated_at = ?"
+                " WHERE seq = ?",
+                (state, error, None if result is None else json.dumps(result), json.dumps(payload), time.time(), seq))
+
+    def discard(self, op_id):
+        """Descarta una operación en conflicto o fallida. Retorna False si no estaba en esos estados."""
+        with self._writing() as conn:
+            cursor = conn.execute(
+                "UPDATE ops SET state = ?, payload = '{}', updated_at = ? WHERE op_id = ? AND state IN (?, ?)",
+                (DISCARDED, time.time(), op_id, CONFLICT, FAILED))
+            return cursor.rowcount == 1
+
+    def requeue(self, owner):
+        """Devuelve a 'pending' las operaciones que otro proceso dejó a medias (p. ej. al morir)."""
+        with self._writing() as conn:
+            return conn.execute(
+                "UPDATE ops SET state = ?, claimed_by = NULL WHERE state = ? AND (claimed_by IS NULL OR claimed_by != ?)",
+                (PENDING, APPLYING, owner)).rowcount
+
+    def purge(self, before):
+        """Borra las operaciones aplicadas o descartadas antes de before."""
+        with self._writing() as conn:
+            return conn.execute("DELETE FROM ops WHERE state IN (?, ?) AND updated_at < ?",
+                                (DONE, DISCARDED, before)).rowcount
+
+    def acquire_lease(self, owner, ttl=LEASE_SECONDS):
+        """Toma (o renueva) el turno de replay. Retorna False si otro proceso lo tiene vigente."""
+        now = time.time()
+        with self._writing() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'leader'").fetchone()
+            if row is not None:
+                holder, expires_at = json.loads(row["value"])
+                if holder != owner and expires_at > now:
+                    return False
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('leader', ?)",
+                         (json.dumps([owner, now + ttl]),))
+            return True
+
+    def unavailable_since(self):
+        """Momento en que se marcó Keycloak como caído, o None."""
+        with self._reading() as conn:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'unavailable_since'").fetchone()
+        return float(row["value"]) if row is not None else None
+
+    def set_unavailable(self, unavailable):
+        with self._writing() as conn:
+            if unavailable:
+                conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('unavailable_since', ?)",
+                             (str(time.time()),))
+            else:
+                conn.execute("DELETE FROM meta WHERE key = 'unavailable_since'")
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+
+def _op(row):
+    op = dict(row)
+    op["payload"] = json.loads(op["payload"])
+    op["base"] = json.loads(op["base"]) if op["base"] is not None else None
+    op["result"] = json.loads(op["result"]) if op["result"] is not None else None
+    op["privileged"] = bool(op["privileged"])
+    return op
+
+
+_lock = threading.Lock()
+_state = {"journal": None, "pid": None, "owner": None}
+# Un solo replay a la vez dentro del proceso (el hilo de fondo y llamadas explícitas)
+_replay_lock = threading.Lock()
+
+
+def enabled():
+    return MUTATION_QUEUE_ENABLED
+
+
+def journal():
+    """Diario compartido (se abre al primer uso)."""
+    with _lock:
+        if _state["journal"] is None:
+            _state["journal"] = Journal(MUTATION_QUEUE_PATH)
+        return _state["journal"]
+
+
+def _owner():
+    # Identifica al proceso en el lease y en las operaciones en curso
+    with _lock:
+        if _state["owner"] is None:
+            _state["owner"] = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        return _state["owner"]
+
+
+def describe(op):
+    """Representación pública de una operación (sin la contraseña de las altas)."""
+    return {
+        "id": op["op_id"],
+        "kind": op["kind"],
+        "state": op["state"],
+        "user_id": op["user_id"] or (op["result"] or {}).get("id"),
+        "actor_id": op["actor_id"],
+        "changes": {key: value for key, value in op["payload"].items() if key != "password"},
+        "attempts": op["attempts"],
+        "error": op["error"],
+        "result": op["result"],
+        "created_at": op["created_at"],
+        "updated_at": op["updated_at"],
+    }
+
+
+# ----------------------------------------------------------------------
+# Aceptación
+# ----------------------------------------------------------------------
+def _subject(kind, payload, user_id):
+    # Las altas se ordenan por email: el ID lo asigna Keycloak al aplicarlas
+    if kind == CREATE_USER:
+        return f"email:{(payload.get('email') or '').lower()}"
+    return user_id
+
+
+def _paths(payload):
+    paths = {_FIELDS[key] for key in payload if key in _FIELDS}
+    attributes = payload.get("attributes")
+    if isinstance(attributes, dict):
+        paths.update(("attributes", key) for key in attributes if key != "created_by")
+    return sorted(paths)
+
+
+def _value(user, path):
+    for part in path:
+        user = (user or {}).get(part)
+    return user
+
+
+def _base(known, payload):
+    """
+    Retorna base(anteriores) para Journal.add: los valores de los campos que modifica
+    la operación según la última representación conocida, con las operaciones
+    anteriores del usuario todavía en cola ya aplicadas.
+    """
+    def base(earlier):
+        if known is None:
+            return None
+        # De vuelta al formato de Keycloak (atributos en listas) para reutilizar user_ops
+        user = {**known, "attributes": {key: [value] for key, value in known["attributes"].items()}}
+        for op in earlier:
+            if op["kind"] in _APPLY:
+                _APPLY[op["kind"]](user, op["payload"])
+        expected = roster_changes.serialize_user(user)
+        return [[list(path), _value(expected, path)] for path in _paths(payload)]
+    return base
+
+
+def _is_admin(token):
+    try:
+        return user_ops.is_admin(token)
+    except Exception:
+        return False
+
+
+def should_defer(kind, payload, user_id=None):
+    """Indica si la mutación debe encolarse sin llamar a Keycloak (caído, u operaciones previas del usuario)."""
+    if not MUTATION_QUEUE_ENABLED:
+        return False
+    try:
+        queue = journal()
+        return queue.unavailable_since() is not None or queue.blocked(_subject(kind, payload, user_id))
+    except MutationQueueError as e:
+        logger.error("[mutation_queue] Error leyendo el diario: %s", e)
+        return False
+
+
+def submit(kind, actor_id, token, payload, user_id=None, idempotency_key=None, upstream_failed=False):
+    """
+    Encola una mutación aceptada.
+
+    Args:
+        kind (str): CREATE_USER, UPDATE_USER o UPDATE_PROFILE
+        actor_id (str): Usuario que hace la petición
+        token (str): Su token, para comprobar el rol de administrador
+        payload (dict): JSON de la petición
+        user_id (str): Usuario modificado (None en las altas)
+        upstream_failed (bool): La petición no pudo llegar a Keycloak; se marca como caído
+
+    Returns:
+        tuple: (cuerpo, status) con 202 y la operación, o el error
+    """
+    queue = journal()
+    privileged = _is_admin(token)
+    known = None
+    if kind == UPDATE_USER:
+        # Sin Keycloak, el permiso se comprueba contra el roster del profesor en memoria
+        known = roster_changes.known_user(user_id, actor_id)
+        if known is None and not privileged:
+            return {"error": "Keycloak no disponible: no se puede comprobar el permiso sobre este usuario"}, 503
+        known = known or roster_changes.known_user(user_id)
+    elif kind == UPDATE_PROFILE:
+        known = roster_changes.known_user(user_id)
+    try:
+        if upstream_failed:
+            queue.set_unavailable(True)
+        op, created = queue.add(kind, _subject(kind, payload, user_id), actor_id, payload, user_id=user_id,
+                                base=_base(known, payload), privileged=privileged, idempotency_key=idempotency_key)
+    except MutationQueueError as e:
+        logger.error("[mutation_queue] No se pudo encolar %s: %s", kind, e)
+        return {"error": "Keycloak no disponible"}, 503
+    if created:
+        logger.info("[mutation_queue] %s de %s encolada (%s)", kind, actor_id, op["op_id"])
+    return {
+        "message": "Cambio aceptado: se aplicará cuando Keycloak esté disponible",
+        "queued": True,
+        "operation": describe(op),
+    }, 202
+
+
+# ----------------------------------------------------------------------
+# Consulta
+# ----------------------------------------------------------------------
+def list_operations(actor_id, token, states=None, limit=100):
+    """Operaciones del actor (de todos para un administrador) y el resumen por estado."""
+    queue = journal()
+    ops = queue.list(None if _is_admin(token) else actor_id, states, limit)
+    return {"operations": [describe(op) for op in ops], "counts": queue.counts(),
+            "keycloak_unavailable_since": queue.unavailable_since()}
+
+
+def list_request(actor_id, token, args):
+    """
+    GET /api/mutations: parámetros state (lista separada por comas) y limit
+    (por defecto 100). Retorna (cuerpo, status).
+    """
+    states = [state for state in args.get("state", "").split(",") if state]
+    if any(state not in STATES for state in states):
+        return {"error": f"Estado no válido; valores posibles: {', '.join(STATES)}"}, 400
+    try:
+        limit = max(1, min(int(args.get("limit", 100)), 1000))
+    except ValueError:
+        return {"error": "limit debe ser un entero"}, 400
+    return list_operations(actor_id, token, states, limit), 200
+
+
+def _visible(op, actor_id, token):
+    return op is not None and (op["actor_id"] == actor_id or _is_admin(token))
+
+
+def get_operation(op_id, actor_id, token):
+    """Retorna (cuerpo, status) con una operación del actor (o cualquiera para un administrador)."""
+    op = journal().get(op_id)
+    if not _visible(op, actor_id, token):
+        return {"error": "Operación no encontrada"}, 404
+    return describe(op), 200
+
+
+def discard_operation(op_id, actor_id, token):
+    """Descarta una operación en conflicto o fallida para desbloquear las siguientes del usuario."""
+    queue = journal()
+    op = queue.get(op_id)
+    if not _visible(op, actor_id, token):
+        return {"error": "Operación no encontrada"}, 404
+    if not queue.discard(op_id):
+        return {"error": f"Solo se pueden descartar operaciones en conflicto o fallidas (estado: {op['state']})"}, 409
+    logger.info("[mutation_queue] Operación %s descartada por %s", op_id, actor_id)
+    return describe(queue.get(op_id)), 200
+
+
+# ----------------------------------------------------------------------
+# Replay
+# ----------------------------------------------------------------------
+def _admin_headers():
+    admin_token = get_admin_token()
+    if not admin_token:
+        raise _Unreachable("sin token administrativo")
+    return {"Authorization": f"Bearer {admin_token}", "Content-Type": "application/json"}
+
+
+def _call(method, url, headers, **kwargs):
+    try:
+        resp = method(url, headers=headers, **get_request_settings(), **kwargs)
+    except requests.RequestException as e:
+        raise _Unreachable(f"{type(e).__name__}: {e}") from e
+    if resp.status_code >= 500:
+        raise _Unreachable(f"Keycloak respondió {resp.status_code}")
+    return resp
+
+
+def _rejected(resp):
+    return FAILED, f"Keycloak respondió {resp.status_code}: {resp.text[:200]}", None
+
+
+def _apply_create(op, headers):
+    new_user = user_ops.build_new_user(op["payload"], op["actor_id"])
+    users_url = f"{KEYCLOAK_ADMIN_URL}/admin/realms/{REALM}/users"
+    resp = _call(keycloak_http.post, users_url, headers, json=new_user)
+    if resp.status_code not in (201, 204, 409):
+        return _rejected(resp)
+    search = _call(keycloak_http.get, users_url, headers, params={"username": new_user["username"], "exact": "true"})
+    created = next((user for user in (search.json() if search.status_code == 200 else [])
+                    if (user.get("username") or "").lower() == new_user["username"].lower()), None)
+    if resp.status_code == 409:
+        availability.add_value(new_user["email"])
+        # Un intento anterior interrumpido (o el propio profesor) ya lo creó
+        if created is None or user_ops.creator_id(created) != user_ops.creator_id(new_user):
+            return CONFLICT, "Ya existe un usuario con ese email", None
+    if created is None:
+        return DONE, None, None
+    roster_changes.record_upsert(created)
+    availability.add_user(created)
+    return DONE, None, {"id": created.get("id")}
+
+
+def _apply_update(op, headers):
+    user_url = f"{KEYCLOAK_ADMIN_URL}/admin/realms/{REALM}/users/{op['user_id']}"
+    resp = _call(keycloak_http.get, user_url, headers)
+    if resp.status_code == 404:
+        return CONFLICT, "El usuario ya no existe en Keycloak", None
+    if resp.status_code != 200:
+        return _rejected(resp)
+    user_data = resp.json()
+    if op["kind"] == UPDATE_USER and not op["privileged"] and user_ops.creator_id(user_data) != op["actor_id"]:
+        return FAILED, "No tienes permiso para actualizar este usuario", None
+
+    apply = _APPLY[op["kind"]]
+    conflicts = _conflicts(op["base"], user_data, op["payload"], apply)
+    if conflicts:
+        return CONFLICT, f"Modificado en Keycloak desde que se aceptó el cambio: {', '.join(conflicts)}", \
+            {"fields": conflicts}
+
+    apply(user_data, op["payload"])
+    update = _call(keycloak_http.put, user_url, headers, json=user_data)
+    if update.status_code not in (200, 204):
+        return _rejected(update)
+    roster_changes.record_upsert(user_data)
+    availability.add_user(user_data)
+    read_cache.forget_user(op["user_id"])
+    return DONE, None, {"id": op["user_id"]}
+
+
+def _conflicts(base, user_data, payload, apply):
+    """Campos cuyo valor actual no es ni el que se conocía al encolar ni el que se quiere escribir."""
+    if not base:
+        return []
+    current = roster_changes.serialize_user(user_data)
+    wanted = roster_changes.serialize_user(apply(copy.deepcopy(user_data), payload))
+    return [".".join(path) for path, seen in base
+            if _value(current, path) not in (seen, _value(wanted, path))]
+
+
+def _apply(op, headers):
+    if op["kind"] == CREATE_USER:
+        return _apply_create(op, headers)
+    return _apply_update(op, headers)
+
+
+def _probe(headers):
+    """Comprueba que Keycloak responde (el token administrativo puede venir de la caché)."""
+    _call(keycloak_http.get, f"{KEYCLOAK_ADMIN_URL}/admin/realms/{REALM}/users/count", headers)
+
+
+def replay():
+    """
+    Aplica en orden las operaciones pendientes si este proceso tiene el turno de replay.
+    Se detiene en el primer fallo transitorio de Keycloak.
+
+    Returns:
+        int: Operaciones resueltas en esta pasada
+    """
+    queue = journal()
+    with _replay_lock:
+        ops = queue.unresolved()
+        unavailable = queue.unavailable_since() is not None
+        if not ops and not unavailable:
+            return 0
+        owner = _owner()
+        if not queue.acquire_lease(owner):
+            return 0
+        if queue.requeue(owner):
+            ops = queue.unresolved()
+
+        resolved = 0
+        blocked = set()
+        try:
+            headers = _admin_headers()
+            if not ops:
+                _probe(headers)
+            for op in ops:
+                if op["subject"] in blocked or op["state"] != PENDING:
+                    # Una operación anterior del usuario en conflicto o fallida bloquea las siguientes
+                    blocked.add(op["subject"])
+                    continue
+                if not queue.claim(op["seq"], owner):
+                    continue
+                try:
+                    state, error, result = _apply(op, headers)
+                except _Unreachable:
+                    queue.finish(op["seq"], PENDING, op["error"])
+                    raise
+                except Exception as e:
+                    logger.exception("[mutation_queue] Error aplicando %s", op["op_id"])
+                    state, error, result = FAILED, f"{type(e).__name__}: {e}", None
+                queue.finish(op["seq"], state, error, result)
+                resolved += 1
+                if state != DONE:
+                    blocked.add(op["subject"])
+                    logger.warning("[mutation_queue] %s %s: %s", op["op_id"], state, error)
+                queue.acquire_lease(owner)
+        except _Unreachable as e:
+            queue.set_unavailable(True)
+            if resolved or not unavailable:
+                logger.warning("[mutation_queue] Keycloak no disponible, replay detenido: %s", e)
+            return resolved
+
+        if unavailable:
+            logger.info("[mutation_queue] Keycloak disponible de nuevo")
+        queue.set_unavailable(False)
+        queue.purge(time.time() - MUTATION_QUEUE_RETENTION)
+        if resolved:
+            logger.info("[mutation_queue] %d operaciones resueltas", resolved)
+        return resolved
+
+
+def _run():
+    while True:
+        time.sleep(MUTATION_QUEUE_RETRY_INTERVAL)
+        try:
+            replay()
+        except Exception as e:
+            logger.error("[mutation_queue] Error en el replay: %s", e)
+
+
+def ensure_started():
+    """Lanza el hilo de replay, una vez por proceso (también en cada worker creado con fork)."""
+    if not MUTATION_QUEUE_ENABLED:
+        return
+    with _lock:
+        if _state["pid"] == os.getpid():
+            return
+        _state["pid"] = os.getpid()
+    threading.Thread(target=_run, daemon=True, name="mutation-replay").start()
+
+
+def _after_fork_in_child():
+    global _lock, _replay_lock
+    _lock = threading.Lock()
+    _replay_lock = threading.Lock()
+    _state["owner"] = None
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
@@ -0,0 +1,65 @@
+# private_files.py
+# Directorios y ficheros locales que comparten los workers del host.
+#
+# La caché compartida guarda el token administrativo y las introspecciones que la API
+# da por buenas, el snapshot del roster los datos de los alumnos y el directorio de
+# invalidación los sockets con los que un worker hace que los demás descarten datos.
+# Otro usuario del host no debe poder leerlos ni crearlos de antemano para inyectar
+# valores, así que los directorios se crean con permisos 0700 y los ficheros con 0600,
+# y uno que ya existe debe pertenecer al usuario del servicio y no ser escribible por
+# otros. Si no, se rechaza con InsecurePathError.
+
+import os
+import stat
+
+
+class InsecurePathError(OSError):
+    """El fichero o directorio existe pero no es privado del usuario del servicio."""
+
+
+def check_owner(path, st):
+    """Rechaza el fichero (resultado de os.stat/os.fstat) si no es del usuario del servicio."""
+    if st.st_uid != os.geteuid():
+        raise InsecurePathError(f"{path} pertenece al uid {st.st_uid}, no al usuario del servicio")
+
+
+def ensure_dir(path):
+    """
+    Crea el directorio con permisos 0700 o comprueba que el existente pertenece al
+    usuario del servicio, no es un enlace simbólico y nadie más puede escribir en él.
+
+    Returns:
+        str: la misma ruta
+    """
+    try:
+        os.makedirs(path, mode=0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode):
+        raise InsecurePathError(f"{path} no es un directorio")
+    check_owner(path, st)
+    if st.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise InsecurePathError(f"{path} es escribible por otros usuarios")
+    return path
+
+
+def ensure_file(path):
+    """
+    Crea el fichero con permisos 0600 (y su directorio con ensure_dir) o comprueba que
+    el existente pertenece al usuario del servicio; si tenía permisos para otros se
+    dejan en 0600.
+
+    Returns:
+        str: la misma ruta
+    """
+    ensure_dir(os.path.dirname(os.path.abspath(path)))
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+    try:
+        st = os.fstat(fd)
+        check_owner(path, st)
+        if st.st_mode & 0o077:
+            os.fchmod(fd, 0o600)
+    finally:
+        os.close(fd)
+    return path
@@ -0,0 +1,335 @@
+# profiler.py
+# Perfilado de CPU bajo demanda sobre peticiones reales, sin reiniciar el servicio.
+#
+# Se perfila una fracción configurable de las peticiones de cada ruta
+# (PROFILE_SAMPLE, p. ej. "/api/users=0.2,*=0.01") o cualquier petición que traiga
+# una cabecera X-Profile-Signature firmada con PROFILE_SECRET (ver sign()). Hay dos
+# modos (PROFILE_MODE):
+#   cprofile  cProfile sobre la petición; se descarga como archivo pstats
+#   sampler   un hilo toma la pila de los hilos perfilados cada PROFILE_INTERVAL
+#             segundos; se descarga como pilas colapsadas (flamegraph.pl, speedscope)
+#
+# Los resultados se agregan por ruta en ventanas de PROFILE_WINDOW segundos; se
+# conservan la ventana en curso y la última completa.
+#
+# Limitaciones: cProfile solo admite un perfilador activo a la vez, así que en ese
+# modo se perfila una petición por proceso simultáneamente (el resto no se muestrea),
+# y desde Python 3.12 el perfil incluye lo que ejecuten otros hilos en ese intervalo.
+# En modo ASGI todas las peticiones comparten el hilo del event loop, por lo que
+# ambos modos atribuyen a la petición perfilada el trabajo de las tareas intercaladas.
+
+import hashlib
+import hmac
+import io
+import marshal
+import os
+import random
+import sys
+import threading
+import time
+
+from config import PROFILE_SAMPLE, PROFILE_MODE, PROFILE_WINDOW, PROFILE_INTERVAL, PROFILE_SECRET
+
+MODES = ("cprofile", "sampler")
+SIGNATURE_HEADER = "X-Profile-Signature"
+FORMATS = {
+    "pstats": "application/octet-stream",
+    "collapsed": "text/plain; charset=utf-8",
+    "text": "text/plain; charset=utf-8",
+}
+
+# Profundidad máxima de las pilas muestreadas
+_MAX_DEPTH = 128
+
+
+def parse_rates(spec):
+    """
+    Interpreta PROFILE_SAMPLE: "0.05" (todas las rutas) o "/api/users=0.2,*=0.01".
+
+    Returns:
+        dict: {regla de ruta o '*': fracción entre 0 y 1}
+    """
+    rates = {}
+    for item in (spec or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        route, sep, rate = item.rpartition("=")
+        try:
+            rates[route if sep else "*"] = min(1.0, max(0.0, float(rate)))
+        except ValueError:
+            continue
+    return rates
+
+
+_rates = parse_rates(PROFILE_SAMPLE)
+_mode = PROFILE_MODE if PROFILE_MODE in MODES else "cprofile"
+
+
+class _Window:
+    def __init__(self):
+        self.started = time.time()
+        # Peticiones perfiladas por ruta
+        self.requests = {}
+        # Modo cprofile: ruta -> pstats.Stats
+        self.stats = {}
+        # Modo sampler: ruta -> {pila colapsada: muestras}
+        self.stacks = {}
+
+    def describe(self):
+        return {
+            "started": self.started,
+            "duration": round(time.time() - self.started, 1),
+            "requests": dict(self.requests),
+        }
+
+
+_lock = threading.Lock()
+_windows = {"current": _Window(), "last": None}
+# cProfile no admite dos perfiladores activos a la vez
+_cprofile_busy = threading.Lock()
+# Modo sampler: ident del hilo -> ruta de la petición que atiende
+_sampled = {}
+_sampler = {"thread": None, "pid": None}
+_wake = threading.Event()
+
+
+def _current_window():
+    # Se llama con _lock tomado
+    window = _windows["current"]
+    if time.time() - window.started >= PROFILE_WINDOW:
+        _windows["last"] = window
+        window = _windows["current"] = _Window()
+    return window
+
+
+# ----------------------------------------------------------------------
+# Cabecera firmada
+# ----------------------------------------------------------------------
+def _signature(expires):
+    return hmac.new(PROFILE_SECRET.encode("utf-8"), str(expires).encode("ascii"), hashlib.sha256).hexdigest()
+
+
+def sign(ttl=300):
+    """
+    Genera un valor para X-Profile-Signature válido durante ttl segundos.
+    Retorna None si PROFILE_SECRET no está configurado.
+    """
+    if not PROFILE_SECRET:
+        return None
+    expires = int(time.time()) + int(ttl)
+    return f"{expires}.{_signature(expires)}"
+
+
+def verify(value):
+    """Indica si un valor de X-Profile-Signature es válido y no ha caducado."""
+    if not PROFILE_SECRET or not value:
+        return False
+    expires, _, digest = value.partition(".")
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    return hmac.compare_digest(digest, _signature(int(expires)))
+
+
+# ----------------------------------------------------------------------
+# Sesiones de perfilado
+# ----------------------------------------------------------------------
+def start(route, signature=None):
+    """
+    Decide si se perfila la petición y, en ese caso, empieza a perfilarla.
+
+    Args:
+        route (str): Regla de la ruta ('/api/users/<user_id>')
+        signature (str): Valor de la cabecera X-Profile-Signature, si la hay
+
+    Returns:
+        Sesión que se debe pasar a stop(), o None si la petición no se perfila
+    """
+    if not _rates and not signature:
+        return None
+    if not verify(signature):
+        rate = _rates.get(route, _rates.get("*", 0.0))
+        if rate <= 0 or random.random() >= rate:
+            return None
+
+    if _mode == "sampler":
+        ident = threading.get_ident()
+        _sampled[ident] = route
+        _ensure_sampler()
+        _wake.set()
+        return ("sampler", route, ident)
+
+    if not _cprofile_busy.acquire(blocking=False):
+        return None
+    # cProfile y pstats se importan al primer perfil: la mayoría de los workers nunca perfila
+    import cProfile
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Otro perfilador (p. ej. un depurador) está activo
+        _cprofile_busy.release()
+        return None
+    return ("cprofile", route, profile)
+
+
+def stop(session):
+    """Termina una sesión de start() y agrega el resultado a la ventana en curso."""
+    if session is None:
+        return
+    mode, route, handle = session
+    if mode == "sampler":
+        _sampled.pop(handle, None)
+        with _lock:
+            window = _current_window()
+            window.requests[route] = window.requests.get(route, 0) + 1
+        return
+
+    handle.disable()
+    _cprofile_busy.release()
+    import pstats
+    try:
+        stats = pstats.Stats(handle)
+    except TypeError:
+        # Perfil vacío
+        return
+    with _lock:
+        window = _current_window()
+        window.requests[route] = window.requests.get(route, 0) + 1
+        if route in window.stats:
+            window.stats[route].add(stats)
+        else:
+            window.stats[route] = stats
+
+
+# ----------------------------------------------------------------------
+# Muestreo de pilas
+# ----------------------------------------------------------------------
+def _collapse(frame):
+    names = []
+    while frame is not None and len(names) < _MAX_DEPTH:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    names.reverse()
+    return ";".join(names)
+
+
+def _sample_loop():
+    own = threading.get_ident()
+    while True:
+        if not _sampled:
+            _wake.wait()
+            _wake.clear()
+            continue
+        frames = sys._current_frames()
+        samples = []
+        for ident, route in list(_sampled.items()):
+            frame = frames.get(ident)
+            if frame is not None and ident != own:
+                samples.append((route, _collapse(frame)))
+        del frames
+        if samples:
+            with _lock:
+                window = _current_window()
+                for route, stack in samples:
+                    counts = window.stacks.setdefault(route, {})
+                    counts[stack] = counts.get(stack, 0) + 1
+        time.sleep(PROFILE_INTERVAL)
+
+
+def _ensure_sampler():
+    if _sampler["pid"] == os.getpid():
+        return
+    with _lock:
+        if _sampler["pid"] == os.getpid():
+            return
+        thread = threading.Thread(target=_sample_loop, name="profiler-sampler", daemon=True)
+        _sampler.update(thread=thread, pid=os.getpid())
+    thread.start()
+
+
+# ----------------------------------------------------------------------
+# Exportación
+# ----------------------------------------------------------------------
+def default_format():
+    return "collapsed" if _mode == "sampler" else "pstats"
+
+
+def status():
+    """Configuración y peticiones perfiladas por ventana."""
+    with _lock:
+        window = _current_window()
+        last = _windows["last"]
+        return {
+            "mode": _mode,
+            "rates": dict(_rates),
+            "window_seconds": PROFILE_WINDOW,
+            "signed_header": bool(PROFILE_SECRET),
+            "current": window.describe(),
+            "last": last.describe() if last else None,
+        }
+
+
+def export(fmt=None, route=None, which="current"):
+    """
+    Exporta una ventana agregada.
+
+    Args:
+        fmt (str): 'pstats' o 'text' (modo cprofile), 'collapsed' (modo sampler)
+        route (str): Limitar a una ruta; por defecto todas
+        which (str): 'current' o 'last'
+
+    Returns:
+        bytes o None si no hay datos para esa ventana o el formato no aplica al modo
+    """
+    fmt = fmt or default_format()
+    with _lock:
+        window = _current_window() if which == "current" else _windows["last"]
+        if window is None:
+            return None
+        if fmt == "collapsed":
+            merged = {}
+            for name, counts in window.stacks.items():
+                if route is None or name == route:
+                    for stack, count in counts.items():
+                        merged[stack] = merged.get(stack, 0) + count
+            if not merged:
+                return None
+            return "".join(f"{stack} {count}\n" for stack, count in sorted(merged.items())).encode("utf-8")
+
+        selected = [stats for name, stats in window.stats.items() if route is None or name == route]
+        if not selected or fmt not in ("pstats", "text"):
+            return None
+        import pstats
+        combined = pstats.Stats()
+        combined.add(*selected)
+
+    if fmt == "pstats":
+        # Mismo contenido que pstats.Stats.dump_stats(); se abre con pstats.Stats(ruta)
+        return marshal.dumps(combined.stats)
+    output = io.StringIO()
+    combined.stream = output
+    combined.sort_stats("cumulative").print_stats(60)
+    return output.getvalue().encode("utf-8")
+
+
+def reset():
+    """Descarta las ventanas acumuladas."""
+    with _lock:
+        _windows["current"] = _Window()
+        _windows["last"] = None
+
+
+def _after_fork_in_child():
+    # El hilo de muestreo no existe en el hijo y los locks pudieron quedar tomados
+    global _lock, _cprofile_busy
+    _lock = threading.Lock()
+    _cprofile_busy = threading.Lock()
+    _sampled.clear()
+    _sampler.update(thread=None, pid=None)
+    _windows["current"] = _Window()
+    _windows["last"] = None
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
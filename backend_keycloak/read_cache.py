@@ -0,0 +1,366 @@
+# read_cache.py
+# Caché de lecturas: la disponibilidad y la latencia de las lecturas dejan de
+# depender de cada corte de Keycloak.
+#
+# Cada worker guarda en memoria la última respuesta buena de los rosters
+# (/api/users), los perfiles (/api/profile) y el detalle de usuarios (el nombre
+# del profesor del perfil) y la sirve según su edad, como stale-while-revalidate y
+# stale-if-error de RFC 5861:
+#
+#   edad <= READ_CACHE_TTL         se sirve la copia                     X-Cache: HIT
+#   edad <= TTL + READ_CACHE_SWR   se sirve la copia y se refresca en    X-Cache: STALE
+#                                  segundo plano                          Warning: 110
+#   más antigua                    se consulta Keycloak                  X-Cache: MISS
+#
+# Si Keycloak no responde (timeout, conexión, 5xx, sin token administrativo) y la
+# copia no supera TTL + READ_CACHE_GRACE segundos, se sirve en lugar del error con
+# X-Cache: STALE y Warning: 111. Age indica la edad de la copia servida.
+#
+# Las entradas de un usuario se descartan cuando cambia (eventos de roster_changes
+# en este worker, namespace 'read_cache' de invalidation para los demás), y un roster
+# solo se sirve sin consultar si su versión no cambió desde que se guardó.
+#
+# La introspección tiene su propia gracia, compartida entre workers y nunca más
+# allá de la expiración del token: sin ella, un corte de Keycloak rechazaría la
+# sesión antes de llegar a la caché.
+
+import asyncio
+import contextvars
+import logging
+import os
+import threading
+import time
+
+import requests
+
+from config import READ_CACHE_TTL, READ_CACHE_SWR, READ_CACHE_GRACE, READ_CACHE_MAX_ENTRIES
+from cache import shared_cache, token_key
+import invalidation
+import memory_guard
+import roster_changes
+
+logger = logging.getLogger(__name__)
+
+HIT, MISS, STALE, STALE_IF_ERROR = "HIT", "MISS", "STALE", "STALE_IF_ERROR"
+# Con varias lecturas en una petición, las cabeceras describen la más degradada
+_SEVERITY = {HIT: 0, MISS: 1, STALE: 2, STALE_IF_ERROR: 3}
+_WARNINGS = {STALE: '110 - "Response is Stale"', STALE_IF_ERROR: '111 - "Revalidation Failed"'}
+
+
+class Unavailable(Exception):
+    """Keycloak no pudo responder una lectura (sin token administrativo, error de la Admin API...)."""
+
+
+class AdminTokenUnavailable(Unavailable):
+    """No se obtuvo el token administrativo."""
+
+
+# Errores con los que se sirve la copia dentro de la gracia
+UPSTREAM_ERRORS = (requests.RequestException, Unavailable)
+
+
+class _Entry:
+    __slots__ = ("value", "fetched_at", "user_id")
+
+    def __init__(self, value, user_id):
+        self.value = value
+        self.fetched_at = time.time()
+        self.user_id = user_id
+
+
+_lock = threading.Lock()
+# (tipo, clave) -> _Entry
+_entries = {}
+# user_id -> {(tipo, clave)}, para descartar las entradas de un usuario modificado
+_by_user = {}
+# Entradas con un refresco en segundo plano en curso
+_refreshing = set()
+# Referencias a las tareas de refresco asíncronas (el loop solo guarda referencias débiles)
+_tasks = set()
+# (estado, edad) de la lectura más degradada de la petición en curso
+_status = contextvars.ContextVar("read_cache_status", default=None)
+
+
+def _max_age():
+    return READ_CACHE_TTL + max(READ_CACHE_SWR, READ_CACHE_GRACE)
+
+
+# ----------------------------------------------------------------------
+# Estado de la petición en curso
+# ----------------------------------------------------------------------
+def begin():
+    """Olvida el estado de la petición anterior atendida en este hilo."""
+    _status.set(None)
+
+
+def _note(state, age=0.0):
+    current = _status.get()
+    if current is None or _SEVERITY[state] > _SEVERITY[current[0]]:
+        _status.set((state, age))
+
+
+def response_headers():
+    """Cabeceras X-Cache, Age y Warning de las lecturas de la petición en curso (y las olvida)."""
+    current = _status.get()
+    _status.set(None)
+    if current is None:
+        return {}
+    state, age = current
+    headers = {"X-Cache": STALE if state == STALE_IF_ERROR else state}
+    if state != MISS:
+        headers["Age"] = str(int(age))
+    if state in _WARNINGS:
+        headers["Warning"] = _WARNINGS[state]
+    return headers
+
+
+# ----------------------------------------------------------------------
+# Entradas
+# ----------------------------------------------------------------------
+def _lookup(kind, key):
+    with _lock:
+        entry = _entries.get((kind, key))
+        if entry is not None and time.time() - entry.fetched_at > _max_age():
+            _drop((kind, key))
+            entry = None
+        return entry
+
+
+def _drop(entry_key):
+    entry = _entries.pop(entry_key, None)
+    if entry is not None and entry.user_id is not None:
+        keys = _by_user.get(entry.user_id)
+        if keys is not None:
+            keys.discard(entry_key)
+            if not keys:
+                del _by_user[entry.user_id]
+
+
+def _store(kind, key, value, user_id):
+    if value is None:
+        forget(kind, key)
+        return
+    if _max_age() <= 0:
+        return
+    with _lock:
+        _drop((kind, key))
+        _entries[(kind, key)] = _Entry(value, user_id)
+        if user_id is not None:
+            _by_user.setdefault(user_id, set()).add((kind, key))
+        if len(_entries) > READ_CACHE_MAX_ENTRIES:
+            _evict_locked(0.1)
+
+
+def forget(kind, key):
+    with _lock:
+        _drop((kind, key))
+
+
+def _forget_user(user_id):
+    with _lock:
+        for entry_key in list(_by_user.get(user_id, ())):
+            _drop(entry_key)
+
+
+def forget_user(user_id):
+    """Descarta las entradas (perfil, detalle) de un usuario que cambió, en este worker y en los demás."""
+    _forget_user(user_id)
+    invalidation.publish("read_cache", user_id)
+
+
+def _plan(entry, fresh_if):
+    """'fresh', 'revalidate' o 'fetch' según la edad de la copia y fresh_if(valor)."""
+    if entry is None:
+        return "fetch", 0.0
+    age = time.time() - entry.fetched_at
+    if fresh_if is not None and not fresh_if(entry.value):
+        return "fetch", age
+    if age <= READ_CACHE_TTL:
+        return "fresh", age
+    if age <= READ_CACHE_TTL + READ_CACHE_SWR:
+        return "revalidate", age
+    return "fetch", age
+
+
+def _claim(kind, key):
+    with _lock:
+        if (kind, key) in _refreshing:
+            return False
+        _refreshing.add((kind, key))
+        return True
+
+
+def _serve_stale(kind, key, entry, age, error):
+    """Copia a servir cuando Keycloak falla, o None si no hay ninguna dentro de la gracia."""
+    if entry is None or age > READ_CACHE_TTL + READ_CACHE_GRACE:
+        return None
+    logger.warning("[read_cache] Keycloak no responde (%s), se sirve %s:%s de hace %.0fs",
+                   error, kind, key, age)
+    _note(STALE_IF_ERROR, age)
+    return entry
+
+
+def read(kind, key, fetch, fresh_if=None, user_id=None, errors=UPSTREAM_ERRORS):
+    """
+    Lee un valor a través de la caché.
+
+    Args:
+        kind (str): Tipo de lectura ('roster', 'profile', 'user')
+        key (str): Clave dentro del tipo
+        fetch (callable): Consulta Keycloak; retorna el valor, None si no existe
+                          (no se guarda ni se sirve la copia) o lanza uno de errors
+        fresh_if (callable): fresh_if(valor) es False si la copia ya no es válida
+                             aunque no haya caducado; solo se sirve si Keycloak falla
+        user_id (str): Usuario al que pertenece la entrada, para invalidarla
+
+    Raises:
+        errors: Si Keycloak falla y no hay copia dentro de la gracia
+    """
+    entry = _lookup(kind, key)
+    plan, age = _plan(entry, fresh_if)
+    if plan == "fresh":
+        _note(HIT, age)
+        return entry.value
+    if plan == "revalidate":
+        _note(STALE, age)
+        if _claim(kind, key):
+            threading.Thread(target=_refresh, args=(kind, key, fetch, user_id), daemon=True,
+                             name="read-cache-refresh").start()
+        return entry.value
+    try:
+        value = fetch()
+    except errors as e:
+        stale = _serve_stale(kind, key, entry, age, e)
+        if stale is None:
+            raise
+        return stale.value
+    _note(MISS)
+    _store(kind, key, value, user_id)
+    return value
+
+
+async def read_async(kind, key, fetch, fresh_if=None, user_id=None, errors=UPSTREAM_ERRORS):
+    """Equivalente de read para el modo ASGI: fetch es una función async."""
+    entry = _lookup(kind, key)
+    plan, age = _plan(entry, fresh_if)
+    if plan == "fresh":
+        _note(HIT, age)
+        return entry.value
+    if plan == "revalidate":
+        _note(STALE, age)
+        if _claim(kind, key):
+            # Contexto vacío: el refresco no pertenece a la petición que lo lanzó
+            task = asyncio.get_running_loop().create_task(_refresh_async(kind, key, fetch, user_id),
+                                                          context=contextvars.Context())
+            _tasks.add(task)
+            task.add_done_callback(_tasks.discard)
+        return entry.value
+    try:
+        value = await fetch()
+    except errors as e:
+        stale = _serve_stale(kind, key, entry, age, e)
+        if stale is None:
+            raise
+        return stale.value
+    _note(MISS)
+    _store(kind, key, value, user_id)
+    return value
+
+
+def _refresh(kind, key, fetch, user_id):
+    try:
+        _store(kind, key, fetch(), user_id)
+    except Exception as e:
+        logger.warning("[read_cache] No se pudo refrescar %s:%s: %s", kind, key, e)
+    finally:
+        with _lock:
+            _refreshing.discard((kind, key))
+
+
+async def _refresh_async(kind, key, fetch, user_id):
+    try:
+        _store(kind, key, await fetch(), user_id)
+    except Exception as e:
+        logger.warning("[read_cache] No se pudo refrescar %s:%s: %s", kind, key, e)
+    finally:
+        with _lock:
+            _refreshing.discard((kind, key))
+
+
+# ----------------------------------------------------------------------
+# Introspección
+# ----------------------------------------------------------------------
+def remember_introspection(token, result):
+    """Guarda la última introspección activa de un token para la gracia (como mucho hasta su exp)."""
+    ttl = READ_CACHE_GRACE
+    if result.get("exp"):
+        ttl = min(ttl, result["exp"] - time.time())
+    if ttl > 0:
+        shared_cache().set(token_key("introspect_last", token), {"result": result, "at": time.time()}, ttl)
+
+
+def last_introspection(token):
+    """
+    Última introspección activa del token, para responder mientras Keycloak no
+    responde. Retorna None si no hay ninguna dentro de la gracia.
+    """
+    try:
+        last = shared_cache().get(token_key("introspect_last", token))
+    except Exception as e:
+        logger.error("[read_cache] Error leyendo la caché compartida: %s", e)
+        return None
+    if not last:
+        return None
+    _note(STALE_IF_ERROR, time.time() - last["at"])
+    return last["result"]
+
+
+def forget_introspection(token):
+    shared_cache().delete(token_key("introspect_last", token))
+
+
+# ----------------------------------------------------------------------
+# Invalidación y memoria
+# ----------------------------------------------------------------------
+def _on_roster_event(event):
+    if event.kind in ("upsert", "delete"):
+        _forget_user(event.user_id)
+    elif event.kind == "evict":
+        forget("roster", event.owner_id)
+
+
+def _memory_stats():
+    with _lock:
+        return len(_entries), memory_guard.estimate_size(_entries)
+
+
+def _evict_locked(fraction):
+    now = time.time()
+    expired = [entry_key for entry_key, entry in _entries.items() if now - entry.fetched_at > _max_age()]
+    for entry_key in expired:
+        _drop(entry_key)
+    oldest = sorted(_entries, key=lambda entry_key: _entries[entry_key].fetched_at)
+    victims = oldest[:int(len(oldest) * fraction)]
+    for entry_key in victims:
+        _drop(entry_key)
+    return len(expired) + len(victims)
+
+
+def evict(fraction):
+    """Descarta las entradas caducadas y la fracción de las restantes más antiguas."""
+    with _lock:
+        return _evict_locked(fraction)
+
+
+def _after_fork_in_child():
+    global _lock
+    _lock = threading.Lock()
+    # Los hilos de refresco no sobreviven al fork
+    _refreshing.clear()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+roster_changes.subscribe(_on_roster_event)
+invalidation.subscribe("read_cache", lambda user_id, version: _forget_user(user_id))
+memory_guard.register_cache("read_cache", _memory_stats, evict)
@@ -0,0 +1,419 @@
+# roster_changes.py
+# Registro de cambios para la sincronización delta de rosters.
+#
+# Cada profesor (roster) tiene una versión que crece de forma monótona con cada
+# alta, modificación o baja de uno de sus alumnos. Los cambios se guardan en un
+# log acotado; cuando el log se trunca y el cliente pide cambios anteriores al
+# inicio del log, se le indica que debe recargar el roster completo.
+#
+# El log vive en la caché compartida (shared_cache), así que cualquier worker del
+# host responde los deltas de una versión obtenida en otro. La versión que ven los
+# clientes es un token opaco '<época>.<contador>': la época se genera al crear el
+# log, y una versión de un log anterior (caducado o perdido con un reinicio) no
+# coincide en la época y se responde resync_required.
+#
+# Cada worker guarda además en memoria los usuarios conocidos de sus rosters y la
+# versión del log que ya aplicó; al sincronizar aplica primero los cambios que
+# registraron los demás workers, de modo que solo llegan al log las diferencias
+# con Keycloak hechas fuera de esta API.
+
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+from cache import shared_cache
+from config import ROSTER_CHANGELOG_SIZE
+import invalidation
+import memory_guard
+
+# Evento emitido a los suscriptores cada vez que un roster cambia.
+# kind es 'load' (primera carga completa; user es la lista de usuarios), 'upsert',
+# 'delete' o 'evict' (el roster se descartó de memoria; los índices derivados deben
+# descartarlo también); en upsert user es la representación de Keycloak, en el resto None.
+RosterEvent = namedtuple('RosterEvent', ['owner_id', 'kind', 'user_id', 'user', 'version'])
+
+_lock = threading.Lock()
+# Estado por profesor: owner_id -> _Roster
+_rosters = {}
+# Funciones que reciben un RosterEvent por cada cambio registrado
+_listeners = []
+
+# Clave del log compartido de un roster en shared_cache
+_LOG_KEY = "roster_log:{}"
+# Un log sin cambios durante este tiempo (s) caduca; el siguiente empieza otra época
+_LOG_TTL = 24 * 3600
+# Campos del usuario guardados en el log: los de /api/users y los que usan los
+# índices derivados (roster_stats). Nunca las credenciales de un alta.
+_LOG_FIELDS = ("id", "username", "email", "firstName", "lastName", "enabled", "createdTimestamp", "attributes")
+
+
+class _Roster:
+    """Estado de un roster en este worker: usuarios conocidos y versión del log aplicada."""
+
+    __slots__ = ('epoch', 'seen', 'known', 'loaded', 'stale', 'used_at')
+
+    def __init__(self):
+        # Época y versión del log compartido hasta la que 'known' está al día
+        self.epoch = None
+        self.seen = 0
+        self.known = {}
+        # Indica si el roster ya se sincronizó con una lista completa de Keycloak
+        self.loaded = False
+        # Otro worker modificó el roster: debe sincronizarse antes de responder
+        self.stale = False
+        # Último uso, para descartar primero los rosters menos usados
+        self.used_at = time.monotonic()
+
+    def token(self):
+        """Versión tal como la ven los clientes: '<época>.<contador>'."""
+        return _token(self.epoch, self.seen)
+
+
+def _token(epoch, version):
+    return f"{epoch}.{version}"
+
+
+def _new_log():
+    return {"epoch": uuid.uuid4().hex[:12], "version": 0, "floor": 0, "log": []}
+
+
+def _shared_log(owner_id, create=False):
+    """
+    Log compartido del roster: {"epoch", "version", "floor", "log"}, donde log es
+    una lista de [versión, kind, user_id, usuario] y floor la versión más antigua a
+    partir de la cual está completo. None si no existe y create es False.
+    """
+    if create:
+        return shared_cache().update(_LOG_KEY.format(owner_id), lambda current: current or _new_log(), _LOG_TTL)
+    return shared_cache().get(_LOG_KEY.format(owner_id))
+
+
+def _append(owner_id, roster, changes):
+    """
+    Añade al log compartido los cambios [(kind, user_id, usuario)] y retorna sus
+    versiones. El roster avanza hasta la nueva versión solo si no había cambios de
+    otro worker pendientes de aplicar; si los había, los aplica la próxima
+    sincronización.
+    """
+    before = {}
+
+    def update(current):
+        current = current or _new_log()
+        before.update(epoch=current["epoch"], version=current["version"])
+        version = current["version"]
+        log = list(current["log"])
+        for kind, user_id, user in changes:
+            version += 1
+            log.append([version, kind, user_id, user])
+        floor = current["floor"]
+        if len(log) > ROSTER_CHANGELOG_SIZE:
+            floor = log[-ROSTER_CHANGELOG_SIZE - 1][0]
+            log = log[-ROSTER_CHANGELOG_SIZE:]
+        return {"epoch": current["epoch"], "version": version, "floor": floor, "log": log}
+
+    state = shared_cache().update(_LOG_KEY.format(owner_id), update, _LOG_TTL)
+    if before["version"] == 0 or (before["epoch"], before["version"]) == (roster.epoch, roster.seen):
+        roster.epoch, roster.seen = state["epoch"], state["version"]
+    first = state["version"] - len(changes) + 1
+    return [_token(state["epoch"], version) for version in range(first, state["version"] + 1)]
+
+
+def _catch_up(owner_id, roster, state):
+    """
+    Aplica a los usuarios conocidos los cambios del log posteriores a la versión del
+    roster. Retorna (eventos, False) si el log ya no cubre esa versión.
+    """
+    if state is None or state["epoch"] != roster.epoch or roster.seen < state["floor"]:
+        return [], False
+    events = []
+    for version, kind, user_id, user in state["log"]:
+        if version <= roster.seen:
+            continue
+        token = _token(state["epoch"], version)
+        if kind == 'upsert':
+            payload = serialize_user(user)
+            if roster.known.get(user_id) != payload:
+                roster.known[user_id] = payload
+                events.append(RosterEvent(owner_id, 'upsert', user_id, user, token))
+        elif roster.known.pop(user_id, None) is not None:
+            events.append(RosterEvent(owner_id, 'delete', user_id, None, token))
+    roster.seen = max(roster.seen, state["version"])
+    return events, True
+
+
+def owner_of(user):
+    """
+    Retorna el ID del profesor que creó al usuario (atributo 'created_by').
+
+    Args:
+        user (dict): Representación del usuario en Keycloak
+
+    Returns:
+        str: ID del creador o None si el usuario no tiene creador
+    """
+    creator = (user.get("attributes") or {}).get("created_by")
+    return creator[0] if isinstance(creator, list) and creator else creator or None
+
+
+def serialize_user(user):
+    """
+    Convierte un usuario de Keycloak al formato que expone /api/users,
+    aplanando los atributos en listas a su primer valor.
+    """
+    processed_attributes = {}
+    for key, value in (user.get("attributes") or {}).items():
+        processed_attributes[key] = value[0] if isinstance(value, list) and value else value
+
+    return {
+        "id": user.get("id"),
+        "username": user.get("username"),
+        "email": user.get("email"),
+        "firstName": user.get("firstName", ""),
+        "lastName": user.get("lastName", ""),
+        "attributes": processed_attributes
+    }
+
+
+def subscribe(listener):
+    """
+    Registra una función que recibirá un RosterEvent por cada cambio.
+    Los suscriptores se invocan fuera del lock y sus errores no afectan al registro.
+    """
+    _listeners.append(listener)
+
+
+def _notify(events):
+    for event in events:
+        for listener in list(_listeners):
+            try:
+                listener(event)
+            except Exception:
+                # Un índice derivado defectuoso no debe romper la mutación
+                pass
+
+
+def _get_roster(owner_id):
+    roster = _rosters.get(owner_id)
+    if roster is None:
+        roster = _rosters[owner_id] = _Roster()
+    return roster
+
+
+def current_version(owner_id):
+    """Retorna la versión actual del roster o None si todavía no se ha cargado."""
+    with _lock:
+        roster = _rosters.get(owner_id)
+        return roster.token() if roster and roster.loaded else None
+
+
+def is_stale(owner_id):
+    """Indica si otro worker modificó el roster y debe sincronizarse con Keycloak."""
+    with _lock:
+        roster = _rosters.get(owner_id)
+        return bool(roster and roster.stale)
+
+
+def known_user(user_id, owner_id=None):
+    """
+    Última representación conocida de un usuario (formato serialize_user) en el roster
+    de owner_id o, sin él, en cualquiera de los cargados en este worker.
+    Retorna None si no está en memoria.
+    """
+    with _lock:
+        rosters = [_rosters.get(owner_id)] if owner_id else list(_rosters.values())
+        for roster in rosters:
+            if roster is not None and user_id in roster.known:
+                payload = roster.known[user_id]
+                return {**payload, "attributes": dict(payload.get("attributes") or {})}
+    return None
+
+
+def _on_invalidation(owner_id, version):
+    # Se conserva el log y la versión: la próxima sincronización registra la
+    # diferencia como cambios normales y los clientes delta no tienen que recargar
+    with _lock:
+        roster = _rosters.get(owner_id)
+        if roster and roster.loaded:
+            roster.stale = True
+
+
+def _log_user(user):
+    return {field: user[field] for field in _LOG_FIELDS if field in user}
+
+
+def record_upsert(user, owner_id=None):
+    """
+    Registra el alta o modificación de un usuario en el roster de su creador.
+
+    Args:
+        user (dict): Representación del usuario en Keycloak (atributos en listas)
+        owner_id (str): ID del profesor; por defecto se toma de 'created_by'
+
+    Returns:
+        str: Nueva versión del roster, o None si el usuario no pertenece a ningún roster
+    """
+    owner_id = owner_id or owner_of(user)
+    user_id = user.get("id")
+    if not owner_id or not user_id:
+        return None
+
+    payload = serialize_user(user)
+    with _lock:
+        roster = _get_roster(owner_id)
+        if roster.known.get(user_id) == payload:
+            return roster.token()
+        roster.known[user_id] = payload
+        version, = _append(owner_id, roster, [('upsert', user_id, _log_user(user))])
+
+    _notify([RosterEvent(owner_id, 'upsert', user_id, user, version)])
+    invalidation.publish("roster", owner_id)
+    return version
+
+
+def record_delete(user_id, owner_id):
+    """
+    Registra la baja de un usuario en el roster de su creador.
+
+    Returns:
+        str: Nueva versión del roster, o None si no hay roster para el creador
+    """
+    if not owner_id or not user_id:
+        return None
+
+    with _lock:
+        roster = _get_roster(owner_id)
+        roster.known.pop(user_id, None)
+        version, = _append(owner_id, roster, [('delete', user_id, None)])
+
+    _notify([RosterEvent(owner_id, 'delete', user_id, None, version)])
+    invalidation.publish("roster", owner_id)
+    return version
+
+
+def sync(owner_id, users):
+    """
+    Sincroniza el roster con la lista completa obtenida de Keycloak. Primero se
+    aplican los cambios que otros workers registraron en el log compartido; las
+    diferencias restantes (cambios hechos fuera de esta API) se registran en el log.
+
+    Args:
+        owner_id (str): ID del profesor
+        users (list): Usuarios del profesor en formato Keycloak
+
+    Returns:
+        str: Versión del roster tras la sincronización
+    """
+    with _lock:
+        roster = _get_roster(owner_id)
+        is_new = not roster.loaded
+        roster.loaded = True
+        roster.stale = False
+        roster.used_at = time.monotonic()
+        state = _shared_log(owner_id, create=is_new)
+        if is_new:
+            # En la primera carga no hay clientes de este worker con versiones previas:
+            # la lista de Keycloak corresponde a la versión actual del log
+            events, caught_up = [], False
+        else:
+            events, caught_up = _catch_up(owner_id, roster, state)
+
+        changes, changed = [], []
+        seen = set()
+        for user in users:
+            user_id = user.get("id")
+            if not user_id:
+                continue
+            seen.add(user_id)
+            payload = serialize_user(user)
+            if roster.known.get(user_id) == payload:
+                continue
+            roster.known[user_id] = payload
+            if not is_new:
+                changes.append(('upsert', user_id, _log_user(user)))
+                changed.append(user)
+
+        for user_id in [uid for uid in roster.known if uid not in seen]:
+            del roster.known[user_id]
+            changes.append(('delete', user_id, None))
+            changed.append(None)
+
+        if changes:
+            versions = _append(owner_id, roster, changes)
+            events.extend(RosterEvent(owner_id, kind, user_id, user, version)
+                          for (kind, user_id, _), user, version in zip(changes, changed, versions))
+        if not caught_up:
+            # La lista de Keycloak reemplaza lo que el log ya no cubre
+            state = _shared_log(owner_id, create=True)
+            roster.epoch, roster.seen = state["epoch"], state["version"]
+
+        version = roster.token()
+        if is_new:
+            events.append(RosterEvent(owner_id, 'load', None, list(users), version))
+
+    _notify(events)
+    return version
+
+
+def changes_since(owner_id, since):
+    """
+    Retorna los cambios del roster posteriores a una versión, registrados por
+    cualquier worker.
+
+    Args:
+        owner_id (str): ID del profesor
+        since (str): Última versión que tiene el cliente (X-Roster-Version)
+
+    Returns:
+        dict: {"version", "upserted", "deleted"} o {"version", "resync_required": True}
+              cuando la versión es de otra época o el log ya no la cubre
+    """
+    with _lock:
+        roster = _rosters.get(owner_id)
+        if roster:
+            roster.used_at = time.monotonic()
+    state = _shared_log(owner_id)
+    epoch, _, counter = (since or "").rpartition(".")
+    if (state is None or epoch != state["epoch"] or not counter.isdigit()
+            or not state["floor"] <= int(counter) <= state["version"]):
+        return {
+            "version": _token(state["epoch"], state["version"]) if state else current_version(owner_id),
+            "resync_required": True
+        }
+
+    # Solo el último cambio de cada usuario es relevante para el cliente
+    latest = {}
+    for version, kind, user_id, user in state["log"]:
+        if version > int(counter):
+            latest[user_id] = (kind, user)
+
+    upserted = [serialize_user(user) for kind, user in latest.values() if kind == 'upsert']
+    deleted = [user_id for user_id, (kind, _) in latest.items() if kind == 'delete']
+    return {"version": _token(state["epoch"], state["version"]), "upserted": upserted, "deleted": deleted}
+
+
+def _memory_stats():
+    with _lock:
+        return len(_rosters), memory_guard.estimate_size(_rosters)
+
+
+def evict(fraction):
+    """
+    Descarta de memoria la fracción de rosters menos usados. Un roster descartado se
+    vuelve a cargar desde Keycloak en su próxima consulta; el log compartido se
+    conserva, así que las versiones que tienen los clientes siguen siendo válidas.
+
+    Returns:
+        int: Número de rosters descartados
+    """
+    with _lock:
+        by_use = sorted(_rosters.items(), key=lambda item: item[1].used_at)
+        victims = by_use[:int(len(by_use) * fraction)]
+        for owner_id, _ in victims:
+            del _rosters[owner_id]
+    _notify([RosterEvent(owner_id, 'evict', None, None, roster.token()) for owner_id, roster in victims])
+    return len(victims)
+
+
+invalidation.subscribe("roster", _on_invalidation)
+memory_guard.register_cache("rosters", _memory_stats, evict)
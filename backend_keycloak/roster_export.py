@@ -0,0 +1,201 @@
+# roster_export.py
+# Exportación en streaming de usuarios de Keycloak a CSV o NDJSON.
+#
+# Los usuarios se leen de Keycloak página a página (first/max) y cada fila se
+# escribe en cuanto se lee, por lo que la memoria usada depende del tamaño de
+# página y no del número de usuarios exportados.
+#
+# Si Keycloak falla a mitad de la exportación el código 200 ya se envió, así que el
+# stream termina con una marca de error (ERROR_MARKER) para que el cliente no tome
+# un fichero truncado por completo: en NDJSON una última línea {"error": ...} y en
+# CSV una última fila cuyo primer campo es '#error'.
+
+import csv
+import io
+import json
+import logging
+
+import requests
+
+from auth import get_request_settings
+from config import KEYCLOAK_ADMIN_URL, REALM, EXPORT_PAGE_SIZE
+import keycloak_http
+
+logger = logging.getLogger(__name__)
+
+# Campos propios de la representación de Keycloak; el resto de columnas son atributos
+USER_FIELDS = ("id", "username", "email", "firstName", "lastName", "enabled", "emailVerified", "createdTimestamp")
+
+DEFAULT_COLUMNS = (
+    "id", "username", "email", "firstName", "lastName", "enabled", "createdTimestamp",
+    "gender", "birth_date", "phone_number", "created_by",
+)
+
+# Primer campo de la fila final de un CSV incompleto
+ERROR_MARKER = "#error"
+# Mensaje para el cliente; el detalle del fallo solo se registra en el log
+INCOMPLETE_MESSAGE = "Exportación incompleta: no se pudo obtener usuarios de Keycloak"
+
+FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson",
+}
+
+
+class ExportError(Exception):
+    """Error al leer una página de usuarios desde Keycloak."""
+
+
+def iter_realm_users(get_token, page_size=EXPORT_PAGE_SIZE):
+    """
+    Recorre todos los usuarios del realm página a página.
+
+    Args:
+        get_token (callable): Retorna un token administrativo vigente; se invoca en
+                              cada página para que una exportación larga sobreviva
+                              a la renovación del token
+        page_size (int): Usuarios por página
+
+    Yields:
+        dict: Usuario en formato Keycloak
+    """
+    users_url = f"{KEYCLOAK_ADMIN_URL}/admin/realms/{REALM}/users"
+    first = 0
+    while True:
+        admin_token = get_token()
+        if not admin_token:
+            raise ExportError("No se pudo obtener token administrativo")
+        try:
+            resp = keycloak_http.get(
+                users_url,
+                headers={"Authorization": f"Bearer {admin_token}"},
+                params={"first": first, "max": page_size, "briefRepresentation": "false"},
+                **get_request_settings()
+            )
+        except requests.RequestException as e:
+            raise ExportError(f"Error de conexión obteniendo usuarios: {e}") from e
+        if resp.status_code != 200:
+            raise ExportError(f"Error obteniendo usuarios ({resp.status_code}): {resp.text}")
+        try:
+            page = resp.json()
+        except ValueError as e:
+            # Un proxy intermedio puede responder 200 con una página HTML
+            raise ExportError(f"Respuesta no JSON obteniendo usuarios: {e}") from e
+        if not isinstance(page, list):
+            raise ExportError(f"Respuesta inesperada obteniendo usuarios: {type(page).__name__}")
+
+        for user in page:
+            yield user
+        if len(page) < page_size:
+            return
+        first += page_size
+
+
+def parse_columns(value):
+    """Convierte el parámetro 'columns' (separado por comas) en una tupla de columnas."""
+    if not value:
+        return DEFAULT_COLUMNS
+    columns = tuple(c.strip() for c in value.split(",") if c.strip())
+    return columns or DEFAULT_COLUMNS
+
+
+def flatten_user(user, columns):
+    """
+    Retorna los valores de las columnas pedidas para un usuario (None si no existen).
+    Los atributos de Keycloak (listas) se aplanan uniendo sus valores con '|'.
+    """
+    attrs = user.get("attributes") or {}
+    row = {}
+    for column in columns:
+        if column in USER_FIELDS:
+            value = user.get(column)
+        else:
+            value = attrs.get(column)
+            if isinstance(value, list):
+                value = "|".join(str(v) for v in value)
+        row[column] = value
+    return row
+
+
+def stream_csv(users, columns):
+    """Genera el CSV fila a fila reutilizando un único buffer."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        chunk = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return chunk
+
+    writer.writerow(columns)
+    yield flush()
+    for user in users:
+        row = flatten_user(user, columns)
+        writer.writerow(["" if row[column] is None else row[column] for column in columns])
+        yield flush()
+
+
+def stream_ndjson(users, columns):
+    """Genera un objeto JSON por línea."""
+    for user in users:
+        yield json.dumps(flatten_user(user, columns), ensure_ascii=False) + "\n"
+
+
+def export_header(columns, export_format):
+    """Retorna la cabecera del formato pedido (vacía en NDJSON)."""
+    if export_format != "csv":
+        return ""
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(columns)
+    return buffer.getvalue()
+
+
+def export_row(user, columns, export_format):
+    """Serializa un único usuario; lo usa la exportación asíncrona de asgi.py."""
+    row = flatten_user(user, columns)
+    if export_format != "csv":
+        return json.dumps(row, ensure_ascii=False) + "\n"
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow(["" if row[column] is None else row[column] for column in columns])
+    return buffer.getvalue()
+
+
+def export_error(export_format, message=INCOMPLETE_MESSAGE):
+    """Marca final de una exportación interrumpida en el formato pedido."""
+    if export_format != "csv":
+        return json.dumps({"error": message}, ensure_ascii=False) + "\n"
+    buffer = io.StringIO()
+    csv.writer(buffer).writerow([ERROR_MARKER, message])
+    return buffer.getvalue()
+
+
+def stream_export(users, columns, export_format):
+    """
+    Serializa los usuarios en el formato pedido ('csv' o 'ndjson'). Si Keycloak falla
+    a mitad de la exportación ya no se puede cambiar el código de estado, así que el
+    error se registra y el stream termina con la marca de export_error.
+    """
+    serializer = stream_csv if export_format == "csv" else stream_ndjson
+    try:
+        yield from serializer(users, columns)
+    except ExportError as e:
+        logger.error("[roster_export] Exportación interrumpida: %s", e)
+        yield export_error(export_format)
+
+
+async def stream_export_async(users, columns, export_format, errors=()):
+    """
+    Equivalente de stream_export para asgi.py: users es un iterador asíncrono y
+    errors son las excepciones de conexión del cliente asíncrono, que también
+    terminan el stream con la marca de export_error.
+    """
+    header = export_header(columns, export_format)
+    if header:
+        yield header
+    try:
+        async for user in users:
+            yield export_row(user, columns, export_format)
+    except (ExportError, *errors) as e:
+        logger.error("[roster_export] Exportación interrumpida: %s", e)
+        yield export_error(export_format)
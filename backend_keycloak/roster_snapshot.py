@@ -0,0 +1,274 @@
+# roster_snapshot.py
+# Snapshot binario, compacto y de solo lectura de los usuarios del realm.
+#
+# Un único worker por host genera el fichero en segundo plano (el turno se reparte
+# con la caché compartida) y lo reemplaza de forma atómica; todos los workers lo
+# abren con mmap, así que las páginas se comparten y en el host hay una sola copia
+# del roster. Sirve las búsquedas por id (el profesor de /api/validate); el listado
+# de alumnos de cada profesor sale de read_cache, que se invalida en cada escritura.
+# Las búsquedas son binarias sobre registros de ancho fijo y retornan vistas ligeras
+# que solo decodifican los campos que se leen.
+#
+# El fichero está en RUNTIME_DIR con permisos 0600 (ver private_files.py) y no se
+# abre uno que pertenezca a otro usuario.
+#
+# Formato (little endian):
+#   cabecera   magic "RSNP", versión, nº de registros, fecha de generación y offsets
+#   registros  uno por usuario, ordenados por id: 9 referencias (offset, longitud)
+#              a la tabla de cadenas, createdTimestamp (int64) y enabled (uint8)
+#   cadenas    UTF-8 concatenado y sin repetir
+
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+
+from auth import get_admin_token
+from cache import shared_cache
+from config import ROSTER_SNAPSHOT_PATH, ROSTER_SNAPSHOT_INTERVAL
+import private_files
+import roster_changes
+import roster_export
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"RSNP"
+FORMAT_VERSION = 2
+_HEADER = struct.Struct("<4sHxxIdQQ")
+_RECORD = struct.Struct("<18IqB7x")
+_REF = struct.Struct("<II")
+
+# Campos de texto de cada registro, en orden
+_FIELDS = ("id", "owner_id", "username", "email", "firstName", "lastName",
+           "gender", "birth_date", "phone_number")
+_ATTRIBUTE_FIELDS = ("gender", "birth_date", "phone_number")
+_ID = 0
+
+# Segundos entre comprobaciones de si el fichero fue reemplazado
+_REOPEN_CHECK = 1.0
+# Segundos de espera antes de reintentar una generación fallida
+RETRY_INTERVAL = 30
+
+
+def _first(value):
+    return value[0] if isinstance(value, list) and value else value
+
+
+def write_snapshot(users, path=ROSTER_SNAPSHOT_PATH):
+    """
+    Escribe el snapshot de una secuencia de usuarios de Keycloak. El fichero se
+    escribe en un temporal (0600, en el mismo directorio privado) y se reemplaza con
+    os.replace, de modo que los lectores ven el snapshot anterior o el nuevo, nunca
+    uno a medias.
+
+    Returns:
+        int: Número de usuarios escritos
+    """
+    strings = bytearray()
+    interned = {}
+
+    def ref(data):
+        if data not in interned:
+            interned[data] = (len(strings), len(data))
+            strings.extend(data)
+        return interned[data]
+
+    rows = []
+    for user in users:
+        attrs = user.get("attributes") or {}
+        values = [user.get("id"), roster_changes.owner_of(user), user.get("username"),
+                  user.get("email"), user.get("firstName"), user.get("lastName")]
+        values += [_first(attrs.get(name)) for name in _ATTRIBUTE_FIELDS]
+        encoded = [b"" if v is None else str(v).encode("utf-8") for v in values]
+        rows.append((encoded, user.get("createdTimestamp") or 0, bool(user.get("enabled", True))))
+
+    rows.sort(key=lambda row: row[0][_ID])
+
+    records = bytearray()
+    for encoded, created, enabled in rows:
+        refs = []
+        for data in encoded:
+            refs.extend(ref(data))
+        records.extend(_RECORD.pack(*refs, created, enabled))
+
+    records_off = _HEADER.size
+    strings_off = records_off + len(records)
+
+    private_files.ensure_dir(os.path.dirname(os.path.abspath(path)))
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o600)
+    with open(fd, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, FORMAT_VERSION, len(rows), time.time(), records_off, strings_off))
+        f.write(records)
+        f.write(strings)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return len(rows)
+
+
+class UserView:
+    """Vista de un registro del snapshot; los campos se decodifican al leerlos."""
+
+    __slots__ = ("_snapshot", "_record")
+
+    def __init__(self, snapshot, record):
+        self._snapshot = snapshot
+        self._record = record
+
+    def _field(self, position):
+        return self._snapshot._string(self._record, position) or None
+
+    id = property(lambda self: self._field(0))
+    owner_id = property(lambda self: self._field(1))
+    username = property(lambda self: self._field(2))
+    email = property(lambda self: self._field(3))
+    first_name = property(lambda self: self._field(4))
+    last_name = property(lambda self: self._field(5))
+    gender = property(lambda self: self._field(6))
+    birth_date = property(lambda self: self._field(7))
+    phone_number = property(lambda self: self._field(8))
+
+    @property
+    def created_timestamp(self):
+        return self._snapshot._fixed(self._record)[0] or None
+
+    @property
+    def enabled(self):
+        return bool(self._snapshot._fixed(self._record)[1])
+
+    def to_dict(self):
+        """Retorna el usuario en el formato que expone /api/users."""
+        attributes = {name: self._field(position)
+                      for position, name in enumerate(_FIELDS) if name in _ATTRIBUTE_FIELDS}
+        attributes = {k: v for k, v in attributes.items() if v is not None}
+        if self.owner_id:
+            attributes["created_by"] = self.owner_id
+        return {
+            "id": self.id,
+            "username": self.username,
+            "email": self.email,
+            "firstName": self.first_name or "",
+            "lastName": self.last_name or "",
+            **attributes,
+        }
+
+
+class RosterSnapshot:
+    """Snapshot abierto con mmap."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            private_files.check_owner(path, os.fstat(f.fileno()))
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, count, built_at, records_off, strings_off = _HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"Snapshot con formato desconocido: {path}")
+        self.count = count
+        self.built_at = built_at
+        self._records_off = records_off
+        self._strings_off = strings_off
+
+    def _refs(self, record):
+        return _RECORD.unpack_from(self._mm, self._records_off + record * _RECORD.size)
+
+    def _raw(self, record, position):
+        offset, length = _REF.unpack_from(self._mm, self._records_off + record * _RECORD.size + position * _REF.size)
+        offset += self._strings_off
+        return self._mm[offset:offset + length]
+
+    def _string(self, record, position):
+        return self._raw(record, position).decode("utf-8")
+
+    def _fixed(self, record):
+        return self._refs(record)[18:]
+
+    def get(self, user_id):
+        """Busca un usuario por id. Retorna un UserView o None."""
+        key = user_id.encode("utf-8")
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            current = self._raw(mid, _ID)
+            if current < key:
+                lo = mid + 1
+            elif current > key:
+                hi = mid
+            else:
+                return UserView(self, mid)
+        return None
+
+    def __len__(self):
+        return self.count
+
+
+_lock = threading.Lock()
+# Snapshot abierto en este proceso y la identidad del fichero del que viene
+_state = {"snapshot": None, "file_id": None, "checked_at": 0, "building": False, "attempted_at": 0}
+
+
+def current():
+    """
+    Retorna el snapshot vigente (reabriéndolo si otro worker lo reemplazó) o None
+    si todavía no existe. Las vistas ya entregadas siguen siendo válidas: mantienen
+    abierto el mmap anterior hasta que dejan de usarse.
+    """
+    now = time.time()
+    with _lock:
+        if now - _state["checked_at"] < _REOPEN_CHECK:
+            return _state["snapshot"]
+        _state["checked_at"] = now
+        try:
+            st = os.stat(ROSTER_SNAPSHOT_PATH)
+        except FileNotFoundError:
+            return _state["snapshot"]
+        file_id = (st.st_ino, st.st_mtime_ns)
+        if file_id != _state["file_id"]:
+            try:
+                _state["snapshot"] = RosterSnapshot(ROSTER_SNAPSHOT_PATH)
+                _state["file_id"] = file_id
+            except (OSError, ValueError) as e:
+                logger.error("[roster_snapshot] No se pudo abrir el snapshot: %s", e)
+        return _state["snapshot"]
+
+
+def get_user(user_id):
+    """Busca un usuario en el snapshot vigente. Retorna un UserView o None."""
+    snapshot = current()
+    return snapshot.get(user_id) if snapshot and user_id else None
+
+
+def _build():
+    count = write_snapshot(roster_export.iter_realm_users(get_admin_token))
+    logger.info("[roster_snapshot] Snapshot generado con %s usuarios", count)
+    return time.time(), ROSTER_SNAPSHOT_INTERVAL
+
+
+def _build_in_background():
+    try:
+        # La entrada caduca a los ROSTER_SNAPSHOT_INTERVAL segundos y solo el worker que
+        # obtiene el lease la recalcula, así que el fichero se genera una vez por host.
+        # Recorrer el realm puede durar más que CACHE_LEASE_TIMEOUT: el lease se renueva
+        # mientras dura para que otro worker no empiece una segunda generación
+        shared_cache().get_or_compute("roster_snapshot_built_at", _build, renew=True)
+    except Exception as e:
+        logger.error("[roster_snapshot] Error generando el snapshot: %s", e)
+    finally:
+        with _lock:
+            _state["building"] = False
+
+
+def ensure_fresh():
+    """Lanza la generación del snapshot en segundo plano si falta o caducó."""
+    snapshot = current()
+    if snapshot and time.time() - snapshot.built_at < ROSTER_SNAPSHOT_INTERVAL:
+        return
+    now = time.time()
+    with _lock:
+        if _state["building"] or now - _state["attempted_at"] < RETRY_INTERVAL:
+            return
+        _state["building"] = True
+        _state["attempted_at"] = now
+    threading.Thread(target=_build_in_background, daemon=True).start()
@@ -0,0 +1,233 @@
+# roster_stats.py
+# Estadísticas de roster mantenidas de forma incremental para los paneles del profesor.
+#
+# Cada roster guarda contadores (total, habilitados, por género, por tramo de edad y
+# por mes de creación) y la contribución de cada alumno a ellos. Los eventos de
+# roster_changes actualizan los contadores, por lo que servir las estadísticas no
+# requiere recorrer la lista de usuarios. Como los tramos de edad cambian con el
+# tiempo, las estadísticas se reconstruyen en segundo plano cuando caducan.
+
+import logging
+import threading
+import time
+from collections import Counter
+from datetime import date, datetime, timezone
+
+import memory_guard
+import roster_changes
+from config import ROSTER_STATS_TTL, REALM_COUNT_TTL
+
+logger = logging.getLogger(__name__)
+
+UNKNOWN = "desconocido"
+# Tramos de edad: (edad mínima, etiqueta), de mayor a menor
+AGE_BANDS = ((45, "45+"), (35, "35-44"), (25, "25-34"), (18, "18-24"), (0, "<18"))
+
+_lock = threading.Lock()
+# Estadísticas por profesor: owner_id -> _RosterStats
+_stats = {}
+# Profesores con una reconstrucción en curso
+_refreshing = set()
+# Total de usuarios del realm (GET /users/count) y su hora de obtención
+_realm_total = {"value": None, "fetched_at": 0}
+
+
+def _attr(user, name):
+    value = (user.get("attributes") or {}).get(name)
+    return value[0] if isinstance(value, list) and value else value or None
+
+
+def age_band(birth_date, today=None):
+    """
+    Retorna el tramo de edad para una fecha de nacimiento 'YYYY-MM-DD'.
+    """
+    try:
+        born = datetime.strptime(str(birth_date)[:10], "%Y-%m-%d").date()
+    except (TypeError, ValueError):
+        return UNKNOWN
+    today = today or date.today()
+    age = today.year - born.year - ((today.month, today.day) < (born.month, born.day))
+    if age < 0:
+        return UNKNOWN
+    for minimum, label in AGE_BANDS:
+        if age >= minimum:
+            return label
+    return UNKNOWN
+
+
+def _contribution(user):
+    """Valores con los que un usuario contribuye a cada contador."""
+    created = user.get("createdTimestamp")
+    if created:
+        month = datetime.fromtimestamp(created / 1000, tz=timezone.utc).strftime("%Y-%m")
+    else:
+        month = UNKNOWN
+    return (
+        user.get("enabled", True) is not False,
+        _attr(user, "gender") or UNKNOWN,
+        age_band(_attr(user, "birth_date")),
+        month,
+    )
+
+
+class _RosterStats:
+    """Contadores de un roster y la contribución de cada alumno."""
+
+    def __init__(self):
+        self.members = {}  # user_id -> contribución
+        self.enabled = 0
+        self.by_gender = Counter()
+        self.by_age_band = Counter()
+        self.by_created_month = Counter()
+        self.built_at = time.time()
+
+    def _apply(self, contribution, delta):
+        enabled, gender, band, month = contribution
+        self.enabled += delta if enabled else 0
+        for counter, key in ((self.by_gender, gender), (self.by_age_band, band),
+                             (self.by_created_month, month)):
+            counter[key] += delta
+            if counter[key] <= 0:
+                del counter[key]
+
+    def upsert(self, user):
+        user_id = user.get("id")
+        if not user_id:
+            return
+        self.remove(user_id)
+        contribution = _contribution(user)
+        self.members[user_id] = contribution
+        self._apply(contribution, 1)
+
+    def remove(self, user_id):
+        contribution = self.members.pop(user_id, None)
+        if contribution is not None:
+            self._apply(contribution, -1)
+
+    def snapshot(self):
+        total = len(self.members)
+        return {
+            "total": total,
+            "enabled": self.enabled,
+            "disabled": total - self.enabled,
+            "by_gender": dict(self.by_gender),
+            "by_age_band": dict(self.by_age_band),
+            "by_created_month": dict(sorted(self.by_created_month.items())),
+            "updated_at": int(self.built_at),
+        }
+
+
+def rebuild(owner_id, users):
+    """
+    Reemplaza las estadísticas del roster por las calculadas desde una lista completa.
+
+    Returns:
+        dict: Las estadísticas calculadas, en el formato de get_stats
+    """
+    stats = _RosterStats()
+    for user in users:
+        stats.upsert(user)
+    with _lock:
+        _stats[owner_id] = stats
+        result = stats.snapshot()
+    result["stale"] = False
+    return result
+
+
+def is_loaded(owner_id):
+    """Indica si ya hay estadísticas para el roster del profesor."""
+    with _lock:
+        return owner_id in _stats
+
+
+def get_stats(owner_id, refresh=None):
+    """
+    Retorna las estadísticas del roster. Si caducaron (ROSTER_STATS_TTL) se sirven
+    igualmente y se lanza una reconstrucción en segundo plano con 'refresh'.
+
+    Args:
+        owner_id (str): ID del profesor
+        refresh (callable): Función sin argumentos que obtiene el roster completo
+                            desde Keycloak, o None si falla
+
+    Returns:
+        dict: Estadísticas del roster, o None si el roster no está cargado
+    """
+    with _lock:
+        stats = _stats.get(owner_id)
+        if stats is None:
+            return None
+        result = stats.snapshot()
+        stale = time.time() - stats.built_at > ROSTER_STATS_TTL
+        start_refresh = stale and refresh is not None and owner_id not in _refreshing
+        if start_refresh:
+            _refreshing.add(owner_id)
+
+    result["stale"] = stale
+    if start_refresh:
+        threading.Thread(target=_refresh, args=(owner_id, refresh), daemon=True).start()
+    return result
+
+
+def _refresh(owner_id, refresh):
+    try:
+        users = refresh()
+        if users is not None:
+            # Sincronizar también el log de cambios con lo que haya cambiado fuera de la API
+            roster_changes.sync(owner_id, users)
+            rebuild(owner_id, users)
+    except Exception as e:
+        logger.error("[roster_stats] Error reconstruyendo estadísticas de %s: %s", owner_id, e)
+    finally:
+        with _lock:
+            _refreshing.discard(owner_id)
+
+
+def realm_total_stale():
+    """Indica si el total del realm en caché caducó y debe consultarse de nuevo."""
+    return time.time() - _realm_total["fetched_at"] > REALM_COUNT_TTL
+
+
+def realm_total(fetch_count):
+    """
+    Retorna el total de usuarios del realm, consultando Keycloak solo cuando el
+    valor en caché es más antiguo que REALM_COUNT_TTL.
+
+    Args:
+        fetch_count (callable): Función sin argumentos que retorna el total o None
+    """
+    if realm_total_stale():
+        count = fetch_count()
+        if count is not None:
+            _realm_total["value"] = count
+            _realm_total["fetched_at"] = time.time()
+    return _realm_total["value"]
+
+
+def _on_roster_event(event):
+    if event.kind == 'load':
+        rebuild(event.owner_id, event.user)
+        return
+    if event.kind == 'evict':
+        with _lock:
+            _stats.pop(event.owner_id, None)
+        return
+    with _lock:
+        stats = _stats.get(event.owner_id)
+        if stats is None:
+            # Las estadísticas se calcularán completas en la primera carga del roster
+            return
+        if event.kind == 'upsert':
+            stats.upsert(event.user)
+        elif event.kind == 'delete':
+            stats.remove(event.user_id)
+
+
+def _memory_stats():
+    with _lock:
+        return len(_stats), memory_guard.estimate_size(_stats)
+
+
+roster_changes.subscribe(_on_roster_event)
+# Las estadísticas se descartan junto con su roster (evento 'evict'), no por separado
+memory_guard.register_cache("roster_stats", _memory_stats)
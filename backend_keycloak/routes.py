@@ -2,25 +2,250 @@
 # Definición de los endpoints de la API utilizando Flask.
 # Cada endpoint se comunica con Keycloak para gestionar la autenticación y el perfil de usuario.
 
-import base64
-import json
+import itertools
 import logging
+import time
+import keycloak_http
+import keycloak_recording
 import requests
-from flask import Flask, request, jsonify, make_response
+from flask import Flask, Response, g, request, jsonify, make_response, stream_with_context
 from config import KEYCLOAK_URL, KEYCLOAK_ADMIN_URL, REALM, CLIENT_ID, CLIENT_SECRET
-from auth import get_admin_token, get_request_settings
+from auth import get_admin_token, get_request_settings, cached_introspection, forget_introspection
+from cache import token_key
+from auth import validate_token as validate_access_token
+import log_config
+import roster_changes
+import search_index
+import roster_stats
+import roster_export
+import availability
+import user_ops
+import metrics
+import tracing
+import profiler
+import memory_guard
+import fault_injection
+import invalidation
+import read_cache
+import mutation_queue
+import admission
+import admin_ops
+import warmup
 
-try:
-    import admin_fallback
-    FALLBACK_AVAILABLE = True
-except ImportError:
-    FALLBACK_AVAILABLE = False
-    logging.warning("Admin fallback module not available. Features will be limited if admin access fails.")
+logger = logging.getLogger(__name__)
 
+# Importar este módulo solo registra las rutas: los hilos, sockets y llamadas a
+# Keycloak del proceso empiezan en create_app()
 app = Flask(__name__)
 
-# Configuración básica del logging para mostrar mensajes de depuración
-logging.basicConfig(level=logging.DEBUG)
+def create_app():
+    """
+    Prepara el proceso y retorna la aplicación: logging asíncrono con redacción de
+    secretos (log_config), canal de invalidación entre workers, calentamiento de
+    arranque (warmup) y replay de la cola de escritura diferida (mutation_queue).
+    Se puede llamar varias veces; solo la primera tiene efecto.
+    """
+    log_config.configure()
+    invalidation.start()
+    warmup.ensure_started()
+    mutation_queue.ensure_started()
+    return app
+
+def _route_label():
+    # Se etiqueta con la regla de la ruta ('/api/users/<user_id>'), no con la URL, para acotar la cardinalidad
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+@app.before_request
+def _begin_request():
+    # Un worker creado con fork tras create_app() calienta en su primera petición
+    # (normalmente la sonda de /healthz/ready)
+    warmup.ensure_started()
+    mutation_queue.ensure_started()
+    g.request_start = time.perf_counter()
+    read_cache.begin()
+    g.request_id = tracing.begin(request.headers.get(tracing.REQUEST_ID_HEADER))
+    g.profile = profiler.start(_route_label(), request.headers.get(profiler.SIGNATURE_HEADER))
+    # Control de admisión: sin hueco en la clase de la ruta se responde 503 sin llamar a Keycloak
+    try:
+        g.admission = admission.admit(admission.classify(_route_label()))
+    except admission.Rejected as e:
+        return _shed(e)
+
+@app.after_request
+def _finish_request(response):
+    route = _route_label()
+    start = g.get("request_start")
+    if start is not None:
+        metrics.http_request_duration.observe(time.perf_counter() - start, route, request.method)
+        if keycloak_recording.recording():
+            _record_request(route, response.status_code, time.perf_counter() - start)
+    metrics.http_requests.inc(route, request.method, str(response.status_code))
+    memory_guard.ensure_checked()
+    timing = tracing.end(request.method, route, response.status_code)
+    if timing:
+        response.headers["Server-Timing"] = timing
+    if g.get("request_id"):
+        response.headers[tracing.REQUEST_ID_HEADER] = g.request_id
+    # X-Cache / Age / Warning si la respuesta salió de la caché de lecturas
+    response.headers.update(read_cache.response_headers())
+    return response
+
+def _record_request(route, status, elapsed):
+    """Graba la petición para poder reenviarla con bench/replay_traffic.py."""
+    form = bool(request.form)
+    body = request.form.to_dict() if form else request.get_json(silent=True)
+    path = request.path + (f"?{request.query_string.decode('utf-8')}" if request.query_string else "")
+    keycloak_recording.record_api(g.get("request_id"), request.method, path, route, body, form,
+                                  request.cookies.get("access_token"), status, elapsed)
+
+@app.teardown_request
+def _stop_profile(exc):
+    # teardown se ejecuta también cuando el handler lanza una excepción
+    profiler.stop(g.pop("profile", None))
+    # y, con stream_with_context, cuando termina la respuesta (las exportaciones ocupan su hueco hasta el final)
+    admission.release(g.pop("admission", None))
+
+def _shed(rejected):
+    """Respuesta 503 de una petición descartada por el control de admisión."""
+    logger.warning("[%s] Petición descartada (%s, %s)", _route_label(), rejected.route_class, rejected.reason)
+    response = jsonify({"error": "Servidor saturado, inténtalo de nuevo más tarde"})
+    response.status_code = 503
+    response.headers["Retry-After"] = str(rejected.retry_after)
+    return response
+
+def _raise_for_upstream_error(resp):
+    """
+    Un 5xx de Keycloak es indisponibilidad, no una respuesta: se convierte en
+    requests.HTTPError para que _upstream_error responda 503 en lugar de tratarlo
+    como credenciales o token inválidos.
+    """
+    if resp.status_code >= 500:
+        resp.raise_for_status()
+
+@app.errorhandler(requests.RequestException)
+def _upstream_error(e):
+    """Keycloak lento, caído o con un cuerpo que no es JSON: error JSON acotado en vez de un 500 sin formato."""
+    logger.warning("[%s] Fallo en la llamada a Keycloak: %s", _route_label(), e)
+    # Una mutación que admite la cola de escritura diferida se acepta igualmente
+    mutation = g.pop("mutation", None)
+    if mutation is not None:
+        return _defer_mutation(*mutation, upstream_failed=True)
+    if isinstance(e, requests.Timeout):
+        return jsonify({"error": "Keycloak no respondió a tiempo"}), 504
+    if isinstance(e, requests.exceptions.InvalidJSONError):
+        return jsonify({"error": "Respuesta no válida de Keycloak"}), 502
+    return jsonify({"error": "Keycloak no disponible"}), 503
+
+def _defer_mutation(kind, actor_id, token, payload, user_id=None, upstream_failed=False):
+    """
+    Cola de escritura diferida (mutation_queue). Si está activa, encola la mutación
+    sin llamar a Keycloak cuando está caído o el usuario tiene cambios anteriores en
+    cola, y la deja en g para que _upstream_error la encole si Keycloak falla a mitad
+    de la petición. Retorna la respuesta 202, o None si la petición sigue contra Keycloak.
+    """
+    if not mutation_queue.enabled():
+        return None
+    g.mutation = (kind, actor_id, token, payload, user_id)
+    if not upstream_failed and not mutation_queue.should_defer(kind, payload, user_id):
+        return None
+    g.pop("mutation", None)
+    body, status = mutation_queue.submit(kind, actor_id, token, payload, user_id,
+                                         request.headers.get(mutation_queue.IDEMPOTENCY_HEADER), upstream_failed)
+    return jsonify(body), status
+
+def _introspect_session(token):
+    """
+    Valida el token de sesión mediante introspección en Keycloak.
+    Retorna el resultado de la introspección si el token está activo, None en otro caso.
+    Los resultados activos se comparten entre workers mediante la caché compartida.
+    """
+    with tracing.span("auth"):
+        return cached_introspection(token, _introspect_form_credentials)
+
+def _introspect_form_credentials(token):
+    introspect_url = f"{KEYCLOAK_URL}/realms/{REALM}/protocol/openid-connect/token/introspect"
+    introspect_payload = {
+        "client_id": CLIENT_ID,
+        "client_secret": CLIENT_SECRET,
+        "token": token
+    }
+    request_settings = get_request_settings()
+    introspect_resp = keycloak_http.post(introspect_url, data=introspect_payload, **request_settings)
+    _raise_for_upstream_error(introspect_resp)
+    if introspect_resp.status_code != 200:
+        return None
+    data = introspect_resp.json()
+    return data if data.get("active") else None
+
+def _require_admin():
+    """
+    Comprueba que la petición venga de un administrador autenticado.
+    Retorna la respuesta de error correspondiente, o None si lo es.
+    """
+    token = request.cookies.get("access_token")
+    if not token:
+        return jsonify({"error": "No autenticado"}), 401
+    if not _introspect_session(token):
+        return jsonify({"error": "Token inválido"}), 401
+    error = user_ops.admin_error(token, "_require_admin")
+    if error:
+        body, status = error
+        return jsonify(body), status
+    return None
+
+def _fetch_roster(owner_id, admin_token):
+    """
+    Obtiene desde Keycloak los usuarios creados por un profesor.
+    Retorna la lista de usuarios en formato Keycloak o None si la consulta falla.
+    """
+    users_url = f"{KEYCLOAK_ADMIN_URL}/admin/realms/{REALM}/users"
+    headers = {"Authorization": f"Bearer {admin_token}"}
+    resp = keycloak_http.get(users_url, headers=headers, **get_request_settings())
+    if resp.status_code != 200:
+        logger.error("[fetch_roster] Error obteniendo usuarios: %s", resp.text)
+        return None
+
+    # Filtrar usuarios cuyo atributo 'created_by' coincida con el ID del profesor
+    return user_ops.filter_own_users(resp.json(), owner_id)
+
+def _fetch_user(user_id):
+    """
+    Obtiene un usuario de la Admin API. Retorna None si no existe; lanza
+    read_cache.AdminTokenUnavailable o requests.RequestException si Keycloak no responde.
+    """
+    admin_token = get_admin_token()
+    if not admin_token:
+        raise read_cache.AdminTokenUnavailable()
+    headers = {"Authorization": f"Bearer {admin_token}", "Content-Type": "application/json"}
+    resp = keycloak_http.get(f"{KEYCLOAK_ADMIN_URL}/admin/realms/{REALM}/users/{user_id}", headers=headers,
+                             **get_request_settings())
+    _raise_for_upstream_error(resp)
+    return resp.json() if resp.status_code == 200 else None
+
+def _resync_roster(owner_id, admin_token=None):
+    """
+    Vuelve a leer el roster desde Keycloak y lo sincroniza (p. ej. cuando otro
+    worker lo modificó). Retorna False si no se pudo obtener.
+    """
+    admin_token = admin_token or get_admin_token()
+    own_users = _fetch_roster(owner_id, admin_token) if admin_token else None
+    if own_users is None:
+        return False
+    roster_changes.sync(owner_id, own_users)
+    return True
+
+def _fetch_realm_user_count(admin_token):
+    """
+    Obtiene el total de usuarios del realm mediante /users/count, sin listar usuarios.
+    Retorna None si la consulta falla.
+    """
+    count_url = f"{KEYCLOAK_ADMIN_URL}/admin/realms/{REALM}/users/count"
+    headers = {"Authorization": f"Bearer {admin_token}"}
+    resp = keycloak_http.get(count_url, headers=headers, **get_request_settings())
+    if resp.status_code != 200:
+        logger.error("[fetch_realm_user_count] Error obteniendo total de usuarios: %s", resp.text)
+        return None
+    return resp.json()
 
 # ----------------------------------------------------------------------
 # ENDPOINT: Login
@@ -32,30 +257,22 @@ def login():
     realiza la autenticación contra Keycloak y retorna el token de acceso.
     """
     data = request.form
-    logging.debug(f"[login] Datos recibidos del cliente: {data}")
+    # Nunca se registra el formulario ni la carga útil: llevan la contraseña, el TOTP
+    # y el secreto del cliente
+    logger.debug("[login] Inicio de sesión de %s", data.get("username"))
 
     # Configurar la carga útil para la solicitud a Keycloak con grant_type 'password'
-    keycloak_payload = {
-        "grant_type": "password",
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "username": data["username"],
-        "password": data["password"],
-        "scope": "openid profile email"
-    }
-    # Se añade el TOTP si está presente en los datos
-    if "totp" in data:
-        keycloak_payload["totp"] = data["totp"]
+    keycloak_payload = user_ops.login_payload(data)
 
     # URL para obtener el token de acceso
     token_url = f"{KEYCLOAK_URL}/realms/{REALM}/protocol/openid-connect/token"
-    logging.debug(f"[login] Enviando POST a {token_url} con {keycloak_payload}")
+    logger.debug("[login] Enviando POST a %s", token_url)
 
     # CRITICAL FIX: Add request settings with SSL handling
     request_settings = get_request_settings()
-    response = requests.post(token_url, data=keycloak_payload, **request_settings)
-    logging.debug(f"[login] Status code: {response.status_code}")
-    logging.debug(f"[login] Response text: {response.text}")
+    response = keycloak_http.post(token_url, data=keycloak_payload, **request_settings)
+    logger.debug("[login] Status code: %s", response.status_code)
+    _raise_for_upstream_error(response)
 
     if response.status_code == 200:
         token_data = response.json()
@@ -63,30 +280,10 @@ def login():
         if not access_token:
             return jsonify({"error": "No se recibió access_token desde Keycloak"}), 401
 
-        # Decodificar el JWT para extraer la expiración (exp)
-        try:
-            token_parts = access_token.split('.')
-            # Se corrige el padding de la parte del payload en base64
-            payload_b64 = token_parts[1] + '=' * ((4 - len(token_parts[1]) % 4) % 4)
-            payload_data = json.loads(base64.urlsafe_b64decode(payload_b64))
-            exp_time = payload_data.get('exp')
-        except Exception as e:
-            logging.warning(f"[login] Error al decodificar el JWT: {e}")
-            exp_time = None
-
-        # Se crea la respuesta y se almacena el token en una cookie HttpOnly
-        resp = make_response(jsonify({
-            "message": "Login exitoso",
-            "access_token": access_token,
-            "exp": exp_time
-        }))
-        resp.set_cookie(
-            "access_token",
-            access_token,
-            httponly=True,  # La cookie no es accesible vía JavaScript
-            secure=True,    # Solo se enviará en conexiones seguras (HTTPS)
-            samesite="Strict"
-        )
+        # Se crea la respuesta (con la expiración del JWT) y se almacena el token en
+        # una cookie HttpOnly, solo para HTTPS
+        resp = make_response(jsonify(user_ops.login_body(access_token)))
+        resp.set_cookie("access_token", access_token, **user_ops.SESSION_COOKIE)
         return resp
 
     # En caso de error en las credenciales se retorna error 401
@@ -103,38 +300,16 @@ def validate_token():
     """
     token = request.cookies.get("access_token")
     if not token:
-        logging.debug("[validate_token] No se encontró cookie 'access_token'")
+        logger.debug("[validate_token] No se encontró cookie 'access_token'")
         return jsonify({"error": "No autenticado"}), 401
 
-    # Configurar la carga útil para la introspección del token
-    introspect_url = f"{KEYCLOAK_URL}/realms/{REALM}/protocol/openid-connect/token/introspect"
-    introspect_payload = {
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "token": token
-    }
-    logging.debug(f"[validate_token] POST a {introspect_url} con {introspect_payload}")
-
-    # CRITICAL FIX: Add request settings with SSL handling
-    request_settings = get_request_settings()
-    response = requests.post(introspect_url, data=introspect_payload, **request_settings)
-    logging.debug(f"[validate_token] Status code: {response.status_code}")
-    logging.debug(f"[validate_token] Response text: {response.text}")
-
-    introspection_result = response.json()
+    # Introspección del token (compartida entre workers durante unos segundos)
+    introspection_result = _introspect_session(token)
     # Se verifica que el token esté activo y se extrae información relevante
-    if response.status_code == 200 and introspection_result.get("active"):
-        username = introspection_result.get("username")
-        exp_time = introspection_result.get("exp")
-        user_id = introspection_result.get("sub")
-        return jsonify({
-            "message": "Token válido",
-            "username": username,
-            "exp": exp_time,
-            "user_id": user_id
-        }), 200
+    if introspection_result:
+        return jsonify(user_ops.validate_body(introspection_result)), 200
     else:
-        logging.warning("[validate_token] Token inválido o expirado")
+        logger.warning("[validate_token] Token inválido o expirado")
         return jsonify({"error": "Token inválido o expirado"}), 401
 
 # ----------------------------------------------------------------------
@@ -145,6 +320,11 @@ def logout():
     """
     Endpoint para cerrar sesión. Se elimina la cookie que contiene el token.
     """
+    token = request.cookies.get("access_token")
+    if token:
+        # El resultado de introspección en caché no debe sobrevivir al logout
+        forget_introspection(token)
+        read_cache.forget("profile", token_key("profile", token))
     resp = make_response(jsonify({"message": "Logout exitoso"}))
     # Se establece la cookie 'access_token' con una fecha de expiración en el pasado para eliminarla
     resp.set_cookie("access_token", "", expires=0)
@@ -158,52 +338,47 @@ def get_profile():
     """
     Endpoint para obtener el perfil del usuario autenticado, incluyendo sus roles.
     Se utiliza la cookie 'access_token' para solicitar información a Keycloak.
+    El perfil pasa por la caché de lecturas (read_cache) asociado al token.
     """
     token = request.cookies.get("access_token")
     if not token:
         return jsonify({"error": "No autenticado"}), 401
 
+    claims = user_ops.token_claims(token)
+    cache_key = token_key("profile", token)
+    if claims.get("exp", 0) <= time.time():
+        # Un token caducado no se responde desde la caché: decide Keycloak
+        read_cache.forget("profile", cache_key)
+    user_info = read_cache.read("profile", cache_key, lambda: _load_profile(token), user_id=claims.get("sub"))
+    if user_info is None:
+        return jsonify({"error": "No se pudo obtener el perfil"}), 400
+    return jsonify(user_info), 200
+
+def _load_profile(token):
+    """Perfil de /api/profile desde Keycloak, o None si Keycloak rechaza el token."""
     # URL para obtener información del usuario
     userinfo_url = f"{KEYCLOAK_URL}/realms/{REALM}/protocol/openid-connect/userinfo"
     headers = {"Authorization": f"Bearer {token}"}
     request_settings = get_request_settings()
-    userinfo_response = requests.get(userinfo_url, headers=headers, **request_settings)
+    userinfo_response = keycloak_http.get(userinfo_url, headers=headers, **request_settings)
+    _raise_for_upstream_error(userinfo_response)
     
-    if userinfo_response.status_code == 200:
-        user_info = userinfo_response.json()
-        # Se decodifica el token JWT para extraer roles asociados al usuario
+    if userinfo_response.status_code != 200:
+        return None
+
+    user_info = userinfo_response.json()
+    # Roles del JWT y, si está en el snapshot del roster, el nombre del profesor
+    professor_id = user_ops.build_profile(user_info, token)
+    if professor_id:
+        # Si el token incluye 'created_by', intenta obtener el nombre completo del profesor.
         try:
-            token_parts = token.split('.')
-            payload_b64 = token_parts[1] + '=' * ((4 - len(token_parts[1]) % 4) % 4)
-            payload_data = json.loads(base64.urlsafe_b64decode(payload_b64))
-            # Roles asignados a nivel de cliente y realm
-            client_roles = payload_data.get("resource_access", {}).get(CLIENT_ID, {}).get("roles", [])
-            realm_roles = payload_data.get("realm_access", {}).get("roles", [])
-            roles = client_roles + realm_roles
-            user_info["roles"] = roles
-            # ------ New code to resolve professor name -------
-            # Si el token incluye 'created_by', intenta obtener el nombre completo del profesor.
-            professor_id = user_info.get("created_by")
-            if professor_id:
-                try:
-                    admin_token = get_admin_token()
-                    headers = {"Authorization": f"Bearer {admin_token}", "Content-Type": "application/json"}
-                    prof_resp = requests.get(f"{KEYCLOAK_ADMIN_URL}/admin/realms/{REALM}/users/{professor_id}", headers=headers, **request_settings)
-                    if prof_resp.status_code == 200:
-                        prof_data = prof_resp.json()
-                        teacher_name = f"{prof_data.get('firstName', '')} {prof_data.get('lastName', '')}".strip()
-                        user_info["teacher_name"] = teacher_name or prof_data.get("email", "Profesor")
-                    else:
-                        user_info["teacher_name"] = f"Profesor (ID: {professor_id})"
-                except Exception as ex:
-                    logging.error(f"[get_profile] Error obteniendo nombre del profesor: {ex}")
-                    user_info["teacher_name"] = f"Profesor (ID: {professor_id})"
-            # ---------------------------------------------------
-        except Exception as e:
-            logging.error(f"[get_profile] Error al decodificar roles: {e}")
-        return jsonify(user_info), 200
-    else:
-        return jsonify({"error": "No se pudo obtener el perfil"}), 400
+            prof_data = read_cache.read("user", professor_id, lambda: _fetch_user(professor_id),
+                                        user_id=professor_id)
+        except Exception as ex:
+            logger.error("[get_profile] Error obteniendo nombre del profesor: %s", ex)
+            prof_data = None
+        user_info["teacher_name"] = user_ops.teacher_name(professor_id, prof_data)
+    return user_info
 
 # ----------------------------------------------------------------------
 # ENDPOINT: Cambiar Email
@@ -220,16 +395,9 @@ def change_email():
         return jsonify({"error": "No autenticado"}), 401
     
     # Validar el token mediante introspección
-    introspect_url = f"{KEYCLOAK_URL}/realms/{REALM}/protocol/openid-connect/token/introspect"
-    introspect_payload = {
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "token": token
-    }
     request_settings = get_request_settings()
-    introspect_resp = requests.post(introspect_url, data=introspect_payload, **request_settings)
-    data = introspect_resp.json()
-    if introspect_resp.status_code != 200 or not data.get("active"):
+    data = _introspect_session(token)
+    if not data:
         return jsonify({"error": "Token inválido"}), 401
     
     # Se extrae el ID del usuario desde la respuesta de introspección
@@ -248,13 +416,13 @@ def change_email():
     headers = {"Authorization": f"Bearer {admin_token}", "Content-Type": "application/json"}
     
     # Obtener la información actual del usuario
-    user_resp = requests.get(
+    user_resp = keycloak_http.get(
         f"{KEYCLOAK_ADMIN_URL}/admin/realms/{REALM}/users/{user_id}", 
         headers=headers,
         **request_settings
     )
     if user_resp.status_code != 200:
-        logging.error(f"[change_email] Error obteniendo usuario: {user_resp.text}")
+        logger.error("[change_email] Error obteniendo usuario: %s", user_resp.text)
         return jsonify({"error": "No se pudo obtener información de usuario"}), 500
     
     user_data = user_resp.json()
@@ -263,7 +431,7 @@ def change_email():
     user_data["username"] = new_email  
     
     # Realizar la actualización del usuario en Keycloak
-    update_resp = requests.put(
+    update_resp = keycloak_http.put(
         f"{KEYCLOAK_ADMIN_URL}/admin/realms/{REALM}/users/{user_id}",
         headers=headers,
         json=user_data,
@@ -271,9 +439,11 @@ def change_email():
     )
     
     if update_resp.status_code not in (200, 204):
-        logging.error(f"[change_email] Error actualizando email: {update_resp.text}")
+        logger.error("[change_email] Error actualizando email: %s", update_resp.text)
         return jsonify({"error": "No se pudo actualizar el email"}), 500
     
+    user_ops.user_saved(user_data)
+    
     return jsonify({"message": "Email actualizado correctamente"}), 200
 
 # ----------------------------------------------------------------------
@@ -291,16 +461,9 @@ def change_password():
         return jsonify({"error": "No autenticado"}), 401
     
     # Validar el token mediante introspección
-    introspect_url = f"{KEYCLOAK_URL}/realms/{REALM}/protocol/openid-connect/token/introspect"
-    introspect_payload = {
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "token": token
-    }
     request_settings = get_request_settings()
-    introspect_resp = requests.post(introspect_url, data=introspect_payload, **request_settings)
-    data = introspect_resp.json()
-    if introspect_resp.status_code != 200 or not data.get("active"):
+    data = _introspect_session(token)
+    if not data:
         return jsonify({"error": "Token inválido"}), 401
     
     # Extraer el ID del usuario
@@ -324,7 +487,7 @@ def change_password():
     }
     
     # Realizar la llamada para resetear la contraseña del usuario
-    update_resp = requests.put(
+    update_resp = keycloak_http.put(
         f"{KEYCLOAK_ADMIN_URL}/admin/realms/{REALM}/users/{user_id}/reset-password",
         headers=headers,
         json=password_data,
@@ -332,7 +495,7 @@ def change_password():
     )
     
     if update_resp.status_code not in (200, 204):
-        logging.error(f"[change_password] Error actualizando contraseña: {update_resp.text}")
+        logger.error("[change_password] Error actualizando contraseña: %s", update_resp.text)
         return jsonify({"error": "No se pudo actualizar la contraseña"}), 500
     
     return jsonify({"message": "Contraseña actualizada correctamente"}), 200
@@ -351,24 +514,14 @@ def update_profile():
         return jsonify({"error": "No autenticado"}), 401
     
     # Validar token mediante introspección
-    introspect_url = f"{KEYCLOAK_URL}/realms/{REALM}/protocol/openid-connect/token/introspect"
-    introspect_payload = {
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "token": token
-    }
     request_settings = get_request_settings()
-    introspect_resp = requests.post(introspect_url, data=introspect_payload, **request_settings)
-    data = introspect_resp.json()
-    if introspect_resp.status_code != 200 or not data.get("active"):
+    data = _introspect_session(token)
+    if not data:
         return jsonify({"error": "Token inválido"}), 401
     
     # Extraer el ID del usuario
     user_id = data.get("sub")
     profile_data = request.json
-    gender = profile_data.get("gender")
-    birth_date = profile_data.get("birth_date")
-    phone_number = profile_data.get("phone_number")
     
     # Obtener token administrativo
     admin_token = get_admin_token()
@@ -377,31 +530,22 @@ def update_profile():
     
     headers = {"Authorization": f"Bearer {admin_token}", "Content-Type": "application/json"}
     # Obtener la información actual del usuario
-    user_resp = requests.get(
+    user_resp = keycloak_http.get(
         f"{KEYCLOAK_ADMIN_URL}/admin/realms/{REALM}/users/{user_id}", 
         headers=headers,
         **request_settings
     )
     if user_resp.status_code != 200:
-        logging.error(f"[update_profile] Error obteniendo usuario: {user_resp.text}")
+        logger.error("[update_profile] Error obteniendo usuario: %s", user_resp.text)
         return jsonify({"error": "No se pudo obtener información de usuario"}), 500
     
     user_data = user_resp.json()
     
-    # Asegurarse de que la clave 'attributes' exista en la data del usuario
-    if "attributes" not in user_data:
-        user_data["attributes"] = {}
-    
-    # Actualizar cada atributo si se encuentra en el request
-    if gender is not None:
-        user_data["attributes"]["gender"] = gender
-    if birth_date is not None:
-        user_data["attributes"]["birth_date"] = birth_date
-    if phone_number is not None:
-        user_data["attributes"]["phone_number"] = phone_number
+    # Actualizar género, fecha de nacimiento y teléfono si se encuentran en el request
+    user_ops.apply_profile_attributes(user_data, profile_data)
     
     # Realizar la actualización del perfil en Keycloak
-    update_resp = requests.put(
+    update_resp = keycloak_http.put(
         f"{KEYCLOAK_ADMIN_URL}/admin/realms/{REALM}/users/{user_id}",
         headers=headers,
         json=user_data,
@@ -409,9 +553,11 @@ def update_profile():
     )
     
     if update_resp.status_code not in (200, 204):
-        logging.error(f"[update_profile] Error actualizando perfil: {update_resp.text}")
+        logger.error("[update_profile] Error actualizando perfil: %s", update_resp.text)
         return jsonify({"error": "No se pudo actualizar el perfil"}), 500
     
+    user_ops.user_saved(user_data)
+    
     return jsonify({"message": "Perfil actualizado correctamente"}), 200
 
 # ----------------------------------------------------------------------
@@ -429,69 +575,244 @@ def get_users():
         return jsonify({"error": "No autenticado"}), 401
 
     # Validar token mediante introspección
-    introspect_url = f"{KEYCLOAK_URL}/realms/{REALM}/protocol/openid-connect/token/introspect"
-    introspect_payload = {
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "token": token
-    }
-    request_settings = get_request_settings()
-    introspect_resp = requests.post(introspect_url, data=introspect_payload, **request_settings)
-    data = introspect_resp.json()
-    if introspect_resp.status_code != 200 or not data.get("active"):
+    data = _introspect_session(token)
+    if not data:
         return jsonify({"error": "Token inválido"}), 401
 
     # ID del usuario actual extraído de la introspección
     current_user_id = data.get("sub")
-    admin_token = get_admin_token()
+
+    def fetch_roster():
+        with tracing.span("upstream"):
+            admin_token = get_admin_token()
+            if not admin_token:
+                raise read_cache.AdminTokenUnavailable()
+            # Obtener desde Keycloak los usuarios creados por el usuario actual
+            own_users = _fetch_roster(current_user_id, admin_token)
+        if own_users is None:
+            raise read_cache.Unavailable("No se pudo obtener usuarios")
+
+        # Convertir atributos en listas a strings para evitar problemas de serialización
+        with tracing.span("filter"):
+            filtered = [roster_changes.serialize_user(user) for user in own_users]
+
+            # Sincronizar el log de cambios para que el cliente pueda pedir solo deltas
+            version = roster_changes.sync(current_user_id, own_users)
+        return {"users": filtered, "version": version}
+
+    # La última lista buena se sirve mientras se refresca o mientras Keycloak no responde
+    try:
+        roster = read_cache.read("roster", current_user_id, fetch_roster,
+                                 fresh_if=user_ops.roster_unchanged(current_user_id))
+    except read_cache.AdminTokenUnavailable:
+        logger.warning("[get_users] Sin token administrativo ni copia del roster")
+        body, status = user_ops.roster_unavailable()
+        return jsonify(body), status
+    except read_cache.Unavailable:
+        return jsonify({"error": "No se pudo obtener usuarios"}), 500
     
-    # ADDED: Use fallback if admin token retrieval fails
+    logger.debug("[get_users] Usuarios filtrados: %d", len(roster["users"]))
+    with tracing.span("serialize"):
+        resp = make_response(jsonify(roster["users"]), 200)
+    resp.headers["X-Roster-Version"] = str(roster["version"])
+    return resp
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Cambios del roster desde una versión (sincronización delta)
+# ----------------------------------------------------------------------
+@app.route('/api/users/changes', methods=['GET'])
+def get_user_changes():
+    """
+    Endpoint para obtener solo los usuarios creados, modificados o eliminados
+    desde una versión del roster. La versión inicial se obtiene del encabezado
+    'X-Roster-Version' de /api/users. Si el log de cambios ya no cubre la versión
+    pedida se responde con 'resync_required' y el cliente debe recargar /api/users.
+    """
+    token = request.cookies.get("access_token")
+    if not token:
+        return jsonify({"error": "No autenticado"}), 401
+
+    since = request.args.get("since")
+    if not since:
+        return jsonify({"error": "Parámetro 'since' inválido o ausente"}), 400
+
+    introspect_data = _introspect_session(token)
+    if not introspect_data:
+        return jsonify({"error": "Token inválido"}), 401
+
+    current_user_id = introspect_data.get("sub")
+    if roster_changes.is_stale(current_user_id) and not _resync_roster(current_user_id):
+        return jsonify({"error": "No se pudo obtener usuarios"}), 500
+
+    changes = roster_changes.changes_since(current_user_id, since)
+    return jsonify(changes), 200
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Búsqueda de alumnos (typeahead)
+# ----------------------------------------------------------------------
+@app.route('/api/users/search', methods=['GET'])
+def search_users():
+    """
+    Endpoint para buscar alumnos del usuario actual por nombre, apellido, email o
+    teléfono, sin distinguir acentos ni mayúsculas. Responde desde un índice en
+    memoria; Keycloak solo se consulta la primera vez para cargar el roster.
+    Parámetros: q (texto a buscar) y limit (máximo de resultados, 10 por defecto).
+    """
+    token = request.cookies.get("access_token")
+    if not token:
+        return jsonify({"error": "No autenticado"}), 401
+
+    query = request.args.get("q", "")
+    limit = min(max(request.args.get("limit", 10, type=int), 1), 50)
+
+    introspect_data = _introspect_session(token)
+    if not introspect_data:
+        return jsonify({"error": "Token inválido"}), 401
+
+    current_user_id = introspect_data.get("sub")
+    if not search_index.is_loaded(current_user_id) or roster_changes.is_stale(current_user_id):
+        admin_token = get_admin_token()
+        if not admin_token:
+            return jsonify({"error": "No se pudo obtener token administrativo"}), 500
+        own_users = _fetch_roster(current_user_id, admin_token)
+        if own_users is None:
+            return jsonify({"error": "No se pudo obtener usuarios"}), 500
+        # La primera carga del roster construye el índice de búsqueda; las
+        # siguientes aplican solo las diferencias
+        roster_changes.sync(current_user_id, own_users)
+
+    return jsonify(search_index.search(current_user_id, query, limit)), 200
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Estadísticas del roster
+# ----------------------------------------------------------------------
+@app.route('/api/users/stats', methods=['GET'])
+def get_user_stats():
+    """
+    Endpoint para obtener métricas de los alumnos del usuario actual: total,
+    habilitados/deshabilitados y distribución por género, tramo de edad y mes de
+    creación, junto con el total de usuarios del realm. Los contadores se mantienen
+    en memoria con cada cambio del roster y se reconstruyen en segundo plano
+    cuando caducan.
+    """
+    token = request.cookies.get("access_token")
+    if not token:
+        return jsonify({"error": "No autenticado"}), 401
+
+    introspect_data = _introspect_session(token)
+    if not introspect_data:
+        return jsonify({"error": "Token inválido"}), 401
+
+    current_user_id = introspect_data.get("sub")
+    admin_token = get_admin_token()
     if not admin_token:
-        logging.warning("[get_users] Could not obtain admin token, using fallback")
-        if FALLBACK_AVAILABLE:
-            mock_users = admin_fallback.fallback_get_users(current_user_id)
-            return jsonify(mock_users), 200
-        else:
-            return jsonify({"error": "No se pudo obtener token administrativo", "hint": "Verifique las credenciales admin en config.py"}), 500
-
-    # Obtener la lista completa de usuarios desde Keycloak
-    users_url = f"{KEYCLOAK_ADMIN_URL}/admin/realms/{REALM}/users"
-    headers = {"Authorization": f"Bearer {admin_token}"}
-    resp = requests.get(users_url, headers=headers, **request_settings)
-    if resp.status_code != 200:
-        logging.error(f"[get_users] Error obteniendo usuarios: {resp.text}")
+        return jsonify({"error": "No se pudo obtener token administrativo"}), 500
+
+    own_users = None
+    stale = roster_changes.is_stale(current_user_id)
+    if stale or not roster_stats.is_loaded(current_user_id):
+        own_users = _fetch_roster(current_user_id, admin_token)
+        if own_users is None:
+            return jsonify({"error": "No se pudo obtener usuarios"}), 500
+        if stale or roster_changes.current_version(current_user_id) is None:
+            # La primera carga del roster calcula las estadísticas; tras una
+            # invalidación la sincronización actualiza los contadores con las diferencias
+            roster_changes.sync(current_user_id, own_users)
+        if not roster_stats.is_loaded(current_user_id):
+            roster_stats.rebuild(current_user_id, own_users)
+
+    def refresh():
+        refresh_token = get_admin_token()
+        return _fetch_roster(current_user_id, refresh_token) if refresh_token else None
+
+    stats = roster_stats.get_stats(current_user_id, refresh)
+    if stats is None:
+        # El roster se descartó (evict) después de comprobarlo: se calcula de la lista completa
+        if own_users is None:
+            own_users = _fetch_roster(current_user_id, admin_token)
+        if own_users is None:
+            return jsonify({"error": "No se pudo obtener usuarios"}), 500
+        stats = roster_stats.rebuild(current_user_id, own_users)
+    stats["realm_total"] = roster_stats.realm_total(lambda: _fetch_realm_user_count(admin_token))
+    return jsonify(stats), 200
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Exportar usuarios (CSV / NDJSON en streaming)
+# ----------------------------------------------------------------------
+@app.route('/api/users/export', methods=['GET'])
+def export_users():
+    """
+    Endpoint para exportar los alumnos del usuario actual en CSV o NDJSON.
+    Parámetros:
+      - format: 'csv' (por defecto) o 'ndjson'
+      - columns: columnas separadas por coma (campos del usuario o nombres de atributos)
+      - scope: 'realm' exporta todos los usuarios del realm (solo administradores)
+    Las filas se envían a medida que se leen de Keycloak, página a página.
+    """
+    token = request.cookies.get("access_token")
+    if not token:
+        return jsonify({"error": "No autenticado"}), 401
+
+    export_format = request.args.get("format", "csv").lower()
+    if export_format not in roster_export.FORMATS:
+        return jsonify({"error": "Formato no soportado, use 'csv' o 'ndjson'"}), 400
+    columns = roster_export.parse_columns(request.args.get("columns"))
+
+    introspect_data = _introspect_session(token)
+    if not introspect_data:
+        return jsonify({"error": "Token inválido"}), 401
+    current_user_id = introspect_data.get("sub")
+
+    realm_scope = request.args.get("scope") == "realm"
+    if realm_scope:
+        error = user_ops.admin_error(token, "export_users", "No tienes permiso para exportar todo el realm")
+        if error:
+            body, status = error
+            return jsonify(body), status
+
+    users = roster_export.iter_realm_users(get_admin_token)
+    if not realm_scope:
+        users = (user for user in users if roster_changes.owner_of(user) == current_user_id)
+
+    # Leer el primer usuario antes de responder para poder informar errores con un código HTTP
+    try:
+        first = next(users, None)
+    except roster_export.ExportError as e:
+        logger.error("[export_users] %s", e)
         return jsonify({"error": "No se pudo obtener usuarios"}), 500
+    if first is not None:
+        users = itertools.chain([first], users)
+
+    body = roster_export.stream_export(users, columns, export_format)
+    return Response(
+        stream_with_context(body),
+        mimetype=roster_export.FORMATS[export_format],
+        headers={"Content-Disposition": f"attachment; filename=usuarios.{export_format}"}
+    )
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Disponibilidad de email / username
+# ----------------------------------------------------------------------
+@app.route('/api/users/availability', methods=['GET'])
+def check_availability():
+    """
+    Endpoint para comprobar si un email (o username) está libre antes de registrarse
+    o crear un usuario. Responde desde un índice local pensado para llamarse en cada
+    pulsación de tecla; con exact=true y una sesión válida los posibles duplicados se
+    confirman contra Keycloak (con límite por minuto). Sin sesión, exact se ignora.
+    'available' es null mientras el índice se está cargando.
+    """
+    value = request.args.get("email") or request.args.get("username")
+    if not value:
+        return jsonify({"error": "Falta el parámetro 'email' o 'username'"}), 400
 
-    all_users = resp.json()
-    filtered = []
-    
-    # Filtrar usuarios cuyo atributo 'created_by' coincida con el ID del usuario actual
-    for user in all_users:
-        # Debug logs
-        logging.debug(f"[get_users] Evaluando usuario: ID={user.get('id')}, firstName={user.get('firstName')}, lastName={user.get('lastName')}")
-        
-        attrs = user.get("attributes", {})
-        creator = attrs.get("created_by")
-        creator_id = creator[0] if isinstance(creator, list) and creator else creator
-        
-        if creator_id == current_user_id:
-            # Convertir atributos en listas a strings para evitar problemas de serialización
-            processed_attributes = {}
-            for key, value in attrs.items():
-                processed_attributes[key] = value[0] if isinstance(value, list) and value else value
-            
-            # Agregar el usuario filtrado con todos los campos necesarios
-            filtered.append({
-                "id": user.get("id"),
-                "username": user.get("username"),
-                "email": user.get("email"),
-                "firstName": user.get("firstName", ""),
-                "lastName": user.get("lastName", ""),
-                "attributes": processed_attributes  # Usar atributos procesados
-            })
-    
-    logging.debug(f"[get_users] Usuarios filtrados: {filtered}")
-    return jsonify(filtered), 200
+    exact = request.args.get("exact", "false").lower() in ("true", "1")
+    if exact:
+        token = request.cookies.get("access_token")
+        session = _introspect_session(token) if token else None
+        exact = bool(session) and availability.allow_exact(session.get("sub"))
+    result = availability.check(value, exact=exact)
+    return jsonify({"value": value, **result}), 200
 
 # ----------------------------------------------------------------------
 # ENDPOINT: Crear Usuario
@@ -508,105 +829,121 @@ def create_user():
         return jsonify({"error": "No autenticado"}), 401
 
     # Validar token mediante introspección
-    introspect_url = f"{KEYCLOAK_URL}/realms/{REALM}/protocol/openid-connect/token/introspect"
-    introspect_payload = {
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "token": token
-    }
     request_settings = get_request_settings()
-    introspect_resp = requests.post(introspect_url, data=introspect_payload, **request_settings)
-    introspect_data = introspect_resp.json()
-    if introspect_resp.status_code != 200 or not introspect_data.get("active"):
+    introspect_data = _introspect_session(token)
+    if not introspect_data:
         return jsonify({"error": "Token inválido"}), 401
 
     current_user_id = introspect_data.get("sub")
     user_input = request.json
-    logging.debug(f"[create_user] Datos recibidos: {user_input}")
+    logger.debug("[create_user] Alta solicitada por %s", current_user_id)
     
     if not user_input.get("email"):
         return jsonify({"error": "Falta el email del usuario"}), 400
     
-    # Obtener nombre y apellido desde los campos correspondientes
-    first_name = user_input.get("firstName", "")
-    last_name = user_input.get("lastName", "")
-    
-    # Si no hay firstName pero hay name, intentar dividir name en firstName y lastName
-    if not first_name and user_input.get("name"):
-        name_parts = user_input.get("name").split(maxsplit=1)
-        first_name = name_parts[0] if len(name_parts) > 0 else ""
-        last_name = name_parts[1] if len(name_parts) > 1 else ""
-    
     # Construir el objeto de usuario en el formato que Keycloak espera
-    new_user = {
-        "username": user_input.get("email"),
-        "email": user_input.get("email"),
-        "firstName": first_name,
-        "lastName": last_name,
-        "enabled": True,
-        "emailVerified": False,
-        "attributes": {
-            "gender": [user_input.get("gender", "")],
-            "birth_date": [user_input.get("birthdate", "")],
-            "phone_number": [user_input.get("phone_number", "")],
-            "created_by": [user_input.get("created_by") or current_user_id],
-            "professor_id": [user_input.get("professor_id") or current_user_id]
-        }
-    }
-    
-    # Si se proporciona una contraseña, configurarla
-    if user_input.get("password"):
-        new_user["credentials"] = [{
-            "type": "password",
-            "value": user_input.get("password"),
-            "temporary": False
-        }]
-    else:
-        # Generar una contraseña temporal aleatoria si no se proporciona una
-        import random
-        import string
-        random_password = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
-        new_user["credentials"] = [{
-            "type": "password",
-            "value": random_password,
-            "temporary": True
-        }]
+    new_user = user_ops.build_new_user(user_input, current_user_id)
+
+    # Comprobar en el índice local si el email ya está ocupado antes de intentar el alta;
+    # solo los posibles duplicados se confirman contra Keycloak
+    if availability.check(new_user["email"], exact=True)["available"] is False:
+        logger.debug("[create_user] Email ya registrado: %s", new_user['email'])
+        body, status = user_ops.duplicate_email_error()
+        return jsonify(body), status
+
+    deferred = _defer_mutation(mutation_queue.CREATE_USER, current_user_id, token, user_input)
+    if deferred:
+        return deferred
 
     admin_token = get_admin_token()
     if not admin_token:
-        return jsonify({"error": "No se pudo obtener token administrativo"}), 500
+        deferred = _defer_mutation(mutation_queue.CREATE_USER, current_user_id, token, user_input,
+                                   upstream_failed=True)
+        if deferred:
+            return deferred
+        body, status = user_ops.admin_unavailable("create_user")
+        return jsonify(body), status
 
     headers = {"Authorization": f"Bearer {admin_token}", "Content-Type": "application/json"}
     create_url = f"{KEYCLOAK_ADMIN_URL}/admin/realms/{REALM}/users"
     
-    logging.debug(f"[create_user] Enviando datos a Keycloak: {new_user}")
-    response = requests.post(create_url, headers=headers, json=new_user, **request_settings)
+    logger.debug("[create_user] Enviando alta a %s", create_url)
+    response = keycloak_http.post(create_url, headers=headers, json=new_user, **request_settings)
+    _raise_for_upstream_error(response)
+    # El alta ya llegó a Keycloak: un fallo posterior no la encola
+    g.pop("mutation", None)
     
     if response.status_code not in (201, 204):
-        logging.error(f"[create_user] Error al crear usuario: {response.status_code}, {response.text}")
-        return jsonify({
-            "error": "Error al crear el usuario", 
-            "status_code": response.status_code,
-            "details": response.text
-        }), response.status_code
+        logger.error("[create_user] Error al crear usuario: %s, %s", response.status_code, response.text)
+        if response.status_code == 409:
+            availability.add_value(new_user["email"])
+        body, status = user_ops.create_error(response.status_code, response.text)
+        return jsonify(body), status
 
     # Si la creación fue exitosa, obtener el ID del usuario creado para devolverlo
     search_url = f"{KEYCLOAK_ADMIN_URL}/admin/realms/{REALM}/users?username={new_user['username']}"
-    search_response = requests.get(search_url, headers=headers, **request_settings)
-    
-    if search_response.status_code == 200 and search_response.json():
-        created_user = search_response.json()[0]
-        return jsonify({
-            "message": "Usuario creado exitosamente",
-            "id": created_user.get("id"),
-            "username": created_user.get("username"),
-            "firstName": created_user.get("firstName"),
-            "lastName": created_user.get("lastName"),
-            "email": created_user.get("email"),
-            "attributes": created_user.get("attributes")
-        }), 201
-    
-    return jsonify({"message": "Usuario creado exitosamente"}), 201
+    try:
+        search_response = keycloak_http.get(search_url, headers=headers, **request_settings)
+        created = search_response.json() if search_response.status_code == 200 else None
+    except requests.RequestException as e:
+        # El alta ya se hizo: un fallo al releer no debe hacer que el cliente la reintente
+        logger.warning("[create_user] No se pudo obtener el usuario creado: %s", e)
+        created = None
+    
+    created_user = created[0] if created else None
+    if created_user:
+        user_ops.user_saved(created_user)
+    return jsonify(user_ops.created_body(created_user)), 201
+
+def _admin_user_url(user_id):
+    return f"{KEYCLOAK_ADMIN_URL}/admin/realms/{REALM}/users/{user_id}"
+
+def _admin_headers(admin_token):
+    return {"Authorization": f"Bearer {admin_token}", "Content-Type": "application/json"}
+
+def _load_managed_user(token, user_id, verb, tag, mutation=None):
+    """
+    Valida la sesión, obtiene el usuario y comprueba que el usuario actual sea su
+    creador o administrador. Retorna (admin_token, user_data, creator_id, None)
+    o (None, None, None, respuesta), con respuesta de error o, sin token
+    administrativo, 503 (user_ops.admin_unavailable).
+    mutation = (tipo, payload) permite aceptar la petición en la cola de escritura
+    diferida (202) en lugar de responder 503.
+    """
+    introspect_data = _introspect_session(token)
+    if not introspect_data:
+        return None, None, None, (jsonify({"error": "Token inválido"}), 401)
+
+    current_user_id = introspect_data.get("sub")
+    if mutation:
+        deferred = _defer_mutation(mutation[0], current_user_id, token, mutation[1], user_id)
+        if deferred:
+            return None, None, None, deferred
+
+    admin_token = get_admin_token()
+    if not admin_token:
+        deferred = mutation and _defer_mutation(mutation[0], current_user_id, token, mutation[1], user_id,
+                                                upstream_failed=True)
+        if deferred:
+            return None, None, None, deferred
+        body, status = user_ops.admin_unavailable(tag)
+        return None, None, None, (jsonify(body), status)
+
+    # Obtener información del usuario
+    user_resp = keycloak_http.get(_admin_user_url(user_id), headers=_admin_headers(admin_token),
+                                  **get_request_settings())
+    _raise_for_upstream_error(user_resp)
+    if user_resp.status_code != 200:
+        logger.error("[%s] Error obteniendo usuario: %s", tag, user_resp.text)
+        return None, None, None, (jsonify({"error": "No se pudo obtener información del usuario"}), 500)
+    user_data = user_resp.json()
+
+    # Verificar que el usuario actual es el creador o tiene rol de administrador
+    error = user_ops.manage_error(token, user_data, current_user_id, verb, tag)
+    if error:
+        body, status = error
+        return None, None, None, (jsonify(body), status)
+    return admin_token, user_data, user_ops.creator_id(user_data), None
 
 # ----------------------------------------------------------------------
 # ENDPOINT: Eliminar Usuario
@@ -620,72 +957,21 @@ def delete_user(user_id):
     token = request.cookies.get("access_token")
     if not token:
         return jsonify({"error": "No autenticado"}), 401
-    
-    # Validar token y obtener ID del profesor actual
-    introspect_url = f"{KEYCLOAK_URL}/realms/{REALM}/protocol/openid-connect/token/introspect"
-    introspect_payload = {
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "token": token
-    }
-    request_settings = get_request_settings()
-    introspect_resp = requests.post(introspect_url, data=introspect_payload, **request_settings)
-    introspect_data = introspect_resp.json()
-    
-    if introspect_resp.status_code != 200 or not introspect_data.get("active"):
-        return jsonify({"error": "Token inválido"}), 401
-    
-    current_user_id = introspect_data.get("sub")
-    admin_token = get_admin_token()
-    if not admin_token:
-        return jsonify({"error": "No se pudo obtener token administrativo"}), 500
 
-    # Primero verificamos si el usuario actual tiene permiso para eliminar este usuario
-    headers = {"Authorization": f"Bearer {admin_token}", "Content-Type": "application/json"}
-    
-    # Obtener información del usuario a eliminar
-    user_info_url = f"{KEYCLOAK_ADMIN_URL}/admin/realms/{REALM}/users/{user_id}"
-    user_resp = requests.get(user_info_url, headers=headers, **request_settings)
-    
-    if user_resp.status_code != 200:
-        logging.error(f"[delete_user] Error obteniendo usuario: {user_resp.text}")
-        return jsonify({"error": "No se pudo obtener información del usuario"}), 500
-    
-    user_data = user_resp.json()
-    attributes = user_data.get("attributes", {})
-    
-    # Verificar que el usuario actual es el creador o tiene permisos para eliminar
-    creator_id = None
-    if "created_by" in attributes:
-        creator_array = attributes["created_by"]
-        creator_id = creator_array[0] if creator_array and len(creator_array) > 0 else None
+    admin_token, _, creator_id, error = _load_managed_user(token, user_id, "eliminar", "delete_user")
+    if error:
+        return error
 
-    if creator_id != current_user_id:
-        # Verificar si el usuario actual tiene rol de administrador
-        try:
-            token_parts = token.split('.')
-            payload_b64 = token_parts[1] + '=' * ((4 - len(token_parts[1]) % 4) % 4)
-            payload_data = json.loads(base64.urlsafe_b64decode(payload_b64))
-            client_roles = payload_data.get("resource_access", {}).get(CLIENT_ID, {}).get("roles", [])
-            realm_roles = payload_data.get("realm_access", {}).get("roles", [])
-            roles = client_roles + realm_roles
-            
-            is_admin = "admin" in roles or "realm-admin" in roles
-            
-            if not is_admin:
-                return jsonify({"error": "No tienes permiso para eliminar este usuario"}), 403
-                
-        except Exception as e:
-            logging.error(f"[delete_user] Error verificando roles: {e}")
-            return jsonify({"error": "Error al verificar permisos"}), 500
-    
     # Realizar la eliminación
-    delete_resp = requests.delete(user_info_url, headers=headers, **request_settings)
-    
+    delete_resp = keycloak_http.delete(_admin_user_url(user_id), headers=_admin_headers(admin_token),
+                                       **get_request_settings())
+    _raise_for_upstream_error(delete_resp)
+
     if delete_resp.status_code not in (200, 204):
-        logging.error(f"[delete_user] Error eliminando usuario: {delete_resp.text}")
+        logger.error("[delete_user] Error eliminando usuario: %s", delete_resp.text)
         return jsonify({"error": "No se pudo eliminar el usuario"}), 500
-    
+
+    user_ops.user_deleted(user_id, creator_id)
     return jsonify({"message": f"Usuario {user_id} eliminado correctamente"}), 200
 
 # ----------------------------------------------------------------------
@@ -701,112 +987,27 @@ def update_user(user_id):
     token = request.cookies.get("access_token")
     if not token:
         return jsonify({"error": "No autenticado"}), 401
-    
-    # Validar token y obtener ID del profesor actual
-    introspect_url = f"{KEYCLOAK_URL}/realms/{REALM}/protocol/openid-connect/token/introspect"
-    introspect_payload = {
-        "client_id": CLIENT_ID,
-        "client_secret": CLIENT_SECRET,
-        "token": token
-    }
-    request_settings = get_request_settings()
-    introspect_resp = requests.post(introspect_url, data=introspect_payload, **request_settings)
-    introspect_data = introspect_resp.json()
-    
-    if introspect_resp.status_code != 200 or not introspect_data.get("active"):
-        return jsonify({"error": "Token inválido"}), 401
-    
-    current_user_id = introspect_data.get("sub")
-    admin_token = get_admin_token()
-    if not admin_token:
-        return jsonify({"error": "No se pudo obtener token administrativo"}), 500
-    
-    # Verificar si el usuario actual puede editar este usuario
-    headers = {"Authorization": f"Bearer {admin_token}", "Content-Type": "application/json"}
-    
-    # Obtener información del usuario a actualizar
-    user_info_url = f"{KEYCLOAK_ADMIN_URL}/admin/realms/{REALM}/users/{user_id}"
-    user_resp = requests.get(user_info_url, headers=headers, **request_settings)
-    
-    if user_resp.status_code != 200:
-        logging.error(f"[update_user] Error obteniendo usuario: {user_resp.text}")
-        return jsonify({"error": "No se pudo obtener información del usuario"}), 500
-    
-    user_data = user_resp.json()
-    attributes = user_data.get("attributes", {})
-    
-    # Verificar que el usuario actual es el creador o tiene permiso para editar
-    creator_id = None
-    if "created_by" in attributes:
-        creator_array = attributes["created_by"]
-        creator_id = creator_array[0] if creator_array and len(creator_array) > 0 else None
-    
-    if creator_id != current_user_id:
-        # Verificar si el usuario actual tiene rol de administrador
-        try:
-            token_parts = token.split('.')
-            payload_b64 = token_parts[1] + '=' * ((4 - len(token_parts[1]) % 4) % 4)
-            payload_data = json.loads(base64.urlsafe_b64decode(payload_b64))
-            client_roles = payload_data.get("resource_access", {}).get(CLIENT_ID, {}).get("roles", [])
-            realm_roles = payload_data.get("realm_access", {}).get("roles", [])
-            roles = client_roles + realm_roles
-            
-            is_admin = "admin" in roles or "realm-admin" in roles
-            
-            if not is_admin:
-                return jsonify({"error": "No tienes permiso para actualizar este usuario"}), 403
-                
-        except Exception as e:
-            logging.error(f"[update_user] Error verificando roles: {e}")
-            return jsonify({"error": "Error al verificar permisos"}), 500
-    
-    # Actualizar los campos permitidos
+
     update_data = request.json
-    
-    # Actualizar email si se proporciona
-    if update_data.get("email"):
-        user_data["email"] = update_data["email"]
-        # Actualizar también el username si es el mismo que el email
-        if user_data.get("username") == user_data.get("email"):
-            user_data["username"] = update_data["email"]
-    
-    # Actualizar nombre y apellido si se proporcionan
-    if update_data.get("firstName"):
-        user_data["firstName"] = update_data["firstName"]
-    
-    if update_data.get("lastName"):
-        user_data["lastName"] = update_data["lastName"]
-    
-    # Actualizar atributos personalizados
-    if "attributes" not in user_data:
-        user_data["attributes"] = {}
-    
-    if update_data.get("gender"):
-        user_data["attributes"]["gender"] = [update_data["gender"]]
-    
-    if update_data.get("birthdate"):
-        user_data["attributes"]["birth_date"] = [update_data["birthdate"]]
-    
-    if update_data.get("phone_number"):
-        user_data["attributes"]["phone_number"] = [update_data["phone_number"]]
-    
+    admin_token, user_data, _, error = _load_managed_user(
+        token, user_id, "actualizar", "update_user", mutation=(mutation_queue.UPDATE_USER, update_data))
+    if error:
+        return error
+
+    # Actualizar los campos permitidos
+    user_ops.apply_user_update(user_data, update_data)
+
     # Enviar la actualización a Keycloak
-    update_resp = requests.put(user_info_url, headers=headers, json=user_data, **request_settings)
-    
+    update_resp = keycloak_http.put(_admin_user_url(user_id), headers=_admin_headers(admin_token), json=user_data,
+                                    **get_request_settings())
+    _raise_for_upstream_error(update_resp)
+
     if update_resp.status_code not in (200, 204):
-        logging.error(f"[update_user] Error actualizando usuario: {update_resp.text}")
+        logger.error("[update_user] Error actualizando usuario: %s", update_resp.text)
         return jsonify({"error": "No se pudo actualizar el usuario"}), 500
-    
-    return jsonify({
-        "message": "Usuario actualizado correctamente",
-        "user": {
-            "id": user_data.get("id"),
-            "firstName": user_data.get("firstName"),
-            "lastName": user_data.get("lastName"),
-            "email": user_data.get("email"),
-            "attributes": user_data.get("attributes")
-        }
-    }), 200
+
+    user_ops.user_saved(user_data)
+    return jsonify(user_ops.updated_body(user_data)), 200
 
 # Fixed version of update_user_profile endpoint
 @app.route('/api/user-profile', methods=['PUT'])
@@ -823,7 +1024,7 @@ def update_user_profile():
     token = auth_header.split(' ')[1]
     
     # Use our improved validate_token function
-    user_info = validate_token(token)
+    user_info = validate_access_token(token)
     if not user_info:
         return jsonify({'error': 'Invalid or expired token'}), 401
     
@@ -832,24 +1033,27 @@ def update_user_profile():
     if not user_id:
         return jsonify({'error': 'User ID not found in token'}), 400
     
-    logging.debug(f"[update_user_profile] Updating profile for user {user_id}")
+    logger.debug("[update_user_profile] Updating profile for user %s", user_id)
     
-    # Get request data
+    # Get request data; only the current user's profile can be updated
     data = request.json
-    if not data:
-        return jsonify({'error': 'No data provided'}), 400
-    
-    # Ensure we only update the current user's profile
-    # This prevents potential security issues where a user could try to update another user's profile
-    request_user_id = data.get('id')
-    if request_user_id and request_user_id != user_id:
-        logging.warning(f"[update_user_profile] Attempt to update different user: {request_user_id} vs {user_id}")
-        return jsonify({'error': 'Cannot update another user\'s profile'}), 403
-    
+    error = user_ops.own_profile_error(user_id, data)
+    if error:
+        body, status = error
+        return jsonify(body), status
+    
+    deferred = _defer_mutation(mutation_queue.UPDATE_PROFILE, user_id, token, data, user_id)
+    if deferred:
+        return deferred
+
     # Get admin token
     admin_token = get_admin_token()
     if not admin_token:
-        logging.error("[update_user_profile] Failed to get admin token")
+        deferred = _defer_mutation(mutation_queue.UPDATE_PROFILE, user_id, token, data, user_id,
+                                   upstream_failed=True)
+        if deferred:
+            return deferred
+        logger.error("[update_user_profile] Failed to get admin token")
         return jsonify({'error': 'Internal server error: admin authentication failed'}), 500
     
     # Get current user data first
@@ -861,78 +1065,166 @@ def update_user_profile():
     # Get the current user data to preserve existing fields
     user_url = f"{KEYCLOAK_URL}/admin/realms/{REALM}/users/{user_id}"
     request_settings = get_request_settings()
-    user_response = requests.get(user_url, headers=headers, **request_settings)
+    user_response = keycloak_http.get(user_url, headers=headers, **request_settings)
+    _raise_for_upstream_error(user_response)
     
     if user_response.status_code != 200:
-        logging.error(f"[update_user_profile] Failed to get user data: {user_response.status_code} - {user_response.text}")
+        logger.error("[update_user_profile] Failed to get user data: %s - %s", user_response.status_code, user_response.text)
         return jsonify({'error': f'Failed to retrieve user data: {user_response.status_code}'}), 500
     
     # Get the existing user data and merge with new data
     user_data = user_response.json()
     
-    # Update basic fields if provided
-    if 'firstName' in data:
-        user_data['firstName'] = data['firstName']
-    if 'lastName' in data:
-        user_data['lastName'] = data['lastName']
-    
-    # Ensure attributes exists
-    if 'attributes' not in user_data:
-        user_data['attributes'] = {}
-    
-    # Update attributes (handle both array and single value formats)
-    if 'attributes' in data:
-        for key, value in data['attributes'].items():
-            # Ensure all attribute values are arrays as required by Keycloak
-            if isinstance(value, list):
-                user_data['attributes'][key] = value
-            else:
-                user_data['attributes'][key] = [value]
-    
-    # Handle direct attribute fields in the request
-    attribute_mappings = {
-        'phone': 'phone_number',
-        'phone_number': 'phone_number',
-        'gender': 'gender',
-        'birthdate': 'birth_date',
-        'birth_date': 'birth_date'
-    }
-    
-    for client_field, keycloak_field in attribute_mappings.items():
-        if client_field in data and data[client_field]:
-            user_data['attributes'][keycloak_field] = [data[client_field]]
-    
-    # Preserve the created_by field which should never be modified by the user
-    if 'created_by' in user_data.get('attributes', {}):
-        created_by = user_data['attributes']['created_by']
-        # Make sure we keep it even if the frontend tries to modify it
-        if 'created_by' in data.get('attributes', {}) or 'createdBy' in data:
-            logging.warning(f"[update_user_profile] Attempt to modify created_by field detected")
-            
-        # Ensure created_by stays intact
-        user_data['attributes']['created_by'] = created_by
+    # Merge the client data, keeping created_by intact
+    user_ops.apply_own_profile_update(user_data, data)
     
     # Execute the update
-    update_response = requests.put(
+    update_response = keycloak_http.put(
         user_url,
         headers=headers,
         json=user_data,
         **request_settings
     )
+    _raise_for_upstream_error(update_response)
     
     if update_response.status_code >= 400:
-        logging.error(f"[update_user_profile] Failed to update user: {update_response.status_code} - {update_response.text}")
+        logger.error("[update_user_profile] Failed to update user: %s - %s", update_response.status_code, update_response.text)
         return jsonify({'error': f'Failed to update user: {update_response.text}'}), update_response.status_code
     
+    user_ops.user_saved(user_data)
+    
     # Success - return updated user data
-    return jsonify({
-        'success': True, 
-        'message': 'Profile updated successfully',
-        'user': {
-            'id': user_id,
-            'firstName': user_data.get('firstName'),
-            'lastName': user_data.get('lastName'),
-            'attributes': user_data.get('attributes')
-        }
-    })
+    return jsonify(user_ops.own_profile_body(user_id, user_data))
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Cola de escritura diferida
+# ----------------------------------------------------------------------
+def _mutation_session():
+    """
+    Sesión de los endpoints de /api/mutations: cookie de sesión o, como en
+    /api/user-profile, token Bearer. Retorna (token, user_id, None) o (None, None, respuesta).
+    """
+    if not mutation_queue.enabled():
+        return None, None, (jsonify({"error": "La cola de escritura diferida no está activa"}), 404)
+    token = user_ops.request_token(request.cookies, request.headers)
+    if not token:
+        return None, None, (jsonify({"error": "No autenticado"}), 401)
+    introspect_data = _introspect_session(token)
+    if not introspect_data:
+        return None, None, (jsonify({"error": "Token inválido"}), 401)
+    return token, introspect_data.get("sub"), None
+
+@app.route('/api/mutations', methods=['GET'])
+def list_mutations():
+    """
+    Operaciones aceptadas por la cola de escritura diferida (ver mutation_queue.py):
+    las propias, o todas para un administrador. Parámetros: state (lista separada
+    por comas, p. ej. 'pending,conflict,failed') y limit (por defecto 100).
+    """
+    token, current_user_id, error = _mutation_session()
+    if error:
+        return error
+    body, status = mutation_queue.list_request(current_user_id, token, request.args)
+    return jsonify(body), status
+
+@app.route('/api/mutations/<op_id>', methods=['GET', 'DELETE'])
+def mutation_detail(op_id):
+    """
+    GET retorna el estado de una operación; DELETE descarta una operación en
+    conflicto o fallida para que se apliquen las siguientes del mismo usuario.
+    """
+    token, current_user_id, error = _mutation_session()
+    if error:
+        return error
+    if request.method == 'DELETE':
+        body, status = mutation_queue.discard_operation(op_id, current_user_id, token)
+    else:
+        body, status = mutation_queue.get_operation(op_id, current_user_id, token)
+    return jsonify(body), status
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Perfilado de CPU (solo administradores)
+# ----------------------------------------------------------------------
+@app.route('/api/admin/profile', methods=['GET', 'POST', 'DELETE'])
+def admin_profile():
+    """
+    GET descarga el perfil agregado (ver profiler.py). Parámetros:
+      - format: 'pstats' o 'text' (modo cprofile), 'collapsed' (modo sampler)
+      - route: limitar a una ruta, p. ej. '/api/users'
+      - window: 'current' (por defecto) o 'last'
+      - status=1: retorna la configuración y el número de peticiones perfiladas
+    POST retorna una cabecera X-Profile-Signature para perfilar peticiones concretas
+    durante 'ttl' segundos. DELETE descarta los perfiles acumulados.
+    """
+    error = _require_admin()
+    if error:
+        return error
+
+    body, status, download = admin_ops.profile_request(request.method, request.args)
+    if download:
+        mimetype, filename = download
+        return Response(body, mimetype=mimetype, headers={"Content-Disposition": f"attachment; filename={filename}"})
+    return jsonify(body), status
 
+# ----------------------------------------------------------------------
+# ENDPOINT: Diagnóstico de memoria (solo administradores)
+# ----------------------------------------------------------------------
+@app.route('/api/admin/memory', methods=['GET', 'POST'])
+def admin_memory():
+    """
+    Diagnóstico de memoria (ver memory_guard.py).
+    GET retorna la memoria residente, el presupuesto, el tamaño de cada caché y, con
+    tracemalloc activo, los lugares que más memoria retienen. Parámetros:
+      - limit: número de lugares (por defecto 20)
+      - group_by: 'lineno' (por defecto), 'filename' o 'traceback'
+      - diff=1: crecimiento respecto a la instantánea de referencia
+    POST con action=start | stop | baseline | evict activa o desactiva tracemalloc,
+    toma una nueva referencia o fuerza el descarte de entradas de las cachés.
+    """
+    error = _require_admin()
+    if error:
+        return error
+
+    body, status = admin_ops.memory_request(request.method, request.args)
+    return jsonify(body), status
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Inyección de fallos en Keycloak (solo administradores, FAULT_INJECTION)
+# ----------------------------------------------------------------------
+@app.route('/api/admin/faults', methods=['GET', 'PUT', 'DELETE'])
+def admin_faults():
+    """
+    Reglas de fallos inyectados en las llamadas a Keycloak de este worker (ver
+    fault_injection.py). GET retorna las reglas activas; PUT las reemplaza con
+    {"spec": "introspect:latency=200;*:error=0.1", "seed": 1}; DELETE las quita.
+    Las llamadas a Keycloak de este endpoint no sufren los fallos.
+    """
+    if not fault_injection.enabled():
+        return jsonify({"error": "La inyección de fallos no está activada (FAULT_INJECTION)"}), 404
+    with fault_injection.bypass():
+        error = _require_admin()
+    if error:
+        return error
+
+    body, status = admin_ops.faults_request(request.method, request.get_json(silent=True))
+    return jsonify(body), status
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Preparación para el balanceador (readiness)
+# ----------------------------------------------------------------------
+@app.route('/healthz/ready', methods=['GET'])
+def healthz_ready():
+    """
+    200 cuando el calentamiento de arranque terminó (ver warmup.py); 503 mientras la
+    instancia está fría, para que el balanceador no le envíe tráfico todavía.
+    """
+    status = warmup.status()
+    return jsonify(status), 200 if status["ready"] else 503
+
+# ----------------------------------------------------------------------
+# ENDPOINT: Métricas (Prometheus)
+# ----------------------------------------------------------------------
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Métricas del worker en formato de texto de Prometheus."""
+    return Response(metrics.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
@@ -0,0 +1,218 @@
+# search_index.py
+# Índice en memoria para la búsqueda incremental (typeahead) de alumnos.
+#
+# Cada roster tiene un índice de trigramas para coincidencias por subcadena y una
+# lista ordenada de palabras para coincidencias por prefijo. Ambos se construyen en
+# la primera carga del roster y se mantienen con los eventos de roster_changes,
+# de modo que una búsqueda nunca necesita consultar Keycloak.
+
+import bisect
+import heapq
+import threading
+import unicodedata
+
+import memory_guard
+import roster_changes
+
+_lock = threading.Lock()
+# Índices por profesor: owner_id -> _RosterIndex
+_indexes = {}
+
+
+def normalize(text):
+    """
+    Normaliza un texto para la búsqueda: minúsculas y sin acentos.
+    'José Pérez' -> 'jose perez'
+    """
+    if not text:
+        return ""
+    decomposed = unicodedata.normalize("NFKD", str(text))
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).lower().strip()
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _document(user):
+    """Extrae del usuario las palabras y el texto normalizado sobre el que se busca."""
+    user = roster_changes.serialize_user(user)
+    attrs = user.get("attributes") or {}
+    values = [user.get("firstName"), user.get("lastName"), user.get("email"), attrs.get("phone_number")]
+
+    words = set()
+    for value in values:
+        value = normalize(value)
+        words.update(value.split())
+        if "@" in value:
+            # Permite buscar por la parte local del email ('juan' en 'juan.p@x.cl')
+            words.add(value.split("@", 1)[0])
+
+    phone = attrs.get("phone_number")
+    if phone:
+        # El teléfono también se indexa solo con dígitos ('912345678')
+        digits = "".join(c for c in str(phone) if c.isdigit())
+        if digits:
+            words.add(digits)
+
+    haystack = " ".join(sorted(words))
+    # Clave de desempate precalculada: apellido, nombre
+    name_key = (normalize(user.get("lastName")), normalize(user.get("firstName")))
+    return user, words, haystack, name_key
+
+
+class _RosterIndex:
+    """Índice de un roster: documentos, palabras ordenadas y posting lists de trigramas."""
+
+    def __init__(self):
+        self.docs = {}       # user_id -> (usuario serializado, palabras, texto, clave de orden)
+        self.words = []      # lista ordenada de (palabra, user_id)
+        self.postings = {}   # trigrama -> set(user_id)
+
+    def load(self, users):
+        """Indexa un roster completo ordenando las palabras una sola vez."""
+        for user in users:
+            user_id = user.get("id")
+            if not user_id or user_id in self.docs:
+                continue
+            doc = _document(user)
+            self.docs[user_id] = doc
+            self.words.extend((word, user_id) for word in doc[1])
+            for trigram in _trigrams(doc[2]):
+                self.postings.setdefault(trigram, set()).add(user_id)
+        self.words.sort()
+
+    def add(self, user):
+        user_id = user.get("id")
+        if not user_id:
+            return
+        self.remove(user_id)
+        doc = _document(user)
+        self.docs[user_id] = doc
+        for word in doc[1]:
+            bisect.insort(self.words, (word, user_id))
+        for trigram in _trigrams(doc[2]):
+            self.postings.setdefault(trigram, set()).add(user_id)
+
+    def remove(self, user_id):
+        doc = self.docs.pop(user_id, None)
+        if doc is None:
+            return
+        for word in doc[1]:
+            i = bisect.bisect_left(self.words, (word, user_id))
+            if i < len(self.words) and self.words[i] == (word, user_id):
+                del self.words[i]
+        for trigram in _trigrams(doc[2]):
+            ids = self.postings.get(trigram)
+            if ids is not None:
+                ids.discard(user_id)
+                if not ids:
+                    del self.postings[trigram]
+
+    def _prefix_matches(self, term):
+        """Retorna {user_id: 0 si la palabra es exacta, 1 si es prefijo}."""
+        matches = {}
+        words = self.words
+        i = bisect.bisect_left(words, (term, ""))
+        while i < len(words) and words[i][0].startswith(term):
+            word, user_id = words[i]
+            if word == term:
+                matches[user_id] = 0
+            else:
+                matches.setdefault(user_id, 1)
+            i += 1
+        return matches
+
+    def _substring_matches(self, term):
+        """Retorna los user_id cuyo texto contiene el término (solo términos de 3+ caracteres)."""
+        if len(term) < 3:
+            return set()
+        candidates = None
+        for trigram in sorted(_trigrams(term), key=lambda t: len(self.postings.get(t, ()))):
+            ids = self.postings.get(trigram)
+            if not ids:
+                return set()
+            candidates = set(ids) if candidates is None else candidates & ids
+            if not candidates:
+                return set()
+        # Los trigramas pueden coincidir en posiciones distintas: verificar la subcadena
+        return {user_id for user_id in candidates if term in self.docs[user_id][2]}
+
+    def search(self, query, limit):
+        terms = normalize(query).split()
+        if not terms:
+            return []
+
+        scores = None
+        for term in terms:
+            term_scores = self._prefix_matches(term)
+            for user_id in self._substring_matches(term):
+                term_scores.setdefault(user_id, 2)
+            if scores is None:
+                scores = term_scores
+            else:
+                # Todas las palabras de la consulta deben coincidir
+                scores = {uid: scores[uid] + rank for uid, rank in term_scores.items() if uid in scores}
+            if not scores:
+                return []
+
+        docs = self.docs
+        best = heapq.nsmallest(limit, scores, key=lambda uid: (scores[uid], docs[uid][3], uid))
+        return [docs[user_id][0] for user_id in best]
+
+
+def is_loaded(owner_id):
+    """Indica si el roster del profesor ya está indexado."""
+    with _lock:
+        return owner_id in _indexes
+
+
+def search(owner_id, query, limit=10):
+    """
+    Busca alumnos del profesor por nombre, apellido, email o teléfono.
+    Las coincidencias exactas de palabra van primero, luego los prefijos y al final
+    las subcadenas; los empates se ordenan por apellido y nombre.
+
+    Args:
+        owner_id (str): ID del profesor
+        query (str): Texto de búsqueda
+        limit (int): Número máximo de resultados
+
+    Returns:
+        list: Usuarios en el formato de /api/users
+    """
+    with _lock:
+        index = _indexes.get(owner_id)
+        if index is None:
+            return []
+        return index.search(query, limit)
+
+
+def _on_roster_event(event):
+    with _lock:
+        if event.kind == 'load':
+            index = _indexes[event.owner_id] = _RosterIndex()
+            index.load(event.user)
+            return
+        if event.kind == 'evict':
+            _indexes.pop(event.owner_id, None)
+            return
+
+        index = _indexes.get(event.owner_id)
+        if index is None:
+            # El roster se indexará completo en su primera carga
+            return
+        if event.kind == 'upsert':
+            index.add(event.user)
+        elif event.kind == 'delete':
+            index.remove(event.user_id)
+
+
+def _memory_stats():
+    with _lock:
+        return len(_indexes), memory_guard.estimate_size(_indexes)
+
+
+roster_changes.subscribe(_on_roster_event)
+# Los índices se descartan junto con su roster (evento 'evict'), no por separado
+memory_guard.register_cache("search_index", _memory_stats)
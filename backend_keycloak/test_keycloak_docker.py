@@ -1,11 +1,21 @@
 #!/usr/bin/env python3
 """
 Test direct access to Keycloak Docker container
+
+Usage:
+    python test_keycloak_docker.py [realm]
+    python test_keycloak_docker.py [realm] --profile [-n 50] [--json profile.json]
+        Checks every container URL concurrently and profiles the latency of each
+        working one (see keycloak_latency.py), e.g. to compare 10.0.0.1 with localhost.
 """
 
+import argparse
+import json
+import os
 import requests
 import logging
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
@@ -22,18 +32,17 @@ TEST_URLS = [
 import urllib3
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-def test_keycloak_docker_access():
+def test_keycloak_docker_access(realm=None):
     """Test direct access to the Keycloak container"""
     print("="*80)
     print(" KEYCLOAK DOCKER ACCESS TEST")
     print("="*80)
     
     # Check for realm parameter
-    realm = "servicios_agroup"
-    if len(sys.argv) > 1:
-        realm = sys.argv[1]
+    if realm:
         print(f"Using provided realm: {realm}")
     else:
+        realm = "servicios_agroup"
         print(f"Using default realm: {realm}")
     
     successful_urls = []
@@ -104,5 +113,65 @@ def test_keycloak_docker_access():
         print("Please check your Docker container configuration and network access.")
     print("="*80)
 
+def _working_prefix(base_url, realm):
+    """Returns the URL prefix ('' or '/auth') serving the realm's OpenID configuration, or None"""
+    for prefix in ("", "/auth"):
+        try:
+            response = requests.get(f"{base_url}{prefix}/realms/{realm}/.well-known/openid-configuration",
+                                    timeout=5, verify=False)
+            if response.status_code == 200 and 'token_endpoint' in response.json():
+                return prefix
+        except (requests.RequestException, ValueError):
+            continue
+    return None
+
+
+def profile_keycloak_docker(realm, repeat, json_path=None):
+    """Check every container URL concurrently and profile the latency of the working ones"""
+    # Credentials come from config.py, like the backend uses them
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from config import CLIENT_ID, CLIENT_SECRET, ADMIN_CLIENT_ID, ADMIN_USERNAME, ADMIN_PASSWORD
+    import keycloak_latency
+
+    realm = realm or "servicios_agroup"
+    print("="*80)
+    print(f" KEYCLOAK DOCKER LATENCY PROFILE (realm {realm})")
+    print("="*80)
+    with ThreadPoolExecutor(max_workers=len(TEST_URLS)) as pool:
+        prefixes = list(pool.map(lambda url: _working_prefix(url, realm), TEST_URLS))
+
+    reports = {}
+    for base_url, prefix in zip(TEST_URLS, prefixes):
+        if prefix is None:
+            print(f"\n✗ {base_url}: no OpenID configuration for realm {realm}")
+            continue
+        profiler = keycloak_latency.Profiler(
+            f"{base_url}{prefix}", realm, CLIENT_ID, CLIENT_SECRET, ADMIN_CLIENT_ID, ADMIN_USERNAME,
+            ADMIN_PASSWORD, verify=False)
+        reports[base_url] = profiler.run(repeat)
+        print()
+        print(keycloak_latency.format_report(reports[base_url]))
+    if not reports:
+        print("\n❌ Could not find any working Keycloak endpoints.")
+    if json_path:
+        text = json.dumps(reports, indent=2, ensure_ascii=False)
+        if json_path == "-":
+            print(text)
+        else:
+            with open(json_path, "w", encoding="utf-8") as f:
+                f.write(text + "\n")
+    return reports
+
+
 if __name__ == "__main__":
-    test_keycloak_docker_access()
+    parser = argparse.ArgumentParser(description="Test direct access to the Keycloak Docker container")
+    parser.add_argument("realm", nargs="?", help="Realm to test (default: servicios_agroup)")
+    parser.add_argument("--profile", action="store_true",
+                        help="Measure DNS/connect/TLS/TTFB per endpoint for every working URL")
+    parser.add_argument("-n", "--repeat", type=int, default=20, help="Calls per endpoint and mode (--profile)")
+    parser.add_argument("--json", help="Write the profiles as JSON to this file ('-' for stdout)")
+    args = parser.parse_args()
+    if args.profile:
+        profile_keycloak_docker(args.realm, args.repeat, args.json)
+    else:
+        test_keycloak_docker_access(args.realm)
@@ -0,0 +1,85 @@
+# conftest.py
+# Entorno de las pruebas: un Keycloak emulado en proceso (keycloak_emulator) y la
+# configuración de la API apuntando a él. config.py lee las variables de entorno al
+# importarse, por eso se fijan antes de importar cualquier módulo de la API.
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+
+from keycloak_emulator import DEFAULT_PASSWORD, KeycloakEmulator
+
+# Timeout de lectura de las llamadas a Keycloak durante las pruebas, en segundos
+READ_TIMEOUT = 0.5
+
+_workdir = tempfile.mkdtemp(prefix="backend-tests-")
+_emulator = KeycloakEmulator(users=200, owners=4, seed=7).start()
+
+os.environ.update(
+    KEYCLOAK_BASE_URL=_emulator.url,
+    VERIFY_SSL="true",
+    CACHE_BACKEND="memory",
+    # Sin reutilizar introspecciones ni lecturas: cada petición llega a Keycloak y sufre
+    # los fallos (test_read_cache activa la caché de lecturas)
+    INTROSPECTION_CACHE_TTL="0",
+    READ_CACHE_TTL="0",
+    READ_CACHE_SWR="0",
+    READ_CACHE_GRACE="0",
+    HTTP_CONNECT_TIMEOUT=str(READ_TIMEOUT),
+    HTTP_READ_TIMEOUT=str(READ_TIMEOUT),
+    FAULT_INJECTION="true",
+    FAULTS="",
+    ROSTER_SNAPSHOT_PATH=os.path.join(_workdir, "roster.snap"),
+    INVALIDATION_DIR=os.path.join(_workdir, "invalidation"),
+    MUTATION_QUEUE_PATH=os.path.join(_workdir, "mutations.sqlite3"),
+    LOG_LEVEL="WARNING",
+)
+
+
+@pytest.fixture(scope="session")
+def emulator():
+    return _emulator
+
+
+@pytest.fixture(scope="session")
+def app():
+    from routes import create_app
+    import warmup
+    app = create_app()
+    # Las pruebas empiezan con la instancia caliente, como tras pasar /healthz/ready
+    assert warmup.wait(10), warmup.status()
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def login(client):
+    """Inicia sesión en la API y deja el token en la cookie del cliente."""
+    def login(username):
+        response = client.post("/api/login", data={"username": username, "password": DEFAULT_PASSWORD})
+        assert response.status_code == 200, response.get_data(as_text=True)
+        token = response.get_json()["access_token"]
+        client.set_cookie("access_token", token)
+        return token
+    return login
+
+
+@pytest.fixture
+def faults():
+    """Activa reglas de fault_injection durante una prueba (con semilla fija)."""
+    import fault_injection
+
+    def apply(spec, seed=1):
+        fault_injection.configure(spec)
+        fault_injection.seed(seed)
+    yield apply
+    fault_injection.clear()
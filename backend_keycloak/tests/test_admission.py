@@ -0,0 +1,108 @@
+# test_admission.py
+# Control de admisión: cada clase de ruta tiene su límite y su cola; lo que no cabe
+# recibe enseguida 503 con Retry-After, bulk se descarta antes que el resto cuando
+# Keycloak va lento y login sigue respondiendo con las otras clases saturadas.
+
+import threading
+import time
+
+import pytest
+
+import admission
+
+PROFESSOR = "profesor0@bench.local"
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    """Configura límites, colas y esperas (s) de la prueba; al terminar vuelve a la configuración."""
+    def configure(limits="auth=4,interactive=1,bulk=1", queue="auth=4,interactive=1,bulk=0",
+                  timeout="auth=1,interactive=0.3,bulk=0", window=60.0, target_ms=100.0):
+        monkeypatch.setattr(admission, "ADMISSION_LIMITS", limits)
+        monkeypatch.setattr(admission, "ADMISSION_QUEUE", queue)
+        monkeypatch.setattr(admission, "ADMISSION_QUEUE_TIMEOUT", timeout)
+        monkeypatch.setattr(admission, "ADMISSION_WINDOW", window)
+        monkeypatch.setattr(admission, "ADMISSION_TARGET_LATENCY_MS", target_ms)
+        admission.reset()
+    yield configure
+    monkeypatch.undo()
+    admission.reset()
+
+
+def _admit_in_thread(route_class, results):
+    def run():
+        try:
+            results.append(admission.admit(route_class))
+        except admission.Rejected as e:
+            results.append(e)
+    thread = threading.Thread(target=run)
+    thread.start()
+    return thread
+
+
+def test_queue_waits_for_a_slot_until_its_deadline(limits):
+    limits()
+    held = admission.admit(admission.INTERACTIVE)
+    granted = []
+    waiting = _admit_in_thread(admission.INTERACTIVE, granted)
+    time.sleep(0.05)
+    # La cola (1) está llena: se rechaza sin esperar
+    start = time.perf_counter()
+    with pytest.raises(admission.Rejected) as rejected:
+        admission.admit(admission.INTERACTIVE)
+    assert rejected.value.reason == "queue_full" and time.perf_counter() - start < 0.05
+    admission.release(held)
+    waiting.join()
+    assert isinstance(granted[0], admission._Ticket)
+
+    # Con el hueco ocupado más allá del plazo, el que espera recibe el rechazo
+    expired = []
+    waiting = _admit_in_thread(admission.INTERACTIVE, expired)
+    waiting.join()
+    assert isinstance(expired[0], admission.Rejected) and expired[0].reason == "timeout"
+    admission.release(granted[0])
+    admission.release(granted[0])
+    assert admission.status()[admission.INTERACTIVE]["in_flight"] == 0
+
+
+def _window(latency):
+    """Cierra la ventana en curso con una sola llamada a Keycloak de la latencia dada (s)."""
+    time.sleep(0.12)
+    admission.observe_upstream(latency)
+
+
+def test_slow_keycloak_sheds_bulk_first_and_restores_it_last(limits):
+    limits(limits="auth=4,interactive=10,bulk=4", window=0.1)
+    _window(0.5)
+    _window(0.5)
+    status = admission.status()
+    assert status[admission.AUTH]["limit"] == 4
+    assert status[admission.BULK]["limit"] == 1
+    assert status[admission.INTERACTIVE]["limit"] == 8
+
+    _window(0.01)
+    _window(0.01)
+    status = admission.status()
+    # Interactive recupera primero; bulk no sube hasta que interactive está en su máximo
+    assert (status[admission.INTERACTIVE]["limit"], status[admission.BULK]["limit"]) == (10, 1)
+    _window(0.01)
+    assert admission.status()[admission.BULK]["limit"] == 2
+
+
+def test_saturated_bulk_gets_503_while_login_keeps_working(client, login, limits):
+    limits()
+    login(PROFESSOR)
+    held = admission.admit(admission.BULK)
+    try:
+        start = time.perf_counter()
+        response = client.get("/api/users/stats")
+        assert response.status_code == 503
+        assert int(response.headers["Retry-After"]) >= 1
+        assert time.perf_counter() - start < 0.2
+        # Las otras clases y las rutas exentas siguen respondiendo
+        login(PROFESSOR)
+        assert client.get("/api/users").status_code == 200
+        assert client.get("/metrics").status_code == 200
+    finally:
+        admission.release(held)
+    assert client.get("/api/users/stats").status_code == 200
@@ -0,0 +1,112 @@
+# test_asgi_parity.py
+# asgi.py repite los endpoints de routes.py con handlers asíncronos: la misma
+# petición con la misma sesión debe recibir el mismo estado y el mismo cuerpo en
+# las dos aplicaciones. Necesita quart y httpx (requirements.txt); si no están
+# instalados, las pruebas se omiten.
+
+import asyncio
+import uuid
+
+import pytest
+
+pytest.importorskip("quart")
+pytest.importorskip("httpx")
+
+import asgi  # noqa: E402
+
+PROFESSOR = "profesor0@bench.local"
+ADMIN = "admin@bench.local"
+
+
+def _asgi(method, path, token, **kwargs):
+    """Ejecuta una petición contra la aplicación ASGI. Retorna (estado, cuerpo JSON)."""
+    async def call():
+        async with asgi.app.test_app() as test_app:
+            client = test_app.test_client()
+            response = await client.open(path, method=method, headers={"Cookie": f"access_token={token}"},
+                                         **kwargs)
+            return response.status_code, await response.get_json()
+    return asyncio.run(call())
+
+
+def _student_of(emulator):
+    realm = emulator.realm
+    return next(iter(realm.by_attribute[("created_by", realm.owners[0])]))
+
+
+READS = [
+    ("/api/validate", None),
+    ("/api/profile", None),
+    ("/api/users", None),
+    ("/api/users/search", {"q": "a", "limit": 20}),
+    ("/api/users/stats", None),
+    ("/api/users/availability", {"email": PROFESSOR}),
+    ("/api/users/availability", {"email": f"libre-{uuid.uuid4().hex[:8]}@bench.local"}),
+    ("/api/users/changes", {"since": ""}),
+]
+
+
+@pytest.mark.parametrize("path,query", READS)
+def test_reads_match(client, login, path, query):
+    token = login(PROFESSOR)
+    expected = client.get(path, query_string=query)
+    status, body = _asgi("GET", path, token, query_string=query)
+    assert status == expected.status_code
+    assert body == expected.get_json()
+
+
+def test_changes_since_match(client, login):
+    token = login(PROFESSOR)
+    version = client.get("/api/users").headers["X-Roster-Version"]
+    expected = client.get("/api/users/changes", query_string={"since": version})
+    assert _asgi("GET", "/api/users/changes", token, query_string={"since": version}) == \
+        (expected.status_code, expected.get_json())
+
+
+def test_update_and_delete_match(client, login, emulator):
+    token = login(PROFESSOR)
+    student = _student_of(emulator)
+    update = {"lastName": "Paridad"}
+    expected = client.put(f"/api/users/{student}", json=update)
+    assert _asgi("PUT", f"/api/users/{student}", token, json=update) == (expected.status_code, expected.get_json())
+
+    missing = f"/api/users/{uuid.uuid4()}"
+    expected = client.delete(missing)
+    assert _asgi("DELETE", missing, token) == (expected.status_code, expected.get_json())
+
+
+def test_create_matches(client, login):
+    token = login(PROFESSOR)
+
+    def new_user():
+        return {"firstName": "Paridad", "lastName": "ASGI", "email": f"paridad-{uuid.uuid4().hex[:10]}@bench.local",
+                "gender": "F", "birthdate": "2010-01-01", "phone_number": "+56 9 1234 5678"}
+    expected = client.post("/api/users", json=new_user())
+    status, body = _asgi("POST", "/api/users", token, json=new_user())
+    assert status == expected.status_code == 201
+    assert set(body) == set(expected.get_json())
+    # El alta hecha por ASGI aparece en el roster que sirve Flask
+    assert body["id"] in [user["id"] for user in client.get("/api/users").get_json()]
+
+
+def test_admin_only_endpoint_matches(client, login):
+    token = login(PROFESSOR)
+    expected = client.get("/api/admin/faults")
+    assert _asgi("GET", "/api/admin/faults", token) == (expected.status_code, expected.get_json())
+    token = login(ADMIN)
+    expected = client.get("/api/admin/faults")
+    assert _asgi("GET", "/api/admin/faults", token) == (expected.status_code, expected.get_json())
+
+
+def test_keycloak_outage_matches(client, login, faults):
+    token = login(PROFESSOR)
+    faults("*:error=1,status=503")
+    for path in ("/api/validate", "/api/users"):
+        expected = client.get(path)
+        assert _asgi("GET", path, token) == (expected.status_code, expected.get_json())
+
+
+def test_login_matches(client):
+    form = {"username": PROFESSOR, "password": "incorrecta"}
+    expected = client.post("/api/login", data=form)
+    assert _asgi("POST", "/api/login", "", form=form) == (expected.status_code, expected.get_json())
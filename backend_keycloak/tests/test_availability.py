@@ -0,0 +1,76 @@
+# test_availability.py
+# Disponibilidad de email: se responde desde el índice local y solo una sesión
+# válida, dentro de su límite por minuto, confirma los ocupados contra Keycloak.
+
+import pytest
+
+import availability
+import invalidation
+
+PROFESSOR = "profesor0@bench.local"
+
+
+@pytest.fixture
+def lookups(monkeypatch):
+    """Registra las consultas exactas a Keycloak sin cambiar su resultado (con el índice cargado)."""
+    availability.warm_up()
+    calls = []
+    real_lookup = availability.lookup_exact
+
+    def lookup_exact(value):
+        calls.append(value)
+        return real_lookup(value)
+
+    monkeypatch.setattr(availability, "lookup_exact", lookup_exact)
+    monkeypatch.setattr(availability, "AVAILABILITY_EXACT_PER_MINUTE", 2)
+    availability._exact_budget.clear()
+    yield calls
+    availability._exact_budget.clear()
+
+
+def _check(client, email, exact=True):
+    response = client.get("/api/users/availability", query_string={"email": email, "exact": str(exact).lower()})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_anonymous_exact_is_answered_from_the_index(client, lookups):
+    client.delete_cookie("access_token")
+    assert _check(client, PROFESSOR) == {"value": PROFESSOR, "available": False, "confirmed": False}
+    assert _check(client, "nadie-usa-esto@bench.local")["available"] is True
+    assert lookups == []
+
+
+def test_exact_confirmation_is_rate_limited_per_session(client, login, lookups):
+    login(PROFESSOR)
+    assert _check(client, PROFESSOR) == {"value": PROFESSOR, "available": False, "confirmed": True}
+    assert _check(client, PROFESSOR)["confirmed"] is True
+    # Agotado el límite del minuto, la respuesta sale del índice
+    assert _check(client, PROFESSOR) == {"value": PROFESSOR, "available": False, "confirmed": False}
+    assert lookups == [PROFESSOR, PROFESSOR]
+
+
+def test_peer_worker_frees_values_of_deleted_user(monkeypatch):
+    monkeypatch.setattr(availability, "_taken", {})
+    monkeypatch.setattr(availability, "_by_user", {})
+    published = []
+    monkeypatch.setattr(invalidation, "publish", lambda namespace, key, version=None: published.append((namespace, key)))
+    user = {"id": "u-par", "username": "Par-Worker", "email": "par-worker@bench.local"}
+    availability.add_user(user)
+    availability.add_user(dict(user, email="par-nuevo@bench.local"))
+    availability.remove_user(user["id"])
+    availability.add_value("conflicto@bench.local")
+    assert [namespace for namespace, _ in published] == [
+        "availability_user", "availability_user", "availability_release", "availability"]
+
+    # Otro worker recibe los mismos eventos: el alta ocupa los valores, la edición
+    # reemplaza el email y la baja libera los que el usuario tenía
+    monkeypatch.setattr(availability, "_taken", {})
+    monkeypatch.setattr(availability, "_by_user", {})
+    for version, (namespace, key) in enumerate(published[:2], start=1):
+        invalidation._dispatch(namespace, key, version)
+    assert availability._taken == {"par-worker": 1, "par-nuevo@bench.local": 1}
+    invalidation._dispatch(*published[2], 3)
+    assert availability._taken == {} and availability._by_user == {}
+    invalidation._dispatch(*published[3], 4)
+    assert availability._taken == {"conflicto@bench.local": 1}
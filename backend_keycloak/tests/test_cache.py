@@ -0,0 +1,52 @@
+# test_cache.py
+# Caché compartida: get_or_compute calcula cada clave una sola vez aunque la pidan
+# varios hilos, sin guardar un lock por cada clave que ya se calculó, y update no
+# pierde escrituras concurrentes.
+
+import threading
+import time
+
+import pytest
+
+import cache
+
+
+def test_concurrent_misses_compute_once_and_release_key_locks():
+    store = cache.InProcessCache()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        time.sleep(0.05)
+        return "valor", 60
+
+    threads = [threading.Thread(target=store.get_or_compute, args=("introspect:x", compute)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert store._key_locks == {}
+
+
+def test_one_key_per_token_does_not_accumulate_locks():
+    store = cache.InProcessCache()
+    for i in range(1000):
+        store.get_or_compute(cache.token_key("introspect", f"token-{i}"), lambda: ({"active": True}, 0.01))
+    assert store._key_locks == {}
+
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_update_is_atomic_across_threads(backend, tmp_path):
+    store = cache.InProcessCache() if backend == "memory" else cache.SQLiteCache(str(tmp_path / "cache.sqlite3"))
+
+    def increment():
+        for _ in range(25):
+            store.update("contador", lambda current: (current or 0) + 1, ttl=60)
+
+    threads = [threading.Thread(target=increment) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert store.get("contador") == 100
@@ -0,0 +1,61 @@
+# test_import_time.py
+# Presupuesto de arranque en frío: cada worker nuevo (y cada ejecución de pruebas)
+# paga la importación de la aplicación, así que se mide con python -X importtime y
+# falla si supera IMPORT_BUDGET_MS. Importar routes además no debe tener efectos:
+# ni hilos, ni sockets, ni ficheros, ni módulos que solo se usan en diagnóstico o
+# en la ruta de error (eso pasa en create_app o al primer uso).
+
+import json
+import os
+import re
+import subprocess
+import sys
+
+from conftest import BACKEND_DIR
+
+# Importación de backend (la entrada de gunicorn, create_app incluido) en ms; ronda
+# los 400 ms en un runner de CI compartido, casi todo flask y requests
+IMPORT_BUDGET_MS = float(os.environ.get("IMPORT_BUDGET_MS", "1000"))
+RUNS = 3
+# Módulos que se importan al primer uso, nunca al importar la aplicación
+LAZY_MODULES = ("cProfile", "pstats", "gzip", "flask_cors", "dotenv")
+
+_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def _python(code, tmp_path, *flags):
+    env = dict(os.environ, WARMUP="false", INVALIDATION_DIR=str(tmp_path / "invalidation"))
+    return subprocess.run([sys.executable, *flags, "-c", code], cwd=BACKEND_DIR, env=env,
+                          capture_output=True, text=True, timeout=60, check=True)
+
+
+def _import_times(module, tmp_path):
+    """(ms acumulados de module, [(ms, dependencia)] hasta dos niveles por debajo) según -X importtime."""
+    stderr = _python(f"import {module}", tmp_path, "-X", "importtime").stderr
+    rows = [(int(m[2]) / 1000, len(m[3]) // 2, m[4]) for m in map(_LINE.match, stderr.splitlines()) if m]
+    index = next(i for i, (_, depth, name) in enumerate(rows) if name == module and depth == 0)
+    # importtime escribe las dependencias antes que el módulo que las importa
+    children = []
+    for ms, depth, name in reversed(rows[:index]):
+        if depth == 0:
+            break
+        if depth <= 2:
+            children.append((ms, name))
+    return rows[index][0], sorted(children, reverse=True)
+
+
+def test_app_import_within_budget(tmp_path):
+    runs = [_import_times("backend", tmp_path) for _ in range(RUNS)]
+    # El mínimo descarta el ruido de otros procesos de la máquina
+    total, children = min(runs)
+    slowest = ", ".join(f"{name} {ms:.0f}ms" for ms, name in children[:8])
+    assert total <= IMPORT_BUDGET_MS, f"import backend: {total:.0f}ms > {IMPORT_BUDGET_MS:.0f}ms ({slowest})"
+
+
+def test_importing_routes_has_no_side_effects(tmp_path):
+    code = ("import json, sys, threading, routes, app; "
+            f"print(json.dumps({{'threads': threading.active_count(), "
+            f"'loaded': [m for m in {LAZY_MODULES!r} if m in sys.modules]}}))")
+    result = json.loads(_python(code, tmp_path).stdout.strip().splitlines()[-1])
+    assert result == {"threads": 1, "loaded": []}
+    assert not (tmp_path / "invalidation").exists()
@@ -0,0 +1,31 @@
+# test_invalidation.py
+# Canal de invalidación entre workers: las versiones recordadas para descartar
+# eventos repetidos tienen un límite, y cada módulo usa su propio namespace.
+
+import invalidation
+import memory_guard
+import read_cache
+
+
+def test_seen_versions_are_bounded(monkeypatch):
+    monkeypatch.setattr(invalidation, "_SEEN_LIMIT", 100)
+    monkeypatch.setattr(invalidation, "_seen", invalidation.OrderedDict())
+    for i in range(250):
+        invalidation._dispatch("test", f"clave-{i}", 1)
+    assert len(invalidation._seen) == 100
+    assert ("test", "clave-249") in invalidation._seen
+    assert ("test", "clave-0") not in invalidation._seen
+
+    assert invalidation.evict(0.5) == 50
+    assert ("test", "clave-249") in invalidation._seen
+    assert "invalidation" in memory_guard._caches
+
+
+def test_read_cache_publishes_in_its_own_namespace(monkeypatch):
+    published = []
+    monkeypatch.setattr(invalidation, "publish", lambda namespace, key, version=None: published.append((namespace, key)))
+    read_cache.forget_user("u-1")
+    assert published == [("read_cache", "u-1")]
+    handlers = invalidation._handlers
+    assert "user" not in handlers
+    assert set(handlers) >= {"roster", "read_cache", "availability", "availability_user", "availability_release"}
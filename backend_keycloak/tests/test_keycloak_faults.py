@@ -0,0 +1,172 @@
+# test_keycloak_faults.py
+# Degradación de la API cuando Keycloak está lento, responde 5xx, corta conexiones
+# o devuelve cuerpos que no son JSON, con fallos inyectados por fault_injection.
+# Cada ruta debe responder un error JSON acotado en el tiempo, nunca un 500 sin
+# formato ni un hilo bloqueado.
+
+import time
+import uuid
+
+import pytest
+
+from cache import shared_cache
+from conftest import READ_TIMEOUT
+from keycloak_emulator import DEFAULT_PASSWORD
+
+# Margen para el trabajo local de la API sobre el tiempo esperado de Keycloak
+SLACK = 1.0
+PROFESSOR = "profesor0@bench.local"
+ADMIN = "admin@bench.local"
+
+
+def _student_of(emulator, owner_index=0):
+    realm = emulator.realm
+    owner_id = realm.owners[owner_index]
+    return next(iter(realm.by_attribute[("created_by", owner_id)]))
+
+
+ROUTES = {
+    "login": lambda c, ctx: c.post("/api/login", data={"username": PROFESSOR, "password": DEFAULT_PASSWORD}),
+    "validate": lambda c, ctx: c.get("/api/validate"),
+    "profile": lambda c, ctx: c.get("/api/profile"),
+    "list_users": lambda c, ctx: c.get("/api/users"),
+    "create_user": lambda c, ctx: c.post("/api/users", json={
+        "firstName": "Prueba", "lastName": "Fallos", "email": f"fallos-{uuid.uuid4().hex[:10]}@bench.local",
+        "gender": "F", "birthdate": "2010-01-01", "phone_number": "+56 9 1234 5678"}),
+    "update_user": lambda c, ctx: c.put(f"/api/users/{ctx['student']}", json={"firstName": "Editado"}),
+    "delete_user": lambda c, ctx: c.delete(f"/api/users/{uuid.uuid4()}"),
+}
+# Estados correctos de cada ruta sin fallos (la baja es de un usuario inexistente)
+SUCCESS = {"login": 200, "validate": 200, "profile": 200, "list_users": 200, "create_user": 201,
+           "update_user": 200, "delete_user": 500}
+
+
+@pytest.fixture
+def ctx(emulator, login):
+    login(PROFESSOR)
+    return {"student": _student_of(emulator)}
+
+
+def _call(client, route, ctx):
+    start = time.perf_counter()
+    response = ROUTES[route](client, ctx)
+    return response, time.perf_counter() - start
+
+
+@pytest.mark.parametrize("route", ROUTES)
+def test_routes_succeed_without_faults(client, ctx, route):
+    response, _ = _call(client, route, ctx)
+    assert response.status_code == SUCCESS[route], response.get_data(as_text=True)
+
+
+@pytest.mark.parametrize("route", ROUTES)
+def test_slow_keycloak_times_out_with_504(client, ctx, faults, route):
+    faults("*:latency=3000")
+    response, elapsed = _call(client, route, ctx)
+    assert response.status_code == 504
+    assert response.is_json
+    # La primera llamada agota el timeout de lectura y la ruta responde sin esperar más
+    assert elapsed < READ_TIMEOUT + SLACK
+
+
+@pytest.mark.parametrize("route", ROUTES)
+def test_keycloak_5xx_returns_503(client, ctx, faults, route):
+    faults("*:error=1,status=503")
+    response, elapsed = _call(client, route, ctx)
+    assert response.status_code == 503
+    assert response.get_json()["error"]
+    assert elapsed < SLACK
+
+
+@pytest.mark.parametrize("route", ROUTES)
+def test_connection_reset_returns_503(client, ctx, faults, route):
+    faults("*:reset=1")
+    response, _ = _call(client, route, ctx)
+    assert response.status_code == 503
+    assert response.is_json
+
+
+def test_html_body_with_200_returns_502(client, ctx, faults):
+    # Un proxy que responde 200 con HTML hacía fallar response.json() sin capturar
+    faults("introspect:error=1,status=200")
+    response, _ = _call(client, "validate", ctx)
+    assert response.status_code == 502
+    assert response.is_json
+
+
+@pytest.mark.parametrize("route", ["list_users", "update_user"])
+def test_admin_api_errors_degrade_to_json_errors(client, ctx, faults, route):
+    faults("admin_users_get:error=1,status=500")
+    response, _ = _call(client, route, ctx)
+    assert response.status_code >= 500
+    assert response.get_json()["error"]
+
+
+@pytest.mark.parametrize("status", [500, 503])
+def test_keycloak_5xx_on_delete_returns_503(client, ctx, faults, status):
+    # El alumno existe y se lee bien: el 5xx llega en la baja misma
+    faults(f"admin_users_delete:error=1,status={status}")
+    response = client.delete(f"/api/users/{ctx['student']}")
+    assert response.status_code == 503
+    assert response.get_json()["error"] == "Keycloak no disponible"
+
+
+def test_writes_without_admin_token_return_503(client, ctx, faults):
+    # Keycloak niega el token administrativo (la introspección sigue funcionando): sin
+    # cola de escritura diferida nada llegaría a Keycloak, así que no se da por hecho
+    shared_cache().delete("admin_token")
+    faults("token:error=1")
+    for route in ("create_user", "update_user", "delete_user"):
+        response, _ = _call(client, route, ctx)
+        assert response.status_code == 503, route
+        assert response.get_json()["error"] == "Keycloak no disponible"
+
+
+@pytest.mark.parametrize("route", ROUTES)
+def test_latency_below_timeout_is_bounded(client, ctx, faults, route):
+    faults("*:latency=40-60")
+    response, elapsed = _call(client, route, ctx)
+    assert response.status_code == SUCCESS[route]
+    # Ninguna ruta hace más de cinco llamadas a Keycloak en serie
+    assert 0.04 <= elapsed < 5 * 0.06 + SLACK
+
+
+def test_slow_body_is_not_cut_by_read_timeout(client, ctx, faults):
+    faults(f"userinfo:slow_body={READ_TIMEOUT * 1000 + 200:.0f}")
+    response, elapsed = _call(client, "profile", ctx)
+    assert response.status_code == 200
+    assert elapsed >= READ_TIMEOUT + 0.2
+
+
+def test_mixed_faults_never_escape_as_unhandled_errors(client, ctx, faults):
+    faults("*:latency=0-20,error=0.3,reset=0.1", seed=3)
+    statuses = []
+    for _ in range(8):
+        for route in ROUTES:
+            # Una excepción sin manejar haría fallar la prueba aquí mismo
+            response, elapsed = _call(client, route, ctx)
+            assert response.is_json, (route, response.get_data(as_text=True)[:200])
+            assert elapsed < READ_TIMEOUT + SLACK
+            statuses.append(response.status_code)
+    assert 503 in statuses
+    assert any(status < 300 for status in statuses)
+
+
+def test_admin_endpoint_changes_rules_and_bypasses_them(client, login):
+    login(ADMIN)
+    response = client.put("/api/admin/faults", json={"spec": "introspect:error=1", "seed": 1})
+    try:
+        assert response.status_code == 200
+        assert response.get_json()["rules"] == {"introspect": "error=1"}
+        assert client.get("/api/validate").status_code == 503
+        # El propio endpoint se autentica aunque la introspección esté fallando
+        assert client.get("/api/admin/faults").status_code == 200
+        assert client.put("/api/admin/faults", json={"spec": "introspect:error=2"}).status_code == 400
+    finally:
+        response = client.delete("/api/admin/faults")
+    assert response.get_json()["rules"] == {}
+    assert client.get("/api/validate").status_code == 200
+
+
+def test_admin_endpoint_requires_admin(client, ctx):
+    assert client.get("/api/admin/faults").status_code == 403
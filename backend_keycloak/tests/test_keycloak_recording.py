@@ -0,0 +1,13 @@
+# test_keycloak_recording.py
+# Las grabaciones de tráfico con Keycloak no guardan credenciales del login.
+
+import keycloak_recording
+
+
+def test_scrub_hides_login_credentials():
+    form = {"grant_type": "password", "username": "profesor0@bench.local", "password": "x",
+            "client_secret": "s", "totp": "123456"}
+    clean = keycloak_recording.scrub(form)
+    assert clean["username"] == "profesor0@bench.local"
+    for field in ("password", "client_secret", "totp"):
+        assert clean[field] == keycloak_recording.SCRUBBED
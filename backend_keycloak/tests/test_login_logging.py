@@ -0,0 +1,54 @@
+# test_login_logging.py
+# Con DEBUG activo, el login no deja en el log la contraseña, el TOTP ni el secreto
+# del cliente, la validación y las altas no dejan los datos personales, y la
+# redacción cubre los formularios aunque alguien los registre.
+
+import logging
+import uuid
+
+from werkzeug.datastructures import ImmutableMultiDict
+
+import auth
+import log_config
+from config import CLIENT_SECRET
+
+PROFESSOR = "profesor0@bench.local"
+PASSWORD = "hunter2-no-registrar"
+TOTP = "918273"
+
+
+def test_login_at_debug_logs_no_credentials(client, caplog):
+    caplog.set_level(logging.DEBUG)
+    response = client.post("/api/login", data={"username": PROFESSOR, "password": PASSWORD, "totp": TOTP})
+    assert response.status_code == 401
+    assert PROFESSOR in caplog.text
+    assert PASSWORD not in caplog.text
+    assert TOTP not in caplog.text
+    if CLIENT_SECRET:
+        assert CLIENT_SECRET not in caplog.text
+
+
+def test_validate_and_create_at_debug_log_no_personal_data(client, login, caplog):
+    token = login(PROFESSOR)
+    caplog.set_level(logging.DEBUG)
+    caplog.clear()
+    assert auth.validate_token(token)["active"]
+    assert "active=True" in caplog.text
+    assert PROFESSOR not in caplog.text
+
+    email = f"log-{uuid.uuid4().hex[:10]}@bench.local"
+    response = client.post("/api/users", json={"firstName": "Registro", "lastName": "Privado", "email": email,
+                                               "phone_number": "+56 9 5555 0101"})
+    assert response.status_code == 201
+    # Solo los mensajes de la API (urllib3 registra las URLs de las consultas)
+    logged = "\n".join(r.getMessage() for r in caplog.records if not r.name.startswith("urllib3"))
+    assert "[create_user]" in logged
+    for value in (email, "Privado", "5555 0101"):
+        assert value not in logged
+
+
+def test_redact_hides_form_pairs():
+    form = ImmutableMultiDict([("username", PROFESSOR), ("password", PASSWORD), ("totp", TOTP)])
+    text = log_config.redact(f"Datos recibidos del cliente: {form}")
+    assert PASSWORD not in text and TOTP not in text
+    assert PROFESSOR in text
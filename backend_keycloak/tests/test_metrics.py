@@ -0,0 +1,26 @@
+# test_metrics.py
+# Shards por hilo: los de hilos terminados se retiran también al crear shards
+# nuevos, así que la memoria no crece si nadie consulta /metrics, y no se pierde
+# ningún incremento.
+
+import threading
+
+import metrics
+
+
+def _inc_in_thread(counter):
+    thread = threading.Thread(target=counter.inc, args=("ok",))
+    thread.start()
+    thread.join()
+
+
+def test_shards_stay_bounded_without_scrapes():
+    counter = metrics.Counter("test_shards_total", "Prueba de shards", ("result",))
+    try:
+        for _ in range(1000):
+            _inc_in_thread(counter)
+        assert len(counter._shards) <= metrics._MIN_RETIRE_AT
+        assert counter._collect() == {("ok",): 1000}
+        assert counter._shards == []
+    finally:
+        metrics._registry.remove(counter)
@@ -0,0 +1,112 @@
+# test_mutation_queue.py
+# Cola de escritura diferida: con Keycloak caído, las altas y ediciones se aceptan
+# (202) en un diario local y se aplican en orden al volver; un cambio hecho en
+# Keycloak entretanto deja la operación en conflicto sin sobrescribirlo.
+
+import uuid
+
+import pytest
+
+import mutation_queue
+from cache import shared_cache
+
+PROFESSOR = "profesor0@bench.local"
+OTHER_PROFESSOR = "profesor1@bench.local"
+
+
+@pytest.fixture
+def queue(tmp_path, monkeypatch):
+    """Activa la cola con un diario propio; el replay se lanza a mano en cada prueba."""
+    monkeypatch.setattr(mutation_queue, "MUTATION_QUEUE_ENABLED", True)
+    monkeypatch.setattr(mutation_queue, "ensure_started", lambda: None)
+    journal = mutation_queue.Journal(str(tmp_path / "mutations.sqlite3"))
+    monkeypatch.setitem(mutation_queue._state, "journal", journal)
+    yield journal
+    journal.close()
+
+
+def _student(client):
+    return client.get("/api/users").get_json()[0]
+
+
+def test_outage_edits_are_accepted_and_replayed_in_order(client, login, faults, emulator, queue):
+    login(PROFESSOR)
+    student = _student(client)
+    faults("admin_users_get:error=1")
+
+    first = client.put(f"/api/users/{student['id']}", json={"firstName": "Primero"},
+                       headers={"Idempotency-Key": "edit-1"})
+    assert first.status_code == 202
+    op_id = first.get_json()["operation"]["id"]
+    # Repetir la petición con la misma clave no encola otra operación
+    retry = client.put(f"/api/users/{student['id']}", json={"firstName": "Primero"},
+                       headers={"Idempotency-Key": "edit-1"})
+    assert retry.status_code == 202 and retry.get_json()["operation"]["id"] == op_id
+    # Keycloak ya está marcado como caído: se encola sin llamarlo
+    assert client.put(f"/api/users/{student['id']}", json={"firstName": "Segundo", "lastName": "Orden"}).status_code == 202
+
+    pending = client.get("/api/mutations?state=pending").get_json()
+    assert [op["changes"] for op in pending["operations"]] == [
+        {"firstName": "Segundo", "lastName": "Orden"}, {"firstName": "Primero"}]
+    assert pending["keycloak_unavailable_since"] is not None
+
+    # Otro profesor no ve la operación ni puede editar sin Keycloak un alumno ajeno
+    login(OTHER_PROFESSOR)
+    assert client.get(f"/api/mutations/{op_id}").status_code == 404
+    assert client.put(f"/api/users/{student['id']}", json={"firstName": "Ajeno"}).status_code == 503
+    login(PROFESSOR)
+
+    faults("")
+    assert mutation_queue.replay() == 2
+    user = emulator.realm.users[student["id"]]
+    assert (user["firstName"], user["lastName"]) == ("Segundo", "Orden")
+    assert client.get(f"/api/mutations/{op_id}").get_json()["state"] == "done"
+    assert queue.unavailable_since() is None
+    # Con la cola vacía y Keycloak disponible, las ediciones vuelven a ir directas
+    assert client.put(f"/api/users/{student['id']}", json={"lastName": "Directo"}).status_code == 200
+
+
+def test_conflict_blocks_later_operations_of_the_user(client, login, faults, emulator, queue):
+    login(PROFESSOR)
+    student = _student(client)
+    faults("admin_users_get:error=1")
+    conflicting = client.put(f"/api/users/{student['id']}", json={"firstName": "Cola"}).get_json()["operation"]
+    later = client.put(f"/api/users/{student['id']}", json={"lastName": "Después"}).get_json()["operation"]
+    # Otro cliente cambia el nombre directamente en Keycloak durante el corte
+    emulator.realm.update_user(student["id"], {"firstName": "Otro"})
+
+    faults("")
+    assert mutation_queue.replay() == 1
+    assert client.get(f"/api/mutations/{conflicting['id']}").get_json()["state"] == "conflict"
+    assert client.get(f"/api/mutations/{later['id']}").get_json()["state"] == "pending"
+    assert emulator.realm.users[student["id"]]["firstName"] == "Otro"
+
+    assert client.delete(f"/api/mutations/{conflicting['id']}").status_code == 200
+    assert client.delete(f"/api/mutations/{conflicting['id']}").status_code == 409
+    assert mutation_queue.replay() == 1
+    assert emulator.realm.users[student["id"]]["lastName"] == "Después"
+
+
+def test_create_without_admin_token_is_replayed_once(client, login, faults, emulator, queue):
+    login(PROFESSOR)
+    shared_cache().delete("admin_token")
+    faults("token:error=1")
+    email = f"diferido-{uuid.uuid4().hex[:8]}@bench.local"
+    response = client.post("/api/users", json={"firstName": "Diferido", "email": email, "password": "secreta-123"})
+    assert response.status_code == 202
+    op = response.get_json()["operation"]
+    assert "password" not in op["changes"]
+    assert mutation_queue.replay() == 0
+
+    faults("")
+    assert mutation_queue.replay() == 1
+    done = client.get(f"/api/mutations/{op['id']}").get_json()
+    assert done["state"] == "done"
+    created = emulator.realm.users[done["user_id"]]
+    assert created["email"] == email and created["attributes"]["created_by"] == [_professor_id(emulator)]
+    # La contraseña no se conserva en el diario una vez aplicada el alta
+    assert "password" not in queue.get(op["id"])["payload"]
+
+
+def _professor_id(emulator):
+    return emulator.realm.users[emulator.realm.by_username[PROFESSOR]]["id"]
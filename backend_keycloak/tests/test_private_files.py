@@ -0,0 +1,58 @@
+# test_private_files.py
+# Ficheros compartidos por los workers: se crean solo para el usuario del servicio y
+# los que otro usuario pudo preparar de antemano se rechazan.
+
+import os
+import stat
+
+import pytest
+
+import cache
+import private_files
+
+
+def _mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+def test_creates_private_directory_and_file(tmp_path):
+    path = tmp_path / "runtime" / "cache.sqlite3"
+    private_files.ensure_file(str(path))
+    assert _mode(path.parent) == 0o700
+    assert _mode(path) == 0o600
+
+
+def test_tightens_permissions_of_own_file(tmp_path):
+    path = tmp_path / "cache.sqlite3"
+    path.write_bytes(b"")
+    path.chmod(0o644)
+    private_files.ensure_file(str(path))
+    assert _mode(path) == 0o600
+
+
+def test_refuses_directory_writable_by_others(tmp_path):
+    shared = tmp_path / "shared"
+    shared.mkdir()
+    shared.chmod(0o777)
+    with pytest.raises(private_files.InsecurePathError):
+        private_files.ensure_file(str(shared / "cache.sqlite3"))
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="cambiar el propietario requiere root")
+def test_refuses_file_owned_by_another_user(tmp_path):
+    path = tmp_path / "cache.sqlite3"
+    path.write_bytes(b"")
+    os.chown(path, 65534, 65534)
+    with pytest.raises(private_files.InsecurePathError):
+        private_files.ensure_file(str(path))
+
+
+def test_shared_cache_falls_back_to_memory_on_insecure_path(tmp_path, monkeypatch):
+    shared = tmp_path / "shared"
+    shared.mkdir()
+    shared.chmod(0o777)
+    monkeypatch.setattr(cache, "CACHE_BACKEND", "sqlite")
+    monkeypatch.setattr(cache, "CACHE_PATH", str(shared / "cache.sqlite3"))
+    monkeypatch.setattr(cache, "_backend", None)
+    assert isinstance(cache.shared_cache(), cache.InProcessCache)
+    assert not (shared / "cache.sqlite3").exists()
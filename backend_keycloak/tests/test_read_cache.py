@@ -0,0 +1,109 @@
+# test_read_cache.py
+# Caché de lecturas: /api/users y /api/profile responden con la última copia buena
+# mientras se refresca en segundo plano y, marcada como obsoleta, mientras Keycloak
+# no responde; una modificación del roster nunca se oculta tras la copia.
+
+import time
+import uuid
+
+import pytest
+
+import read_cache
+from cache import shared_cache
+
+PROFESSOR = "profesor0@bench.local"
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    """Activa la caché de lecturas con los plazos (s) de cada prueba."""
+    def configure(ttl=0, swr=0, grace=0):
+        monkeypatch.setattr(read_cache, "READ_CACHE_TTL", ttl)
+        monkeypatch.setattr(read_cache, "READ_CACHE_SWR", swr)
+        monkeypatch.setattr(read_cache, "READ_CACHE_GRACE", grace)
+    yield configure
+    with read_cache._lock:
+        read_cache._entries.clear()
+        read_cache._by_user.clear()
+
+
+def _ids(response):
+    return sorted(user["id"] for user in response.get_json())
+
+
+def test_fresh_copy_is_served_without_keycloak(client, login, cache, faults):
+    cache(ttl=60)
+    login(PROFESSOR)
+    first = client.get("/api/users")
+    assert first.headers["X-Cache"] == "MISS"
+    faults("admin_users_get:error=1")
+    second = client.get("/api/users")
+    assert second.status_code == 200
+    assert second.headers["X-Cache"] == "HIT" and "Warning" not in second.headers
+    assert _ids(second) == _ids(first)
+    assert second.headers["X-Roster-Version"] == first.headers["X-Roster-Version"]
+
+
+def test_stale_copy_is_served_while_refreshing(client, login, cache, faults):
+    cache(ttl=0, swr=60)
+    login(PROFESSOR)
+    client.get("/api/users")
+    faults("admin_users_get:latency=400")
+    start = time.perf_counter()
+    response = client.get("/api/users")
+    # No espera a Keycloak: el refresco corre en segundo plano
+    assert time.perf_counter() - start < 0.3
+    assert response.headers["X-Cache"] == "STALE"
+    assert response.headers["Warning"].startswith("110")
+
+
+def test_keycloak_outage_serves_marked_stale_copy_within_grace(client, login, cache, faults):
+    cache(grace=60)
+    login(PROFESSOR)
+    expected = _ids(client.get("/api/users"))
+    profile = client.get("/api/profile").get_json()
+    faults("*:error=1")
+    # La introspección también se responde con la última activa del token
+    response = client.get("/api/users")
+    assert response.status_code == 200
+    assert _ids(response) == expected
+    assert response.headers["X-Cache"] == "STALE"
+    assert response.headers["Warning"].startswith("111")
+    response = client.get("/api/profile")
+    assert response.status_code == 200 and response.get_json() == profile
+    assert response.headers["X-Cache"] == "STALE"
+
+
+def test_no_admin_token_serves_marked_copy_or_503(client, login, cache, faults):
+    cache(grace=60)
+    login(PROFESSOR)
+    expected = _ids(client.get("/api/users"))
+    shared_cache().delete("admin_token")
+    faults("token:error=1")
+    response = client.get("/api/users")
+    assert response.status_code == 200 and _ids(response) == expected
+    assert response.headers["X-Cache"] == "STALE"
+
+    # Sin copia no hay roster de ejemplo: 503
+    cache(grace=0)
+    response = client.get("/api/users")
+    assert response.status_code == 503
+    assert response.get_json()["error"] == "Keycloak no disponible"
+
+
+def test_outage_without_copy_still_fails(client, login, cache, faults):
+    cache(grace=60)
+    login(PROFESSOR)
+    faults("userinfo:error=1")
+    assert client.get("/api/profile").status_code == 503
+
+
+def test_roster_change_is_never_hidden_by_the_copy(client, login, cache):
+    cache(ttl=60)
+    login(PROFESSOR)
+    student = client.get("/api/users").get_json()[0]
+    name = f"Editado {uuid.uuid4().hex[:6]}"
+    assert client.put(f"/api/users/{student['id']}", json={"firstName": name}).status_code == 200
+    response = client.get("/api/users")
+    assert response.headers["X-Cache"] == "MISS"
+    assert {user["id"]: user["firstName"] for user in response.get_json()}[student["id"]] == name
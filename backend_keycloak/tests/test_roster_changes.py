@@ -0,0 +1,105 @@
+# test_roster_changes.py
+# Sincronización delta: /api/users/changes devuelve solo lo modificado desde la
+# versión del cliente, la responda el worker que la responda, y una versión de otra
+# época (de un log perdido o caducado) recibe resync_required en lugar de cambios ajenos.
+
+import copy
+
+import roster_changes
+
+PROFESSOR = "profesor2@bench.local"
+
+
+def _roster(client):
+    response = client.get("/api/users")
+    assert response.status_code == 200
+    return response.get_json(), response.headers["X-Roster-Version"]
+
+
+def _changes(client, since):
+    response = client.get("/api/users/changes", query_string={"since": since})
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def test_changes_since_returns_only_later_edits(client, login):
+    login(PROFESSOR)
+    users, version = _roster(client)
+    assert _changes(client, version) == {"version": version, "upserted": [], "deleted": []}
+
+    student = users[0]
+    assert client.put(f"/api/users/{student['id']}", json={"lastName": "Delta"}).status_code == 200
+    changes = _changes(client, version)
+    assert [user["id"] for user in changes["upserted"]] == [student["id"]]
+    assert changes["upserted"][0]["lastName"] == "Delta" and changes["deleted"] == []
+    # Desde la versión nueva ya no hay nada pendiente
+    assert _changes(client, changes["version"])["upserted"] == []
+
+
+def _another_worker(monkeypatch, rosters=None):
+    """A partir de aquí las peticiones las atiende otro worker con su propia memoria."""
+    monkeypatch.setattr(roster_changes, "_rosters", rosters if rosters is not None else {})
+
+
+def test_version_from_another_worker_is_answered(client, login, monkeypatch):
+    login(PROFESSOR)
+    users, version = _roster(client)
+    student = users[1]
+    assert client.put(f"/api/users/{student['id']}", json={"lastName": "Otro"}).status_code == 200
+
+    # El log es compartido: un worker que nunca cargó el roster responde el delta
+    _another_worker(monkeypatch)
+    changes = _changes(client, version)
+    assert [user["id"] for user in changes["upserted"]] == [student["id"]]
+    assert changes["upserted"][0]["lastName"] == "Otro"
+
+
+def test_peer_changes_are_applied_without_duplicating_them(client, login, monkeypatch):
+    login(PROFESSOR)
+    users, version = _roster(client)
+    # Otro worker con el roster ya cargado antes del cambio
+    peer = copy.deepcopy(roster_changes._rosters)
+    student = users[2]
+    assert client.put(f"/api/users/{student['id']}", json={"firstName": "Compartido"}).status_code == 200
+    _, after_edit = _roster(client)
+
+    _another_worker(monkeypatch, peer)
+    # El aviso de invalidación del primer worker marca el roster como obsoleto
+    roster_changes._on_invalidation(student["attributes"]["created_by"], None)
+    _, synced = _roster(client)
+    # El worker aplica el cambio del log en lugar de registrarlo otra vez
+    assert synced == after_edit
+    assert roster_changes.known_user(student["id"])["firstName"] == "Compartido"
+    assert _changes(client, version)["upserted"][0]["id"] == student["id"]
+
+
+def test_foreign_or_malformed_versions_require_resync(client, login):
+    login(PROFESSOR)
+    _, version = _roster(client)
+    counter = version.rpartition(".")[2]
+    # Un log perdido o caducado se recrea con otra época: su contador no es comparable
+    for foreign in (f"0123456789ab.{counter}", counter, "basura", f"{version.rpartition('.')[0]}.999999"):
+        changes = _changes(client, foreign)
+        assert changes == {"version": version, "resync_required": True}
+
+
+def test_evicted_roster_keeps_its_versions(client, login):
+    login(PROFESSOR)
+    users, version = _roster(client)
+    roster_changes.evict(1.0)
+    _, reloaded = _roster(client)
+    assert reloaded == version
+    assert client.put(f"/api/users/{users[3]['id']}", json={"lastName": "Tras descarte"}).status_code == 200
+    assert [user["id"] for user in _changes(client, version)["upserted"]] == [users[3]["id"]]
+
+
+def test_truncated_log_requires_resync(client, login, monkeypatch):
+    login(PROFESSOR)
+    users, version = _roster(client)
+    monkeypatch.setattr(roster_changes, "ROSTER_CHANGELOG_SIZE", 2)
+    for i, student in enumerate(users[4:7]):
+        assert client.put(f"/api/users/{student['id']}", json={"lastName": f"Corte {i}"}).status_code == 200
+    changes = _changes(client, version)
+    assert changes["resync_required"] is True
+    _, current = _roster(client)
+    assert changes["version"] == current
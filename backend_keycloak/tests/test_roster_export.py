@@ -0,0 +1,72 @@
+# test_roster_export.py
+# Exportación en streaming: si Keycloak falla (o responde algo que no es JSON) después
+# de enviar el 200, el fichero termina con una marca de error en lugar de quedar
+# truncado sin aviso.
+
+import csv
+import functools
+import io
+import json
+
+import pytest
+import requests
+
+import roster_export
+
+ADMIN = "admin@bench.local"
+PAGE_SIZE = 50
+
+
+def _html_page():
+    response = requests.Response()
+    response.status_code = 200
+    response._content = b"<html><body>Mantenimiento</body></html>"
+    response.headers["Content-Type"] = "text/html"
+    return response
+
+
+@pytest.fixture(params=["connection", "html"])
+def failing_second_page(request, monkeypatch):
+    """
+    Exporta en páginas pequeñas y hace que Keycloak corte la conexión, o que un proxy
+    responda 200 con HTML, a partir de la segunda página.
+    """
+    real_get = roster_export.keycloak_http.get
+
+    def get(url, **kwargs):
+        if kwargs.get("params", {}).get("first", 0) > 0:
+            if request.param == "html":
+                return _html_page()
+            raise requests.ConnectionError("conexión reiniciada por Keycloak")
+        return real_get(url, **kwargs)
+
+    monkeypatch.setattr(roster_export, "iter_realm_users",
+                        functools.partial(roster_export.iter_realm_users, page_size=PAGE_SIZE))
+    monkeypatch.setattr(roster_export.keycloak_http, "get", get)
+
+
+def test_ndjson_export_ends_with_error_line(client, login, failing_second_page):
+    login(ADMIN)
+    response = client.get("/api/users/export", query_string={"format": "ndjson", "scope": "realm"})
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert len(lines) == PAGE_SIZE + 1
+    assert lines[-1] == {"error": roster_export.INCOMPLETE_MESSAGE}
+    assert all("error" not in line for line in lines[:-1])
+
+
+def test_csv_export_ends_with_error_row(client, login, failing_second_page):
+    login(ADMIN)
+    response = client.get("/api/users/export", query_string={"format": "csv", "scope": "realm"})
+    assert response.status_code == 200
+    rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+    # Cabecera, la primera página y la fila de error
+    assert len(rows) == PAGE_SIZE + 2
+    assert rows[-1] == [roster_export.ERROR_MARKER, roster_export.INCOMPLETE_MESSAGE]
+
+
+def test_complete_export_has_no_error_marker(client, login):
+    login(ADMIN)
+    response = client.get("/api/users/export", query_string={"format": "ndjson", "scope": "realm"})
+    lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert lines and all("error" not in line for line in lines)
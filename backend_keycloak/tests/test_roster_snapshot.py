@@ -0,0 +1,49 @@
+# test_roster_snapshot.py
+# Snapshot compartido del roster: se escribe solo para el usuario del servicio y el
+# worker que lo genera conserva el turno aunque tarde más que el lease de la caché.
+
+import os
+import stat
+import threading
+import time
+
+import cache
+import roster_snapshot
+
+USERS = [
+    {"id": "b", "username": "beta", "email": "beta@bench.local", "attributes": {"created_by": ["p1"]}},
+    {"id": "a", "username": "alfa", "email": "alfa@bench.local", "firstName": "Ana"},
+]
+
+
+def test_snapshot_file_is_private_and_searchable(tmp_path):
+    path = tmp_path / "runtime" / "roster.snap"
+    assert roster_snapshot.write_snapshot(USERS, str(path)) == 2
+    assert stat.S_IMODE(os.stat(path.parent).st_mode) == 0o700
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    assert list(path.parent.iterdir()) == [path]
+
+    snapshot = roster_snapshot.RosterSnapshot(str(path))
+    assert snapshot.get("a").first_name == "Ana"
+    assert snapshot.get("b").owner_id == "p1"
+    assert snapshot.get("c") is None
+
+
+def test_slow_build_keeps_its_lease(tmp_path):
+    shared = cache.SQLiteCache(str(tmp_path / "cache.sqlite3"), lease_timeout=0.2)
+    started = threading.Event()
+
+    def slow_build():
+        started.set()
+        time.sleep(0.8)
+        return time.time(), 60
+
+    builder = threading.Thread(target=shared.get_or_compute,
+                               args=("roster_snapshot_built_at", slow_build), kwargs={"renew": True})
+    builder.start()
+    started.wait()
+    time.sleep(0.5)
+    # Pasado lease_timeout otro worker sigue sin poder empezar una segunda generación
+    assert not shared._acquire_lease("roster_snapshot_built_at", "otro-worker")
+    builder.join()
+    assert shared.get("roster_snapshot_built_at") is not None
@@ -0,0 +1,108 @@
+# test_roster_stats.py
+# Estadísticas de roster: altas, ediciones y bajas actualizan los contadores sin
+# recalcular la lista, las caducadas se sirven marcadas mientras se reconstruyen en
+# segundo plano y un roster descartado se vuelve a calcular en lugar de fallar.
+
+import time
+import uuid
+from datetime import date
+
+import roster_changes
+import roster_stats
+
+PROFESSOR = "profesor3@bench.local"
+
+
+def _stats(client):
+    response = client.get("/api/users/stats")
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def _user(user_id, gender, birth_date, enabled=True):
+    return {"id": user_id, "enabled": enabled, "createdTimestamp": 1700000000000,
+            "attributes": {"gender": [gender], "birth_date": [birth_date]}}
+
+
+def test_age_band():
+    today = date(2024, 6, 1)
+    assert roster_stats.age_band("2006-06-01", today) == "18-24"
+    assert roster_stats.age_band("2006-06-02", today) == "<18"
+    assert roster_stats.age_band("1970-01-01", today) == "45+"
+    assert roster_stats.age_band("2030-01-01", today) == roster_stats.UNKNOWN
+    assert roster_stats.age_band(None, today) == roster_stats.UNKNOWN
+
+
+def test_events_update_counters_incrementally():
+    owner = f"owner-{uuid.uuid4().hex[:8]}"
+    roster_stats.rebuild(owner, [_user("a", "F", "2000-01-01"), _user("b", "M", "2000-01-01")])
+    try:
+        def event(kind, user_id=None, user=None):
+            roster_stats._on_roster_event(roster_changes.RosterEvent(owner, kind, user_id, user, None))
+
+        event('upsert', "c", _user("c", "F", "1970-01-01", enabled=False))
+        stats = roster_stats.get_stats(owner)
+        assert (stats["total"], stats["enabled"], stats["disabled"]) == (3, 2, 1)
+        assert stats["by_gender"] == {"F": 2, "M": 1}
+        assert stats["by_age_band"]["45+"] == 1
+
+        # Editar reemplaza la contribución anterior del alumno
+        event('upsert', "b", _user("b", "F", "2000-01-01"))
+        assert roster_stats.get_stats(owner)["by_gender"] == {"F": 3}
+
+        event('delete', "c")
+        stats = roster_stats.get_stats(owner)
+        assert (stats["total"], stats["disabled"]) == (2, 0)
+        assert "45+" not in stats["by_age_band"]
+
+        event('evict')
+        assert roster_stats.get_stats(owner) is None
+    finally:
+        with roster_stats._lock:
+            roster_stats._stats.pop(owner, None)
+
+
+def test_api_create_and_delete_adjust_stats(client, login):
+    login(PROFESSOR)
+    before = _stats(client)
+    response = client.post("/api/users", json={
+        "firstName": "Cuenta", "lastName": "Stats", "email": f"stats-{uuid.uuid4().hex[:10]}@bench.local",
+        "gender": "F", "birthdate": "2010-01-01"})
+    assert response.status_code == 201
+    created = _stats(client)
+    assert created["total"] == before["total"] + 1
+    assert created["by_gender"].get("F", 0) == before["by_gender"].get("F", 0) + 1
+
+    assert client.delete(f"/api/users/{response.get_json()['id']}").status_code == 200
+    assert _stats(client)["total"] == before["total"]
+
+
+def test_stale_stats_are_served_and_rebuilt_in_background(monkeypatch):
+    owner = f"owner-{uuid.uuid4().hex[:8]}"
+    roster_stats.rebuild(owner, [_user("a", "F", "2000-01-01")])
+    try:
+        monkeypatch.setattr(roster_stats, "ROSTER_STATS_TTL", -1)
+        refreshed = [_user("a", "F", "2000-01-01"), _user("b", "M", "2000-01-01")]
+        stats = roster_stats.get_stats(owner, lambda: refreshed)
+        # Se sirven las caducadas sin esperar a la reconstrucción
+        assert stats["stale"] is True and stats["total"] == 1
+
+        deadline = time.time() + 2
+        while roster_stats.get_stats(owner)["total"] != 2 and time.time() < deadline:
+            time.sleep(0.01)
+        assert roster_stats.get_stats(owner)["by_gender"] == {"F": 1, "M": 1}
+        assert owner not in roster_stats._refreshing
+    finally:
+        with roster_stats._lock:
+            roster_stats._stats.pop(owner, None)
+
+
+def test_stats_evicted_after_check_are_recomputed(client, login, monkeypatch):
+    login(PROFESSOR)
+    expected = _stats(client)["total"]
+    # El roster se descarta entre is_loaded() y get_stats()
+    monkeypatch.setattr(roster_stats, "is_loaded", lambda owner_id: True)
+    with roster_stats._lock:
+        roster_stats._stats.clear()
+    stats = _stats(client)
+    assert stats["total"] == expected and stats["stale"] is False
@@ -0,0 +1,124 @@
+# test_search_index.py
+# Búsqueda incremental: el índice sigue las altas, ediciones y bajas del roster,
+# ordena exactas antes que prefijos y subcadenas, y responde en pocos milisegundos
+# sobre un roster grande.
+
+import random
+import time
+import uuid
+
+import search_index
+
+PROFESSOR = "profesor1@bench.local"
+
+
+def _user(user_id, first, last, email=None, phone=None):
+    attributes = {"phone_number": [phone]} if phone else {}
+    return {"id": user_id, "username": email or user_id, "email": email,
+            "firstName": first, "lastName": last, "attributes": attributes}
+
+
+def _ids(index, query, limit=10):
+    return [user["id"] for user in index.search(query, limit)]
+
+
+def _index(*users):
+    index = search_index._RosterIndex()
+    index.load(users)
+    return index
+
+
+def test_normalize_ignores_case_and_accents():
+    assert search_index.normalize("  José PÉREZ ") == "jose perez"
+    assert search_index.normalize(None) == ""
+
+
+def test_upsert_rename_and_delete_keep_index_consistent():
+    index = _index(_user("a", "Ana", "Rojas", "ana.rojas@bench.local"))
+    index.add(_user("b", "Bruno", "Díaz", "bruno@bench.local", "+56 9 1234 5678"))
+    assert _ids(index, "bruno") == ["b"]
+    assert _ids(index, "912345678") == ["b"]
+    assert _ids(index, "diaz") == ["b"]
+
+    # Renombrar reemplaza las palabras y trigramas anteriores
+    index.add(_user("b", "Benito", "Díaz", "bruno@bench.local"))
+    assert _ids(index, "benito") == ["b"]
+    assert _ids(index, "bruno") == ["b"]  # sigue en el email
+    assert _ids(index, "912345678") == []
+    index.add(_user("b", "Benito", "Díaz", "benito@bench.local"))
+    assert _ids(index, "bruno") == []
+    assert len(index.docs) == 2
+
+    index.remove("b")
+    assert _ids(index, "benito") == [] and _ids(index, "diaz") == []
+    assert all(user_id != "b" for _, user_id in index.words)
+    assert all("b" not in ids for ids in index.postings.values())
+    # Eliminar dos veces o un desconocido no falla
+    index.remove("b")
+    index.remove("nadie")
+    assert _ids(index, "ana") == ["a"]
+
+
+def test_ranking_exact_then_prefix_then_substring():
+    index = _index(
+        _user("sub", "Mariana", "Soto"),
+        _user("pre", "Marianela", "Alvarez"),
+        _user("exact-z", "Maria", "Zuñiga"),
+        _user("exact-a", "María", "Araya"),
+    )
+    # Exactas (desempate por apellido), luego prefijo, luego subcadena
+    assert _ids(index, "maria") == ["exact-a", "exact-z", "pre", "sub"]
+    assert _ids(index, "maria", limit=2) == ["exact-a", "exact-z"]
+    # Todas las palabras de la consulta deben coincidir
+    assert _ids(index, "maria soto") == ["sub"]
+    assert _ids(index, "maria perez") == []
+
+
+def test_prefix_and_trigram_matching():
+    index = _index(_user("a", "Cristóbal", "Fuentes", "cfuentes@bench.local"))
+    # Prefijos de cualquier largo
+    assert _ids(index, "c") == ["a"]
+    assert _ids(index, "cris") == ["a"]
+    # Subcadenas solo desde 3 caracteres, verificadas sobre el texto
+    assert _ids(index, "ris") == ["a"]
+    assert _ids(index, "to") == []
+    assert _ids(index, "ntes") == ["a"]
+    # Todos los trigramas de 'uench' están indexados ('uen', 'enc', 'nch'), pero no la subcadena
+    assert all(trigram in index.postings for trigram in search_index._trigrams("uench"))
+    assert _ids(index, "uench") == []
+    assert _ids(index, "uentes@") == ["a"]
+
+
+def test_search_endpoint_follows_roster_changes(client, login):
+    login(PROFESSOR)
+    student = client.get("/api/users").get_json()[0]
+    name = f"Zq{uuid.uuid4().hex[:6]}"
+    assert client.put(f"/api/users/{student['id']}", json={"firstName": name}).status_code == 200
+    response = client.get("/api/users/search", query_string={"q": name.lower()})
+    assert response.status_code == 200
+    assert [user["id"] for user in response.get_json()] == [student["id"]]
+
+    assert client.delete(f"/api/users/{student['id']}").status_code == 200
+    assert client.get("/api/users/search", query_string={"q": name.lower()}).get_json() == []
+
+
+def test_search_on_large_roster_is_fast():
+    rng = random.Random(5)
+    first = ["Ana", "Benjamín", "Camila", "Diego", "Elena", "Felipe", "Gabriela", "Héctor", "Isidora", "Joaquín"]
+    last = ["González", "Muñoz", "Rojas", "Díaz", "Pérez", "Soto", "Contreras", "Silva", "Martínez", "Sepúlveda"]
+    users = [_user(f"u{i}", rng.choice(first), f"{rng.choice(last)}{i % 97}",
+                   f"alumno{i}@bench.local", f"+56 9 {rng.randrange(10**7, 10**8)}")
+             for i in range(5000)]
+    index = _index(*users)
+
+    queries = ["ana", "gonz", "mu", "alumno42", "rojas1", "ez", "camila soto", "9123", "zzz", "e"]
+    index.search("warm", 10)
+    timings = []
+    for _ in range(5):
+        for query in queries:
+            start = time.perf_counter()
+            index.search(query, 10)
+            timings.append(time.perf_counter() - start)
+    timings.sort()
+    # Se mide la mediana y no el máximo para tolerar pausas de una máquina de CI cargada
+    assert timings[len(timings) // 2] < 0.005
@@ -0,0 +1,79 @@
+# test_warmup.py
+# Calentamiento de arranque y /healthz/ready: la instancia no se declara lista hasta
+# haber descubierto Keycloak, traído las claves, obtenido el token administrativo y
+# abierto conexiones, salvo que venza el plazo con Keycloak fallando.
+
+import os
+import stat
+
+import pytest
+
+import fault_injection
+import warmup
+from cache import shared_cache
+from config import WARMUP_CONNECTIONS
+
+
+@pytest.fixture
+def restart(app, monkeypatch):
+    """Vuelve a lanzar el calentamiento del proceso con la caché compartida vacía."""
+    monkeypatch.setattr(warmup, "WARMUP_RETRY_INTERVAL", 0.05)
+
+    def restart(deadline=10.0):
+        monkeypatch.setattr(warmup, "WARMUP_DEADLINE", deadline)
+        for key in ("oidc_discovery", "jwks", "admin_token"):
+            shared_cache().delete(key)
+        warmup._state["pid"] = None
+        warmup.ensure_started()
+    yield restart
+    # Se deja la instancia caliente para las demás pruebas (este teardown corre antes que el de faults)
+    fault_injection.clear()
+    monkeypatch.undo()
+    warmup._state["pid"] = None
+    warmup.ensure_started()
+    assert warmup.wait(10)
+
+
+def test_ready_once_every_step_succeeds(client):
+    response = client.get("/healthz/ready")
+    assert response.status_code == 200
+    body = response.get_json()
+    assert body["ready"] and body["degraded"] == []
+    tasks = body["tasks"]
+    assert all(tasks[name]["state"] == "ok" for name in warmup.REQUIRED)
+    assert tasks["jwks"]["detail"] >= 1
+    assert tasks["connections"]["detail"] == WARMUP_CONNECTIONS
+    assert "detail" not in tasks["admin_token"]
+
+
+def test_not_ready_while_keycloak_fails_then_degraded(client, faults, restart):
+    faults("*:error=1")
+    restart(deadline=0.5)
+    assert client.get("/healthz/ready").status_code == 503
+    assert warmup.wait(5)
+    body = client.get("/healthz/ready").get_json()
+    assert body["ready"]
+    assert set(body["degraded"]) == set(warmup.REQUIRED)
+    assert body["tasks"]["admin_token"]["attempts"] > 1
+
+
+def test_failed_steps_are_retried_until_keycloak_recovers(client, faults, restart):
+    faults("*:error=1")
+    restart()
+    faults("")
+    assert warmup.wait(5)
+    body = client.get("/healthz/ready").get_json()
+    assert body["degraded"] == []
+    assert shared_cache().get("admin_token")
+
+
+def test_snapshot_restores_in_memory_caches(app, tmp_path):
+    path = str(tmp_path / "warmup.json")
+    token = shared_cache().get("admin_token")
+    assert warmup.save_snapshot(path) > 0
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    shared_cache().delete("admin_token")
+    restored = warmup.restore_snapshot(path)
+    assert restored["cache"] >= 1
+    assert shared_cache().get("admin_token") == token
+    assert warmup.restore_snapshot(str(tmp_path / "missing.json")) == {}
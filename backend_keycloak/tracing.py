@@ -0,0 +1,173 @@
+# tracing.py
+# Trazas por petición: un span por llamada a Keycloak y por fase del handler.
+#
+# Al empezar una petición se abre una traza en un ContextVar, así que funciona
+# igual con un hilo por petición (Flask) que con una tarea por petición (Quart).
+# Los spans se exponen en la cabecera Server-Timing (visible en las devtools del
+# navegador) y, si TRACE_FILE está definido, se añaden como una línea JSON por
+# petición a ese archivo.
+#
+# El ID de petición (cabecera X-Request-ID, recibida o generada) se propaga a las
+# llamadas a Keycloak aunque el tracing esté desactivado. Con TRACING desactivado
+# span() solo consulta el ContextVar y retorna un context manager vacío.
+
+import contextvars
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+from config import TRACING_ENABLED, TRACE_FILE
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+# IDs recibidos del cliente que se aceptan tal cual; el resto se reemplaza
+_VALID_REQUEST_ID = re.compile(r"^[\w\-.]{1,128}$")
+
+_trace = contextvars.ContextVar("trace", default=None)
+_request_id = contextvars.ContextVar("request_id", default=None)
+
+_file_lock = threading.Lock()
+_file = {"pid": None, "handle": None}
+
+
+class Trace:
+    """Spans de una petición: (nombre, inicio relativo, duración) en segundos."""
+
+    __slots__ = ("request_id", "start", "spans")
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.start = time.perf_counter()
+        self.spans = []
+
+    def add(self, name, start, duration):
+        # list.append es atómico: los hilos de asyncio.to_thread pueden añadir spans
+        self.spans.append((name, start - self.start, duration))
+
+
+class _Span:
+    __slots__ = ("trace", "name", "start")
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.trace.add(self.name, self.start, time.perf_counter() - self.start)
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def begin(incoming_id=None):
+    """
+    Abre el contexto de una petición.
+
+    Args:
+        incoming_id (str): Valor de X-Request-ID enviado por el cliente, si lo hay
+
+    Returns:
+        str: ID de la petición
+    """
+    if incoming_id and _VALID_REQUEST_ID.match(incoming_id):
+        request_id = incoming_id
+    else:
+        request_id = uuid.uuid4().hex
+    _request_id.set(request_id)
+    _trace.set(Trace(request_id) if TRACING_ENABLED else None)
+    return request_id
+
+
+def request_id():
+    """ID de la petición en curso o None fuera de una petición."""
+    return _request_id.get()
+
+
+def span(name):
+    """Context manager que mide una fase de la petición en curso."""
+    trace = _trace.get()
+    if trace is None:
+        return _NULL_SPAN
+    return _Span(trace, name)
+
+
+def record(name, start, duration):
+    """Añade un span ya medido (start es un valor de time.perf_counter())."""
+    trace = _trace.get()
+    if trace is not None:
+        trace.add(name, start, duration)
+
+
+def end(method, route, status):
+    """
+    Cierra el contexto de la petición en curso.
+
+    Returns:
+        str: Valor de la cabecera Server-Timing, o None si el tracing está desactivado
+    """
+    trace = _trace.get()
+    _trace.set(None)
+    _request_id.set(None)
+    if trace is None:
+        return None
+    total = time.perf_counter() - trace.start
+    # Los spans se añaden al terminar; se ordenan por inicio para leer la traza en orden
+    spans = sorted(trace.spans, key=lambda span: span[1])
+    if TRACE_FILE:
+        _write({
+            "request_id": trace.request_id,
+            "method": method,
+            "route": route,
+            "status": status,
+            "total_ms": round(total * 1000, 3),
+            "spans": [{"name": name, "start_ms": round(offset * 1000, 3), "duration_ms": round(duration * 1000, 3)}
+                      for name, offset, duration in spans],
+        })
+    return server_timing(spans, total)
+
+
+def server_timing(spans, total):
+    """Formatea los spans como cabecera Server-Timing (duraciones en milisegundos)."""
+    entries = [f"{name};dur={duration * 1000:.1f}" for name, _, duration in spans]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+def _write(entry):
+    line = json.dumps(entry, separators=(",", ":")) + "\n"
+    with _file_lock:
+        # El archivo se reabre en cada proceso hijo para no compartir el buffer del padre
+        if _file["pid"] != os.getpid():
+            try:
+                _file["handle"] = open(TRACE_FILE, "a", buffering=1, encoding="utf-8")
+            except OSError:
+                _file["handle"] = None
+            _file["pid"] = os.getpid()
+        if _file["handle"] is not None:
+            _file["handle"].write(line)
+
+
+def _after_fork_in_child():
+    global _file_lock
+    _file_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
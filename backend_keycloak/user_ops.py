@@ -0,0 +1,453 @@
+# user_ops.py
+# Lógica de los endpoints que no depende del servidor web.
+#
+# La comparten la aplicación Flask (routes.py) y la aplicación ASGI (asgi.py),
+# de modo que ambas construyen y modifican los usuarios de Keycloak exactamente igual.
+# Los handlers solo hacen las llamadas a Keycloak (síncronas o asíncronas); las
+# validaciones, permisos, cuerpos de respuesta y la propagación de cada cambio a los
+# índices locales están aquí, y las funciones que responden retornan (cuerpo, estado).
+
+import base64
+import json
+import logging
+import random
+import string
+
+from config import CLIENT_ID, CLIENT_SECRET
+import availability
+import read_cache
+import roster_changes
+import roster_snapshot
+
+logger = logging.getLogger(__name__)
+
+
+def decode_token_payload(token):
+    """
+    Decodifica (sin verificar la firma) el payload de un JWT.
+    """
+    token_parts = token.split('.')
+    # Se corrige el padding de la parte del payload en base64
+    payload_b64 = token_parts[1] + '=' * ((4 - len(token_parts[1]) % 4) % 4)
+    return json.loads(base64.urlsafe_b64decode(payload_b64))
+
+
+def token_roles(token):
+    """
+    Retorna los roles de cliente y de realm presentes en el JWT.
+    """
+    payload_data = decode_token_payload(token)
+    client_roles = payload_data.get("resource_access", {}).get(CLIENT_ID, {}).get("roles", [])
+    realm_roles = payload_data.get("realm_access", {}).get("roles", [])
+    return client_roles + realm_roles
+
+
+def is_admin(token):
+    """
+    Indica si el JWT tiene rol de administrador. Lanza una excepción si no se puede decodificar.
+    """
+    roles = token_roles(token)
+    return "admin" in roles or "realm-admin" in roles
+
+
+def admin_error(token, tag, message="Solo disponible para administradores"):
+    """
+    None si el JWT tiene rol de administrador; si no, (cuerpo, estado) del error
+    (403, o 500 si no se pueden leer los roles).
+    """
+    try:
+        if is_admin(token):
+            return None
+    except Exception as e:
+        logger.error("[%s] Error verificando roles: %s", tag, e)
+        return {"error": "Error al verificar permisos"}, 500
+    return {"error": message}, 403
+
+
+def manage_error(token, user_data, current_user_id, verb, tag):
+    """
+    None si el usuario actual puede modificar user_data (es su creador o
+    administrador); si no, (cuerpo, estado) del error.
+    """
+    if creator_id(user_data) == current_user_id:
+        return None
+    return admin_error(token, tag, f"No tienes permiso para {verb} este usuario")
+
+
+def request_token(cookies, headers):
+    """Token de sesión de la cookie o, como en /api/user-profile, del encabezado Bearer."""
+    token = cookies.get("access_token")
+    auth_header = headers.get("Authorization", "")
+    if not token and auth_header.startswith("Bearer "):
+        token = auth_header.split(" ")[1]
+    return token
+
+
+def creator_id(user_data):
+    """
+    Retorna el ID del creador ('created_by') de un usuario de Keycloak, o None.
+    """
+    creator_array = user_data.get("attributes", {}).get("created_by")
+    return creator_array[0] if creator_array and len(creator_array) > 0 else None
+
+
+def roster_unchanged(owner_id):
+    """
+    Para read_cache: una copia del roster ({"users", "version"}) solo se sirve sin
+    consultar a Keycloak si nadie lo modificó desde que se guardó.
+    """
+    def check(roster):
+        return roster["version"] == roster_changes.current_version(owner_id) and not roster_changes.is_stale(owner_id)
+    return check
+
+
+def token_claims(token):
+    """Payload del JWT sin verificar, o {} si no se puede decodificar (solo para claves de caché)."""
+    try:
+        return decode_token_payload(token)
+    except Exception:
+        return {}
+
+
+def filter_own_users(all_users, owner_id):
+    """
+    Filtra los usuarios cuyo atributo 'created_by' coincide con el ID del profesor.
+    """
+    own_users = []
+    for user in all_users:
+        if roster_changes.owner_of(user) == owner_id:
+            own_users.append(user)
+    return own_users
+
+
+def build_new_user(user_input, current_user_id):
+    """
+    Construye la representación de Keycloak para un alumno nuevo a partir del
+    JSON recibido en POST /api/users.
+    """
+    # Obtener nombre y apellido desde los campos correspondientes
+    first_name = user_input.get("firstName", "")
+    last_name = user_input.get("lastName", "")
+
+    # Si no hay firstName pero hay name, intentar dividir name en firstName y lastName
+    if not first_name and user_input.get("name"):
+        name_parts = user_input.get("name").split(maxsplit=1)
+        first_name = name_parts[0] if len(name_parts) > 0 else ""
+        last_name = name_parts[1] if len(name_parts) > 1 else ""
+
+    # Construir el objeto de usuario en el formato que Keycloak espera
+    new_user = {
+        "username": user_input.get("email"),
+        "email": user_input.get("email"),
+        "firstName": first_name,
+        "lastName": last_name,
+        "enabled": True,
+        "emailVerified": False,
+        "attributes": {
+            "gender": [user_input.get("gender", "")],
+            "birth_date": [user_input.get("birthdate", "")],
+            "phone_number": [user_input.get("phone_number", "")],
+            "created_by": [user_input.get("created_by") or current_user_id],
+            "professor_id": [user_input.get("professor_id") or current_user_id]
+        }
+    }
+
+    # Si se proporciona una contraseña, configurarla
+    if user_input.get("password"):
+        new_user["credentials"] = [{
+            "type": "password",
+            "value": user_input.get("password"),
+            "temporary": False
+        }]
+    else:
+        # Generar una contraseña temporal aleatoria si no se proporciona una
+        random_password = ''.join(random.choices(string.ascii_letters + string.digits, k=12))
+        new_user["credentials"] = [{
+            "type": "password",
+            "value": random_password,
+            "temporary": True
+        }]
+    return new_user
+
+
+def apply_user_update(user_data, update_data):
+    """
+    Aplica sobre la representación de Keycloak los campos permitidos en
+    PUT /api/users/<id>: email, nombre, apellido, género, fecha de nacimiento y teléfono.
+    """
+    # Actualizar email si se proporciona
+    if update_data.get("email"):
+        user_data["email"] = update_data["email"]
+        # Actualizar también el username si es el mismo que el email
+        if user_data.get("username") == user_data.get("email"):
+            user_data["username"] = update_data["email"]
+
+    # Actualizar nombre y apellido si se proporcionan
+    if update_data.get("firstName"):
+        user_data["firstName"] = update_data["firstName"]
+
+    if update_data.get("lastName"):
+        user_data["lastName"] = update_data["lastName"]
+
+    # Actualizar atributos personalizados
+    if "attributes" not in user_data:
+        user_data["attributes"] = {}
+
+    if update_data.get("gender"):
+        user_data["attributes"]["gender"] = [update_data["gender"]]
+
+    if update_data.get("birthdate"):
+        user_data["attributes"]["birth_date"] = [update_data["birthdate"]]
+
+    if update_data.get("phone_number"):
+        user_data["attributes"]["phone_number"] = [update_data["phone_number"]]
+    return user_data
+
+
+def apply_profile_attributes(user_data, profile_data):
+    """
+    Aplica los atributos de POST /api/update-profile (género, fecha de nacimiento, teléfono).
+    """
+    # Asegurarse de que la clave 'attributes' exista en la data del usuario
+    if "attributes" not in user_data:
+        user_data["attributes"] = {}
+
+    # Actualizar cada atributo si se encuentra en el request
+    for field in ("gender", "birth_date", "phone_number"):
+        value = profile_data.get(field)
+        if value is not None:
+            user_data["attributes"][field] = value
+    return user_data
+
+
+def apply_own_profile_update(user_data, data):
+    """
+    Fusiona los datos de PUT /api/user-profile con el usuario actual.
+    """
+    # Update basic fields if provided
+    if 'firstName' in data:
+        user_data['firstName'] = data['firstName']
+    if 'lastName' in data:
+        user_data['lastName'] = data['lastName']
+
+    # Ensure attributes exists
+    if 'attributes' not in user_data:
+        user_data['attributes'] = {}
+
+    # Update attributes (handle both array and single value formats)
+    if 'attributes' in data:
+        for key, value in data['attributes'].items():
+            # Ensure all attribute values are arrays as required by Keycloak
+            if isinstance(value, list):
+                user_data['attributes'][key] = value
+            else:
+                user_data['attributes'][key] = [value]
+
+    # Handle direct attribute fields in the request
+    attribute_mappings = {
+        'phone': 'phone_number',
+        'phone_number': 'phone_number',
+        'gender': 'gender',
+        'birthdate': 'birth_date',
+        'birth_date': 'birth_date'
+    }
+
+    for client_field, keycloak_field in attribute_mappings.items():
+        if client_field in data and data[client_field]:
+            user_data['attributes'][keycloak_field] = [data[client_field]]
+
+    # Preserve the created_by field which should never be modified by the user
+    if 'created_by' in user_data.get('attributes', {}):
+        created_by = user_data['attributes']['created_by']
+        # Make sure we keep it even if the frontend tries to modify it
+        if 'created_by' in data.get('attributes', {}) or 'createdBy' in data:
+            logging.warning("[update_user_profile] Attempt to modify created_by field detected")
+
+        # Ensure created_by stays intact
+        user_data['attributes']['created_by'] = created_by
+    return user_data
+
+
+# ----------------------------------------------------------------------
+# Respuestas de los endpoints
+# ----------------------------------------------------------------------
+# Opciones de la cookie de sesión que fija /api/login
+SESSION_COOKIE = {"httponly": True, "secure": True, "samesite": "Strict"}
+
+
+def login_payload(form):
+    """Carga útil del grant 'password' para Keycloak a partir del formulario de /api/login."""
+    payload = {
+        "grant_type": "password",
+        "client_id": CLIENT_ID,
+        "client_secret": CLIENT_SECRET,
+        "username": form["username"],
+        "password": form["password"],
+        "scope": "openid profile email"
+    }
+    # Se añade el TOTP si está presente en los datos
+    if "totp" in form:
+        payload["totp"] = form["totp"]
+    return payload
+
+
+def login_body(access_token):
+    """Cuerpo de un login correcto, con la expiración (exp) del JWT si se puede decodificar."""
+    try:
+        exp_time = decode_token_payload(access_token).get('exp')
+    except Exception as e:
+        logger.warning("[login] Error al decodificar el JWT: %s", e)
+        exp_time = None
+    return {"message": "Login exitoso", "access_token": access_token, "exp": exp_time}
+
+
+def validate_body(introspection):
+    """Cuerpo de /api/validate para un token activo."""
+    return {
+        "message": "Token válido",
+        "username": introspection.get("username"),
+        "exp": introspection.get("exp"),
+        "user_id": introspection.get("sub")
+    }
+
+
+def build_profile(user_info, token):
+    """
+    Completa la respuesta de userinfo para /api/profile con los roles del JWT y, si
+    el profesor que creó al usuario está en el snapshot compartido del roster, con
+    su nombre (teacher_name). Retorna el ID del profesor que queda por resolver
+    contra Keycloak (ver teacher_name), o None.
+    """
+    try:
+        user_info["roles"] = token_roles(token)
+        professor_id = user_info.get("created_by")
+        # Primero se busca en el snapshot compartido del roster, sin llamar a Keycloak
+        roster_snapshot.ensure_fresh()
+        professor = roster_snapshot.get_user(professor_id)
+    except Exception as e:
+        logger.error("[get_profile] Error al decodificar roles: %s", e)
+        return None
+    if professor:
+        name = f"{professor.first_name or ''} {professor.last_name or ''}".strip()
+        user_info["teacher_name"] = name or professor.email or "Profesor"
+        return None
+    return professor_id
+
+
+def teacher_name(professor_id, prof_data):
+    """Nombre del profesor para /api/profile a partir de su usuario de Keycloak (None si no se obtuvo)."""
+    if not prof_data:
+        return f"Profesor (ID: {professor_id})"
+    name = f"{prof_data.get('firstName', '')} {prof_data.get('lastName', '')}".strip()
+    return name or prof_data.get("email", "Profesor")
+
+
+def user_saved(user_data):
+    """
+    Propaga un alta o modificación ya aplicada en Keycloak: log del roster (y con él
+    búsqueda y estadísticas), índice de disponibilidad y caché de lecturas.
+    """
+    roster_changes.record_upsert(user_data)
+    availability.add_user(user_data)
+    read_cache.forget_user(user_data.get("id"))
+
+
+def user_deleted(user_id, owner_id):
+    """Propaga una baja ya aplicada en Keycloak a los mismos índices que user_saved."""
+    roster_changes.record_delete(user_id, owner_id)
+    availability.remove_user(user_id)
+    read_cache.forget_user(user_id)
+
+
+def duplicate_email_error():
+    """Respuesta de POST /api/users cuando el índice confirma que el email ya existe."""
+    return {
+        "error": "Error al crear el usuario",
+        "status_code": 409,
+        "details": json.dumps({"errorMessage": "User exists with same email"})
+    }, 409
+
+
+def create_error(status_code, details):
+    """Respuesta de POST /api/users cuando Keycloak rechaza el alta."""
+    return {"error": "Error al crear el usuario", "status_code": status_code, "details": details}, status_code
+
+
+def created_body(created_user):
+    """Cuerpo 201 de POST /api/users; sin created_user si no se pudo releer el alta."""
+    if not created_user:
+        return {"message": "Usuario creado exitosamente"}
+    return {
+        "message": "Usuario creado exitosamente",
+        "id": created_user.get("id"),
+        "username": created_user.get("username"),
+        "firstName": created_user.get("firstName"),
+        "lastName": created_user.get("lastName"),
+        "email": created_user.get("email"),
+        "attributes": created_user.get("attributes")
+    }
+
+
+def _user_fields(user):
+    return {
+        "id": user.get("id"),
+        "firstName": user.get("firstName"),
+        "lastName": user.get("lastName"),
+        "email": user.get("email"),
+        "attributes": user.get("attributes")
+    }
+
+
+def updated_body(user_data):
+    """Cuerpo 200 de PUT /api/users/<id>."""
+    return {"message": "Usuario actualizado correctamente", "user": _user_fields(user_data)}
+
+
+def own_profile_error(user_id, data):
+    """
+    Comprueba el cuerpo de PUT /api/user-profile: no vacío y sin 'id' de otro
+    usuario. Retorna None o (cuerpo, estado) del error.
+    """
+    if not data:
+        return {'error': 'No data provided'}, 400
+    # Ensure we only update the current user's profile
+    request_user_id = data.get('id')
+    if request_user_id and request_user_id != user_id:
+        logger.warning("[update_user_profile] Attempt to update different user: %s vs %s", request_user_id, user_id)
+        return {'error': 'Cannot update another user\'s profile'}, 403
+    return None
+
+
+def own_profile_body(user_id, user_data):
+    """Cuerpo de un PUT /api/user-profile correcto."""
+    return {
+        'success': True,
+        'message': 'Profile updated successfully',
+        'user': {
+            'id': user_id,
+            'firstName': user_data.get('firstName'),
+            'lastName': user_data.get('lastName'),
+            'attributes': user_data.get('attributes')
+        }
+    }
+
+
+def roster_unavailable():
+    """
+    GET /api/users sin token administrativo y sin copia del roster dentro de la
+    gracia de read_cache: no hay datos reales que servir, así que 503.
+    """
+    return {"error": "Keycloak no disponible",
+            "details": "No se pudo obtener el token administrativo ni hay una copia reciente del roster"}, 503
+
+
+def admin_unavailable(tag):
+    """
+    Alta, edición o baja sin token administrativo (y sin cola de escritura diferida
+    que la acepte): no se guarda en ningún sitio, así que se responde 503 para que
+    el cliente no la dé por hecha: un cambio guardado fuera de Keycloak nunca
+    llegaría a él.
+    """
+    logger.warning("[%s] Sin token administrativo: el cambio no se guarda", tag)
+    return {"error": "Keycloak no disponible",
+            "details": "No se pudo obtener el token administrativo; el cambio no se guardó"}, 503
@@ -0,0 +1,236 @@
+# warmup.py
+# Calentamiento al arrancar y estado de preparación para /healthz/ready.
+#
+# Tras un despliegue, las primeras peticiones pagaban en línea el descubrimiento de
+# la URL de Keycloak, la metadata OIDC, el primer grant del token administrativo y
+# la apertura de conexiones. Cada proceso ejecuta estos pasos en segundo plano al
+# arrancar:
+#
+#   restore       cachés en memoria del snapshot de apagado (WARMUP_SNAPSHOT_PATH)
+#   discovery     URL de Keycloak y metadata OIDC del realm
+#   jwks          claves de firma del realm
+#   admin_token   token administrativo
+#   connections   WARMUP_CONNECTIONS conexiones keep-alive abiertas en el pool
+#
+# restore va primero porque puede traer ya la metadata y el token; el resto corre
+# en paralelo (jwks espera a la metadata gracias al get_or_compute de la caché
+# compartida). /healthz/ready responde 503 hasta que todos terminan bien, de modo
+# que el balanceador no envía tráfico a una instancia fría. Los pasos fallidos se
+# reintentan cada WARMUP_RETRY_INTERVAL s; pasado WARMUP_DEADLINE la instancia se
+# declara lista igualmente con los pasos pendientes en 'degraded', para que una
+# caída de Keycloak durante el arranque no la deje fuera de servicio.
+#
+# Con WARMUP_SNAPSHOT_PATH, al terminar el proceso se guardan la caché compartida
+# en memoria (solo con CACHE_BACKEND=memory: la SQLite ya persiste en disco) y el
+# índice de disponibilidad. El fichero se crea con permisos 0600 porque contiene el
+# token administrativo.
+
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import (
+    REALM, WARMUP_ENABLED, WARMUP_CONNECTIONS, WARMUP_RETRY_INTERVAL, WARMUP_DEADLINE, WARMUP_SNAPSHOT_PATH
+)
+import auth
+import availability
+import keycloak_http
+from cache import InProcessCache, shared_cache
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+# Pasos de los que depende la preparación (restore es opcional)
+REQUIRED = ("discovery", "jwks", "admin_token", "connections")
+
+_lock = threading.Lock()
+_state = {"pid": None, "started_at": None, "finished_at": None, "tasks": {}, "atexit": False}
+
+
+def _discover():
+    if not auth.get_oidc_metadata():
+        return None
+    return auth.discover_keycloak_url()
+
+
+def _fetch_jwks():
+    jwks = auth.get_jwks()
+    return len(jwks.get("keys", [])) if jwks else None
+
+
+def _fetch_admin_token():
+    return True if auth.get_admin_token() else None
+
+
+def _open_connections():
+    url = f"{auth.discover_keycloak_url()}/realms/{REALM}/.well-known/openid-configuration"
+    return keycloak_http.warm_connections(url, WARMUP_CONNECTIONS, **auth.get_request_settings()) or None
+
+
+def _step(name, function):
+    """Ejecuta un paso y registra su resultado. Un paso falla si lanza o retorna None."""
+    start = time.perf_counter()
+    try:
+        detail = function()
+        error = None if detail is not None else "Keycloak no respondió como se esperaba"
+    except Exception as e:
+        detail, error = None, f"{type(e).__name__}: {e}"
+    with _lock:
+        task = _state["tasks"][name]
+        task["state"] = "ok" if error is None else "failed"
+        task["attempts"] = task.get("attempts", 0) + 1
+        task["elapsed_ms"] = round((time.perf_counter() - start) * 1000, 1)
+        task.pop("error", None)
+        if error:
+            task["error"] = error
+        elif detail is not True:
+            task["detail"] = detail
+    if error:
+        logger.warning("[warmup] %s falló: %s", name, error)
+    return error is None
+
+
+def _run(connections):
+    _step("restore", restore_snapshot)
+    steps = {"discovery": _discover, "jwks": _fetch_jwks, "admin_token": _fetch_admin_token,
+             "connections": connections}
+    deadline = _state["started_at"] + WARMUP_DEADLINE
+    pending = list(steps)
+    with ThreadPoolExecutor(max_workers=len(steps), thread_name_prefix="warmup") as pool:
+        while True:
+            results = list(pool.map(lambda name: _step(name, steps[name]), pending))
+            pending = [name for name, ok in zip(pending, results) if not ok]
+            if not pending or time.time() + WARMUP_RETRY_INTERVAL > deadline:
+                break
+            time.sleep(WARMUP_RETRY_INTERVAL)
+    with _lock:
+        _state["finished_at"] = time.time()
+        elapsed = _state["finished_at"] - _state["started_at"]
+    if pending:
+        logger.error("[warmup] Instancia lista sin completar el calentamiento (%.1fs): %s",
+                     elapsed, ", ".join(pending))
+    else:
+        logger.info("[warmup] Calentamiento completado en %.1fs", elapsed)
+
+
+def ensure_started(connections=None):
+    """
+    Lanza el calentamiento en segundo plano, una vez por proceso (también en cada
+    worker creado con fork). connections reemplaza la apertura de conexiones del pool
+    síncrono: el modo ASGI abre las de su cliente httpx.
+    """
+    with _lock:
+        if _state["pid"] == os.getpid():
+            return
+        now = time.time()
+        _state.update(pid=os.getpid(), started_at=now, finished_at=None if WARMUP_ENABLED else now,
+                      tasks={name: {"state": "pending"} for name in ("restore",) + REQUIRED} if WARMUP_ENABLED else {})
+        # Se registra aquí y no al importar para ejecutarse antes que el cierre del logging
+        # asíncrono (atexit es LIFO); los workers creados con fork lo heredan
+        register_atexit = bool(WARMUP_SNAPSHOT_PATH) and not _state["atexit"]
+        if register_atexit:
+            _state["atexit"] = True
+    if register_atexit:
+        atexit.register(_save_at_exit)
+    if WARMUP_ENABLED:
+        threading.Thread(target=_run, args=(connections or _open_connections,), daemon=True,
+                         name="warmup").start()
+
+
+def status():
+    """
+    Estado del calentamiento de este proceso.
+
+    Returns:
+        dict: {"ready": bool, "degraded": [pasos sin completar], "elapsed_s", "tasks": {paso: estado}}
+    """
+    with _lock:
+        tasks = {name: dict(task) for name, task in _state["tasks"].items()}
+        started, finished = _state["started_at"], _state["finished_at"]
+    ready = finished is not None
+    return {
+        "ready": ready,
+        "degraded": [name for name in REQUIRED if name in tasks and tasks[name]["state"] != "ok"] if ready else [],
+        "elapsed_s": round((finished or time.time()) - started, 3) if started else 0.0,
+        "tasks": tasks,
+    }
+
+
+def wait(timeout):
+    """Espera a que el calentamiento termine. Retorna True si la instancia está lista."""
+    deadline = time.monotonic() + timeout
+    while not status()["ready"]:
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+# ----------------------------------------------------------------------
+# Snapshot de apagado
+# ----------------------------------------------------------------------
+def save_snapshot(path=WARMUP_SNAPSHOT_PATH):
+    """Guarda los cachés en memoria del proceso. Retorna el número de entradas de caché guardadas."""
+    entries = []
+    cache = shared_cache()
+    if isinstance(cache, InProcessCache):
+        for entry in cache.export_entries():
+            try:
+                json.dumps(entry)
+            except (TypeError, ValueError):
+                continue
+            entries.append(entry)
+    data = {"version": SNAPSHOT_VERSION, "saved_at": time.time(), "cache": entries,
+            "availability": availability.export_state()}
+    tmp = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        json.dump(data, f, separators=(",", ":"))
+    # Reemplazo atómico: con varios workers gana el último en terminar
+    os.replace(tmp, path)
+    return len(entries)
+
+
+def restore_snapshot(path=WARMUP_SNAPSHOT_PATH):
+    """
+    Restaura el snapshot de apagado si existe.
+
+    Returns:
+        dict: entradas de caché restauradas y si se restauró el índice de disponibilidad
+    """
+    if not path:
+        return {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    if data.get("version") != SNAPSHOT_VERSION:
+        logger.warning("[warmup] Snapshot %s con versión desconocida, se ignora", path)
+        return {}
+    restored = {"cache": 0, "availability": availability.restore_state(data.get("availability"))}
+    cache = shared_cache()
+    if isinstance(cache, InProcessCache):
+        restored["cache"] = cache.import_entries(data.get("cache") or [])
+    logger.info("[warmup] Snapshot restaurado: %s", restored)
+    return restored
+
+
+def _save_at_exit():
+    try:
+        count = save_snapshot()
+        logger.info("[warmup] Snapshot guardado en %s (%s entradas de caché)", WARMUP_SNAPSHOT_PATH, count)
+    except Exception as e:
+        logger.error("[warmup] No se pudo guardar el snapshot: %s", e)
+
+
+def _after_fork_in_child():
+    global _lock
+    _lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
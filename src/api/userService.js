@@ -220,6 +220,86 @@ export const getUserList = async () => {
   }
 };
 
+/**
+ * Get only the roster changes since a given version.
+ * The initial version comes from the X-Roster-Version header of /users.
+ * @param {string} since - Last roster version known by the client (opaque token)
+ * @returns {Promise<Object>} - { version, upserted, deleted } or { version, resync_required }
+ */
+export const getUserChanges = async (since) => {
+  const token = localStorage.getItem('token');
+  if (!token) {
+    throw new Error('No authentication token available');
+  }
+
+  const response = await fetch(`${API_URL}/users/changes?since=${encodeURIComponent(since)}`, {
+    method: 'GET',
+    headers: {
+      'Authorization': `Bearer ${token}`,
+      'Content-Type': 'application/json'
+    },
+    credentials: 'include'
+  });
+
+  if (!response.ok) {
+    throw new Error(`Error del servidor: ${response.status} ${response.statusText}`);
+  }
+
+  return response.json();
+};
+
+/**
+ * Search the current professor's students (typeahead)
+ * @param {string} query - Text to search in name, email or phone
+ * @param {number} limit - Maximum number of results
+ * @returns {Promise<Array>} - Matching users, best matches first
+ */
+export const searchUsers = async (query, limit = 10) => {
+  const token = localStorage.getItem('token');
+  if (!token) {
+    throw new Error('No authentication token available');
+  }
+
+  const params = new URLSearchParams({ q: query, limit: String(limit) });
+  const response = await fetch(`${API_URL}/users/search?${params}`, {
+    method: 'GET',
+    headers: {
+      'Authorization': `Bearer ${token}`,
+      'Content-Type': 'application/json'
+    },
+    credentials: 'include'
+  });
+
+  if (!response.ok) {
+    throw new Error(`Error del servidor: ${response.status} ${response.statusText}`);
+  }
+
+  return response.json();
+};
+
+/**
+ * Check whether an email is still free. Cheap enough to call while the user types.
+ * @param {string} email - Email to check
+ * @param {boolean} exact - Confirm "maybe taken" answers against Keycloak (signed-in users only, rate limited)
+ * @returns {Promise<Object>} - { value, available, confirmed }; available is null while the index loads
+ */
+export const checkEmailAvailability = async (email, exact = false) => {
+  const params = new URLSearchParams({ email, exact: String(exact) });
+  const response = await fetch(`${API_URL}/users/availability?${params}`, {
+    method: 'GET',
+    headers: {
+      'Content-Type': 'application/json'
+    },
+    credentials: 'include'
+  });
+
+  if (!response.ok) {
+    throw new Error(`Error del servidor: ${response.status} ${response.statusText}`);
+  }
+
+  return response.json();
+};
+
 /**
  * Create a new user in Keycloak
  * @param {Object} userData - User data
@@ -680,6 +760,9 @@ const userServiceAPI = {
   getUserProfileFromToken,
   getProfile,
   getUserList,
+  getUserChanges,
+  searchUsers,
+  checkEmailAvailability,
   createUser,
   updateUser,
   deleteUser,
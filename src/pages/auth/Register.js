@@ -1,8 +1,10 @@
-import React, { useState } from 'react';
+import React, { useState, useEffect } from 'react';
 import { Link, Navigate, useNavigate } from 'react-router-dom';
 import styled, { keyframes } from 'styled-components';
 import { useAuth } from '../../context/AuthContext';
 import { register } from '../../api/auth';
+import { checkEmailAvailability } from '../../api/userService';
+import useDebounce from '../../hooks/useDebounce';
 import { colors } from '../../styles/GlobalStyles';
 
 // Animation keyframes
@@ -185,9 +187,38 @@ const Register = () => {
     confirmPassword: ''
   });
   const [error, setError] = useState(null);
+  const [emailTaken, setEmailTaken] = useState(false);
   const [isSubmitting, setIsSubmitting] = useState(false);
   const navigate = useNavigate();
   const { isAuthenticated } = useAuth();
+  const debouncedEmail = useDebounce(formData.email, 300);
+  
+  // Check email availability while the user types
+  useEffect(() => {
+    let cancelled = false;
+    if (!debouncedEmail || !debouncedEmail.includes('@')) {
+      setEmailTaken(false);
+      return undefined;
+    }
+    
+    // Anonymous callers are answered from the server-side index (exact needs a session)
+    checkEmailAvailability(debouncedEmail)
+      .then((result) => {
+        if (!cancelled) {
+          setEmailTaken(result.available === false);
+        }
+      })
+      .catch(() => {
+        // The server validates again on submit
+        if (!cancelled) {
+          setEmailTaken(false);
+        }
+      });
+    
+    return () => {
+      cancelled = true;
+    };
+  }, [debouncedEmail]);
   
   // Redirect if already authenticated
   if (isAuthenticated) {
@@ -211,6 +242,11 @@ const Register = () => {
       return;
     }
     
+    if (emailTaken) {
+      setError('Este correo electrónico ya está registrado');
+      return;
+    }
+    
     if (formData.password !== formData.confirmPassword) {
       setError('Las contraseñas no coinciden');
       return;
@@ -257,6 +293,7 @@ const Register = () => {
           <Title>Crear Cuenta</Title>
           
           {error && <ErrorMessage>{error}</ErrorMessage>}
+          {!error && emailTaken && <ErrorMessage>Este correo electrónico ya está registrado</ErrorMessage>}
           
           <StyledInput
             type="text"